@@ -1,5 +1,5 @@
 """キャラクターAPIエンドポイント"""
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Request, Query
 from fastapi.responses import Response, StreamingResponse
 from typing import List, Optional
 from datetime import datetime
@@ -16,9 +16,17 @@ from app.core.config import settings
 from app.models.character import (
     Character, CharacterCreate, CharacterUpdate, CharacterInDB
 )
+from app.services.relationship_graph import relationship_graph, Direction
+from app.services import index_sync
 
 router = APIRouter()
 
+def graph_not_modified(request: Request, response: Response) -> bool:
+    """ETagを設定し、If-None-Matchと一致する場合はTrueを返す"""
+    etag = relationship_graph.etag
+    response.headers["ETag"] = etag
+    return request.headers.get("if-none-match") == etag
+
 @router.get("", response_model=List[Character])
 @router.get("/", response_model=List[Character])
 async def get_characters():
@@ -30,6 +38,62 @@ async def get_characters():
         characters.append(Character(**char))
     return characters
 
+@router.get("/graph")
+async def get_character_graph(request: Request, response: Response):
+    """関係性ネットワーク全体を取得（可視化用）"""
+    await relationship_graph.ensure_loaded(get_database())
+    if graph_not_modified(request, response):
+        return Response(status_code=304, headers={"ETag": relationship_graph.etag})
+    return relationship_graph.snapshot()
+
+@router.get("/graph/path")
+async def get_relationship_path(
+    request: Request,
+    response: Response,
+    source_id: str,
+    target_id: str,
+    direction: Direction = "both",
+    max_depth: int = Query(6, ge=1, le=12)
+):
+    """2キャラクター間の最短の関係性経路を取得"""
+    await relationship_graph.ensure_loaded(get_database())
+    for character_id in (source_id, target_id):
+        if not relationship_graph.has_character(character_id):
+            raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
+    if graph_not_modified(request, response):
+        return Response(status_code=304, headers={"ETag": relationship_graph.etag})
+
+    path = relationship_graph.shortest_path(source_id, target_id, direction, max_depth)
+    if path is None:
+        return {"found": False, "nodes": [], "edges": []}
+    return {"found": True, **relationship_graph.path_details(path)}
+
+@router.get("/{character_id}/graph")
+async def get_character_neighborhood(
+    character_id: str,
+    request: Request,
+    response: Response,
+    depth: int = Query(1, ge=1, le=6),
+    direction: Direction = "both"
+):
+    """指定キャラクターから depth ホップ以内の関係性を取得"""
+    await relationship_graph.ensure_loaded(get_database())
+    if not relationship_graph.has_character(character_id):
+        raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
+    if graph_not_modified(request, response):
+        return Response(status_code=304, headers={"ETag": relationship_graph.etag})
+    return relationship_graph.neighborhood(character_id, depth, direction)
+
+@router.get("/{character_id}/mutual")
+async def get_mutual_relationships(character_id: str, request: Request, response: Response):
+    """相互に関係性を持つキャラクターを取得"""
+    await relationship_graph.ensure_loaded(get_database())
+    if not relationship_graph.has_character(character_id):
+        raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
+    if graph_not_modified(request, response):
+        return Response(status_code=304, headers={"ETag": relationship_graph.etag})
+    return {"character_id": character_id, "mutual": relationship_graph.mutual(character_id)}
+
 @router.get("/{character_id}", response_model=Character)
 async def get_character(character_id: str):
     """特定のキャラクターを取得"""
@@ -95,6 +159,7 @@ async def create_character(
     # データベースに保存
     result = await db[COLLECTIONS["characters"]].insert_one(character_data)
     character_data["_id"] = str(result.inserted_id)
+    index_sync.character_saved(character_data)
     
     return Character(**character_data)
 
@@ -126,6 +191,7 @@ async def update_character(
     # 更新後のデータを返す
     char = await db[COLLECTIONS["characters"]].find_one({"_id": ObjectId(character_id)})
     char["_id"] = str(char["_id"])
+    index_sync.character_saved(char)
     return Character(**char)
 
 @router.post("/{character_id}/image", response_model=Character)
@@ -180,6 +246,7 @@ async def update_character_image(
     # 更新後のデータを返す
     char = await db[COLLECTIONS["characters"]].find_one({"_id": ObjectId(character_id)})
     char["_id"] = str(char["_id"])
+    index_sync.character_saved(char)
     return Character(**char)
 
 @router.get("/export/all")
@@ -284,6 +351,7 @@ async def delete_character(character_id: str):
 
     # キャラクター自体を削除
     result = await db[COLLECTIONS["characters"]].delete_one({"_id": ObjectId(character_id)})
+    index_sync.character_deleted(character_id)
 
     return {
         "message": f"キャラクター「{character['name']}」を削除しました",
@@ -437,6 +505,12 @@ async def import_characters(files: List[UploadFile] = File(...)):
                 # 関係性の解決に失敗してもキャラクター自体は作成済み
                 print(f"Warning: Failed to resolve relationships for {char_info['name']}: {str(e)}")
 
+    # 作成したキャラクターをまとめてインデックスに反映
+    if created_characters:
+        created_ids = [ObjectId(char_info["id"]) for char_info in created_characters]
+        imported = db[COLLECTIONS["characters"]].find({"_id": {"$in": created_ids}})
+        index_sync.characters_saved([char async for char in imported])
+
     return {
         "message": f"{len(files)}個のファイルを処理しました",
         "results": results
@@ -506,6 +580,7 @@ async def import_character_overwrite(character_id: str, file: UploadFile = File(
             {"_id": ObjectId(character_id)},
             {"$set": update_data}
         )
+        index_sync.character_saved({**existing_character, **update_data})
 
         return {
             "message": f"キャラクター「{update_data['name']}」を上書きしました",
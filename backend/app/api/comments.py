@@ -1,51 +1,21 @@
 """コメントAPIエンドポイント"""
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
 from typing import List
 from datetime import datetime
 from bson import ObjectId
 
+from app.core.cancellation import CLIENT_CLOSED_REQUEST, ClientDisconnected
 from app.core.database import get_database, COLLECTIONS
+from app.core.idempotency import idempotent
 from app.models.comment import (
     Comment, CommentCreate, CommentUpdate, CommentGenerateRequest
 )
-from app.services.ollama import generate_comment
+from app.core.task_queue import TaskFailedError, TaskTimeoutError, task_queue
+from app.services import index_sync
+from app.services.generation import COMMENT_TASK
 
 router = APIRouter()
 
-async def enrich_character_relationships(character: dict, db) -> dict:
-    """キャラクターの関係性にターゲットキャラクター名を追加
-
-    target_character_idからキャラクター名を解決して、
-    target_character_nameフィールドを追加する
-    """
-    enriched_relationships = []
-
-    for rel in character.get("relationships", []):
-        target_id = rel.get("target_character_id")
-
-        # target_character_idからキャラクター情報を取得
-        if target_id:
-            try:
-                target_char = await db[COLLECTIONS["characters"]].find_one({"_id": ObjectId(target_id)})
-                target_name = target_char["name"] if target_char else "不明なキャラクター"
-            except Exception:
-                target_name = "不明なキャラクター"
-        else:
-            target_name = "不明なキャラクター"
-
-        enriched_rel = {
-            "target_character_id": target_id,
-            "target_character_name": target_name,
-            "description": rel.get("description", "")
-        }
-        enriched_relationships.append(enriched_rel)
-
-    # 元のキャラクター情報をコピーして関係性を置き換え
-    enriched_character = character.copy()
-    enriched_character["relationships"] = enriched_relationships
-
-    return enriched_character
-
 @router.get("/journal/{journal_id}", response_model=List[Comment])
 async def get_journal_comments(journal_id: str):
     """特定のジャーナルのコメントを取得"""
@@ -87,6 +57,7 @@ async def create_comment(comment: CommentCreate):
     
     result = await db[COLLECTIONS["comments"]].insert_one(comment_data)
     comment_data["_id"] = str(result.inserted_id)
+    index_sync.comment_saved(comment_data, created=True)
     
     # ジャーナルのコメントIDリストを更新
     await db[COLLECTIONS["journals"]].update_one(
@@ -97,51 +68,32 @@ async def create_comment(comment: CommentCreate):
     return Comment(**comment_data)
 
 @router.post("/generate", response_model=Comment)
-async def generate_comment_endpoint(request: CommentGenerateRequest):
-    """コメントを自動生成"""
-    db = get_database()
-    
-    # ジャーナルを取得
-    journal = await db[COLLECTIONS["journals"]].find_one({"_id": ObjectId(request.journal_id)})
-    if not journal:
-        raise HTTPException(status_code=404, detail="ジャーナルが見つかりません")
-    
-    # キャラクターを取得
-    character = await db[COLLECTIONS["characters"]].find_one({"_id": ObjectId(request.character_id)})
-    if not character:
-        raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
-
-    # 関係性にキャラクター名を追加
-    enriched_character = await enrich_character_relationships(character, db)
-
-    # 既存のコメントを取得
-    existing_comments = []
-    async for comment in db[COLLECTIONS["comments"]].find({"journal_id": request.journal_id}).sort("created_at", 1):
-        existing_comments.append(comment)
+async def generate_comment_endpoint(request: CommentGenerateRequest, http_request: Request, response: Response):
+    """コメントを自動生成
 
-    # コメントを生成
-    content = await generate_comment(enriched_character, journal, existing_comments, request.parent_comment_id)
-    
-    # コメントを保存
-    comment_data = {
+    クライアントが切断したら中止する。Idempotency-Key ヘッダーを付けると、
+    同じキーの再送には同じ結果を返す。
+    """
+    payload = {
         "journal_id": request.journal_id,
         "character_id": request.character_id,
-        "content": content,
-        "parent_comment_id": request.parent_comment_id,
-        "created_at": datetime.now(),
-        "updated_at": datetime.now()
+        "parent_comment_id": request.parent_comment_id
     }
-    
-    result = await db[COLLECTIONS["comments"]].insert_one(comment_data)
-    comment_data["_id"] = str(result.inserted_id)
-    
-    # ジャーナルのコメントIDリストを更新
-    await db[COLLECTIONS["journals"]].update_one(
-        {"_id": ObjectId(request.journal_id)},
-        {"$push": {"comment_ids": str(result.inserted_id)}}
-    )
-    
-    return Comment(**comment_data)
+
+    async def generate() -> Comment:
+        comment_data = await task_queue.submit(COMMENT_TASK, payload)
+        return Comment(**comment_data)
+
+    try:
+        return await idempotent(http_request, response, COMMENT_TASK, payload, generate)
+    except ClientDisconnected:
+        raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="クライアントが切断したため生成を中止しました")
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except TaskTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except TaskFailedError as e:
+        raise HTTPException(status_code=500, detail=f"コメントの生成に失敗しました: {e}")
 
 @router.put("/{comment_id}", response_model=Comment)
 @router.put("/{comment_id}/", response_model=Comment)
@@ -165,6 +117,7 @@ async def update_comment(comment_id: str, comment_update: CommentUpdate):
     
     comment = await db[COLLECTIONS["comments"]].find_one({"_id": ObjectId(comment_id)})
     comment["_id"] = str(comment["_id"])
+    index_sync.comment_saved(comment)
     return Comment(**comment)
 
 @router.delete("/{comment_id}")
@@ -180,6 +133,7 @@ async def delete_comment(comment_id: str):
     
     # コメントを削除
     result = await db[COLLECTIONS["comments"]].delete_one({"_id": ObjectId(comment_id)})
+    index_sync.comment_deleted(comment)
     
     # ジャーナルのコメントIDリストから削除
     await db[COLLECTIONS["journals"]].update_one(
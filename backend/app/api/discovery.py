@@ -1,11 +1,28 @@
 """Friends Discovery APIエンドポイント"""
-from fastapi import APIRouter, HTTPException
-from typing import List, Dict, Any
-from pydantic import BaseModel
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from typing import List, Dict, Any, Optional, Union
+from pydantic import BaseModel, Field
 from bson import ObjectId
+from datetime import datetime
+from pymongo import InsertOne, UpdateOne
+import json
 
+from app.core.cancellation import CLIENT_CLOSED_REQUEST, ClientDisconnected, iterate_until_disconnect
 from app.core.database import get_database, COLLECTIONS
-from app.services.ollama import generate_friends_discovery
+from app.core.deadline import DeadlineExceeded
+from app.core.idempotency import idempotent
+from app.core.llm_scheduler import SchedulerOverloadedError
+from app.models.character import Character
+from app.services import index_sync
+from app.services.ollama import generate_friends_candidates, stream_friends_discovery
+from app.services.relationship_graph import relationship_graph
+
+# countで指定できる候補数の上限
+MAX_DISCOVERY_CANDIDATES = 12
+
+# 冪等性キーの名前空間
+DISCOVERY_SCOPE = "discovery.friends"
 
 router = APIRouter()
 
@@ -13,22 +30,190 @@ class FriendsDiscoveryRequest(BaseModel):
     """Friends Discovery リクエスト"""
     character_id: str
     relationship_phrase: str
+    # 省略時は1回の生成（3人）。指定すると並列に生成して重複を除いた最大count人を返す
+    count: Optional[int] = Field(None, ge=1, le=MAX_DISCOVERY_CANDIDATES)
 
 class FriendsDiscoveryResponse(BaseModel):
     """Friends Discovery レスポンス"""
     characters: List[Dict[str, Any]]
 
+class DiscoveredCharacter(BaseModel):
+    """Friends Discoveryで生成されたキャラクター"""
+    name: str = Field(..., min_length=1)
+    introduction: str = ""
+    backstory: str = ""
+    my_relationship: str = ""
+    your_relationship: str = ""
+
+class FriendsAcceptRequest(BaseModel):
+    """生成されたキャラクターの保存リクエスト"""
+    character_id: str
+    characters: List[DiscoveredCharacter] = Field(..., min_length=1, max_length=MAX_DISCOVERY_CANDIDATES)
+
+class FriendsAcceptResponse(BaseModel):
+    """生成されたキャラクターの保存レスポンス"""
+    character: Character
+    created: List[Character]
+
 @router.post("/friends", response_model=FriendsDiscoveryResponse)
-async def generate_friends(request: FriendsDiscoveryRequest):
-    """既存キャラクターに関連する新しいキャラクターを生成"""
+async def generate_friends(request: FriendsDiscoveryRequest, http_request: Request, response: Response):
+    """既存キャラクターに関連する新しいキャラクターを生成
+
+    Idempotency-Key ヘッダーを付けると、同じキーの再送には同じ結果を返す。
+    """
     db = get_database()
     
     # キャラクター情報を取得
     character = await db[COLLECTIONS["characters"]].find_one({"_id": ObjectId(request.character_id)})
     if not character:
         raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
-    
-    # 新しいキャラクターを生成
-    new_characters = await generate_friends_discovery(character, request.relationship_phrase)
-    
-    return FriendsDiscoveryResponse(characters=new_characters)
\ No newline at end of file
+
+    async def generate() -> FriendsDiscoveryResponse:
+        # 新しいキャラクターを生成（既存キャラクターと同名の候補は除く）
+        await relationship_graph.ensure_loaded(db)
+        try:
+            new_characters = await generate_friends_candidates(
+                character,
+                request.relationship_phrase,
+                request.count,
+                relationship_graph.names()
+            )
+        except (SchedulerOverloadedError, DeadlineExceeded):
+            # 混雑は 503 + Retry-After、期限切れは 504 で返す
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=502, detail=f"キャラクターの生成に失敗しました: {str(e)}")
+        if not new_characters:
+            raise HTTPException(status_code=502, detail="キャラクターの生成に失敗しました")
+        return FriendsDiscoveryResponse(characters=new_characters)
+
+    try:
+        return await idempotent(http_request, response, DISCOVERY_SCOPE, request.dict(), generate)
+    except ClientDisconnected:
+        raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="クライアントが切断したため生成を中止しました")
+
+def sse_event(event: str, data: Any) -> str:
+    """Server-Sent Events の1イベント分の文字列を作成"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@router.post("/friends/stream")
+async def stream_friends(request: FriendsDiscoveryRequest, http_request: Request):
+    """新しいキャラクターを1人完成するたびにSSEで送信
+
+    最初のキャラクターまでに混雑・期限切れになった場合は /friends と同じく
+    503 + Retry-After・504 で返す。クライアントが切断したら生成を中止する。
+    """
+    db = get_database()
+
+    # キャラクター情報を取得
+    character = await db[COLLECTIONS["characters"]].find_one({"_id": ObjectId(request.character_id)})
+    if not character:
+        raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
+
+    candidates = iterate_until_disconnect(
+        http_request,
+        stream_friends_discovery(character, request.relationship_phrase),
+        f"{DISCOVERY_SCOPE}.stream"
+    )
+    # レスポンスのステータスを決めるため、最初の1人はここで待つ
+    first: Optional[Dict[str, Any]] = None
+    error: Optional[Exception] = None
+    try:
+        first = await candidates.__anext__()
+    except StopAsyncIteration:
+        pass
+    except (SchedulerOverloadedError, DeadlineExceeded):
+        await candidates.aclose()
+        raise
+    except ClientDisconnected:
+        raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="クライアントが切断したため生成を中止しました")
+    except Exception as e:
+        await candidates.aclose()
+        error = e
+
+    async def events():
+        count = 0
+        try:
+            if first is not None:
+                count += 1
+                yield sse_event("character", first)
+                async for new_character in candidates:
+                    count += 1
+                    yield sse_event("character", new_character)
+            if error is not None:
+                raise error
+        except ClientDisconnected:
+            return
+        except Exception as e:
+            yield sse_event("error", {"message": f"キャラクターの生成に失敗しました: {str(e)}"})
+        finally:
+            await candidates.aclose()
+        yield sse_event("done", {"count": count})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/friends/accept", response_model=FriendsAcceptResponse)
+async def accept_friends(request: FriendsAcceptRequest):
+    """生成されたキャラクターを、双方向の関係性付きで1回の bulk_write で保存"""
+    db = get_database()
+    collection = db[COLLECTIONS["characters"]]
+
+    if not ObjectId.is_valid(request.character_id):
+        raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
+    source_id = ObjectId(request.character_id)
+    if not await collection.find_one({"_id": source_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
+
+    now = datetime.now()
+    new_characters: List[Dict[str, Any]] = []
+    for discovered in request.characters:
+        attributes = [
+            {"type": attribute_type, "content": content}
+            for attribute_type, content in (
+                ("description", discovered.introduction),
+                ("backstory", discovered.backstory),
+            )
+            if content
+        ]
+        new_characters.append({
+            "_id": ObjectId(),
+            "name": discovered.name,
+            "image_path": None,
+            "attributes": attributes,
+            # 新キャラクターから見た元キャラクターとの関係
+            "relationships": [{
+                "target_character_id": request.character_id,
+                "description": discovered.my_relationship
+            }],
+            "created_at": now,
+            "updated_at": now
+        })
+
+    # 元キャラクターから見た新キャラクターとの関係
+    source_relationships = [
+        {"target_character_id": str(new_character["_id"]), "description": discovered.your_relationship}
+        for new_character, discovered in zip(new_characters, request.characters)
+    ]
+
+    operations: List[Union[InsertOne, UpdateOne]] = [InsertOne(new_character) for new_character in new_characters]
+    operations.append(UpdateOne(
+        {"_id": source_id},
+        {"$push": {"relationships": {"$each": source_relationships}}, "$set": {"updated_at": now}}
+    ))
+    await collection.bulk_write(operations, ordered=True)
+
+    source = await collection.find_one({"_id": source_id})
+    for document in [source, *new_characters]:
+        document["_id"] = str(document["_id"])
+
+    # 派生インデックスへはまとめて1回で反映
+    index_sync.characters_saved([source, *new_characters])
+
+    return FriendsAcceptResponse(
+        character=Character(**source),
+        created=[Character(**new_character) for new_character in new_characters]
+    )
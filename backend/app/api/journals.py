@@ -1,73 +1,38 @@
 """ジャーナルAPIエンドポイント"""
-from fastapi import APIRouter, HTTPException
-from typing import List
+import asyncio
+from fastapi import APIRouter, HTTPException, Request, Response
+from typing import Dict, List
 from datetime import datetime
 from bson import ObjectId
 
+from app.core.cancellation import CLIENT_CLOSED_REQUEST, ClientDisconnected
 from app.core.database import get_database, COLLECTIONS
+from app.core.idempotency import idempotent
+from app.core.llm_scheduler import BATCH, INTERACTIVE, llm_lane
 from app.models.journal import (
-    Journal, JournalCreate, JournalUpdate, JournalGenerateRequest, PromptPreviewRequest
+    Journal, JournalCreate, JournalUpdate, JournalGenerateRequest, PromptPreviewRequest,
+    BatchPromptPreviewRequest
 )
-from app.services.ollama import generate_journal
+from app.core.settings_store import provider_settings
+from app.core.task_queue import TaskFailedError, TaskTimeoutError, task_queue
 from app.prompts import journal_prompt
+from app.services import index_sync
+from app.services.character_memory import character_memory
+from app.services.generation import JOURNAL_TASK, enrich_character_relationships, enrich_characters_relationships
+from app.services.tokenizer import (
+    count_tokens_batch, estimate_cost, estimate_token_count, get_tokenizer
+)
 
 router = APIRouter()
 
-def estimate_token_count(text: str) -> int:
-    """プロンプトの概算トークン数を計算
-
-    簡易的な推定方法:
-    - 日本語文字（ひらがな・カタカナ・漢字）: 1文字 ≈ 2.5トークン
-    - 英数字・記号: 1文字 ≈ 0.25トークン
-
-    注: これは概算値であり、実際のトークン数とは±20%程度の誤差があります
-    """
-    if not text:
-        return 0
-
-    # 日本語文字（U+3000以上）をカウント
-    japanese_chars = sum(1 for c in text if ord(c) >= 0x3000)
-    # その他の文字
-    other_chars = len(text) - japanese_chars
-
-    # 概算トークン数を計算
-    estimated = int(japanese_chars * 2.5 + other_chars * 0.25)
+# 一括プレビューで扱うプロンプト数の上限
+MAX_BATCH_PREVIEW_PROMPTS = 200
 
-    return estimated
+# 一括プレビューで記憶を並行して読み込むキャラクター数
+BATCH_PREVIEW_CONCURRENCY = 4
 
-async def enrich_character_relationships(character: dict, db) -> dict:
-    """キャラクターの関係性にターゲットキャラクター名を追加
-
-    target_character_idからキャラクター名を解決して、
-    target_character_nameフィールドを追加する
-    """
-    enriched_relationships = []
-
-    for rel in character.get("relationships", []):
-        target_id = rel.get("target_character_id")
-
-        # target_character_idからキャラクター情報を取得
-        if target_id:
-            try:
-                target_char = await db[COLLECTIONS["characters"]].find_one({"_id": ObjectId(target_id)})
-                target_name = target_char["name"] if target_char else "不明なキャラクター"
-            except Exception:
-                target_name = "不明なキャラクター"
-        else:
-            target_name = "不明なキャラクター"
-
-        enriched_rel = {
-            "target_character_id": target_id,
-            "target_character_name": target_name,
-            "description": rel.get("description", "")
-        }
-        enriched_relationships.append(enriched_rel)
-
-    # 元のキャラクター情報をコピーして関係性を置き換え
-    enriched_character = character.copy()
-    enriched_character["relationships"] = enriched_relationships
-
-    return enriched_character
+# 日記1件あたりの想定出力トークン数（500-800文字の日本語）
+EXPECTED_JOURNAL_OUTPUT_TOKENS = 2000
 
 @router.get("", response_model=List[Journal])
 @router.get("/", response_model=List[Journal])
@@ -103,42 +68,38 @@ async def create_journal(journal: JournalCreate):
     
     result = await db[COLLECTIONS["journals"]].insert_one(journal_data)
     journal_data["_id"] = str(result.inserted_id)
+    index_sync.journal_saved(journal_data, created=True)
     
     return Journal(**journal_data)
 
 @router.post("/generate", response_model=List[Journal])
-async def generate_journals(request: JournalGenerateRequest):
-    """複数のキャラクターのジャーナルを自動生成"""
-    db = get_database()
-    generated_journals = []
-    
-    for character_id in request.character_ids:
-        # キャラクター情報を取得
-        character = await db[COLLECTIONS["characters"]].find_one({"_id": ObjectId(character_id)})
-        if not character:
-            continue
+async def generate_journals(request: JournalGenerateRequest, http_request: Request, response: Response):
+    """複数のキャラクターのジャーナルを自動生成
 
-        # 関係性にキャラクター名を追加
-        enriched_character = await enrich_character_relationships(character, db)
+    クライアントが切断したら、残りのキャラクターの生成を中止する。
+    Idempotency-Key ヘッダーを付けると、同じキーの再送には同じ結果を返す。
+    複数キャラクターの一括生成は batch レーンで実行し、対話的な呼び出しを待たせない。
+    """
+    payloads = [
+        {"character_id": character_id, "theme": request.theme}
+        for character_id in request.character_ids
+    ]
 
-        # ジャーナルを生成
-        content = await generate_journal(enriched_character, request.theme)
-        
-        # ジャーナルを保存
-        journal_data = {
-            "character_id": character_id,
-            "theme": request.theme,
-            "content": content,
-            "created_at": datetime.now(),
-            "updated_at": datetime.now(),
-            "comment_ids": []
-        }
-        
-        result = await db[COLLECTIONS["journals"]].insert_one(journal_data)
-        journal_data["_id"] = str(result.inserted_id)
-        generated_journals.append(Journal(**journal_data))
-    
-    return generated_journals
+    async def generate() -> List[Journal]:
+        results = await task_queue.submit_many(JOURNAL_TASK, payloads)
+        # 見つからなかったキャラクターは飛ばす
+        return [Journal(**journal_data) for journal_data in results if journal_data is not None]
+
+    lane = BATCH if len(payloads) > 1 else INTERACTIVE
+    try:
+        with llm_lane(lane):
+            return await idempotent(http_request, response, JOURNAL_TASK, request.dict(), generate)
+    except ClientDisconnected:
+        raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="クライアントが切断したため生成を中止しました")
+    except TaskTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except TaskFailedError as e:
+        raise HTTPException(status_code=500, detail=f"ジャーナルの生成に失敗しました: {e}")
 
 @router.post("/preview-prompt")
 async def preview_journal_prompt(request: PromptPreviewRequest):
@@ -154,17 +115,114 @@ async def preview_journal_prompt(request: PromptPreviewRequest):
         # 関係性にキャラクター名を追加
         enriched_character = await enrich_character_relationships(character, db)
 
+        # 過去の日記・コメントから関連する記憶を取得
+        memories = await character_memory.retrieve(character, request.theme, db)
+
         # プロンプトを生成
-        prompt = journal_prompt.create_journal_prompt(enriched_character, request.theme)
+        prompt = journal_prompt.create_journal_prompt(enriched_character, request.theme, memories)
 
-        # トークン数を推定
+        # トークン数を計算
         token_count = estimate_token_count(prompt)
 
         return {
             "prompt": prompt,
             "character_name": character["name"],
             "theme": request.theme,
-            "estimated_tokens": token_count
+            "memories": memories,
+            "estimated_tokens": token_count,
+            "tokenizer": get_tokenizer().name
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"プロンプト生成エラー: {str(e)}")
+
+@router.post("/preview-prompt/batch")
+async def preview_journal_prompts_batch(request: BatchPromptPreviewRequest):
+    """複数キャラクター × 複数テーマのプロンプトとトークン数・料金の概算を一括取得"""
+    db = get_database()
+
+    prompt_count = len(request.character_ids) * len(request.themes)
+    if prompt_count == 0:
+        raise HTTPException(status_code=400, detail="キャラクターとテーマを1つ以上指定してください")
+    if prompt_count > MAX_BATCH_PREVIEW_PROMPTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"一度にプレビューできるプロンプトは{MAX_BATCH_PREVIEW_PROMPTS}件までです"
+        )
+
+    try:
+        # キャラクターをまとめて取得
+        object_ids = [ObjectId(character_id) for character_id in request.character_ids if ObjectId.is_valid(character_id)]
+        characters = {}
+        async for character in db[COLLECTIONS["characters"]].find({"_id": {"$in": object_ids}}):
+            characters[str(character["_id"])] = character
+        ordered = [characters[character_id] for character_id in request.character_ids if character_id in characters]
+        enriched = await enrich_characters_relationships(ordered, db)
+
+        # 記憶はキャラクターごとに候補を1回だけ読み込み、全テーマで使い回す
+        semaphore = asyncio.Semaphore(BATCH_PREVIEW_CONCURRENCY)
+
+        async def memories_of(character: dict) -> Dict[str, List[dict]]:
+            async with semaphore:
+                return await character_memory.retrieve_many(character, request.themes, db)
+
+        memories_by_character = await asyncio.gather(*(memories_of(character) for character in ordered))
+
+        # プロンプトを生成
+        items = []
+        prompts = []
+        for character, enriched_character, memories_by_theme in zip(ordered, enriched, memories_by_character):
+            for theme in request.themes:
+                memories = memories_by_theme[theme]
+                prompt = journal_prompt.create_journal_prompt(enriched_character, theme, memories)
+                prompts.append(prompt)
+                items.append({
+                    "character_id": str(character["_id"]),
+                    "character_name": character["name"],
+                    "theme": theme,
+                    "memories": len(memories),
+                })
+
+        # 現在のプロバイダーでのトークン数
+        for item, prompt, tokens in zip(items, prompts, count_tokens_batch(prompts)):
+            item["estimated_tokens"] = tokens
+            if request.include_prompts:
+                item["prompt"] = prompt
+
+        # 設定済みのモデルごとの料金概算
+        current = provider_settings()
+        configured_models = [("ollama", current.ollama_model)]
+        if current.openai_api_key or current.ai_provider == "openai":
+            configured_models.append(("openai", current.openai_model))
+        if current.anthropic_api_key or current.ai_provider == "anthropic":
+            configured_models.append(("anthropic", current.anthropic_model))
+        if current.google_api_key or current.ai_provider == "google":
+            configured_models.append(("google", current.google_model))
+
+        cost_estimates = []
+        for provider, model in configured_models:
+            input_tokens = sum(count_tokens_batch(prompts, provider, model))
+            output_tokens = EXPECTED_JOURNAL_OUTPUT_TOKENS * len(prompts)
+            cost_estimates.append({
+                "provider": provider,
+                "model": model,
+                "current": provider == current.ai_provider,
+                "tokenizer": get_tokenizer(provider, model).name,
+                "input_tokens": input_tokens,
+                "expected_output_tokens": output_tokens,
+                "estimated_cost_usd": estimate_cost(model, input_tokens, output_tokens, provider)
+            })
+
+        return {
+            "items": items,
+            "missing_character_ids": [
+                character_id for character_id in request.character_ids if character_id not in characters
+            ],
+            "total_prompts": len(prompts),
+            "total_estimated_tokens": sum(item["estimated_tokens"] for item in items),
+            "cost_estimates": cost_estimates
         }
 
     except HTTPException:
@@ -194,6 +252,7 @@ async def update_journal(journal_id: str, journal_update: JournalUpdate):
     
     journal = await db[COLLECTIONS["journals"]].find_one({"_id": ObjectId(journal_id)})
     journal["_id"] = str(journal["_id"])
+    index_sync.journal_saved(journal)
     return Journal(**journal)
 
 @router.delete("/{journal_id}")
@@ -212,6 +271,7 @@ async def delete_journal(journal_id: str):
 
     # ジャーナル自体を削除
     result = await db[COLLECTIONS["journals"]].delete_one({"_id": ObjectId(journal_id)})
+    index_sync.journal_deleted(journal_id, journal.get("character_id"))
 
     return {
         "message": "ジャーナルを削除しました",
@@ -0,0 +1,69 @@
+"""リアルタイム配信APIエンドポイント"""
+import json
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter, Header, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+
+from app.core.config import settings
+from app.services.live_updates import Subscription, live_updates
+
+router = APIRouter()
+
+# 切断後にブラウザ（EventSource）が再接続するまでの時間（ミリ秒）
+SSE_RETRY_MS = 3000
+
+def _ids(value: Optional[str]) -> List[str]:
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+def _sse(event: Dict[str, Any]) -> str:
+    """Server-Sent Events の1イベント分の文字列（id は再接続時の Last-Event-ID になる）"""
+    lines = f"id: {event['id']}\n" if event.get("id") else ""
+    return lines + f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+@router.get("/status")
+async def get_live_status():
+    """配信方式（change_stream / in_process）と購読者数"""
+    return {
+        "mode": live_updates.mode,
+        "subscribers": live_updates.subscriber_count,
+        "heartbeat_interval": settings.live_heartbeat_interval
+    }
+
+@router.get("/events")
+async def stream_live_events(
+    journal_ids: Optional[str] = Query(None, description="購読するジャーナルIDのカンマ区切り"),
+    character_ids: Optional[str] = Query(None, description="購読するキャラクターIDのカンマ区切り（そのキャラクターが書いたもの）"),
+    last_event_id: Optional[str] = Query(None, description="このイベントより後から再開"),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    """ジャーナル・コメントの差分イベントをSSEで配信（どちらも省略すると全件）"""
+    subscription = Subscription(_ids(journal_ids), _ids(character_ids))
+
+    async def events():
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        async for event in live_updates.events(subscription, last_event_id_header or last_event_id):
+            # ハートビートはコメント行（プロキシの切断防止と切断の検出）
+            yield ": heartbeat\n\n" if event is None else _sse(event)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.websocket("/ws")
+async def live_events_websocket(
+    websocket: WebSocket,
+    journal_ids: Optional[str] = None,
+    character_ids: Optional[str] = None,
+    last_event_id: Optional[str] = None
+):
+    """ジャーナル・コメントの差分イベントをWebSocketで配信（1メッセージ1イベントのJSON）"""
+    await websocket.accept()
+    subscription = Subscription(_ids(journal_ids), _ids(character_ids))
+    try:
+        async for event in live_updates.events(subscription, last_event_id):
+            await websocket.send_json(event if event is not None else {"type": "heartbeat"})
+    except WebSocketDisconnect:
+        pass
@@ -0,0 +1,30 @@
+"""プロファイルAPIエンドポイント（管理者専用）"""
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from app.core.admin import require_admin
+from app.core.profiling import profile_store
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+@router.get("")
+@router.get("/")
+async def get_profiles():
+    """保存されているプロファイルの一覧（新しい順）"""
+    return {"profiles": [session.summary() for session in profile_store.list()]}
+
+@router.get("/{profile_id}")
+async def get_profile(profile_id: str):
+    """プロファイルの概要"""
+    session = profile_store.get(profile_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="プロファイルが見つかりません")
+    return session.summary()
+
+@router.get("/{profile_id}/folded", response_class=PlainTextResponse)
+async def get_profile_folded(profile_id: str):
+    """flamegraph互換の folded 形式（flamegraph.pl / speedscope で表示可能）"""
+    session = profile_store.get(profile_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="プロファイルが見つかりません")
+    return PlainTextResponse(session.folded())
@@ -0,0 +1,101 @@
+"""検索APIエンドポイント"""
+from fastapi import APIRouter, HTTPException, Query
+from typing import Optional
+from bson import ObjectId
+
+from app.core.database import get_database, COLLECTIONS
+from app.services import index_sync
+from app.services.search_index import search_index, DOCUMENT_KINDS
+from app.services.semantic_index import semantic_index, SEMANTIC_KINDS
+
+router = APIRouter()
+
+@router.get("")
+@router.get("/")
+async def search(
+    q: str = Query(..., min_length=1),
+    types: Optional[str] = Query(None, description="character,journal,comment のカンマ区切り"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0)
+):
+    """キャラクター・ジャーナル・コメントを全文検索"""
+    kinds = None
+    if types:
+        kinds = [kind.strip() for kind in types.split(",") if kind.strip()]
+        invalid = [kind for kind in kinds if kind not in DOCUMENT_KINDS]
+        if invalid:
+            raise HTTPException(
+                status_code=400,
+                detail=f"不明な検索対象です: {', '.join(invalid)}"
+            )
+
+    await search_index.ensure_loaded(get_database())
+    result = search_index.search(q, kinds, limit, offset)
+    return {**result, "limit": limit, "offset": offset}
+
+@router.get("/semantic")
+async def semantic_search(
+    q: str = Query(..., min_length=1),
+    types: Optional[str] = Query(None, description="journal,comment のカンマ区切り"),
+    k: int = Query(10, ge=1, le=100)
+):
+    """ジャーナル・コメントを意味的な近さで検索"""
+    kinds = list(SEMANTIC_KINDS)
+    if types:
+        kinds = [kind.strip() for kind in types.split(",") if kind.strip()]
+        invalid = [kind for kind in kinds if kind not in SEMANTIC_KINDS]
+        if invalid:
+            raise HTTPException(
+                status_code=400,
+                detail=f"不明な検索対象です: {', '.join(invalid)}"
+            )
+
+    try:
+        hits = await semantic_index.search(q, k, kinds)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"埋め込みの計算に失敗しました: {str(e)}")
+
+    # 本文を取得（削除済みのドキュメントはインデックスからも取り除く）
+    db = get_database()
+    documents = {}
+    for kind, collection in (("journal", COLLECTIONS["journals"]), ("comment", COLLECTIONS["comments"])):
+        ids = [ObjectId(document_id) for hit_kind, document_id, _ in hits if hit_kind == kind]
+        if ids:
+            async for doc in db[collection].find({"_id": {"$in": ids}}):
+                documents[(kind, str(doc["_id"]))] = doc
+
+    results = []
+    for kind, document_id, score in hits:
+        doc = documents.get((kind, document_id))
+        if doc is None:
+            semantic_index.remove(kind, document_id)
+            continue
+        result = {
+            "type": kind,
+            "id": document_id,
+            "score": round(score, 4),
+            "character_id": doc.get("character_id"),
+            "snippet": doc.get("content", "")[:200],
+            "created_at": doc.get("created_at"),
+        }
+        if kind == "journal":
+            result["theme"] = doc.get("theme")
+        else:
+            result["journal_id"] = doc.get("journal_id")
+        results.append(result)
+
+    return {"query": q, "results": results}
+
+@router.post("/rebuild")
+async def rebuild_search_index():
+    """検索インデックスをデータベースから再構築
+
+    このプロセスで再構築を終えてから、他のプロセス（APIワーカー）にも
+    index_events で再構築を依頼する（他のプロセスの完了は待たない）。
+    """
+    counts = await search_index.rebuild(get_database())
+    index_sync.search_index_rebuilt()
+    return {
+        "message": "検索インデックスを再構築しました（他のAPIプロセスにも再構築を依頼しました）",
+        "indexed": counts
+    }
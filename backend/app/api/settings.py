@@ -1,9 +1,16 @@
 """設定管理API"""
 from fastapi import APIRouter, HTTPException
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
-from typing import Optional, Literal
-from app.core.config import settings, AIProvider
-from app.core.env_manager import env_manager
+from typing import Dict, Optional, Literal, get_args
+from app.core.config import settings, AIProvider, GenerationTask
+from app.core.deadline import DeadlineExceeded
+from app.core.llm_scheduler import SchedulerOverloadedError
+from app.core.settings_store import SettingsConflictError, TaskRoute, settings_store
+from app.core.settings_store import provider_settings as current_provider_settings
+from app.services import model_router as routing
+from app.services.ai_provider import ProviderConfig, generate_text
+from app.services.provider_health import configured_targets, parse_models, provider_health
 
 router = APIRouter()
 
@@ -29,6 +36,9 @@ class AIProviderSettings(BaseModel):
     google_api_key: Optional[str] = None
     google_model: Optional[str] = None
 
+    # 取得時は現在のバージョン。更新時に指定すると、そのバージョンからの変更としてのみ保存する
+    version: Optional[int] = None
+
 
 class AIProviderInfo(BaseModel):
     """AI プロバイダー情報"""
@@ -85,164 +95,163 @@ async def get_available_providers() -> list[AIProviderInfo]:
 @router.get("/ai-provider")
 async def get_current_provider() -> AIProviderSettings:
     """現在のAI プロバイダー設定を取得"""
+    current = current_provider_settings()
     return AIProviderSettings(
-        provider=settings.ai_provider,
-        ollama_api_url=settings.ollama_api_url,
-        ollama_model=settings.ollama_model,
-        openai_api_key="***" if settings.openai_api_key else None,
-        openai_model=settings.openai_model,
-        openai_base_url=settings.openai_base_url,
-        anthropic_api_key="***" if settings.anthropic_api_key else None,
-        anthropic_model=settings.anthropic_model,
-        google_api_key="***" if settings.google_api_key else None,
-        google_model=settings.google_model
+        provider=current.ai_provider,
+        ollama_api_url=current.ollama_api_url,
+        ollama_model=current.ollama_model,
+        openai_api_key="***" if current.openai_api_key else None,
+        openai_model=current.openai_model,
+        openai_base_url=current.openai_base_url,
+        anthropic_api_key="***" if current.anthropic_api_key else None,
+        anthropic_model=current.anthropic_model,
+        google_api_key="***" if current.google_api_key else None,
+        google_model=current.google_model,
+        version=current.version
     )
 
 
 @router.post("/ai-provider")
 async def update_provider_settings(provider_settings: AIProviderSettings):
-    """AI プロバイダー設定を更新"""
-    try:
-        # .envファイルに書き込む変数を収集
-        env_updates = {}
-
-        # AI プロバイダー選択
-        env_updates["AI_PROVIDER"] = provider_settings.provider
-
-        # Ollama設定
-        if provider_settings.ollama_api_url:
-            env_updates["OLLAMA_API_URL"] = provider_settings.ollama_api_url
-        if provider_settings.ollama_model:
-            env_updates["OLLAMA_MODEL"] = provider_settings.ollama_model
-
-        # OpenAI設定
-        if provider_settings.openai_api_key and provider_settings.openai_api_key != "***":
-            env_updates["OPENAI_API_KEY"] = provider_settings.openai_api_key
-        if provider_settings.openai_model:
-            env_updates["OPENAI_MODEL"] = provider_settings.openai_model
-        if provider_settings.openai_base_url:
-            env_updates["OPENAI_BASE_URL"] = provider_settings.openai_base_url
-
-        # Anthropic設定
-        if provider_settings.anthropic_api_key and provider_settings.anthropic_api_key != "***":
-            env_updates["ANTHROPIC_API_KEY"] = provider_settings.anthropic_api_key
-        if provider_settings.anthropic_model:
-            env_updates["ANTHROPIC_MODEL"] = provider_settings.anthropic_model
-
-        # Google設定
-        if provider_settings.google_api_key and provider_settings.google_api_key != "***":
-            env_updates["GOOGLE_API_KEY"] = provider_settings.google_api_key
-        if provider_settings.google_model:
-            env_updates["GOOGLE_MODEL"] = provider_settings.google_model
-
-        # .envファイルに一括書き込み
-        success = env_manager.update_multiple_env_variables(env_updates)
-
-        if not success:
-            raise HTTPException(status_code=500, detail="設定ファイルの更新に失敗しました")
-
-        # メモリ内の設定も更新（即座反映のため）
-        settings.ai_provider = provider_settings.provider
-        if provider_settings.ollama_api_url:
-            settings.ollama_api_url = provider_settings.ollama_api_url
-        if provider_settings.ollama_model:
-            settings.ollama_model = provider_settings.ollama_model
-        if provider_settings.openai_api_key and provider_settings.openai_api_key != "***":
-            settings.openai_api_key = provider_settings.openai_api_key
-        if provider_settings.openai_model:
-            settings.openai_model = provider_settings.openai_model
-        if provider_settings.openai_base_url:
-            settings.openai_base_url = provider_settings.openai_base_url
-        if provider_settings.anthropic_api_key and provider_settings.anthropic_api_key != "***":
-            settings.anthropic_api_key = provider_settings.anthropic_api_key
-        if provider_settings.anthropic_model:
-            settings.anthropic_model = provider_settings.anthropic_model
-        if provider_settings.google_api_key and provider_settings.google_api_key != "***":
-            settings.google_api_key = provider_settings.google_api_key
-        if provider_settings.google_model:
-            settings.google_model = provider_settings.google_model
+    """AI プロバイダー設定を更新
 
-        return {
-            "message": "設定を更新しました。設定は.envファイルに保存され、再起動後も維持されます。",
-            "saved_to": ".env"
-        }
+    設定はデータベースに保存され、全てのワーカーに反映される（再起動不要）。
+    空欄の項目と "***"（マスクされたAPIキー）は変更しない。
+    """
+    changes = {"ai_provider": provider_settings.provider}
+    for field, value in provider_settings.dict(exclude={"provider", "version"}).items():
+        if value and value != "***":
+            changes[field] = value
 
+    try:
+        updated = await settings_store.update(changes, provider_settings.version)
+    except SettingsConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"設定の更新に失敗しました: {str(e)}")
 
+    # ヘルスチェックのキャッシュは、設定の変更を受け取った各プロセスで破棄される
+    return {
+        "message": "設定を更新しました。設定はデータベースに保存され、全てのワーカーに反映されます。",
+        "saved_to": "database",
+        "version": updated.version
+    }
+
+
+def _config_from_request(provider_settings: AIProviderSettings) -> ProviderConfig:
+    """リクエストの設定（空欄は現在の設定）から接続設定を作成"""
+    provider = provider_settings.provider
+    api_key = getattr(provider_settings, f"{provider}_api_key", None)
+    base_url = {
+        "ollama": provider_settings.ollama_api_url,
+        "openai": provider_settings.openai_base_url,
+    }.get(provider)
+    return ProviderConfig.from_settings(
+        provider,
+        model=getattr(provider_settings, f"{provider}_model"),
+        base_url=base_url,
+        api_key=api_key if api_key != "***" else None
+    )
+
 
 @router.post("/ai-provider/test")
 async def test_ai_provider(test_settings: Optional[AIProviderSettings] = None):
     """AI プロバイダーの接続テスト
 
     test_settingsが指定されている場合、その設定でテスト
-    指定されていない場合、現在の設定でテスト
+    指定されていない場合、現在の設定（connection_test のルートがあればそのルート）でテスト
     """
+    provider = test_settings.provider if test_settings else current_provider_settings().ai_provider
+    route = None
     try:
-        # テスト用の設定を一時的に適用
+        test_prompt = "Hi"
         if test_settings:
-            # 元の設定を保存
-            original_provider = settings.ai_provider
-            original_ollama_url = settings.ollama_api_url
-            original_ollama_model = settings.ollama_model
-            original_openai_key = settings.openai_api_key
-            original_openai_model = settings.openai_model
-            original_openai_base_url = settings.openai_base_url
-            original_anthropic_key = settings.anthropic_api_key
-            original_anthropic_model = settings.anthropic_model
-            original_google_key = settings.google_api_key
-            original_google_model = settings.google_model
-
-            # テスト用設定を一時適用
-            settings.ai_provider = test_settings.provider
-            if test_settings.ollama_api_url:
-                settings.ollama_api_url = test_settings.ollama_api_url
-            if test_settings.ollama_model:
-                settings.ollama_model = test_settings.ollama_model
-            if test_settings.openai_api_key and test_settings.openai_api_key != "***":
-                settings.openai_api_key = test_settings.openai_api_key
-            if test_settings.openai_model:
-                settings.openai_model = test_settings.openai_model
-            if test_settings.openai_base_url:
-                settings.openai_base_url = test_settings.openai_base_url
-            if test_settings.anthropic_api_key and test_settings.anthropic_api_key != "***":
-                settings.anthropic_api_key = test_settings.anthropic_api_key
-            if test_settings.anthropic_model:
-                settings.anthropic_model = test_settings.anthropic_model
-            if test_settings.google_api_key and test_settings.google_api_key != "***":
-                settings.google_api_key = test_settings.google_api_key
-            if test_settings.google_model:
-                settings.google_model = test_settings.google_model
-
-        try:
-            from app.services.ai_provider import generate_text
-
-            test_prompt = "Hi"
-            response = await generate_text(test_prompt)
-
-            return {
-                "success": True,
-                "provider": settings.ai_provider,
-                "response": response[:100] + ("..." if len(response) > 100 else "")
-            }
-
-        finally:
-            # 元の設定に戻す
-            if test_settings:
-                settings.ai_provider = original_provider
-                settings.ollama_api_url = original_ollama_url
-                settings.ollama_model = original_ollama_model
-                settings.openai_api_key = original_openai_key
-                settings.openai_model = original_openai_model
-                settings.openai_base_url = original_openai_base_url
-                settings.anthropic_api_key = original_anthropic_key
-                settings.anthropic_model = original_anthropic_model
-                settings.google_api_key = original_google_key
-                settings.google_model = original_google_model
+            # グローバルな設定は書き換えず、テスト用の接続設定を渡す
+            response = await generate_text(
+                test_prompt, _config_from_request(test_settings), task="connection_test"
+            )
+        else:
+            with routing.record_routes() as routes:
+                response = await routing.generate_text("connection_test", test_prompt)
+            route = routes[-1] if routes else None
+            provider = route["provider"] if route else provider
+
+        return {
+            "success": True,
+            "provider": provider,
+            "route": route,
+            "response": response[:100] + ("..." if len(response) > 100 else "")
+        }
 
+    except (SchedulerOverloadedError, DeadlineExceeded):
+        # 接続の失敗ではないため、503 + Retry-After / 504 で返す
+        raise
     except Exception as e:
         return {
             "success": False,
-            "provider": settings.ai_provider if not test_settings else test_settings.provider,
+            "provider": provider,
             "error": str(e)
-        }
\ No newline at end of file
+        }
+
+
+class RoutingSettings(BaseModel):
+    """タスク種別ごとのモデルのルーティング"""
+    routes: Dict[GenerationTask, TaskRoute] = {}
+
+    # 取得時は現在のバージョン。更新時に指定すると、そのバージョンからの変更としてのみ保存する
+    version: Optional[int] = None
+
+
+@router.get("/routing")
+async def get_routing():
+    """タスク種別ごとのルートと、候補ごとの直近の応答時間・タスク種別ごとのヘッジ率"""
+    current = current_provider_settings()
+    return {
+        "tasks": list(get_args(GenerationTask)),
+        "default_provider": current.ai_provider,
+        "routes": current.llm_routing,
+        "version": current.version,
+        "stats": routing.model_router.stats()
+    }
+
+
+@router.put("/routing")
+async def update_routing(request: RoutingSettings):
+    """タスク種別ごとのルートを置き換える（全てのワーカーに反映、再起動不要）
+
+    routes に含まれないタスク種別は ai_provider の設定で呼び出す。
+    """
+    try:
+        updated = await settings_store.update({"llm_routing": jsonable_encoder(request.routes)}, request.version)
+    except SettingsConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {
+        "message": "ルーティングを更新しました",
+        "routes": updated.llm_routing,
+        "version": updated.version
+    }
+
+
+@router.get("/ai-providers/health")
+async def get_providers_health(models: Optional[str] = None, refresh: bool = False):
+    """設定済みの全プロバイダーを並行して検査
+
+    models に "provider:model" のカンマ区切りを指定すると、そのモデルも検査する。
+    結果は provider_health_ttl 秒キャッシュされる（refresh=true で再検査）。
+    """
+    try:
+        extra_models = parse_models(models)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    results = await provider_health.matrix(configured_targets(extra_models), refresh)
+    return {
+        "current_provider": current_provider_settings().ai_provider,
+        "ttl": settings.provider_health_ttl,
+        "results": results
+    }
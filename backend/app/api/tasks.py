@@ -0,0 +1,26 @@
+"""生成タスクAPIエンドポイント"""
+from fastapi import APIRouter, HTTPException
+
+from app.core.config import settings
+from app.core.llm_scheduler import llm_scheduler
+from app.core.task_queue import task_queue
+
+router = APIRouter()
+
+@router.get("/stats")
+async def get_task_stats():
+    """実行方式と、状態ごとのタスク数・このプロセスのLLM呼び出しの実行枠"""
+    return {
+        "generation_mode": settings.generation_mode,
+        "counts": await task_queue.counts(),
+        "llm_scheduler": llm_scheduler.snapshot()
+    }
+
+@router.get("/{task_id}")
+async def get_task(task_id: str):
+    """タスクの状態と結果"""
+    task = await task_queue.get(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="タスクが見つかりません")
+    task["_id"] = str(task["_id"])
+    return task
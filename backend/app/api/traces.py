@@ -0,0 +1,36 @@
+"""トレースAPIエンドポイント"""
+from fastapi import APIRouter, HTTPException, Query
+from typing import Any, Dict, Optional
+
+from app.core.database import get_database, COLLECTIONS
+
+router = APIRouter()
+
+@router.get("/slow")
+async def get_slow_traces(
+    route: Optional[str] = Query(None, description="ルートのパステンプレートで絞り込み"),
+    min_duration_ms: float = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=200)
+):
+    """しきい値より遅かったリクエストのトレース一覧（新しい順、スパンは含まない）"""
+    db = get_database()
+    query: Dict[str, Any] = {"duration_ms": {"$gte": min_duration_ms}}
+    if route:
+        query["route"] = route
+
+    cursor = db[COLLECTIONS["slow_traces"]].find(query, {"spans": 0}).sort("$natural", -1).limit(limit)
+    traces = []
+    async for trace in cursor:
+        trace["_id"] = str(trace["_id"])
+        traces.append(trace)
+    return {"traces": traces}
+
+@router.get("/slow/{trace_id}")
+async def get_slow_trace(trace_id: str):
+    """遅かったリクエストのトレース（スパンを含む）"""
+    db = get_database()
+    trace = await db[COLLECTIONS["slow_traces"]].find_one({"trace_id": trace_id})
+    if not trace:
+        raise HTTPException(status_code=404, detail="トレースが見つかりません")
+    trace["_id"] = str(trace["_id"])
+    return trace
@@ -0,0 +1,22 @@
+"""管理者向け機能の認証"""
+import hmac
+from typing import Optional
+
+from fastapi import Header, HTTPException
+
+from app.core.config import settings
+
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+
+def is_admin_token(token: Optional[str]) -> bool:
+    """管理者トークンが正しいか（admin_token 未設定の場合は常に False）"""
+    if not settings.admin_token or not token:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), settings.admin_token.encode("utf-8"))
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    """管理者トークンを要求する依存関係"""
+    if not is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="管理者トークンが必要です")
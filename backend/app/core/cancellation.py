@@ -0,0 +1,56 @@
+"""クライアントの切断による処理の中断
+
+生成のように長くかかる処理を別タスクで実行し、その間 request.is_disconnected() を
+監視する。クライアントが切断したらタスクを取り消す。取り消しは await の連鎖を
+さかのぼって伝わり、LLMへの httpx のリクエスト（Ollama ではストリーム）も閉じられる。
+"""
+import asyncio
+from typing import AsyncGenerator, Awaitable, TypeVar
+
+from fastapi import Request
+
+from app.core import metrics
+from app.core.config import settings
+
+T = TypeVar("T")
+
+# nginx に倣った「クライアントが切断した」ステータス（クライアントには届かない）
+CLIENT_CLOSED_REQUEST = 499
+
+
+class ClientDisconnected(Exception):
+    """処理中にクライアントが切断した"""
+
+
+async def cancel_on_disconnect(request: Request, awaitable: Awaitable[T], operation: str) -> T:
+    """awaitable を実行し、クライアントが切断したら取り消して ClientDisconnected を送出"""
+    work = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({work}, timeout=settings.disconnect_poll_interval)
+            if done:
+                return work.result()
+            if await request.is_disconnected():
+                work.cancel()
+                await asyncio.gather(work, return_exceptions=True)
+                metrics.client_disconnects_total.inc(operation=operation)
+                raise ClientDisconnected()
+    except asyncio.CancelledError:
+        work.cancel()
+        raise
+
+
+async def iterate_until_disconnect(
+    request: Request, iterator: AsyncGenerator[T, None], operation: str
+) -> AsyncGenerator[T, None]:
+    """iterator の要素を順に返し、次の要素を待つ間にクライアントが切断したら
+    取り消して ClientDisconnected を送出（SSE のようなストリーミングレスポンス用）"""
+    try:
+        while True:
+            try:
+                item = await cancel_on_disconnect(request, iterator.__anext__(), operation)
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        await iterator.aclose()
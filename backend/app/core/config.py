@@ -1,9 +1,12 @@
 """アプリケーション設定"""
 from pydantic_settings import BaseSettings
-from typing import Optional, Literal
+from typing import Any, Dict, Optional, Literal
 
 AIProvider = Literal["ollama", "openai", "anthropic", "google"]
 
+# モデルのルーティングを指定できるLLM呼び出しの種別
+GenerationTask = Literal["journal", "comment", "discovery", "summary", "connection_test"]
+
 class Settings(BaseSettings):
     """アプリケーション設定"""
 
@@ -17,6 +20,17 @@ class Settings(BaseSettings):
     # Ollama API設定
     ollama_api_url: str = "http://192.168.1.7:11434"
     ollama_model: str = "gpt-oss:20B"
+    ollama_keep_alive: str = "30m"  # 最後の呼び出しからモデルをメモリに残す時間（"-1" で無期限）
+    ollama_preload: bool = True  # 起動時・設定変更時にモデルを読み込んでおく
+    ollama_num_ctx: Optional[int] = None  # コンテキスト長（未指定ならモデルの既定値）
+    # タスク種別ごとの出力トークン数の上限（num_predict。思考するモデルでは思考のトークンも含む）
+    ollama_num_predict: Dict[str, int] = {
+        "journal": 4096,
+        "comment": 1024,
+        "discovery": 4096,
+        "summary": 1024,
+        "connection_test": 256,
+    }
 
     # OpenAI API設定
     openai_api_key: Optional[str] = None
@@ -26,10 +40,104 @@ class Settings(BaseSettings):
     # Anthropic API設定
     anthropic_api_key: Optional[str] = None
     anthropic_model: str = "claude-3-sonnet-20240229"
+    anthropic_base_url: Optional[str] = None
 
     # Google AI API設定
     google_api_key: Optional[str] = None
     google_model: str = "gemini-pro"
+    google_base_url: Optional[str] = None
+
+    # タスク種別ごとのモデルのルーティング（初期値。JSON、例: {"comment": {"targets": [{"provider": "ollama", "model": "llama3.2:3b"}]}}）
+    llm_routing: Dict[str, Any] = {}
+
+    # LLM呼び出しのタイムアウト（秒）。llm_timeouts で プロバイダー・タスク種別・"プロバイダー:タスク種別" ごとに上書きできる
+    # 例: {"ollama": {"read": 180}, "comment": {"total": 30}, "ollama:journal": {"total": 600}}
+    llm_connect_timeout: float = 10.0
+    llm_read_timeout: float = 60.0  # 応答（ストリーミングでは次のチャンク）を待つ時間
+    llm_total_timeout: float = 300.0  # 1回の呼び出し全体
+    llm_timeouts: Dict[str, Dict[str, float]] = {}
+
+    # ルートの hedge を有効にしたタスク種別で、次の候補にも送るまでの待ち時間
+    llm_hedge_percentile: float = 0.95  # 候補の直近の最初のトークン（一括生成では応答）までの時間のこのパーセンタイル
+    llm_hedge_min_delay: float = 0.5  # 待ち時間の下限（秒）
+    llm_hedge_initial_delay: float = 10.0  # 応答時間の記録が少ないうちの待ち時間（秒）
+
+    # プロバイダーのヘルスチェック
+    provider_health_ttl: int = 30  # 結果をキャッシュする秒数
+    provider_health_timeout: float = 20.0  # 1プローブあたりのタイムアウト（秒）
+
+    # MongoDBに保存したプロバイダー設定の確認間隔（change streamが使えない場合、秒）
+    provider_settings_poll_interval: float = 5.0
+
+    # 生成タスクの実行方式
+    # local: APIプロセス内で実行（開発用） / queue: MongoDBのタスクキュー経由で生成ワーカー（worker.py）が実行
+    generation_mode: Literal["local", "queue"] = "local"
+    task_visibility_timeout: float = 60.0  # ハートビートが途絶えてから他のワーカーが取り直すまでの秒数
+    task_heartbeat_interval: float = 15.0  # リースを延長する間隔（秒）
+    task_max_attempts: int = 3
+    task_retry_delay: float = 5.0  # 失敗後に再試行するまでの秒数（試行ごとに倍）
+    task_poll_interval: float = 0.5  # 空のキュー・結果を確認する間隔の上限（秒）
+    task_wait_timeout: float = 600.0  # APIがタスクの完了を待つ最大秒数
+    task_retention_seconds: int = 24 * 60 * 60  # 完了したタスクを残す秒数
+    worker_concurrency: int = 4  # 1ワーカープロセスで並行して処理するタスク数
+    worker_metrics_host: str = "0.0.0.0"  # ワーカーの /metrics を待ち受けるアドレス
+    worker_metrics_port: int = 9100  # ワーカーの /metrics のポート（0で無効）
+    disconnect_poll_interval: float = 0.5  # 生成中にクライアントの切断を確認する間隔（秒）
+
+    # LLM呼び出しのスケジューラー（レーン: interactive / batch / background）
+    llm_max_concurrency: int = 4  # プロバイダーごとに同時に実行するLLM呼び出し数
+    llm_lane_weights: str = "interactive:8,batch:2,background:1"  # 空いた枠を割り当てる重み
+    llm_lane_max_depth: str = "interactive:32,batch:256,background:16"  # レーンごとの待ち件数の上限（超えると503）
+
+    # 生成エンドポイントの冪等性キー（Idempotency-Key ヘッダー）
+    idempotency_ttl_seconds: int = 24 * 60 * 60  # 結果を保存しておく秒数
+    idempotency_lock_timeout: float = 60.0  # 処理中のプロセスが落ちたとみなすまでの秒数
+    idempotency_poll_interval: float = 0.5  # 他のプロセスで処理中のキーの完了を確認する間隔（秒）
+    idempotency_wait_timeout: float = 600.0  # 処理中のキーの完了を待つ最大秒数
+
+    # ジャーナル・コメントのリアルタイム配信
+    live_heartbeat_interval: float = 15.0  # イベントが無いときのハートビート間隔（秒）
+    live_queue_size: int = 256  # 購読者ごとの送信待ちイベント数の上限（超えると reset を送る）
+    live_buffer_size: int = 1000  # 再接続時の再送用に残す最近のイベント数
+    live_replay_limit: int = 1000  # 再開トークンから再送するイベント数の上限
+
+    # 派生インデックス（検索・関係性グラフ・記憶のキャッシュ）の変更のプロセス間伝搬
+    index_event_poll_interval: float = 1.0  # 他のプロセスの変更を確認する間隔（秒）
+    index_event_lookback: float = 10.0  # 毎回読み直す範囲（秒）。書き込みの遅れ・時計のずれより長くする
+    index_event_ttl_seconds: int = 60 * 60  # 変更イベントを残す秒数
+
+    # 埋め込み（セマンティック検索）設定
+    embedding_provider: Literal["hashing", "ollama", "openai"] = "hashing"
+    ollama_embedding_model: str = "nomic-embed-text"
+    openai_embedding_model: str = "text-embedding-3-small"
+    embedding_dimension: int = 256  # hashing埋め込みの次元数
+    embedding_batch_size: int = 32
+    embedding_index_dir: str = "/app/data/embeddings"
+
+    # キャラクターの記憶（ジャーナル生成時に過去の日記・コメントを参照）
+    memory_top_k: int = 5
+    memory_token_budget: int = 1500
+    memory_recency_half_life_days: float = 14.0
+    memory_cache_ttl: int = 300
+
+    # トレーシング
+    tracing_enabled: bool = True
+    tracing_exporter: Literal["none", "jsonl", "otlp"] = "none"
+    tracing_jsonl_path: str = "/app/data/traces.jsonl"
+    tracing_otlp_endpoint: str = "http://localhost:4318/v1/traces"
+    tracing_slow_threshold_ms: int = 5000  # これより遅いトレースをMongoDBに保存
+    tracing_slow_sample_rate: float = 1.0
+    tracing_slow_collection_size: int = 64 * 1024 * 1024  # capped collectionのサイズ（バイト）
+
+    # 管理者トークン（プロファイリングなど管理者向け機能用。未設定の場合は無効）
+    admin_token: Optional[str] = None
+
+    # プロファイリング
+    profiling_routes: str = ""  # 常にプロファイルするルートのパステンプレート（カンマ区切り）
+    profiling_route_sample_rate: float = 1.0
+    profiling_interval_ms: float = 5.0
+    profiling_max_stored: int = 50
+    profiling_dir: Optional[str] = None  # 指定するとfolded形式のファイルも保存
 
     # ファイルアップロード設定
     upload_dir: str = "/app/uploads"
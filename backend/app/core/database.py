@@ -3,6 +3,11 @@ from motor.motor_asyncio import AsyncIOMotorClient
 from typing import Optional
 import logging
 from .config import settings
+from .metrics import MongoCommandMetrics
+from .tracing import MongoCommandTracer, SLOW_TRACES_COLLECTION
+from .settings_store import SETTINGS_COLLECTION
+from .task_queue import TASKS_COLLECTION
+from .idempotency import IDEMPOTENCY_COLLECTION
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +21,7 @@ async def connect_to_mongo():
     """MongoDBに接続"""
     try:
         logger.info(f"MongoDBに接続中: {settings.mongodb_url}")
-        db.client = AsyncIOMotorClient(settings.mongodb_url)
+        db.client = AsyncIOMotorClient(settings.mongodb_url, event_listeners=[MongoCommandMetrics(), MongoCommandTracer()])
         db.db = db.client[settings.database_name]
         
         # 接続確認
@@ -40,5 +45,9 @@ def get_database():
 COLLECTIONS = {
     "characters": "characters",
     "journals": "journals",
-    "comments": "comments"
+    "comments": "comments",
+    "slow_traces": SLOW_TRACES_COLLECTION,
+    "settings": SETTINGS_COLLECTION,
+    "generation_tasks": TASKS_COLLECTION,
+    "idempotency_keys": IDEMPOTENCY_COLLECTION
 }
\ No newline at end of file
@@ -0,0 +1,147 @@
+"""リクエストの期限（X-Request-Deadline）
+
+クライアントは X-Request-Deadline ヘッダーで、応答が不要になる時刻を
+Unix時刻（秒）または ISO 8601 形式で指定できる。期限はコンテキスト変数で
+リクエストの処理全体（ここから作ったタスクを含む）に伝わり、
+
+- MongoDB の操作は pymongo.timeout() で残り時間を上限にする
+- LLM 呼び出しは接続・読み取り・全体のタイムアウトを残り時間までに縮め、
+  実行枠の待ちも含めて期限で打ち切る
+- 生成タスク（queue モード）には期限を記録し、ワーカーも同じ期限で打ち切る
+  （期限を過ぎたタスクは実行しない）
+
+間に合わない処理は早めに諦め、API は 504 を返す。
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import AsyncIterator, Iterator, Optional
+
+import pymongo
+from fastapi.responses import JSONResponse
+
+from app.core import metrics
+
+DEADLINE_HEADER = "X-Request-Deadline"
+
+# 期限（Unix時刻、秒）
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """リクエストの期限までに処理が終わらない"""
+
+    def __init__(self, operation: str = "request"):
+        super().__init__(f"リクエストの期限を過ぎたため {operation} を中止しました")
+        self.operation = operation
+
+
+def parse_deadline(value: str) -> float:
+    """ヘッダーの値を Unix時刻（秒）に変換"""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return parsed.timestamp()
+
+
+def current_deadline() -> Optional[float]:
+    return _deadline.get()
+
+
+def remaining() -> Optional[float]:
+    """期限までの秒数（期限が無ければ None、過ぎていれば 0）"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0.0)
+
+
+def clamp(seconds: float) -> float:
+    """タイムアウトを期限までの残り時間に縮める"""
+    left = remaining()
+    return seconds if left is None else min(seconds, left)
+
+
+def check(operation: str) -> None:
+    """期限を過ぎていれば DeadlineExceeded"""
+    if remaining() == 0.0:
+        metrics.deadline_exceeded_total.inc(operation=operation)
+        raise DeadlineExceeded(operation)
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[float]) -> Iterator[None]:
+    """この範囲（とここから作ったタスク）の期限を指定（既存の期限より延ばすことはない）"""
+    current = _deadline.get()
+    if deadline is not None and current is not None:
+        deadline = min(deadline, current)
+    token = _deadline.set(deadline if deadline is not None else current)
+    try:
+        if deadline is None:
+            yield
+        else:
+            # MongoDB の操作にも残り時間を上限として渡す
+            with pymongo.timeout(max(deadline - time.time(), 0.001)):
+                yield
+    finally:
+        _deadline.reset(token)
+
+
+@asynccontextmanager
+async def enforce(operation: str) -> AsyncIterator[None]:
+    """期限が来たら範囲内の処理を取り消して DeadlineExceeded にする"""
+    check(operation)
+    left = remaining()
+    if left is None:
+        yield
+        return
+    try:
+        async with asyncio.timeout(left):
+            yield
+    except TimeoutError as e:
+        if isinstance(e, DeadlineExceeded) or remaining() != 0.0:
+            # 範囲内の処理自身のタイムアウト
+            raise
+        metrics.deadline_exceeded_total.inc(operation=operation)
+        raise DeadlineExceeded(operation) from e
+
+
+class DeadlineMiddleware:
+    """X-Request-Deadline ヘッダーの期限をリクエストの処理全体に伝えるASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        header = DEADLINE_HEADER.lower().encode("latin-1")
+        value = next((v for k, v in scope.get("headers", []) if k == header), None)
+        if value is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            deadline = parse_deadline(value.decode("latin-1"))
+        except ValueError:
+            response = JSONResponse(
+                status_code=400,
+                content={"detail": f"{DEADLINE_HEADER} はUnix時刻（秒）またはISO 8601形式で指定してください"}
+            )
+            await response(scope, receive, send)
+            return
+        if deadline <= time.time():
+            metrics.deadline_exceeded_total.inc(operation="request")
+            response = JSONResponse(status_code=504, content={"detail": str(DeadlineExceeded())})
+            await response(scope, receive, send)
+            return
+
+        with deadline_scope(deadline):
+            await self.app(scope, receive, send)
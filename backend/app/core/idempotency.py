@@ -0,0 +1,245 @@
+"""生成エンドポイントの冪等性キー
+
+Idempotency-Key ヘッダー付きのリクエストは、キーごとに MongoDB の
+idempotency_keys コレクション（TTLで自動削除）に記録する。
+
+- 最初のリクエストがキーを取得して生成し、結果を保存する
+- 同じキーの再送は、完了していれば保存済みの結果を返し、処理中であれば
+  その完了を待って同じ結果を返す（同じプロセスなら実行中の処理を直接待つ）
+- 同じキーで内容の異なるリクエストは 422
+- 生成に失敗した場合はキーを解放し、次の再送で生成し直す
+
+キーを取得した処理はリクエストから切り離して実行するため、クライアントが
+切断しても最後まで実行され、再送されたリクエストが結果を受け取れる。
+キーの無いリクエストは従来どおり、切断すると生成を中止する。
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from pymongo.errors import DuplicateKeyError
+
+from app.core import metrics
+from app.core.cancellation import cancel_on_disconnect
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+IDEMPOTENCY_COLLECTION = "idempotency_keys"
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+
+class IdempotencyConflictError(Exception):
+    """同じキーが内容の異なるリクエストに使われた"""
+
+
+class IdempotencyTimeoutError(Exception):
+    """同じキーの処理が待ち時間内に終わらなかった"""
+
+
+def _fingerprint(payload: Any) -> str:
+    text = json.dumps(jsonable_encoder(payload), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """キーの取得・結果の保存と、処理中のキーへの合流"""
+
+    def __init__(self):
+        self._collection = None
+        # このプロセスで実行中の処理（record_id -> 結果の Future）
+        self._running: Dict[str, "asyncio.Future[Any]"] = {}
+
+    async def start(self, db) -> None:
+        self._collection = db[IDEMPOTENCY_COLLECTION]
+        try:
+            await self._collection.create_index("expires_at", expireAfterSeconds=0)
+        except Exception as e:
+            logger.warning(f"冪等性キーのインデックスを作成できませんでした: {e}")
+
+    def _require_collection(self):
+        if self._collection is None:
+            raise RuntimeError("冪等性キーのストアが開始されていません")
+        return self._collection
+
+    async def run(
+        self,
+        key: str,
+        scope: str,
+        payload: Any,
+        compute: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, str]:
+        """(結果, "new" | "replayed" | "attached") を返す"""
+        collection = self._require_collection()
+        record_id = f"{scope}:{key}"
+        fingerprint = _fingerprint(payload)
+        deadline = time.monotonic() + settings.idempotency_wait_timeout
+        attached = False
+
+        while True:
+            record = await collection.find_one({"_id": record_id})
+            if record is None:
+                owner = await self._insert(record_id, scope, fingerprint)
+                if owner is None:
+                    # 他のリクエストが先に取得した
+                    continue
+                result = await self._own(record_id, owner, compute)
+                return result, "attached" if attached else "new"
+
+            if record["request_hash"] != fingerprint:
+                raise IdempotencyConflictError()
+            if record["status"] == COMPLETED:
+                return record["response"], "attached" if attached else "replayed"
+
+            attached = True
+            future = self._running.get(record_id)
+            if future is not None:
+                try:
+                    return await asyncio.shield(future), "attached"
+                except asyncio.CancelledError:
+                    if future.cancelled():
+                        continue
+                    raise
+                except Exception:
+                    # 先行の処理が失敗した（キーは解放済み）。取得し直して生成する
+                    continue
+
+            if record["lease_expires_at"] < datetime.now():
+                # 処理していたプロセスが落ちた
+                owner = await self._take_over(record_id)
+                if owner is not None:
+                    return await self._own(record_id, owner, compute), "attached"
+                continue
+
+            if time.monotonic() >= deadline:
+                raise IdempotencyTimeoutError()
+            await asyncio.sleep(settings.idempotency_poll_interval)
+
+    async def _insert(self, record_id: str, scope: str, fingerprint: str) -> Optional[str]:
+        now = datetime.now()
+        owner = uuid.uuid4().hex
+        try:
+            await self._require_collection().insert_one({
+                "_id": record_id,
+                "scope": scope,
+                "request_hash": fingerprint,
+                "status": IN_PROGRESS,
+                "owner": owner,
+                "lease_expires_at": now + timedelta(seconds=settings.idempotency_lock_timeout),
+                "response": None,
+                "created_at": now,
+                "completed_at": None,
+                "expires_at": now + timedelta(seconds=settings.idempotency_ttl_seconds),
+            })
+        except DuplicateKeyError:
+            return None
+        return owner
+
+    async def _take_over(self, record_id: str) -> Optional[str]:
+        now = datetime.now()
+        owner = uuid.uuid4().hex
+        record = await self._require_collection().find_one_and_update(
+            {"_id": record_id, "status": IN_PROGRESS, "lease_expires_at": {"$lt": now}},
+            {"$set": {"owner": owner, "lease_expires_at": now + timedelta(seconds=settings.idempotency_lock_timeout)}}
+        )
+        return owner if record is not None else None
+
+    async def _own(self, record_id: str, owner: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """キーを取得した処理をリクエストから切り離して実行し、その完了を待つ"""
+        future = asyncio.ensure_future(self._compute_and_store(record_id, owner, compute))
+        self._running[record_id] = future
+        future.add_done_callback(lambda _: self._running.pop(record_id, None))
+        return await asyncio.shield(future)
+
+    async def _extend_lease(self, record_id: str, owner: str) -> None:
+        """処理中であることを示すため、リースを延長し続ける"""
+        while True:
+            await asyncio.sleep(settings.idempotency_lock_timeout / 3)
+            try:
+                await self._require_collection().update_one(
+                    {"_id": record_id, "owner": owner},
+                    {"$set": {"lease_expires_at": datetime.now() + timedelta(seconds=settings.idempotency_lock_timeout)}}
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"冪等性キーのリースを延長できませんでした: {e}")
+
+    async def _compute_and_store(self, record_id: str, owner: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        collection = self._require_collection()
+        lease = asyncio.create_task(self._extend_lease(record_id, owner))
+        try:
+            result = await compute()
+        except BaseException:
+            # 失敗した結果は保存せず、次の再送で生成し直せるようにする
+            await asyncio.shield(collection.delete_one({"_id": record_id, "owner": owner}))
+            raise
+        finally:
+            lease.cancel()
+
+        now = datetime.now()
+        response = jsonable_encoder(result)
+        await collection.update_one(
+            {"_id": record_id, "owner": owner},
+            {"$set": {
+                "status": COMPLETED,
+                "response": response,
+                "lease_expires_at": now,
+                "completed_at": now,
+                "expires_at": now + timedelta(seconds=settings.idempotency_ttl_seconds),
+            }}
+        )
+        return result
+
+
+idempotency_store = IdempotencyStore()
+
+
+async def idempotent(
+    request: Request,
+    response: Response,
+    scope: str,
+    payload: Any,
+    compute: Callable[[], Awaitable[T]]
+) -> T:
+    """Idempotency-Key ヘッダーがあれば冪等に、無ければ切断で中止できるように実行"""
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if not key:
+        return await cancel_on_disconnect(request, compute(), scope)
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"{IDEMPOTENCY_HEADER} は{MAX_KEY_LENGTH}文字以内で指定してください")
+
+    try:
+        result, outcome = await idempotency_store.run(key, scope, payload, compute)
+    except IdempotencyConflictError:
+        metrics.idempotency_requests_total.inc(scope=scope, outcome="conflict")
+        raise HTTPException(
+            status_code=422,
+            detail=f"この {IDEMPOTENCY_HEADER} は内容の異なるリクエストで使われています"
+        )
+    except IdempotencyTimeoutError:
+        metrics.idempotency_requests_total.inc(scope=scope, outcome="timeout")
+        raise HTTPException(
+            status_code=409,
+            detail=f"同じ {IDEMPOTENCY_HEADER} のリクエストを処理中です",
+            headers={"Retry-After": str(int(settings.idempotency_poll_interval) + 1)}
+        )
+
+    metrics.idempotency_requests_total.inc(scope=scope, outcome=outcome)
+    if outcome != "new":
+        response.headers[REPLAYED_HEADER] = "true"
+    return result
@@ -0,0 +1,243 @@
+"""LLM呼び出しの優先度付きスケジューラー
+
+プロバイダーごとに同時に実行するLLM呼び出しを llm_max_concurrency 件に制限し、
+空きを待つ呼び出しを次のレーンに分けて並べる。
+
+- interactive: 画面操作に応答する呼び出し（コメント1件の生成、接続テストなど）
+- batch: 複数キャラクターのジャーナル一括生成など
+- background: ヘルスチェックなど、遅れても困らない呼び出し
+
+空いた枠は重み付き公平キューイング（llm_lane_weights）で割り当てる。各呼び出しに
+「前回の同じレーンの呼び出し」と「現在の仮想時刻」の大きい方に 1/重み を足した
+仮想終了時刻を付け、小さいものから実行する。重みの比率で枠を分け合うため、
+一括生成が溜まっていても対話的な呼び出しはすぐに実行され、かつ一括生成も止まらない。
+
+レーンごとの待ち件数が llm_lane_max_depth を超えた呼び出しは待たせずに
+SchedulerOverloadedError で断る（API は 503 と Retry-After を返す）。
+
+呼び出しのレーンは llm_lane() で囲んだ範囲（コンテキスト変数）で決まり、
+指定が無ければ interactive になる。
+
+ストリーミングの呼び出しは、呼び出し元がチャンクを読んでいる間も接続を開いたままに
+するため、最後まで読み終わるか閉じるまで枠を持ち続ける（読むのが遅い呼び出し元は
+そのぶん枠を使う）。一方、Retry-After の見積もりに使う1件あたりの所要時間には、
+呼び出し元に制御を返している時間（SlotUsage.idle()）を含めない。
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from app.core import deadline, metrics
+from app.core.config import settings
+from app.core.deadline import DeadlineExceeded
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+BACKGROUND = "background"
+LANES = (INTERACTIVE, BATCH, BACKGROUND)
+
+# 実行時間の実績が無いうちに Retry-After の見積もりに使う1呼び出しの秒数
+INITIAL_SERVICE_TIME = 10.0
+# 実行時間の指数移動平均の重み
+SERVICE_TIME_SMOOTHING = 0.2
+
+_lane: ContextVar[str] = ContextVar("llm_lane", default=INTERACTIVE)
+
+
+def current_lane() -> str:
+    return _lane.get()
+
+
+@contextmanager
+def llm_lane(lane: str) -> Iterator[None]:
+    """この範囲（とここから作ったタスク）のLLM呼び出しのレーンを指定"""
+    if lane not in LANES:
+        raise ValueError(f"Unknown LLM lane: {lane}")
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def _parse_lane_values(value: str, name: str) -> Dict[str, float]:
+    """"interactive:8,batch:2,background:1" 形式の設定を読む"""
+    values: Dict[str, float] = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        lane, _, number = item.partition(":")
+        lane = lane.strip()
+        if lane not in LANES:
+            raise ValueError(f"{name}: unknown lane '{lane}'")
+        values[lane] = float(number)
+    missing = [lane for lane in LANES if lane not in values]
+    if missing:
+        raise ValueError(f"{name}: missing lanes {', '.join(missing)}")
+    return values
+
+
+class SchedulerOverloadedError(Exception):
+    """レーンの待ち件数が上限を超えたため断った"""
+
+    def __init__(self, provider: str, lane: str, retry_after: int):
+        super().__init__(f"{provider} の {lane} レーンが混雑しています。{retry_after}秒後に再試行してください")
+        self.provider = provider
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class SlotUsage:
+    """実行枠を使っている時間の計測（idle() の範囲は含めない）"""
+
+    def __init__(self):
+        self._started = time.perf_counter()
+        self._idle = 0.0
+
+    @contextmanager
+    def idle(self) -> Iterator[None]:
+        """プロバイダーとのやり取りをしていない範囲（ストリームの yield など）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._idle += time.perf_counter() - started
+
+    @property
+    def busy_seconds(self) -> float:
+        return time.perf_counter() - self._started - self._idle
+
+
+class _ProviderQueue:
+    """1プロバイダーの実行枠と待ち行列"""
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.active = 0
+        # (仮想終了時刻, 登録順, レーン, 枠の割り当てを待つ Future)
+        self.waiting: List[Tuple[float, int, str, "asyncio.Future[None]"]] = []
+        self.depth: Dict[str, int] = {lane: 0 for lane in LANES}
+        self.virtual_time = 0.0
+        self.last_finish: Dict[str, float] = {lane: 0.0 for lane in LANES}
+        self.service_time = INITIAL_SERVICE_TIME
+        self.sequence = itertools.count()
+
+
+class LLMScheduler:
+    """プロバイダーごとの実行枠を、レーンの重みに従って割り当てる"""
+
+    def __init__(self):
+        self._queues: Dict[str, _ProviderQueue] = {}
+
+    @property
+    def weights(self) -> Dict[str, float]:
+        return _parse_lane_values(settings.llm_lane_weights, "llm_lane_weights")
+
+    @property
+    def max_depths(self) -> Dict[str, int]:
+        return {
+            lane: int(depth)
+            for lane, depth in _parse_lane_values(settings.llm_lane_max_depth, "llm_lane_max_depth").items()
+        }
+
+    def _queue(self, provider: str) -> _ProviderQueue:
+        queue = self._queues.get(provider)
+        if queue is None:
+            queue = self._queues[provider] = _ProviderQueue(provider)
+        return queue
+
+    def estimate_retry_after(self, lane: str, depth: int, service_time: Optional[float] = None) -> int:
+        """レーンに depth 件が待っているとき、捌けるまでのおおよその秒数
+
+        service_time を省略した場合は、このプロセスで実績のあるプロバイダーのうち
+        最も遅いものの1件あたりの所要時間を使う。
+        """
+        if service_time is None:
+            service_time = max((queue.service_time for queue in self._queues.values()), default=INITIAL_SERVICE_TIME)
+        capacity = max(settings.llm_max_concurrency, 1)
+        share = self.weights[lane] / sum(self.weights.values())
+        return max(1, math.ceil(depth * service_time / (capacity * share)))
+
+    def _retry_after(self, queue: _ProviderQueue, lane: str) -> int:
+        """待ち行列が捌けるまでのおおよその秒数"""
+        return self.estimate_retry_after(lane, queue.depth[lane], queue.service_time)
+
+    def _set_depth(self, queue: _ProviderQueue, lane: str, delta: int) -> None:
+        queue.depth[lane] += delta
+        metrics.llm_queue_depth.set(queue.depth[lane], provider=queue.provider, lane=lane)
+
+    def _dispatch(self, queue: _ProviderQueue) -> None:
+        """空いている枠を仮想終了時刻の小さい順に割り当てる"""
+        while queue.active < max(settings.llm_max_concurrency, 1) and queue.waiting:
+            finish, _, lane, future = heapq.heappop(queue.waiting)
+            if future.done():
+                # 待っている間に取り消された（待ち件数は取り消し時に減らしている）
+                continue
+            self._set_depth(queue, lane, -1)
+            queue.virtual_time = finish
+            queue.active += 1
+            future.set_result(None)
+
+    def _release(self, queue: _ProviderQueue) -> None:
+        queue.active -= 1
+        self._dispatch(queue)
+
+    @asynccontextmanager
+    async def slot(self, provider: str, lane: Optional[str] = None) -> AsyncIterator[SlotUsage]:
+        """プロバイダーの実行枠を得てから本体を実行する（枠を使った時間の計測を返す）"""
+        lane = lane or current_lane()
+        queue = self._queue(provider)
+        if queue.depth[lane] >= self.max_depths[lane]:
+            metrics.llm_requests_shed_total.inc(provider=provider, lane=lane)
+            raise SchedulerOverloadedError(provider, lane, self._retry_after(queue, lane))
+
+        finish = max(queue.virtual_time, queue.last_finish[lane]) + 1.0 / self.weights[lane]
+        queue.last_finish[lane] = finish
+        future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        heapq.heappush(queue.waiting, (finish, next(queue.sequence), lane, future))
+        self._set_depth(queue, lane, 1)
+        self._dispatch(queue)
+
+        enqueued = time.perf_counter()
+        try:
+            # リクエストの期限があれば、それまでしか待たない
+            await asyncio.wait_for(future, deadline.remaining())
+        except (asyncio.CancelledError, TimeoutError) as e:
+            if future.done() and not future.cancelled():
+                # 枠を割り当てられた直後に取り消された
+                self._release(queue)
+            else:
+                future.cancel()
+                self._set_depth(queue, lane, -1)
+            if isinstance(e, TimeoutError):
+                metrics.deadline_exceeded_total.inc(operation="llm.queue")
+                raise DeadlineExceeded("llm.queue") from e
+            raise
+        metrics.llm_queue_wait_seconds.observe(time.perf_counter() - enqueued, provider=provider, lane=lane)
+
+        usage = SlotUsage()
+        try:
+            yield usage
+        finally:
+            queue.service_time += SERVICE_TIME_SMOOTHING * (usage.busy_seconds - queue.service_time)
+            self._release(queue)
+
+    def snapshot(self) -> Dict[str, Dict[str, object]]:
+        """プロバイダーごとの実行中・待ち件数"""
+        return {
+            provider: {
+                "active": queue.active,
+                "capacity": settings.llm_max_concurrency,
+                "waiting": dict(queue.depth),
+                "service_time_seconds": round(queue.service_time, 3),
+            }
+            for provider, queue in self._queues.items()
+        }
+
+
+llm_scheduler = LLMScheduler()
@@ -0,0 +1,418 @@
+"""Prometheus形式のメトリクス
+
+外部ライブラリを使わない軽量な実装。カウンター・ゲージ・ヒストグラムを
+ラベルの組み合わせごとに保持し、/metrics でテキスト形式に書き出す。
+MongoDBのコマンド監視はドライバーのスレッドから呼ばれるため、
+値の更新はメトリクスごとのロックで保護する。
+
+HTTPサーバーを持たない生成ワーカーは serve() で /metrics だけを公開する。
+"""
+import asyncio
+import bisect
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import monitoring
+
+# レイテンシ用ヒストグラムの既定バケット（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# LLM呼び出し用（数秒〜数分かかる）
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+# MongoDBコマンド用
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """単調増加するカウンター"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def total(self) -> float:
+        """全ラベルの合計"""
+        with self._lock:
+            return sum(self._values.values())
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(Counter):
+    """増減する値"""
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """累積バケットのヒストグラム"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベル -> (バケットごとの件数（累積前）, 合計, 件数)
+        self._values: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, **labels: Any) -> int:
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """メトリクスの登録とテキスト形式への書き出し"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> Any:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+registry = MetricsRegistry()
+
+# ---- HTTP ----
+http_requests_total = registry.counter(
+    "http_requests_total", "HTTPリクエスト数", ("method", "route", "status")
+)
+http_request_duration_seconds = registry.histogram(
+    "http_request_duration_seconds", "HTTPリクエストの処理時間", ("method", "route")
+)
+http_requests_in_flight = registry.gauge(
+    "http_requests_in_flight", "処理中のHTTPリクエスト数", ("method",)
+)
+
+# ---- LLM ----
+llm_requests_total = registry.counter(
+    "llm_requests_total", "LLM呼び出し数", ("provider", "model", "operation", "status")
+)
+llm_request_duration_seconds = registry.histogram(
+    "llm_request_duration_seconds", "LLM呼び出しの所要時間", ("provider", "model", "operation"), LLM_BUCKETS
+)
+llm_time_to_first_token_seconds = registry.histogram(
+    "llm_time_to_first_token_seconds", "ストリーミング生成の最初のチャンクまでの時間", ("provider", "model"), LLM_BUCKETS
+)
+llm_tokens_total = registry.counter(
+    "llm_tokens_total", "プロバイダーが報告したトークン数", ("provider", "model", "type")
+)
+llm_requests_in_flight = registry.gauge(
+    "llm_requests_in_flight", "実行中のLLM呼び出し数", ("provider",)
+)
+llm_provider_errors_total = registry.counter(
+    "llm_provider_errors_total", "プロバイダーAPIのエラー数（http / request / unexpected）",
+    ("provider", "model", "operation", "error")
+)
+llm_route_attempts_total = registry.counter(
+    "llm_route_attempts_total", "ルーティングした候補ごとの結果（ok / failed / skipped_latency / skipped_cost）",
+    ("task", "provider", "model", "status")
+)
+llm_hedges_total = registry.counter(
+    "llm_hedges_total", "応答が遅いため次の候補にも送ったLLM呼び出し数（送った候補）", ("task", "provider", "model")
+)
+llm_hedged_requests_total = registry.counter(
+    "llm_hedged_requests_total", "ヘッジした呼び出しで先に成功した側（primary / backup）", ("task", "winner")
+)
+llm_queue_depth = registry.gauge(
+    "llm_queue_depth", "実行枠の空きを待っているLLM呼び出し数", ("provider", "lane")
+)
+llm_queue_wait_seconds = registry.histogram(
+    "llm_queue_wait_seconds", "LLM呼び出しが実行枠を得るまでの待ち時間", ("provider", "lane"), LLM_BUCKETS
+)
+llm_requests_shed_total = registry.counter(
+    "llm_requests_shed_total", "待ち件数の上限を超えて断ったLLM呼び出し数", ("provider", "lane")
+)
+ollama_load_duration_seconds = registry.histogram(
+    "ollama_load_duration_seconds", "Ollamaがモデルの読み込みに使った時間（load_duration）", ("model",), LLM_BUCKETS
+)
+ollama_prompt_eval_duration_seconds = registry.histogram(
+    "ollama_prompt_eval_duration_seconds", "Ollamaがプロンプトの評価に使った時間（prompt_eval_duration）", ("model",), LLM_BUCKETS
+)
+ollama_eval_duration_seconds = registry.histogram(
+    "ollama_eval_duration_seconds", "Ollamaが出力の生成に使った時間（eval_duration）", ("model",), LLM_BUCKETS
+)
+ollama_warmups_total = registry.counter(
+    "ollama_warmups_total", "Ollamaのモデルを事前に読み込んだ回数", ("model", "status")
+)
+
+# ---- MongoDB ----
+mongodb_command_duration_seconds = registry.histogram(
+    "mongodb_command_duration_seconds", "MongoDBコマンドの所要時間", ("command",), MONGO_BUCKETS
+)
+mongodb_commands_total = registry.counter(
+    "mongodb_commands_total", "MongoDBコマンド数", ("command", "status")
+)
+
+# ---- タスクキュー ----
+tasks_enqueued_total = registry.counter(
+    "tasks_enqueued_total", "登録したタスク数", ("type",)
+)
+tasks_total = registry.counter(
+    "tasks_total", "ワーカーが処理したタスク数", ("type", "status")
+)
+generations_cancelled_total = registry.counter(
+    "generations_cancelled_total", "取り消された（未完了のまま中止した）生成の件数", ("type",)
+)
+deadline_exceeded_total = registry.counter(
+    "deadline_exceeded_total", "X-Request-Deadline の期限を過ぎて中止した処理の数", ("operation",)
+)
+client_disconnects_total = registry.counter(
+    "client_disconnects_total", "処理中にクライアントが切断して中断したリクエスト数", ("operation",)
+)
+idempotency_requests_total = registry.counter(
+    "idempotency_requests_total", "冪等性キー付きのリクエスト数（new / replayed / attached / conflict / timeout）",
+    ("scope", "outcome")
+)
+task_queue_wait_seconds = registry.histogram(
+    "task_queue_wait_seconds", "タスクの登録からワーカーが取得するまでの時間", ("type",), LLM_BUCKETS
+)
+task_duration_seconds = registry.histogram(
+    "task_duration_seconds", "ワーカーでのタスクの実行時間", ("type",), LLM_BUCKETS
+)
+
+# ---- リアルタイム配信 ----
+live_subscribers = registry.gauge(
+    "live_subscribers", "リアルタイム配信の購読者数"
+)
+live_events_total = registry.counter(
+    "live_events_total", "発行した差分イベント数", ("type",)
+)
+live_events_dropped_total = registry.counter(
+    "live_events_dropped_total", "送信待ちが上限を超えて捨てたイベント数"
+)
+
+# ---- 派生インデックス ----
+index_events_total = registry.counter(
+    "index_events_total", "派生インデックスの変更イベント数（published: 記録 / applied: 他のプロセスから反映）",
+    ("direction",)
+)
+
+
+def record_llm_usage(provider: str, model: str, input_tokens: Optional[int], output_tokens: Optional[int]) -> None:
+    """プロバイダーの usage フィールドから得たトークン数を記録"""
+    if input_tokens:
+        llm_tokens_total.inc(input_tokens, provider=provider, model=model, type="input")
+    if output_tokens:
+        llm_tokens_total.inc(output_tokens, provider=provider, model=model, type="output")
+
+
+def record_ollama_durations(model: str, result: Dict[str, Any]) -> None:
+    """Ollamaの応答（最後のチャンク）が報告した所要時間（ナノ秒）を記録"""
+    for field, histogram in (
+        ("load_duration", ollama_load_duration_seconds),
+        ("prompt_eval_duration", ollama_prompt_eval_duration_seconds),
+        ("eval_duration", ollama_eval_duration_seconds),
+    ):
+        if result.get(field) is not None:
+            histogram.observe(result[field] / 1_000_000_000, model=model)
+
+
+async def _handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5.0)
+        # ヘッダーは読み捨てる
+        while (await asyncio.wait_for(reader.readline(), timeout=5.0)).strip():
+            pass
+        method, path, *_ = request_line.decode("latin-1").split() + ["", ""]
+        if method == "GET" and path.split("?", 1)[0] == "/metrics":
+            status, content_type, body = "200 OK", CONTENT_TYPE, registry.render().encode("utf-8")
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> asyncio.AbstractServer:
+    """GET /metrics に応答する最小限のHTTPサーバーを開始（生成ワーカー用）"""
+    return await asyncio.start_server(_handle_scrape, host, port)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """MongoDBのコマンド監視イベントから所要時間を記録"""
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        mongodb_command_duration_seconds.observe(event.duration_micros / 1_000_000, command=event.command_name)
+        mongodb_commands_total.inc(command=event.command_name, status="ok")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        mongodb_command_duration_seconds.observe(event.duration_micros / 1_000_000, command=event.command_name)
+        mongodb_commands_total.inc(command=event.command_name, status="error")
+
+
+_route_paths: Dict[int, Dict[Any, str]] = {}
+
+
+def route_template(scope) -> str:
+    """ASGIスコープから、マッチしたルートのパステンプレートを取得"""
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    app = scope["app"]
+    paths = _route_paths.get(id(app))
+    if paths is None:
+        paths = {}
+        for route in app.routes:
+            route_endpoint = getattr(route, "endpoint", None)
+            if route_endpoint is not None and route_endpoint not in paths:
+                paths[route_endpoint] = route.path
+        _route_paths[id(app)] = paths
+    return paths.get(endpoint, "unmatched")
+
+
+class MetricsMiddleware:
+    """ルートごとのレイテンシと処理中リクエスト数を記録するASGIミドルウェア
+
+    ラベルにはURLではなくルートのパステンプレート（/api/characters/{character_id}）を
+    使い、ラベルの組み合わせが増え続けないようにする。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc(method=method)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec(method=method)
+            route = route_template(scope)
+            http_request_duration_seconds.observe(time.perf_counter() - start, method=method, route=route)
+            http_requests_total.inc(method=method, route=route, status=str(status_code))
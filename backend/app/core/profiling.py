@@ -0,0 +1,257 @@
+"""リクエスト単位のサンプリングプロファイラー
+
+管理者トークン付きの X-Profile ヘッダー、または profiling_routes に指定した
+ルートへのリクエストを、サンプリングプロファイラーの下で実行する。
+別スレッドから一定間隔でイベントループのスレッドのスタックを取得し、
+flamegraph.pl / speedscope で読める folded 形式（"a;b;c 回数"）で集計する。
+
+ASGIアプリの呼び出しはレスポンス本文を送り終えるまで戻らないため、
+StreamingResponse の本文生成も計測範囲に含まれる。同期イテレーターの本文や
+同期エンドポイント、Motorの処理はワーカースレッドで実行されるため、
+待機中でないワーカースレッドのスタックもスレッド名を先頭に付けて記録する。
+プロファイルはレスポンスヘッダー X-Profile-Id のIDで /api/profiles から取得する。
+
+注: サンプリングはイベントループのスレッド単位なので、計測中に並行して
+処理された他のリクエストのスタックも含まれる（concurrent_requests を参照）。
+"""
+import asyncio
+import logging
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from starlette.routing import Match
+
+from app.core.admin import is_admin_token
+from app.core.config import settings
+from app.core.metrics import http_requests_in_flight, route_template
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-profile"
+ADMIN_TOKEN_HEADER = b"x-admin-token"
+
+# 1スタックに記録するフレーム数の上限
+MAX_STACK_DEPTH = 128
+
+# ワーカースレッドが待機中であることを示す最も内側のフレーム（記録しない）
+IDLE_FRAMES = {
+    "threading.Condition.wait",
+    "threading.Event.wait",
+    "queue.Queue.get",
+    "thread._worker",
+    "selectors.EpollSelector.select",
+    "selectors.KqueueSelector.select",
+    "selectors.SelectSelector.select",
+}
+
+
+class ProfileSession:
+    """1リクエスト分のサンプル"""
+
+    def __init__(self, thread_id: int, method: str, path: str, trigger: str):
+        self.id = secrets.token_hex(8)
+        self.thread_id = thread_id
+        self.method = method
+        self.path = path
+        self.route: Optional[str] = None
+        self.trigger = trigger
+        self.status_code: Optional[int] = None
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.duration_ms = 0.0
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self.concurrent_requests = 0
+
+    def folded(self) -> str:
+        """flamegraph互換の folded 形式"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "trigger": self.trigger,
+            "status_code": self.status_code,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 3),
+            "interval_ms": settings.profiling_interval_ms,
+            "sample_count": self.sample_count,
+            "concurrent_requests": self.concurrent_requests,
+        }
+
+
+class SamplingProfiler:
+    """計測中のセッションがある間だけ動くサンプリングスレッド"""
+
+    def __init__(self):
+        self._sessions: List[ProfileSession] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._names: Dict[Any, str] = {}
+
+    def start(self, session: ProfileSession) -> None:
+        with self._lock:
+            self._sessions.append(session)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def stop(self, session: ProfileSession) -> None:
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+        session.duration_ms = (time.perf_counter() - session.start) * 1000
+
+    def _frame_name(self, code) -> str:
+        name = self._names.get(code)
+        if name is None:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            name = self._names[code] = f"{module}.{getattr(code, 'co_qualname', code.co_name)}"
+        return name
+
+    def _stack(self, frame) -> List[str]:
+        names: List[str] = []
+        while frame is not None and len(names) < MAX_STACK_DEPTH:
+            names.append(self._frame_name(frame.f_code))
+            frame = frame.f_back
+        names.reverse()
+        return names
+
+    def _sample(self) -> Dict[int, str]:
+        """スレッドごとの folded スタック（待機中のワーカースレッドと自身は除く）"""
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        stacks: Dict[int, str] = {}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            names = self._stack(frame)
+            if thread_id not in self._loop_threads and names and names[-1] in IDLE_FRAMES:
+                continue
+            thread_name = thread_names.get(thread_id, str(thread_id)).replace(" ", "_").replace(";", "_")
+            stacks[thread_id] = ";".join([thread_name, *names])
+        return stacks
+
+    @property
+    def _loop_threads(self) -> set:
+        return {session.thread_id for session in self._sessions}
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                sessions = list(self._sessions)
+            if not sessions:
+                self._wake.clear()
+                self._wake.wait()
+                continue
+
+            time.sleep(settings.profiling_interval_ms / 1000)
+            stacks = self._sample()
+            for session in sessions:
+                for thread_id, stack in stacks.items():
+                    # 他のイベントループのスレッドは別セッションのもの
+                    if thread_id != session.thread_id and thread_id in self._loop_threads:
+                        continue
+                    session.samples[stack] += 1
+                session.sample_count += 1
+
+
+class ProfileStore:
+    """完了したプロファイルを新しいものから一定数保持（profiling_dir があればファイルにも保存）"""
+
+    def __init__(self):
+        self._profiles: "OrderedDict[str, ProfileSession]" = OrderedDict()
+
+    async def add(self, session: ProfileSession) -> None:
+        self._profiles[session.id] = session
+        while len(self._profiles) > settings.profiling_max_stored:
+            self._profiles.popitem(last=False)
+        if settings.profiling_dir:
+            # ファイルへの書き出しはイベントループを止めないようワーカースレッドで行う
+            try:
+                await asyncio.to_thread(self._write, settings.profiling_dir, session)
+            except OSError as e:
+                logger.warning(f"プロファイルをファイルに保存できませんでした（{session.id}）: {e}")
+
+    @staticmethod
+    def _write(directory: str, session: ProfileSession) -> None:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{session.started_at:%Y%m%d-%H%M%S}-{session.id}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(session.folded())
+
+    def get(self, profile_id: str) -> Optional[ProfileSession]:
+        return self._profiles.get(profile_id)
+
+    def list(self) -> List[ProfileSession]:
+        return list(reversed(self._profiles.values()))
+
+
+profiler = SamplingProfiler()
+profile_store = ProfileStore()
+
+
+def _profiled_routes() -> List[str]:
+    return [route.strip() for route in settings.profiling_routes.split(",") if route.strip()]
+
+
+def _matches_profiled_route(scope) -> bool:
+    routes = _profiled_routes()
+    if not routes:
+        return False
+    for route in scope["app"].routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path in routes
+    return False
+
+
+class ProfilingMiddleware:
+    """プロファイル対象のリクエストをサンプリングプロファイラーの下で実行するASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def _trigger(self, scope) -> Optional[str]:
+        headers = dict(scope.get("headers") or [])
+        if headers.get(PROFILE_HEADER, b"").lower() in (b"1", b"true", b"on"):
+            token = headers.get(ADMIN_TOKEN_HEADER, b"").decode("latin-1")
+            return "header" if is_admin_token(token) else None
+        if _matches_profiled_route(scope) and random.random() < settings.profiling_route_sample_rate:
+            return "route"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        trigger = self._trigger(scope) if scope["type"] == "http" else None
+        if trigger is None:
+            await self.app(scope, receive, send)
+            return
+
+        session = ProfileSession(threading.get_ident(), scope["method"], scope["path"], trigger)
+        session.concurrent_requests = int(http_requests_in_flight.total())
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                session.status_code = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", session.id.encode())]
+            await send(message)
+
+        profiler.start(session)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.stop(session)
+            session.route = route_template(scope)
+            await profile_store.add(session)
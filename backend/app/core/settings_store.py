@@ -0,0 +1,231 @@
+"""AIプロバイダー設定のストア
+
+プロバイダー設定は MongoDB の1ドキュメント（バージョン番号付き）に保存する。
+環境変数・.env の値は初期値として使い、保存された値がそれを上書きする。
+
+- 書き込みは find_one_and_update による1回の原子的な更新で、バージョンを
+  1つ進める。expected_version を指定すると楽観的排他制御になる。
+- 各ワーカーは change stream（使えない場合はポーリング）で変更を受け取り、
+  手元のスナップショットを差し替える。再起動は不要。
+- スナップショットは変更不可で、リクエストの開始時に固定される
+  （SettingsSnapshotMiddleware）。処理の途中で設定が変わっても、
+  1リクエストの中では同じ設定が使われる。
+
+タスク種別ごとのモデルのルーティング（llm_routing）も同じドキュメントに保存する。
+"""
+import asyncio
+import contextvars
+import logging
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel, Field
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from app.core.config import AIProvider, GenerationTask, settings
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_COLLECTION = "settings"
+PROVIDER_SETTINGS_ID = "ai_provider"
+
+
+class RouteTarget(BaseModel):
+    """ルートの候補（model を省略するとそのプロバイダーに設定したモデル）"""
+    provider: AIProvider
+    model: Optional[str] = None
+
+    class Config:
+        frozen = True
+
+
+class TaskRoute(BaseModel):
+    """1つのタスク種別のルート
+
+    targets を先頭から順に試し、失敗したら次の候補にフォールバックする。
+    直近の応答時間（p95）が latency_budget_ms を超える候補と、見積もった料金が
+    cost_budget_usd を超える候補は飛ばす（全て飛ばす場合は予算を無視して順に試す）。
+    hedge を有効にすると、応答の遅い候補を待つ間に次の候補にも送る。
+    """
+    targets: Tuple[RouteTarget, ...] = Field(..., min_length=1)
+    latency_budget_ms: Optional[float] = Field(None, gt=0)
+    cost_budget_usd: Optional[float] = Field(None, ge=0)
+    hedge: bool = False
+
+    class Config:
+        frozen = True
+
+
+class ProviderSettings(BaseModel):
+    """AIプロバイダー設定のスナップショット（変更不可）"""
+    version: int = 0
+    ai_provider: AIProvider
+    ollama_api_url: str
+    ollama_model: str
+    openai_api_key: Optional[str] = Field(None, repr=False)
+    openai_model: str
+    openai_base_url: Optional[str] = None
+    anthropic_api_key: Optional[str] = Field(None, repr=False)
+    anthropic_model: str
+    anthropic_base_url: Optional[str] = None
+    google_api_key: Optional[str] = Field(None, repr=False)
+    google_model: str
+    google_base_url: Optional[str] = None
+    # ルートの無いタスク種別は ai_provider の設定で呼び出す
+    llm_routing: Dict[GenerationTask, TaskRoute] = {}
+
+    class Config:
+        frozen = True
+
+    @classmethod
+    def fields(cls) -> List[str]:
+        return [name for name in cls.model_fields if name != "version"]
+
+    @classmethod
+    def from_env(cls) -> "ProviderSettings":
+        """環境変数・.env の値（バージョン0）"""
+        return cls(**{name: getattr(settings, name) for name in cls.fields()})
+
+
+class SettingsConflictError(Exception):
+    """expected_version が保存済みのバージョンと一致しない"""
+
+
+Listener = Callable[[ProviderSettings, ProviderSettings], Optional[Awaitable[None]]]
+
+_request_snapshot: contextvars.ContextVar[Optional[ProviderSettings]] = contextvars.ContextVar(
+    "provider_settings", default=None
+)
+
+
+class SettingsStore:
+    """MongoDB に保存したプロバイダー設定と、その最新のスナップショット"""
+
+    def __init__(self):
+        self._current = ProviderSettings.from_env()
+        self._collection = None
+        self._watcher: Optional[asyncio.Task] = None
+        self._listeners: List[Listener] = []
+
+    @property
+    def current(self) -> ProviderSettings:
+        """このワーカーが知っている最新の設定"""
+        return self._current
+
+    def add_listener(self, listener: Listener) -> None:
+        """設定が変わったときに (旧, 新) で呼ばれる関数を登録"""
+        self._listeners.append(listener)
+
+    async def start(self, db) -> None:
+        """保存済みの設定を読み込み、変更の監視を始める"""
+        self._collection = db[SETTINGS_COLLECTION]
+        try:
+            self._apply(await self._collection.find_one({"_id": PROVIDER_SETTINGS_ID}))
+        except Exception as e:
+            logger.warning(f"保存済みのプロバイダー設定を読み込めませんでした: {e}")
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+
+    async def update(self, changes: Dict[str, Any], expected_version: Optional[int] = None) -> ProviderSettings:
+        """設定を原子的に更新して新しいスナップショットを返す"""
+        if self._collection is None:
+            raise RuntimeError("設定ストアが開始されていません")
+        unknown = set(changes) - set(ProviderSettings.fields())
+        if unknown:
+            raise ValueError(f"不明な設定項目です: {', '.join(sorted(unknown))}")
+        # 値を検証してから書き込む
+        ProviderSettings(**{**self._current.dict(), **changes})
+
+        query: Dict[str, Any] = {"_id": PROVIDER_SETTINGS_ID}
+        if expected_version is not None:
+            query["version"] = expected_version
+        try:
+            document = await self._collection.find_one_and_update(
+                query,
+                {
+                    "$set": {**{f"values.{key}": value for key, value in changes.items()}, "updated_at": datetime.now()},
+                    "$inc": {"version": 1},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # バージョンが一致せず、同じ _id で新規作成しようとした
+            raise SettingsConflictError(
+                f"設定は他の更新によって変更されています（現在のバージョン: {self._current.version}）"
+            )
+        self._apply(document)
+        return self._current
+
+    def _apply(self, document: Optional[Dict[str, Any]]) -> None:
+        """保存済みのドキュメントが手元より新しければスナップショットを差し替える"""
+        if not document or document.get("version", 0) <= self._current.version:
+            return
+        previous = self._current
+        values = {**ProviderSettings.from_env().dict(), **document.get("values", {})}
+        self._current = ProviderSettings(**{**values, "version": document["version"]})
+        logger.info(f"プロバイダー設定をバージョン {self._current.version} に更新しました")
+        for listener in self._listeners:
+            try:
+                result = listener(previous, self._current)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception as e:
+                logger.warning(f"設定変更の通知に失敗しました: {e}")
+
+    async def _watch(self) -> None:
+        """change stream で変更を受け取る（レプリカセットでない場合はポーリング）"""
+        pipeline = [{"$match": {"documentKey._id": PROVIDER_SETTINGS_ID}}]
+        try:
+            async with self._collection.watch(pipeline, full_document="updateLookup") as stream:
+                logger.info("プロバイダー設定の変更を change stream で監視します")
+                async for change in stream:
+                    self._apply(change.get("fullDocument"))
+        except asyncio.CancelledError:
+            raise
+        except (OperationFailure, NotImplementedError, AttributeError) as e:
+            logger.info(f"change stream を使えないため、プロバイダー設定をポーリングします: {e}")
+        except Exception as e:
+            logger.warning(f"change stream が停止したため、ポーリングに切り替えます: {e}")
+        await self._poll()
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(settings.provider_settings_poll_interval)
+            try:
+                self._apply(await self._collection.find_one({"_id": PROVIDER_SETTINGS_ID}))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"プロバイダー設定の取得に失敗しました: {e}")
+
+
+settings_store = SettingsStore()
+
+
+def provider_settings() -> ProviderSettings:
+    """現在のリクエストのスナップショット（リクエスト外では最新の設定）"""
+    return _request_snapshot.get() or settings_store.current
+
+
+class SettingsSnapshotMiddleware:
+    """リクエストの開始時にプロバイダー設定のスナップショットを固定するASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = _request_snapshot.set(settings_store.current)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_snapshot.reset(token)
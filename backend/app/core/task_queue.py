@@ -0,0 +1,566 @@
+"""MongoDB のタスクキュー
+
+ジャーナル・コメントの生成は generation_mode に応じて次のどちらかで実行する。
+
+- local: API プロセス内でそのまま実行する（開発用の1プロセス構成）
+- queue: API はタスクを generation_tasks コレクションに登録して結果を待つだけにし、
+  専用のワーカープロセス（backend/worker.py）が取り出して実行する。
+  API プロセスは状態を持たないため、生成のスケールはワーカーを増やすだけでよい。
+
+ワーカーは find_one_and_update でタスクを原子的に取得し、リース
+（lease_owner / lease_expires_at）を得る。実行中はハートビートでリースを延長し、
+ワーカーが落ちてハートビートが途絶えると、task_visibility_timeout 秒後に
+他のワーカーが同じタスクを取り直す。失敗したタスクは task_max_attempts 回まで、
+待ち時間を倍にしながら再試行する。LookupError（対象が見つからない）は再試行しない。
+
+タスクには登録時の LLM レーン（llm_scheduler）を記録し、ワーカーは interactive の
+タスクを batch・background より先に取得する。ワーカー内の LLM 呼び出しも同じ
+レーンで実行する。レーンの待機中のタスクが llm_lane_max_depth を超える場合は
+登録せずに SchedulerOverloadedError で断る（API は 503 と Retry-After を返す）。
+ワーカー内で実行枠が混雑していた場合は、試行回数に数えずに Retry-After 後に
+待機中に戻す。
+
+リクエストに期限（X-Request-Deadline）があれば、タスクにも deadline として記録する。
+ワーカーは期限を過ぎたタスクを実行せずに失敗にし、実行中は同じ期限を DB・LLM
+呼び出しに伝える。期限切れは再試行しない。
+
+待っていたクライアントが切断した場合は、未着手のタスクを取り消し、実行中の
+タスクには中断を要求する（ワーカーは次のハートビートで気付いて処理を止める）。
+
+保存の後・complete() の前にワーカーが落ちたりリースを失ったりすると、同じタスクが
+再実行される。ハンドラーは current_task_id() を保存するドキュメントに記録し、
+すでに保存済みなら同じ結果を返すようにする（generation を参照）。
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+
+from app.core import deadline as request_deadline
+from app.core import metrics
+from app.core.config import settings
+from app.core.deadline import DeadlineExceeded
+from app.core.llm_scheduler import LANES, SchedulerOverloadedError, current_lane, llm_lane, llm_scheduler
+from app.core.tracing import current_trace_id
+
+logger = logging.getLogger(__name__)
+
+TASKS_COLLECTION = "generation_tasks"
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# 登録時に混雑で断った場合の llm_requests_shed_total の provider ラベル
+QUEUE_SHED_PROVIDER = "task_queue"
+
+# 結果待ちのポーリング間隔の初期値（task_poll_interval まで倍にしていく）
+WAIT_INITIAL_INTERVAL = 0.05
+
+Handler = Callable[[Dict[str, Any]], Awaitable[Any]]
+ResultCallback = Callable[[Any], None]
+
+_task_id: ContextVar[Optional[str]] = ContextVar("task_id", default=None)
+
+
+def current_task_id() -> Optional[str]:
+    """ワーカーで実行中のタスクの ID（local で実行している場合は None）"""
+    return _task_id.get()
+
+
+class TaskFailedError(Exception):
+    """タスクが再試行の上限まで失敗した"""
+
+    def __init__(self, message: str, task_id: Optional[str] = None):
+        super().__init__(message)
+        self.task_id = task_id
+
+
+class TaskTimeoutError(Exception):
+    """待ち時間内にタスクが完了しなかった（タスク自体は続行している）"""
+
+    def __init__(self, message: str, task_id: Optional[str] = None):
+        super().__init__(message)
+        self.task_id = task_id
+
+
+def _error_message(error: BaseException) -> str:
+    # KeyError などは str() が引用符付きになるため args を優先する
+    if error.args and isinstance(error.args[0], str):
+        return error.args[0]
+    return str(error) or type(error).__name__
+
+
+def _error_type(error: BaseException) -> str:
+    if isinstance(error, DeadlineExceeded):
+        return "deadline_exceeded"
+    # 再試行しない失敗のうち、対象が見つからないものだけ API で 404 にする
+    return "not_found" if isinstance(error, LookupError) else "error"
+
+
+class TaskQueue:
+    """タスクの登録・取得・リース管理と、ハンドラーの登録"""
+
+    def __init__(self):
+        self._collection = None
+        self._handlers: Dict[str, Handler] = {}
+
+    def register(self, task_type: str, handler: Handler) -> None:
+        """タスクの種類ごとに、payload を受け取って結果を返す関数を登録"""
+        self._handlers[task_type] = handler
+
+    def handler(self, task_type: str) -> Handler:
+        if task_type not in self._handlers:
+            raise LookupError(f"不明なタスクの種類です: {task_type}")
+        return self._handlers[task_type]
+
+    @property
+    def task_types(self) -> List[str]:
+        return list(self._handlers)
+
+    async def start(self, db) -> None:
+        """コレクションとインデックスを準備"""
+        self._collection = db[TASKS_COLLECTION]
+        try:
+            await self._collection.create_index([("status", ASCENDING), ("available_at", ASCENDING)])
+            await self._collection.create_index([("status", ASCENDING), ("priority", ASCENDING), ("created_at", ASCENDING)])
+            await self._collection.create_index([("status", ASCENDING), ("lease_expires_at", ASCENDING)])
+            # 完了したタスクは一定時間後に自動で削除
+            await self._collection.create_index(
+                "finished_at", expireAfterSeconds=settings.task_retention_seconds
+            )
+        except Exception as e:
+            logger.warning(f"タスクキューのインデックスを作成できませんでした: {e}")
+
+    def _require_collection(self):
+        if self._collection is None:
+            raise RuntimeError("タスクキューが開始されていません")
+        return self._collection
+
+    # ---- API側 ----
+
+    async def submit(
+        self,
+        task_type: str,
+        payload: Dict[str, Any],
+        on_result: Optional[ResultCallback] = None
+    ) -> Any:
+        """generation_mode に従って1件実行し、結果を返す"""
+        return (await self.submit_many(task_type, [payload], on_result))[0]
+
+    async def submit_many(
+        self,
+        task_type: str,
+        payloads: List[Dict[str, Any]],
+        on_result: Optional[ResultCallback] = None
+    ) -> List[Any]:
+        """複数件を実行して結果を同じ順序で返す
+
+        local では順番に実行し、queue ではまとめて登録して各ワーカーに並行して処理させる。
+        on_result は1件終わるごとに呼ばれるため、途中で取り消されても
+        それまでに保存された結果を反映できる。取り消された場合は残りの処理を中止する。
+        """
+        handler = self.handler(task_type)
+        results: List[Any] = []
+
+        if settings.generation_mode == "local":
+            try:
+                for payload in payloads:
+                    result = await handler(payload)
+                    if on_result is not None:
+                        on_result(result)
+                    results.append(result)
+            except asyncio.CancelledError:
+                metrics.generations_cancelled_total.inc(len(payloads) - len(results), type=task_type)
+                raise
+            return results
+
+        task_ids = await self.enqueue_many(task_type, payloads)
+
+        async def wait_one(task_id: str) -> Any:
+            result = await self.wait(task_id)
+            if on_result is not None:
+                on_result(result)
+            return result
+
+        waits = [asyncio.ensure_future(wait_one(task_id)) for task_id in task_ids]
+        try:
+            return list(await asyncio.gather(*waits))
+        except asyncio.CancelledError:
+            unfinished = [task_id for task_id, wait in zip(task_ids, waits) if not wait.done() or wait.cancelled()]
+            cancelled = await asyncio.shield(self.cancel(unfinished))
+            metrics.generations_cancelled_total.inc(cancelled, type=task_type)
+            raise
+        except BaseException:
+            for wait in waits:
+                wait.cancel()
+            raise
+
+    async def enqueue(self, task_type: str, payload: Dict[str, Any]) -> str:
+        return (await self.enqueue_many(task_type, [payload]))[0]
+
+    async def enqueue_many(self, task_type: str, payloads: List[Dict[str, Any]]) -> List[str]:
+        """タスクを登録して ID を返す"""
+        if not payloads:
+            return []
+        lane = current_lane()
+        await self._admit(lane, len(payloads))
+        now = datetime.now()
+        trace_id = current_trace_id()
+        documents = [
+            {
+                "type": task_type,
+                "payload": payload,
+                "lane": lane,
+                "priority": LANES.index(lane),
+                "deadline": request_deadline.current_deadline(),
+                "status": QUEUED,
+                "attempts": 0,
+                "max_attempts": settings.task_max_attempts,
+                "available_at": now,
+                "lease_owner": None,
+                "lease_expires_at": None,
+                "heartbeat_at": None,
+                "result": None,
+                "error": None,
+                "trace_id": trace_id,
+                "created_at": now,
+                "updated_at": now,
+                "finished_at": None,
+            }
+            for payload in payloads
+        ]
+        result = await self._require_collection().insert_many(documents)
+        metrics.tasks_enqueued_total.inc(len(payloads), type=task_type)
+        return [str(task_id) for task_id in result.inserted_ids]
+
+    async def _admit(self, lane: str, count: int) -> None:
+        """レーンの待機中のタスクが llm_lane_max_depth を超える場合は登録せずに断る
+
+        数えてから登録するまでの間に他のプロセスも登録できるため、上限は目安になる。
+        待機中のタスクが無いレーンには、上限より多い一括生成でも登録できる。
+        """
+        queued = await self._require_collection().count_documents(
+            {"status": QUEUED, "priority": LANES.index(lane)}
+        )
+        if queued and queued + count > llm_scheduler.max_depths[lane]:
+            metrics.llm_requests_shed_total.inc(count, provider=QUEUE_SHED_PROVIDER, lane=lane)
+            raise SchedulerOverloadedError(QUEUE_SHED_PROVIDER, lane, llm_scheduler.estimate_retry_after(lane, queued))
+
+    async def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        if not ObjectId.is_valid(task_id):
+            return None
+        return await self._require_collection().find_one({"_id": ObjectId(task_id)})
+
+    async def wait(self, task_id: str, timeout: Optional[float] = None) -> Any:
+        """タスクの完了を待って結果を返す（失敗した場合は例外）
+
+        レプリカセットでなくても動くように、間隔を広げながらポーリングする。
+        """
+        timeout = settings.task_wait_timeout if timeout is None else timeout
+        timeout = request_deadline.clamp(timeout)
+        deadline = time.monotonic() + timeout
+        interval = WAIT_INITIAL_INTERVAL
+        projection = {"status": 1, "result": 1, "error": 1}
+        while True:
+            task = await self._require_collection().find_one({"_id": ObjectId(task_id)}, projection)
+            if task is None:
+                raise TaskFailedError("タスクが見つかりません", task_id)
+            if task["status"] == SUCCEEDED:
+                return task["result"]
+            if task["status"] == CANCELLED:
+                raise TaskFailedError("タスクは取り消されました", task_id)
+            if task["status"] == FAILED:
+                error = task.get("error") or {}
+                if error.get("type") == "not_found":
+                    raise LookupError(error.get("message", ""))
+                if error.get("type") == "deadline_exceeded":
+                    raise DeadlineExceeded("task")
+                raise TaskFailedError(error.get("message", "タスクが失敗しました"), task_id)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                request_deadline.check("task")
+                raise TaskTimeoutError(f"タスク {task_id} が {timeout}秒以内に完了しませんでした", task_id)
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * 2, settings.task_poll_interval)
+
+    async def counts(self) -> Dict[str, int]:
+        """状態ごとのタスク数"""
+        counts = {status: 0 for status in (QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED)}
+        async for row in self._require_collection().aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+            counts[row["_id"]] = row["count"]
+        return counts
+
+    async def cancel(self, task_ids: List[str]) -> int:
+        """未着手のタスクを取り消し、実行中のタスクには中断を要求する（対象になった件数を返す）"""
+        if not task_ids:
+            return 0
+        now = datetime.now()
+        ids = [ObjectId(task_id) for task_id in task_ids]
+        collection = self._require_collection()
+        try:
+            queued = await collection.update_many(
+                {"_id": {"$in": ids}, "status": QUEUED},
+                {"$set": {"status": CANCELLED, "updated_at": now, "finished_at": now}}
+            )
+            running = await collection.update_many(
+                {"_id": {"$in": ids}, "status": RUNNING},
+                {"$set": {"cancel_requested": True, "updated_at": now}}
+            )
+        except Exception as e:
+            logger.warning(f"タスクを取り消せませんでした: {e}")
+            return 0
+        return queued.modified_count + running.modified_count
+
+    # ---- ワーカー側 ----
+
+    async def claim(self, worker_id: str, task_types: List[str]) -> Optional[Dict[str, Any]]:
+        """実行可能なタスクを1件取得してリースを得る
+
+        待機中のタスクと、リースの期限が切れた（ワーカーが落ちた）実行中のタスクが対象。
+        優先度（レーン）の高いものから、同じ優先度では古いものから取得する。
+        """
+        now = datetime.now()
+        return await self._require_collection().find_one_and_update(
+            {
+                "type": {"$in": task_types},
+                "$or": [
+                    {"status": QUEUED, "available_at": {"$lte": now}},
+                    {"status": RUNNING, "lease_expires_at": {"$lt": now}},
+                ],
+            },
+            {
+                "$set": {
+                    "status": RUNNING,
+                    "lease_owner": worker_id,
+                    "lease_expires_at": now + timedelta(seconds=settings.task_visibility_timeout),
+                    "heartbeat_at": now,
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("priority", ASCENDING), ("created_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _leased(self, task: Dict[str, Any], worker_id: str) -> Dict[str, Any]:
+        """このワーカーがリースを持っている場合だけ一致する条件"""
+        return {"_id": task["_id"], "status": RUNNING, "lease_owner": worker_id}
+
+    async def heartbeat(self, task: Dict[str, Any], worker_id: str) -> Optional[Dict[str, Any]]:
+        """リースを延長する（リースを失っていれば None、中断の要求は cancel_requested）"""
+        now = datetime.now()
+        return await self._require_collection().find_one_and_update(
+            self._leased(task, worker_id),
+            {"$set": {
+                "lease_expires_at": now + timedelta(seconds=settings.task_visibility_timeout),
+                "heartbeat_at": now,
+                "updated_at": now,
+            }},
+            projection={"cancel_requested": 1}
+        )
+
+    async def complete(self, task: Dict[str, Any], worker_id: str, result: Any) -> bool:
+        now = datetime.now()
+        updated = await self._require_collection().update_one(
+            self._leased(task, worker_id),
+            {"$set": {
+                "status": SUCCEEDED,
+                "result": result,
+                "error": None,
+                "lease_owner": None,
+                "lease_expires_at": None,
+                "updated_at": now,
+                "finished_at": now,
+            }}
+        )
+        return updated.modified_count > 0
+
+    async def fail(self, task: Dict[str, Any], worker_id: str, error: BaseException, retry: bool = True) -> bool:
+        """失敗を記録する。再試行できる場合は待機中に戻して True を返す"""
+        now = datetime.now()
+        retrying = retry and task["attempts"] < task.get("max_attempts", settings.task_max_attempts)
+        details = {
+            "type": _error_type(error),
+            "message": _error_message(error),
+            "exception": type(error).__name__,
+            "attempt": task["attempts"],
+        }
+        if retrying:
+            delay = settings.task_retry_delay * 2 ** (task["attempts"] - 1)
+            changes = {"status": QUEUED, "available_at": now + timedelta(seconds=delay)}
+        else:
+            changes = {"status": FAILED, "finished_at": now}
+        await self._require_collection().update_one(
+            self._leased(task, worker_id),
+            {"$set": {**changes, "error": details, "lease_owner": None, "lease_expires_at": None, "updated_at": now}}
+        )
+        return retrying
+
+    async def mark_cancelled(self, task: Dict[str, Any], worker_id: str) -> None:
+        now = datetime.now()
+        await self._require_collection().update_one(
+            self._leased(task, worker_id),
+            {"$set": {"status": CANCELLED, "lease_owner": None, "lease_expires_at": None,
+                      "updated_at": now, "finished_at": now}}
+        )
+
+    async def release(self, task: Dict[str, Any], worker_id: str, delay: float = 0.0) -> None:
+        """実行中のタスクを delay 秒後に実行できる待機中に戻す（試行回数に数えない）
+
+        終了するワーカーや、実行枠が混雑していたワーカーが使う。
+        """
+        now = datetime.now()
+        await self._require_collection().update_one(
+            self._leased(task, worker_id),
+            {
+                "$set": {"status": QUEUED, "available_at": now + timedelta(seconds=delay), "lease_owner": None,
+                         "lease_expires_at": None, "updated_at": now},
+                "$inc": {"attempts": -1},
+            }
+        )
+
+
+task_queue = TaskQueue()
+
+
+class TaskWorker:
+    """タスクキューを消費するワーカー（1プロセスで concurrency 件を並行処理）"""
+
+    def __init__(self, queue: TaskQueue, concurrency: int, worker_id: Optional[str] = None):
+        self.queue = queue
+        self.concurrency = max(1, concurrency)
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._stopping = asyncio.Event()
+
+    def stop(self) -> None:
+        """新しいタスクの取得をやめる（実行中のタスクは最後まで処理する）"""
+        if not self._stopping.is_set():
+            logger.info(f"ワーカー {self.worker_id} を停止します（実行中のタスクの完了を待ちます）")
+        self._stopping.set()
+
+    async def run(self) -> None:
+        logger.info(
+            f"ワーカー {self.worker_id} を開始しました"
+            f"（並行数: {self.concurrency}, 種類: {', '.join(self.queue.task_types)}）"
+        )
+        await asyncio.gather(*(self._loop() for _ in range(self.concurrency)))
+
+    async def _idle(self) -> None:
+        try:
+            await asyncio.wait_for(self._stopping.wait(), settings.task_poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _loop(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                task = await self.queue.claim(self.worker_id, self.queue.task_types)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"タスクの取得に失敗しました: {e}")
+                task = None
+            if task is None:
+                await self._idle()
+                continue
+            await self._execute(task)
+
+    async def _heartbeat(self, task: Dict[str, Any], work: asyncio.Task) -> str:
+        """リースを延長し続ける
+
+        リースを失った（"lease_lost"）か中断を要求された（"cancelled"）場合は、
+        処理を中断してその理由を返す。
+        """
+        while True:
+            await asyncio.sleep(settings.task_heartbeat_interval)
+            try:
+                lease = await self.queue.heartbeat(task, self.worker_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"タスク {task['_id']} のハートビートに失敗しました: {e}")
+                continue
+            if lease is None or lease.get("cancel_requested"):
+                work.cancel()
+                return "lease_lost" if lease is None else "cancelled"
+
+    async def _execute(self, task: Dict[str, Any]) -> None:
+        task_type = task["type"]
+        metrics.task_queue_wait_seconds.observe(
+            max((datetime.now() - task["created_at"]).total_seconds(), 0.0), type=task_type
+        )
+        if task["attempts"] > task.get("max_attempts", settings.task_max_attempts):
+            # リースの期限切れで取り直され続けたタスク
+            await self.queue.fail(task, self.worker_id, TimeoutError("ワーカーの応答が途絶えました"), retry=False)
+            metrics.tasks_total.inc(type=task_type, status="failed")
+            return
+
+        if task.get("deadline") is not None and task["deadline"] <= time.time():
+            # 待っていたリクエストの期限を過ぎた（結果を受け取る相手がいない）
+            metrics.deadline_exceeded_total.inc(operation="task")
+            await self.queue.fail(task, self.worker_id, DeadlineExceeded("task"), retry=False)
+            metrics.tasks_total.inc(type=task_type, status="expired")
+            return
+
+        try:
+            handler = self.queue.handler(task_type)
+        except LookupError as e:
+            await self.queue.fail(task, self.worker_id, e, retry=False)
+            metrics.tasks_total.inc(type=task_type, status="failed")
+            return
+
+        start = time.perf_counter()
+        # タスクのコンテキストは作成時にコピーされるため、登録時のレーン・期限で LLM を呼び出す
+        with llm_lane(task.get("lane") or LANES[0]), request_deadline.deadline_scope(task.get("deadline")):
+            token = _task_id.set(str(task["_id"]))
+            try:
+                work = asyncio.ensure_future(handler(task["payload"]))
+            finally:
+                _task_id.reset(token)
+        heartbeat = asyncio.create_task(self._heartbeat(task, work))
+        status = "succeeded"
+        try:
+            result = await work
+        except asyncio.CancelledError:
+            reason = heartbeat.result() if heartbeat.done() and not heartbeat.cancelled() else None
+            if reason == "lease_lost":
+                logger.warning(f"タスク {task['_id']} のリースを失ったため中断しました")
+                status = "lease_lost"
+            elif reason == "cancelled":
+                logger.info(f"タスク {task['_id']} は取り消されたため中断しました")
+                await self.queue.mark_cancelled(task, self.worker_id)
+                status = "cancelled"
+            else:
+                # ワーカーの終了（待機中に戻して他のワーカーに任せる）
+                await asyncio.shield(self.queue.release(task, self.worker_id))
+                raise
+        except (LookupError, DeadlineExceeded) as e:
+            await self.queue.fail(task, self.worker_id, e, retry=False)
+            status = "expired" if isinstance(e, DeadlineExceeded) else "failed"
+        except SchedulerOverloadedError as e:
+            # 失敗ではないため、試行回数に数えずに混雑が捌けるころに取り直す
+            logger.info(f"タスク {task['_id']}（{task_type}）は実行枠が混雑しているため {e.retry_after}秒後に再実行します")
+            await self.queue.release(task, self.worker_id, delay=e.retry_after)
+            status = "deferred"
+        except Exception as e:
+            logger.warning(f"タスク {task['_id']}（{task_type}）が失敗しました: {_error_message(e)}")
+            status = "retried" if await self.queue.fail(task, self.worker_id, e) else "failed"
+        else:
+            if not await self.queue.complete(task, self.worker_id, result):
+                status = "lease_lost"
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+            metrics.task_duration_seconds.observe(time.perf_counter() - start, type=task_type)
+        metrics.tasks_total.inc(type=task_type, status=status)
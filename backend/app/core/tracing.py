@@ -0,0 +1,376 @@
+"""リクエスト単位のトレーシング
+
+HTTPリクエストごとにトレースIDを割り当て、MongoDBコマンド・プロンプト構築・
+LLM呼び出しをスパンとして記録する。現在のトレースとスパンはcontextvarsで
+受け渡す（Motorはcontextvarsをコピーしてスレッドプールで実行するため、
+コマンド監視のイベントからも参照できる）。
+
+完了したトレースはバックグラウンドで書き出す:
+- tracing_exporter = "jsonl": 1スパン1行のJSONLファイル
+- tracing_exporter = "otlp": OTLP/HTTP (JSON) 互換のコレクター
+しきい値より遅いトレースは、エクスポーターとは別にMongoDBのcapped collectionに保存する。
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import secrets
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+from pymongo import monitoring
+
+from app.core.config import settings
+from app.core.metrics import route_template
+
+logger = logging.getLogger(__name__)
+
+# 遅いトレースを保存するコレクション
+SLOW_TRACES_COLLECTION = "slow_traces"
+
+# 1トレースに記録するスパン数の上限（大量のgetMoreなどで肥大化させない）
+MAX_SPANS_PER_TRACE = 1000
+
+# 書き出し待ちトレースの上限（超えた分は捨てる）
+EXPORT_QUEUE_SIZE = 1000
+EXPORT_BATCH_SIZE = 50
+
+SERVICE_NAME = "constella-api"
+
+
+class Span:
+    """処理1つ分の区間"""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "status")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], kind: str = "internal", **attributes: Any):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.status = "ok"
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def end(self, status: Optional[str] = None, end_ns: Optional[int] = None) -> None:
+        if self.end_ns is not None:
+            return
+        self.end_ns = end_ns or time.time_ns()
+        if status:
+            self.status = status
+        self.trace.add(self)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1_000_000
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    """1リクエスト分のスパンの集まり"""
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.spans: List[Span] = []
+        self.dropped = 0
+
+    def add(self, span: Span) -> None:
+        # list.append はスレッドセーフ（コマンド監視はドライバーのスレッドから呼ばれる）
+        if len(self.spans) < MAX_SPANS_PER_TRACE:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+def start_span(name: str, kind: str = "internal", **attributes: Any) -> Optional[Span]:
+    """現在のスパンの子スパンを開始（現在のスパンは切り替えない）
+
+    非同期ジェネレーターのように、区間の途中で呼び出し元に制御を返す処理に使う。
+    トレース中でなければ None を返す。
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    parent = _current_span.get()
+    return Span(trace, name, parent.span_id if parent else None, kind, **attributes)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """区間をスパンとして記録し、その間の処理の親スパンにする"""
+    current = start_span(name, **attributes)
+    if current is None:
+        yield None
+        return
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=type(e).__name__)
+        current.end("error")
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """MongoDBのコマンドを、発行したリクエストのトレースにスパンとして記録"""
+
+    def __init__(self):
+        self._collections: Dict[Tuple[Any, int], str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if _current_trace.get() is None:
+            return
+        collection = event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else ""
+        )
+
+    def _record(self, event, status: str) -> None:
+        collection = self._collections.pop((event.connection_id, event.request_id), None)
+        if collection is None:
+            return
+        current = start_span(
+            f"mongodb.{event.command_name}",
+            kind="client",
+            **{"db.system": "mongodb", "db.operation": event.command_name, "db.collection": collection}
+        )
+        if current is None:
+            return
+        end_ns = time.time_ns()
+        current.start_ns = end_ns - event.duration_micros * 1000
+        current.end(status, end_ns)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._record(event, "ok")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._record(event, "error")
+
+
+def _parse_traceparent(value: str) -> Tuple[Optional[str], Optional[str]]:
+    """W3C traceparent ヘッダーから (trace_id, parent_span_id) を取得"""
+    parts = value.split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None, None
+    return parts[1], parts[2]
+
+
+class TracingMiddleware:
+    """HTTPリクエストごとにトレースを開始し、X-Trace-Id ヘッダーで返すASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.tracing_enabled:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        trace_id, parent_id = _parse_traceparent(headers.get(b"traceparent", b"").decode("latin-1"))
+        trace = Trace(trace_id)
+        root = Span(trace, f"{scope['method']} {scope['path']}", parent_id, "server")
+        root.set(**{"http.method": scope["method"], "http.target": scope["path"]})
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span.set(root)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                root.set(**{"http.status_code": message["status"]})
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-trace-id", trace.trace_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException:
+            root.status = "error"
+            raise
+        finally:
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+            route = route_template(scope)
+            root.name = f"{scope['method']} {route}"
+            root.set(**{"http.route": route})
+            if root.attributes.get("http.status_code", 500) >= 500:
+                root.status = "error"
+            root.end()
+            trace_exporter.submit(trace, root)
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans: List[Span]) -> Dict[str, Any]:
+    """スパンをOTLP/HTTP (JSON) のリクエストボディに変換"""
+    kinds = {"internal": 1, "server": 2, "client": 3}
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{
+                "scope": {"name": "constella"},
+                "spans": [
+                    {
+                        "traceId": span.trace.trace_id,
+                        "spanId": span.span_id,
+                        **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                        "name": span.name,
+                        "kind": kinds.get(span.kind, 1),
+                        "startTimeUnixNano": str(span.start_ns),
+                        "endTimeUnixNano": str(span.end_ns),
+                        "attributes": [
+                            {"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()
+                        ],
+                        "status": {"code": 2 if span.status == "error" else 1},
+                    }
+                    for span in spans
+                ],
+            }],
+        }]
+    }
+
+
+class TraceExporter:
+    """完了したトレースをバックグラウンドで書き出す"""
+
+    def __init__(self):
+        self._queue: "asyncio.Queue[Tuple[Trace, Span]]" = asyncio.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self._worker: Optional[asyncio.Task] = None
+        self._db = None
+        self.dropped = 0
+
+    async def start(self, db) -> None:
+        self._db = db
+        if settings.tracing_enabled:
+            try:
+                await self._ensure_slow_collection()
+            except Exception as e:
+                logger.warning(f"遅いトレース用コレクションの作成に失敗しました: {e}")
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+    async def _ensure_slow_collection(self) -> None:
+        names = await self._db.list_collection_names(filter={"name": SLOW_TRACES_COLLECTION})
+        if not names:
+            await self._db.create_collection(
+                SLOW_TRACES_COLLECTION,
+                capped=True,
+                size=settings.tracing_slow_collection_size
+            )
+
+    def submit(self, trace: Trace, root: Span) -> None:
+        if self._worker is None:
+            return
+        try:
+            self._queue.put_nowait((trace, root))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def _is_slow(self, root: Span) -> bool:
+        return (
+            root.duration_ms >= settings.tracing_slow_threshold_ms
+            and random.random() < settings.tracing_slow_sample_rate
+        )
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < EXPORT_BATCH_SIZE and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._export(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"トレースの書き出しに失敗しました（{len(batch)}件）: {e}")
+
+    async def _export(self, batch: List[Tuple[Trace, Span]]) -> None:
+        spans = [span for trace, _ in batch for span in trace.spans]
+        if settings.tracing_exporter == "jsonl":
+            await asyncio.to_thread(self._write_jsonl, spans)
+        elif settings.tracing_exporter == "otlp":
+            async with httpx.AsyncClient(timeout=5.0) as client:
+                response = await client.post(settings.tracing_otlp_endpoint, json=to_otlp(spans))
+                response.raise_for_status()
+
+        slow = [self._slow_document(trace, root) for trace, root in batch if self._is_slow(root)]
+        if slow and self._db is not None:
+            await self._db[SLOW_TRACES_COLLECTION].insert_many(slow)
+
+    def _write_jsonl(self, spans: List[Span]) -> None:
+        directory = os.path.dirname(settings.tracing_jsonl_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(settings.tracing_jsonl_path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+    @staticmethod
+    def _slow_document(trace: Trace, root: Span) -> Dict[str, Any]:
+        return {
+            "trace_id": trace.trace_id,
+            "name": root.name,
+            "route": root.attributes.get("http.route"),
+            "method": root.attributes.get("http.method"),
+            "status_code": root.attributes.get("http.status_code"),
+            "duration_ms": round(root.duration_ms, 3),
+            "started_at": datetime.fromtimestamp(root.start_ns / 1_000_000_000),
+            "dropped_spans": trace.dropped,
+            "spans": [span.to_dict() for span in sorted(trace.spans, key=lambda span: span.start_ns)],
+        }
+
+
+# シングルトンインスタンス
+trace_exporter = TraceExporter()
@@ -1,6 +1,6 @@
 """コメントモデル"""
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Any, Dict, Optional
 from datetime import datetime
 from bson import ObjectId
 
@@ -24,6 +24,8 @@ class CommentInDB(CommentBase):
     id: str = Field(alias="_id")
     created_at: datetime
     updated_at: datetime
+    # 生成したドキュメントでは、使ったプロバイダー・モデルのルート
+    generation_route: Optional[Dict[str, Any]] = None
     
     class Config:
         populate_by_name = True
@@ -1,6 +1,6 @@
 """ジャーナルモデル"""
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from datetime import datetime
 from bson import ObjectId
 
@@ -24,6 +24,8 @@ class JournalInDB(JournalBase):
     created_at: datetime
     updated_at: datetime
     comment_ids: List[str] = []
+    # 生成したドキュメントでは、使ったプロバイダー・モデルのルート
+    generation_route: Optional[Dict[str, Any]] = None
     
     class Config:
         populate_by_name = True
@@ -44,4 +46,10 @@ class JournalGenerateRequest(BaseModel):
 class PromptPreviewRequest(BaseModel):
     """プロンプトプレビューリクエスト"""
     character_id: str
-    theme: str
\ No newline at end of file
+    theme: str
+
+class BatchPromptPreviewRequest(BaseModel):
+    """プロンプト一括プレビューリクエスト（キャラクター × テーマ）"""
+    character_ids: List[str]
+    themes: List[str]
+    include_prompts: bool = False
\ No newline at end of file
@@ -1,5 +1,5 @@
 """Friends Discovery生成プロンプト"""
-from typing import Dict, Any
+from typing import Dict, Any, List
 
 def create_discovery_prompt(character: Dict[str, Any], relationship_phrase: str) -> str:
     """Friends Discovery用のプロンプトを作成"""
@@ -47,4 +47,73 @@ def create_discovery_prompt(character: Dict[str, Any], relationship_phrase: str)
 
 JSON出力:"""
     
-    return prompt
\ No newline at end of file
+    return prompt
+
+# 生成されるキャラクター1人分のJSONスキーマ（構造化出力・JSONモード用）
+CHARACTER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "introduction": {"type": "string"},
+        "backstory": {"type": "string"},
+        "my_relationship": {"type": "string"},
+        "your_relationship": {"type": "string"}
+    },
+    "required": ["name", "introduction", "backstory", "my_relationship", "your_relationship"]
+}
+
+FRIENDS_DISCOVERY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "characters": {
+            "type": "array",
+            "items": CHARACTER_SCHEMA
+        }
+    },
+    "required": ["characters"]
+}
+
+def create_single_character_prompt(
+    character: Dict[str, Any],
+    relationship_phrase: str,
+    exclude_names: List[str]
+) -> str:
+    """Friends Discoveryでキャラクターを1人だけ作り直すためのプロンプトを作成"""
+
+    # キャラクター属性を整形
+    attributes_text = ""
+    for attr in character.get("attributes", []):
+        if attr["type"] == "description":
+            attributes_text += f"説明: {attr['content']}\n"
+        elif attr["type"] == "personality":
+            attributes_text += f"性格: {attr['content']}\n"
+        elif attr["type"] == "currentStatus":
+            attributes_text += f"現在の状況: {attr['content']}\n"
+        elif attr["type"] == "backstory":
+            attributes_text += f"背景: {attr['content']}\n"
+
+    exclude_text = "、".join(exclude_names) if exclude_names else "なし"
+
+    prompt = f"""あなたはプロのストーリーライターです。以下のキャラクターに関連する新しいキャラクターを1人作成してください。
+
+既存のキャラクター: {character['name']}
+
+{attributes_text}
+
+関係性のフレーズ: {relationship_phrase}
+
+作成済みのキャラクター（これらとは異なる人物にすること）: {exclude_text}
+
+以下のJSON形式のみを出力してください:
+
+{{
+  "name": "キャラクター名",
+  "introduction": "キャラクターの簡単な紹介（50-100文字）",
+  "backstory": "キャラクターの背景設定（100-200文字）",
+  "my_relationship": "このキャラクターから{character['name']}への関係性の説明（50-100文字）",
+  "your_relationship": "{character['name']}からこのキャラクターへの関係性の説明（50-100文字）"
+}}
+
+JSON出力:"""
+
+    return prompt
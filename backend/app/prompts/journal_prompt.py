@@ -1,8 +1,15 @@
 """ジャーナル生成プロンプト"""
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 
-def create_journal_prompt(character: Dict[str, Any], theme: str) -> str:
-    """ジャーナルエントリー生成用のプロンプトを作成"""
+def create_journal_prompt(
+    character: Dict[str, Any],
+    theme: str,
+    memories: Optional[List[Dict[str, Any]]] = None
+) -> str:
+    """ジャーナルエントリー生成用のプロンプトを作成
+
+    memories が指定されている場合、過去の日記・コメントの抜粋を記憶として含める
+    """
     
     # キャラクター属性を整形
     attributes_text = ""
@@ -25,6 +32,22 @@ def create_journal_prompt(character: Dict[str, Any], theme: str) -> str:
             relationships_text += f"- {target_name}: {description}\n"
         else:
             relationships_text += f"- {description}\n"
+
+    # 過去の記憶を整形
+    memories_text = ""
+    for memory in memories or []:
+        created_at = memory.get("created_at")
+        date = created_at.strftime("%Y-%m-%d") if created_at else "日付不明"
+        if memory["type"] == "journal":
+            source = f"自分の日記「{memory.get('theme', '')}」"
+        elif memory.get("own"):
+            source = "自分のコメント"
+        else:
+            source = f"{memory.get('author_name') or '誰か'}からのコメント"
+        memories_text += f"- [{date} {source}] {memory['excerpt']}\n"
+    memories_section = f"""
+過去の記憶（これまでの日記やコメントの抜粋。内容と矛盾しないこと）:
+{memories_text}""" if memories_text else ""
     
     prompt = f"""あなたは高度に創造的な俳優です。以下のキャラクターを演じて、与えられたテーマについて日記を書いてください。
 
@@ -34,7 +57,7 @@ def create_journal_prompt(character: Dict[str, Any], theme: str) -> str:
 
 関係性:
 {relationships_text if relationships_text else "なし"}
-
+{memories_section}
 テーマ: {theme}
 
 重要な指示:
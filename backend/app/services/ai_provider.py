@@ -1,65 +1,338 @@
 """AI プロバイダー抽象化レイヤー"""
+import asyncio
+import json
+import logging
 import httpx
 from abc import ABC, abstractmethod
-from typing import Dict, Any, List, Optional
-from app.core.config import settings, AIProvider
+from typing import Dict, Any, List, Optional, AsyncGenerator, AsyncIterator, Type
+import time
+from pydantic import BaseModel, Field
+from app.core import deadline
+from app.core.config import AIProvider, GenerationTask, settings
+from app.core.settings_store import provider_settings
+from app.core import metrics, tracing
+from app.core.llm_scheduler import llm_scheduler
+
+logger = logging.getLogger(__name__)
+
+# 生成オプションを指定しない場合の温度
+DEFAULT_TEMPERATURE = 0.7
+
+
+class GenerationOptions(BaseModel):
+    """生成ごとのサンプリング設定（未指定の項目はプロバイダーの既定値）"""
+    temperature: Optional[float] = None
+    seed: Optional[int] = None
+
+    class Config:
+        frozen = True
+
+    def temperature_or_default(self) -> float:
+        return DEFAULT_TEMPERATURE if self.temperature is None else self.temperature
+
+
+# プロバイダーごとの既定のAPIエンドポイント（Ollamaは ollama_api_url を使う）
+DEFAULT_BASE_URLS = {
+    "openai": "https://api.openai.com/v1",
+    "anthropic": "https://api.anthropic.com/v1",
+    "google": "https://generativelanguage.googleapis.com/v1beta",
+}
+
+
+class ProviderConfig(BaseModel):
+    """プロバイダーの接続設定
+
+    変更不可のため、並行するリクエストがそれぞれ別の設定でプロバイダーを
+    使っても（接続テストなど）互いに影響しない。
+    """
+    provider: AIProvider
+    model: str
+    base_url: str
+    api_key: Optional[str] = Field(None, repr=False)
+
+    class Config:
+        frozen = True
+
+    @classmethod
+    def from_settings(cls, provider: Optional[str] = None, **overrides: Any) -> "ProviderConfig":
+        """現在の設定から作成（overrides の値が空でなければそちらを優先。provider は作成時に検証する）"""
+        current = provider_settings()
+        provider = provider or current.ai_provider
+        values = {
+            "provider": provider,
+            "model": getattr(current, f"{provider}_model"),
+            "base_url": current.ollama_api_url if provider == "ollama" else getattr(current, f"{provider}_base_url"),
+            "api_key": None if provider == "ollama" else getattr(current, f"{provider}_api_key"),
+        }
+        values.update({key: value for key, value in overrides.items() if value})
+        values["base_url"] = (values["base_url"] or DEFAULT_BASE_URLS[provider]).rstrip("/")
+        return cls(**values)
+
+    def summary(self) -> Dict[str, Any]:
+        """APIキーを除いた内容"""
+        return {"provider": self.provider, "model": self.model, "base_url": self.base_url}
+
+
+class LLMTimeouts(BaseModel):
+    """1回のLLM呼び出しのタイムアウト（秒）"""
+    connect: float
+    read: float
+    total: float
+
+    class Config:
+        frozen = True
+
+    def httpx_timeout(self) -> httpx.Timeout:
+        """接続以外（読み取り・書き込み・接続プール）は read を使う"""
+        return httpx.Timeout(self.read, connect=self.connect)
+
+
+def resolve_timeouts(provider: str, task: Optional[GenerationTask] = None) -> LLMTimeouts:
+    """既定値 < プロバイダー < タスク種別 < "プロバイダー:タスク種別" の順に上書きし、期限までに縮める"""
+    values = {
+        "connect": settings.llm_connect_timeout,
+        "read": settings.llm_read_timeout,
+        "total": settings.llm_total_timeout,
+    }
+    for key in (provider, task, f"{provider}:{task}"):
+        if key in settings.llm_timeouts:
+            values.update({name: value for name, value in settings.llm_timeouts[key].items() if name in values})
+    values["total"] = deadline.clamp(values["total"])
+    return LLMTimeouts(
+        connect=min(values["connect"], values["total"]),
+        read=min(values["read"], values["total"]),
+        total=values["total"]
+    )
+
+
+class _StreamStatusError(ValueError):
+    """ストリーミングレスポンスのHTTPエラー（呼び出し元には ValueError として扱われる）"""
+
+
+async def _raise_for_stream_status(response: httpx.Response, provider_name: str) -> None:
+    """ストリーミングレスポンスのエラーを、本文を読み込んだうえで例外にする"""
+    if response.status_code < 400:
+        return
+    body = (await response.aread()).decode("utf-8", errors="replace")
+    if response.status_code == 429:
+        raise _StreamStatusError(f"{provider_name} API rate limit exceeded. Please check your usage limits or wait before retrying.")
+    if response.status_code == 401:
+        raise _StreamStatusError(f"Invalid {provider_name} API key. Please check your API key settings.")
+    raise _StreamStatusError(f"{provider_name} API error ({response.status_code}): {body[:500]}")
+
+
+async def _iter_sse_data(response: httpx.Response) -> AsyncIterator[Dict[str, Any]]:
+    """Server-Sent Events の data 行をJSONとして順に返す"""
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if not data or data == "[DONE]":
+            continue
+        yield json.loads(data)
 
 
 class BaseAIProvider(ABC):
-    """AI プロバイダーの基底クラス"""
+    """AI プロバイダーの基底クラス
+
+    接続設定は作成時の ProviderConfig に固定され、以降のグローバル設定の
+    変更の影響を受けない。
+    """
+
+    name: str = ""
+
+    def __init__(
+        self,
+        config: Optional[ProviderConfig] = None,
+        timeouts: Optional[LLMTimeouts] = None,
+        task: Optional[GenerationTask] = None
+    ):
+        self.config = config or ProviderConfig.from_settings(self.name)
+        self.task = task
+        self.timeouts = timeouts or resolve_timeouts(self.name, task)
+
+    @property
+    def model(self) -> str:
+        """使用するモデル名"""
+        return self.config.model
+
+    def _log_error(self, operation: str, error: str, exc: BaseException, detail: str = "") -> None:
+        """プロバイダーAPIのエラーを記録する（error: http / request / unexpected）"""
+        metrics.llm_provider_errors_total.inc(provider=self.name, model=self.model, operation=operation, error=error)
+        logger.warning(
+            f"{self.name} API {error} error ({operation}, {self.model}): {exc}" + (f", Details: {detail}" if detail else "")
+        )
+
+    @abstractmethod
+    async def list_models(self) -> List[str]:
+        """プロバイダーで利用できるモデル名の一覧"""
+        pass
 
     @abstractmethod
     async def generate_text(self, prompt: str) -> str:
         """テキスト生成"""
         pass
 
+    async def stream_text(
+        self,
+        prompt: str,
+        json_schema: Optional[Dict[str, Any]] = None,
+        options: Optional[GenerationOptions] = None
+    ) -> AsyncGenerator[str, None]:
+        """テキストをストリーミング生成
+
+        json_schema が指定された場合、プロバイダーのJSONモード・構造化出力を使う。
+        options で温度・シードを指定できる（シード非対応のプロバイダーでは無視）。
+        ストリーミング非対応のプロバイダーは一括生成した結果を1チャンクで返す。
+        """
+        yield await self.generate_text(prompt)
+
+
+def _ollama_keep_alive() -> Any:
+    """数値（秒、-1 で無期限）はそのまま、"30m" などの期間は文字列で渡す"""
+    try:
+        seconds = float(settings.ollama_keep_alive)
+    except ValueError:
+        return settings.ollama_keep_alive
+    return int(seconds) if seconds.is_integer() else seconds
+
 
 class OllamaProvider(BaseAIProvider):
-    """Ollama プロバイダー"""
+    """Ollama プロバイダー
+
+    /api/chat を使い、チャットテンプレートの適用はOllamaに任せる。プロンプトの
+    先頭が同じ呼び出しは、読み込み済みのモデルのKVキャッシュを再利用できる。
+    keep_alive・num_ctx は設定の値を毎回渡す（num_ctx が変わるとモデルが読み込み直される）。
+    """
+
+    name = "ollama"
+
+    def _options(self, options: Optional[GenerationOptions] = None) -> Dict[str, Any]:
+        """リクエストの options（温度・シードに、タスク種別の num_predict と num_ctx を加える）"""
+        values: Dict[str, Any] = (options or GenerationOptions()).dict(exclude_none=True)
+        num_predict = settings.ollama_num_predict.get(self.task) if self.task else None
+        if num_predict:
+            values["num_predict"] = num_predict
+        if settings.ollama_num_ctx:
+            values["num_ctx"] = settings.ollama_num_ctx
+        return values
+
+    def _payload(self, messages: List[Dict[str, str]], stream: bool, options: Dict[str, Any]) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {
+            "model": self.config.model,
+            "messages": messages,
+            "stream": stream,
+            "keep_alive": _ollama_keep_alive(),
+        }
+        if options:
+            payload["options"] = options
+        return payload
+
+    def _record(self, result: Dict[str, Any]) -> None:
+        metrics.record_llm_usage(self.name, self.model, result.get("prompt_eval_count"), result.get("eval_count"))
+        metrics.record_ollama_durations(self.model, result)
+
+    async def preload(self) -> None:
+        """空のメッセージで呼び出し、モデルをメモリに読み込む（生成はしない）"""
+        options = {"num_ctx": settings.ollama_num_ctx} if settings.ollama_num_ctx else {}
+        timeout = httpx.Timeout(self.timeouts.total, connect=self.timeouts.connect)
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            response = await client.post(
+                f"{self.config.base_url}/api/chat",
+                json=self._payload([], stream=False, options=options)
+            )
+            response.raise_for_status()
+            metrics.record_ollama_durations(self.model, response.json())
+
+    async def list_models(self) -> List[str]:
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            response = await client.get(f"{self.config.base_url}/api/tags")
+            response.raise_for_status()
+            return [model["name"] for model in response.json().get("models", [])]
 
     async def generate_text(self, prompt: str) -> str:
-        async with httpx.AsyncClient(timeout=60.0) as client:
+        async with httpx.AsyncClient(timeout=self.timeouts.httpx_timeout()) as client:
             try:
                 response = await client.post(
-                    f"{settings.ollama_api_url}/api/generate",
-                    json={
-                        "model": settings.ollama_model,
-                        "prompt": prompt,
-                        "stream": False
-                    }
+                    f"{self.config.base_url}/api/chat",
+                    json=self._payload([{"role": "user", "content": prompt}], stream=False, options=self._options())
                 )
                 response.raise_for_status()
                 result = response.json()
-                return result.get("response", "")
+                self._record(result)
+                return (result.get("message") or {}).get("content", "")
             except httpx.RequestError as e:
-                print(f"Ollama API request error: {e}")
+                self._log_error("generate", "request", e)
                 raise
             except Exception as e:
-                print(f"Unexpected error: {e}")
+                self._log_error("generate", "unexpected", e)
+                raise
+
+    async def stream_text(
+        self,
+        prompt: str,
+        json_schema: Optional[Dict[str, Any]] = None,
+        options: Optional[GenerationOptions] = None
+    ) -> AsyncGenerator[str, None]:
+        payload = self._payload([{"role": "user", "content": prompt}], stream=True, options=self._options(options))
+        if json_schema:
+            payload["format"] = json_schema
+
+        async with httpx.AsyncClient(timeout=self.timeouts.httpx_timeout()) as client:
+            try:
+                async with client.stream("POST", f"{self.config.base_url}/api/chat", json=payload) as response:
+                    await _raise_for_stream_status(response, "Ollama")
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        content = (chunk.get("message") or {}).get("content")
+                        if content:
+                            yield content
+                        if chunk.get("done"):
+                            self._record(chunk)
+                            break
+            except _StreamStatusError as e:
+                self._log_error("stream", "http", e)
+                raise
+            except httpx.RequestError as e:
+                self._log_error("stream", "request", e)
                 raise
 
 
 class OpenAIProvider(BaseAIProvider):
     """OpenAI プロバイダー"""
 
+    name = "openai"
+
+    async def list_models(self) -> List[str]:
+        if not self.config.api_key:
+            raise ValueError("OpenAI API key is not set")
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            response = await client.get(
+                f"{self.config.base_url}/models",
+                headers={"Authorization": f"Bearer {self.config.api_key}"}
+            )
+            response.raise_for_status()
+            return sorted(model["id"] for model in response.json().get("data", []))
+
     async def generate_text(self, prompt: str) -> str:
-        if not settings.openai_api_key:
+        if not self.config.api_key:
             raise ValueError("OpenAI API key is not set")
 
         headers = {
-            "Authorization": f"Bearer {settings.openai_api_key}",
+            "Authorization": f"Bearer {self.config.api_key}",
             "Content-Type": "application/json"
         }
 
-        base_url = settings.openai_base_url or "https://api.openai.com/v1"
 
-        async with httpx.AsyncClient(timeout=60.0) as client:
+        async with httpx.AsyncClient(timeout=self.timeouts.httpx_timeout()) as client:
             try:
                 response = await client.post(
-                    f"{base_url}/chat/completions",
+                    f"{self.config.base_url}/chat/completions",
                     headers=headers,
                     json={
-                        "model": settings.openai_model,
+                        "model": self.config.model,
                         "messages": [
                             {"role": "user", "content": prompt}
                         ],
@@ -69,6 +342,8 @@ class OpenAIProvider(BaseAIProvider):
                 )
                 response.raise_for_status()
                 result = response.json()
+                usage = result.get("usage") or {}
+                metrics.record_llm_usage(self.name, self.model, usage.get("prompt_tokens"), usage.get("completion_tokens"))
                 return result["choices"][0]["message"]["content"]
             except httpx.HTTPStatusError as e:
                 if e.response.status_code == 429:
@@ -76,37 +351,101 @@ class OpenAIProvider(BaseAIProvider):
                 elif e.response.status_code == 401:
                     raise ValueError("Invalid OpenAI API key. Please check your API key settings.")
                 elif e.response.status_code == 404:
-                    raise ValueError(f"Model '{settings.openai_model}' not found. Available models: gpt-4o-mini, gpt-4o, gpt-4-turbo, gpt-3.5-turbo")
-                print(f"OpenAI API HTTP error: {e}")
+                    raise ValueError(f"Model '{self.config.model}' not found. Available models: gpt-4o-mini, gpt-4o, gpt-4-turbo, gpt-3.5-turbo")
+                self._log_error("generate", "http", e)
                 raise
             except httpx.RequestError as e:
-                print(f"OpenAI API request error: {e}")
+                self._log_error("generate", "request", e)
                 raise
             except Exception as e:
-                print(f"Unexpected error: {e}")
+                self._log_error("generate", "unexpected", e)
+                raise
+
+    async def stream_text(
+        self,
+        prompt: str,
+        json_schema: Optional[Dict[str, Any]] = None,
+        options: Optional[GenerationOptions] = None
+    ) -> AsyncGenerator[str, None]:
+        if not self.config.api_key:
+            raise ValueError("OpenAI API key is not set")
+
+        headers = {
+            "Authorization": f"Bearer {self.config.api_key}",
+            "Content-Type": "application/json"
+        }
+        options = options or GenerationOptions()
+        payload = {
+            "model": self.config.model,
+            "messages": [
+                {"role": "user", "content": prompt}
+            ],
+            "max_tokens": 2000,
+            "temperature": options.temperature_or_default(),
+            "stream": True,
+            "stream_options": {"include_usage": True}
+        }
+        if options.seed is not None:
+            payload["seed"] = options.seed
+        if json_schema:
+            payload["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "response", "schema": json_schema}
+            }
+
+        async with httpx.AsyncClient(timeout=self.timeouts.httpx_timeout()) as client:
+            try:
+                async with client.stream("POST", f"{self.config.base_url}/chat/completions", headers=headers, json=payload) as response:
+                    await _raise_for_stream_status(response, "OpenAI")
+                    async for event in _iter_sse_data(response):
+                        choices = event.get("choices") or []
+                        if choices and choices[0].get("delta", {}).get("content"):
+                            yield choices[0]["delta"]["content"]
+                        if event.get("usage"):
+                            usage = event["usage"]
+                            metrics.record_llm_usage(self.name, self.model, usage.get("prompt_tokens"), usage.get("completion_tokens"))
+            except _StreamStatusError as e:
+                self._log_error("stream", "http", e)
+                raise
+            except httpx.RequestError as e:
+                self._log_error("stream", "request", e)
                 raise
 
 
 class AnthropicProvider(BaseAIProvider):
     """Anthropic Claude プロバイダー"""
 
+    name = "anthropic"
+
+    async def list_models(self) -> List[str]:
+        if not self.config.api_key:
+            raise ValueError("Anthropic API key is not set")
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            response = await client.get(
+                f"{self.config.base_url}/models",
+                headers={"x-api-key": self.config.api_key, "anthropic-version": "2023-06-01"}
+            )
+            response.raise_for_status()
+            return [model["id"] for model in response.json().get("data", [])]
+
     async def generate_text(self, prompt: str) -> str:
-        if not settings.anthropic_api_key:
+        if not self.config.api_key:
             raise ValueError("Anthropic API key is not set")
 
         headers = {
-            "x-api-key": settings.anthropic_api_key,
+            "x-api-key": self.config.api_key,
             "content-type": "application/json",
             "anthropic-version": "2023-06-01"
         }
 
-        async with httpx.AsyncClient(timeout=60.0) as client:
+
+        async with httpx.AsyncClient(timeout=self.timeouts.httpx_timeout()) as client:
             try:
                 response = await client.post(
-                    "https://api.anthropic.com/v1/messages",
+                    f"{self.config.base_url}/messages",
                     headers=headers,
                     json={
-                        "model": settings.anthropic_model,
+                        "model": self.config.model,
                         "max_tokens": 2000,
                         "messages": [
                             {"role": "user", "content": prompt}
@@ -115,6 +454,8 @@ class AnthropicProvider(BaseAIProvider):
                 )
                 response.raise_for_status()
                 result = response.json()
+                usage = result.get("usage") or {}
+                metrics.record_llm_usage(self.name, self.model, usage.get("input_tokens"), usage.get("output_tokens"))
                 return result["content"][0]["text"]
             except httpx.HTTPStatusError as e:
                 error_detail = ""
@@ -132,27 +473,87 @@ class AnthropicProvider(BaseAIProvider):
                     raise ValueError(f"Anthropic API endpoint not found (404). This may indicate an invalid API key or account access issue. Available models: claude-sonnet-4-5-20250929, claude-3-5-sonnet-20241022. Details: {error_detail}")
                 elif e.response.status_code == 400:
                     raise ValueError(f"Bad request to Anthropic API: {error_detail}. Available models: claude-sonnet-4-5-20250929, claude-3-5-sonnet-20241022")
-                print(f"Anthropic API HTTP error: {e}, Details: {error_detail}")
+                self._log_error("generate", "http", e, error_detail)
                 raise
             except httpx.RequestError as e:
-                print(f"Anthropic API request error: {e}")
+                self._log_error("generate", "request", e)
                 raise
             except Exception as e:
-                print(f"Unexpected error: {e}")
+                self._log_error("generate", "unexpected", e)
+                raise
+
+    async def stream_text(
+        self,
+        prompt: str,
+        json_schema: Optional[Dict[str, Any]] = None,
+        options: Optional[GenerationOptions] = None
+    ) -> AsyncGenerator[str, None]:
+        # Anthropic にはJSONモードがないため、スキーマはプロンプト側の指示に任せる
+        if not self.config.api_key:
+            raise ValueError("Anthropic API key is not set")
+
+        headers = {
+            "x-api-key": self.config.api_key,
+            "content-type": "application/json",
+            "anthropic-version": "2023-06-01"
+        }
+        payload = {
+            "model": self.config.model,
+            "max_tokens": 2000,
+            "messages": [
+                {"role": "user", "content": prompt}
+            ],
+            "stream": True
+        }
+        if options and options.temperature is not None:
+            payload["temperature"] = min(options.temperature, 1.0)
+
+        async with httpx.AsyncClient(timeout=self.timeouts.httpx_timeout()) as client:
+            try:
+                async with client.stream("POST", f"{self.config.base_url}/messages", headers=headers, json=payload) as response:
+                    await _raise_for_stream_status(response, "Anthropic")
+                    async for event in _iter_sse_data(response):
+                        if event.get("type") == "content_block_delta":
+                            text = event.get("delta", {}).get("text")
+                            if text:
+                                yield text
+                        elif event.get("type") == "message_start":
+                            usage = event.get("message", {}).get("usage") or {}
+                            metrics.record_llm_usage(self.name, self.model, usage.get("input_tokens"), None)
+                        elif event.get("type") == "message_delta":
+                            usage = event.get("usage") or {}
+                            metrics.record_llm_usage(self.name, self.model, None, usage.get("output_tokens"))
+            except _StreamStatusError as e:
+                self._log_error("stream", "http", e)
+                raise
+            except httpx.RequestError as e:
+                self._log_error("stream", "request", e)
                 raise
 
 
 class GoogleProvider(BaseAIProvider):
     """Google Gemini プロバイダー"""
 
+    name = "google"
+
+    async def list_models(self) -> List[str]:
+        if not self.config.api_key:
+            raise ValueError("Google API key is not set")
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            response = await client.get(f"{self.config.base_url}/models", params={"key": self.config.api_key})
+            response.raise_for_status()
+            # "models/gemini-pro" の形式で返る
+            return [model["name"].split("/", 1)[-1] for model in response.json().get("models", [])]
+
     async def generate_text(self, prompt: str) -> str:
-        if not settings.google_api_key:
+        if not self.config.api_key:
             raise ValueError("Google API key is not set")
 
-        async with httpx.AsyncClient(timeout=60.0) as client:
+
+        async with httpx.AsyncClient(timeout=self.timeouts.httpx_timeout()) as client:
             try:
                 response = await client.post(
-                    f"https://generativelanguage.googleapis.com/v1beta/models/{settings.google_model}:generateContent?key={settings.google_api_key}",
+                    f"{self.config.base_url}/models/{self.config.model}:generateContent?key={self.config.api_key}",
                     json={
                         "contents": [
                             {
@@ -169,32 +570,207 @@ class GoogleProvider(BaseAIProvider):
                 )
                 response.raise_for_status()
                 result = response.json()
+                usage = result.get("usageMetadata") or {}
+                metrics.record_llm_usage(self.name, self.model, usage.get("promptTokenCount"), usage.get("candidatesTokenCount"))
                 return result["candidates"][0]["content"]["parts"][0]["text"]
             except httpx.RequestError as e:
-                print(f"Google API request error: {e}")
+                self._log_error("generate", "request", e)
                 raise
             except Exception as e:
-                print(f"Unexpected error: {e}")
+                self._log_error("generate", "unexpected", e)
                 raise
 
+    async def stream_text(
+        self,
+        prompt: str,
+        json_schema: Optional[Dict[str, Any]] = None,
+        options: Optional[GenerationOptions] = None
+    ) -> AsyncGenerator[str, None]:
+        if not self.config.api_key:
+            raise ValueError("Google API key is not set")
+
+        options = options or GenerationOptions()
+        generation_config: Dict[str, Any] = {
+            "temperature": options.temperature_or_default(),
+            "maxOutputTokens": 2000
+        }
+        if options.seed is not None:
+            generation_config["seed"] = options.seed
+        if json_schema:
+            generation_config["responseMimeType"] = "application/json"
+            generation_config["responseSchema"] = json_schema
 
-def get_ai_provider() -> BaseAIProvider:
-    """現在の設定に基づいてAI プロバイダーを取得"""
-    provider_map = {
+        async with httpx.AsyncClient(timeout=self.timeouts.httpx_timeout()) as client:
+            try:
+                async with client.stream(
+                    "POST",
+                    f"{self.config.base_url}/models/{self.config.model}:streamGenerateContent?alt=sse&key={self.config.api_key}",
+                    json={
+                        "contents": [
+                            {
+                                "parts": [
+                                    {"text": prompt}
+                                ]
+                            }
+                        ],
+                        "generationConfig": generation_config
+                    }
+                ) as response:
+                    await _raise_for_stream_status(response, "Google")
+                    usage: Dict[str, Any] = {}
+                    async for event in _iter_sse_data(response):
+                        for candidate in event.get("candidates", [])[:1]:
+                            for part in candidate.get("content", {}).get("parts", []):
+                                if part.get("text"):
+                                    yield part["text"]
+                        # usageMetadata は累計値がチャンクごとに送られるため最後の値を使う
+                        usage = event.get("usageMetadata") or usage
+                    metrics.record_llm_usage(self.name, self.model, usage.get("promptTokenCount"), usage.get("candidatesTokenCount"))
+            except _StreamStatusError as e:
+                self._log_error("stream", "http", e)
+                raise
+            except httpx.RequestError as e:
+                self._log_error("stream", "request", e)
+                raise
+
+
+def get_ai_provider(config: Optional[ProviderConfig] = None, task: Optional[GenerationTask] = None) -> BaseAIProvider:
+    """AI プロバイダーを取得（config を省略した場合は現在の設定から。task はタスク種別ごとの設定に使う）"""
+    config = config or ProviderConfig.from_settings()
+    provider_map: Dict[str, Type[BaseAIProvider]] = {
         "ollama": OllamaProvider,
         "openai": OpenAIProvider,
         "anthropic": AnthropicProvider,
         "google": GoogleProvider
     }
 
-    provider_class = provider_map.get(settings.ai_provider)
+    provider_class = provider_map.get(config.provider)
     if not provider_class:
-        raise ValueError(f"Unsupported AI provider: {settings.ai_provider}")
+        raise ValueError(f"Unsupported AI provider: {config.provider}")
+
+    return provider_class(config, task=task)
+
 
-    return provider_class()
+def _total_timeout_error(provider: BaseAIProvider) -> TimeoutError:
+    return TimeoutError(f"{provider.name} の応答が {provider.timeouts.total:g} 秒以内に終わりませんでした")
 
 
-async def generate_text(prompt: str) -> str:
-    """統一API: テキスト生成"""
-    provider = get_ai_provider()
-    return await provider.generate_text(prompt)
\ No newline at end of file
+async def generate_text(
+    prompt: str,
+    config: Optional[ProviderConfig] = None,
+    task: Optional[GenerationTask] = None
+) -> str:
+    """統一API: テキスト生成（スケジューラーの実行枠を得てから呼び出す）
+
+    task を指定すると、そのタスク種別のタイムアウト（llm_timeouts）を使う。
+    リクエストの期限があれば、実行枠の待ちも含めて期限で打ち切る。
+    """
+    provider = get_ai_provider(config, task)
+    async with deadline.enforce("llm.generate"):
+        async with llm_scheduler.slot(provider.name):
+            # 実行枠を待った分だけ期限までの残り時間が減っている
+            provider.timeouts = resolve_timeouts(provider.name, task)
+            return await _generate_text(provider, prompt)
+
+
+async def _generate_text(provider: BaseAIProvider, prompt: str) -> str:
+    labels: Dict[str, Any] = {"provider": provider.name, "model": provider.model}
+    status = "error"
+    start = time.perf_counter()
+    span = tracing.start_span("llm.generate", kind="client", **labels)
+    metrics.llm_requests_in_flight.inc(provider=provider.name)
+    try:
+        try:
+            async with asyncio.timeout(provider.timeouts.total):
+                result = await provider.generate_text(prompt)
+        except TimeoutError as e:
+            raise _total_timeout_error(provider) from e
+        status = "ok"
+        return result
+    except asyncio.CancelledError:
+        # 呼び出し元が取り消された（HTTPリクエストも中断される）
+        status = "cancelled"
+        raise
+    except (TimeoutError, httpx.TimeoutException):
+        status = "timeout"
+        raise
+    finally:
+        if span:
+            span.end(status)
+        metrics.llm_requests_in_flight.dec(provider=provider.name)
+        metrics.llm_request_duration_seconds.observe(time.perf_counter() - start, operation="generate", **labels)
+        metrics.llm_requests_total.inc(operation="generate", status=status, **labels)
+
+
+async def stream_text(
+    prompt: str,
+    json_schema: Optional[Dict[str, Any]] = None,
+    options: Optional[GenerationOptions] = None,
+    config: Optional[ProviderConfig] = None,
+    task: Optional[GenerationTask] = None
+) -> AsyncGenerator[str, None]:
+    """統一API: ストリーミングテキスト生成（スケジューラーの実行枠を得てから呼び出す）
+
+    チャンクを1つ待つごとに、読み取りのタイムアウト・全体の残り時間・リクエストの期限の
+    最も短いもので打ち切る（チャンクの間で止まったプロバイダーも期限までに中断する）。
+    """
+    provider = get_ai_provider(config, task)
+    deadline.check("llm.stream")
+    # 呼び出し元がチャンクを読み終わるまで枠を持つ（llm_scheduler を参照）
+    async with llm_scheduler.slot(provider.name) as usage:
+        provider.timeouts = resolve_timeouts(provider.name, task)
+        labels: Dict[str, Any] = {"provider": provider.name, "model": provider.model}
+        status = "error"
+        first_chunk = True
+        start = time.perf_counter()
+        # ジェネレーターの途中で呼び出し元に戻るため、現在のスパンは切り替えない
+        span = tracing.start_span("llm.stream", kind="client", **labels)
+        metrics.llm_requests_in_flight.inc(provider=provider.name)
+        chunks = provider.stream_text(prompt, json_schema, options)
+        try:
+            while True:
+                # 全体の残り時間（期限までの残り時間で縮める）と読み取りのタイムアウトの短い方
+                total_left = deadline.clamp(provider.timeouts.total - (time.perf_counter() - start))
+                wait = min(provider.timeouts.read, total_left)
+                timeout = asyncio.timeout(max(wait, 0.0))
+                try:
+                    async with timeout:
+                        chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                except TimeoutError:
+                    if not timeout.expired():
+                        raise
+                    deadline.check("llm.stream")
+                    if wait >= provider.timeouts.read:
+                        raise httpx.ReadTimeout(
+                            f"{provider.name} から {provider.timeouts.read:g} 秒以上応答がありません"
+                        ) from None
+                    raise _total_timeout_error(provider) from None
+                if first_chunk:
+                    first_chunk = False
+                    ttft = time.perf_counter() - start
+                    metrics.llm_time_to_first_token_seconds.observe(ttft, **labels)
+                    if span:
+                        span.set(ttft_ms=round(ttft * 1000, 3))
+                # 呼び出し元が処理している時間は、枠の所要時間（Retry-After の見積もり）に数えない
+                with usage.idle():
+                    yield chunk
+            status = "ok"
+        except GeneratorExit:
+            # 呼び出し側が途中で読むのをやめた
+            status = "closed"
+            raise
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        except (TimeoutError, httpx.TimeoutException):
+            status = "timeout"
+            raise
+        finally:
+            await chunks.aclose()
+            if span:
+                span.end("ok" if status == "closed" else status)
+            metrics.llm_requests_in_flight.dec(provider=provider.name)
+            metrics.llm_request_duration_seconds.observe(time.perf_counter() - start, operation="stream", **labels)
+            metrics.llm_requests_total.inc(operation="stream", status=status, **labels)
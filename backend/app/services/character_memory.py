@@ -0,0 +1,290 @@
+"""キャラクターの記憶の検索（ジャーナル生成プロンプト用）
+
+キャラクターが過去に書いたジャーナル・コメント、そのキャラクターの
+ジャーナルに付いたコメントから、テーマとの類似度と新しさで上位の記憶を選び、
+トークン予算内に収めてプロンプトに渡す。結果はキャラクター単位でキャッシュし、
+そのキャラクターに関わる書き込みがあった時点で破棄する。キャッシュは
+MEMORY_CACHE_LIMIT 人分まで（古く使われていないものから忘れる）で、
+memory_cache_ttl を過ぎた結果は使わずに捨てる。
+"""
+import math
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.database import COLLECTIONS
+from app.services.embeddings import get_embedder
+from app.services.relationship_graph import relationship_graph
+from app.services.search_index import normalize_text, tokenize
+from app.services.semantic_index import semantic_index
+from app.services.tokenizer import estimate_token_count
+
+# 候補として読み込む件数の上限（種類ごと）
+CANDIDATE_LIMIT = 200
+
+# プロンプトに載せる記憶1件あたりの最大文字数
+EXCERPT_LENGTH = 200
+
+# スコアの重み（類似度と新しさ）
+SIMILARITY_WEIGHT = 0.7
+RECENCY_WEIGHT = 0.3
+
+# ジャーナルの持ち主を覚えておく件数の上限（古く使われていないものから忘れる）
+JOURNAL_OWNER_LIMIT = 10000
+
+# 記憶をキャッシュするキャラクター数の上限（古く使われていないものから忘れる）
+MEMORY_CACHE_LIMIT = 1000
+
+CacheKey = Tuple[str, int, int]
+
+
+def _bigram_similarity(a: str, b: str) -> float:
+    """bi-gram集合のDice係数（埋め込みが未計算の場合の代替）"""
+    grams_a = set(tokenize(normalize_text(a)))
+    grams_b = set(tokenize(normalize_text(b)))
+    if not grams_a or not grams_b:
+        return 0.0
+    return 2 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b))
+
+
+def _excerpt(text: str) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= EXCERPT_LENGTH else text[:EXCERPT_LENGTH] + "…"
+
+
+class CharacterMemory:
+    """キャラクターごとの記憶検索とキャッシュ"""
+
+    def __init__(self):
+        # character_id -> {(theme, top_k, token_budget): (作成時刻, 記憶リスト)}
+        self._cache: "OrderedDict[str, Dict[CacheKey, Tuple[float, List[Dict[str, Any]]]]]" = OrderedDict()
+        # 検索中のキャラクター -> [検索中の数, 破棄された回数]（検索中に破棄された結果はキャッシュしない）
+        self._loading: Dict[str, List[int]] = {}
+        # journal_id -> 書いたキャラクターのID（コメント追加時のキャッシュ破棄用）
+        self._journal_owner: "OrderedDict[str, str]" = OrderedDict()
+
+    def invalidate(self, character_id: Optional[str]) -> None:
+        if character_id:
+            self._cache.pop(character_id, None)
+            loading = self._loading.get(character_id)
+            if loading is not None:
+                loading[1] += 1
+
+    def _cached(self, character_id: str, key: CacheKey) -> Optional[List[Dict[str, Any]]]:
+        entries = self._cache.get(character_id)
+        if entries is None or key not in entries:
+            return None
+        created_at, memories = entries[key]
+        if time.monotonic() - created_at >= settings.memory_cache_ttl:
+            del entries[key]
+            if not entries:
+                del self._cache[character_id]
+            return None
+        self._cache.move_to_end(character_id)
+        return memories
+
+    def _store(self, character_id: str, key: CacheKey, memories: List[Dict[str, Any]]) -> None:
+        now = time.monotonic()
+        entries = self._cache.setdefault(character_id, {})
+        # 同じキャラクターの期限切れの結果も捨てる
+        for expired in [k for k, (created_at, _) in entries.items() if now - created_at >= settings.memory_cache_ttl]:
+            del entries[expired]
+        entries[key] = (now, memories)
+        self._cache.move_to_end(character_id)
+        while len(self._cache) > MEMORY_CACHE_LIMIT:
+            self._cache.popitem(last=False)
+
+    def _remember_owner(self, journal_id: str, character_id: str) -> None:
+        self._journal_owner[journal_id] = character_id
+        self._journal_owner.move_to_end(journal_id)
+        while len(self._journal_owner) > JOURNAL_OWNER_LIMIT:
+            self._journal_owner.popitem(last=False)
+
+    def _owner_of(self, journal_id: Optional[str]) -> Optional[str]:
+        if journal_id is None:
+            return None
+        owner = self._journal_owner.get(journal_id)
+        if owner is not None:
+            self._journal_owner.move_to_end(journal_id)
+        return owner
+
+    def journal_changed(self, journal_id: str, character_id: Optional[str] = None) -> None:
+        """ジャーナルの作成・更新・削除時にキャッシュを破棄"""
+        if character_id:
+            self._remember_owner(journal_id, character_id)
+        self.invalidate(character_id or self._owner_of(journal_id))
+
+    def comment_changed(self, comment: Dict[str, Any]) -> None:
+        """コメントの作成・更新・削除時に、書き手とジャーナルの持ち主のキャッシュを破棄
+
+        JOURNAL_OWNER_LIMIT を超えて持ち主を忘れたジャーナルへのコメントは、
+        持ち主のキャッシュが memory_cache_ttl で期限切れになるまで反映されない。
+        """
+        self.invalidate(comment.get("character_id"))
+        self.invalidate(self._owner_of(comment.get("journal_id")))
+
+    async def _candidates(self, character_id: str, db) -> List[Dict[str, Any]]:
+        candidates = []
+        journal_ids = []
+        cursor = db[COLLECTIONS["journals"]].find(
+            {"character_id": character_id},
+            {"theme": 1, "content": 1, "created_at": 1}
+        ).sort("created_at", -1).limit(CANDIDATE_LIMIT)
+        async for journal in cursor:
+            journal_ids.append(str(journal["_id"]))
+            self._remember_owner(str(journal["_id"]), character_id)
+            candidates.append({
+                "type": "journal",
+                "id": str(journal["_id"]),
+                "theme": journal.get("theme", ""),
+                "content": journal.get("content", ""),
+                "created_at": journal.get("created_at"),
+            })
+
+        # 自分が書いたコメントと、自分のジャーナルに付いたコメント
+        cursor = db[COLLECTIONS["comments"]].find(
+            {"$or": [{"character_id": character_id}, {"journal_id": {"$in": journal_ids}}]},
+            {"character_id": 1, "journal_id": 1, "content": 1, "created_at": 1}
+        ).sort("created_at", -1).limit(CANDIDATE_LIMIT)
+        async for comment in cursor:
+            candidates.append({
+                "type": "comment",
+                "id": str(comment["_id"]),
+                "journal_id": comment.get("journal_id"),
+                "author_id": comment.get("character_id"),
+                "own": comment.get("character_id") == character_id,
+                "author_name": relationship_graph.name_of(comment.get("character_id", "")),
+                "content": comment.get("content", ""),
+                "created_at": comment.get("created_at"),
+            })
+        return candidates
+
+    async def _similarities(self, themes: List[str], candidates: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+        """テーマごとの候補との類似度（埋め込みがあれば埋め込み、なければbi-gram）"""
+        keys = [f"{candidate['type']}:{candidate['id']}" for candidate in candidates]
+        scores: Dict[str, Dict[str, float]] = {theme: {} for theme in themes}
+        try:
+            embedder = get_embedder()
+            semantic_index.refresh()
+            if semantic_index.index.is_open and semantic_index.index.embedder_name == embedder.name:
+                found, matrix = semantic_index.index.vectors(keys)
+                if found:
+                    # テーマの埋め込みは1回の呼び出しでまとめて計算する
+                    theme_vectors = await embedder.embed(themes)
+                    for theme, row in zip(themes, (theme_vectors @ matrix.T).tolist()):
+                        scores[theme] = dict(zip(found, row))
+        except Exception:
+            scores = {theme: {} for theme in themes}
+
+        for theme in themes:
+            for key, candidate in zip(keys, candidates):
+                if key not in scores[theme]:
+                    text = f"{candidate.get('theme', '')}\n{candidate['content']}"
+                    scores[theme][key] = _bigram_similarity(theme, text)
+        return scores
+
+    def _select(
+        self,
+        candidates: List[Dict[str, Any]],
+        similarities: Dict[str, float],
+        top_k: int,
+        token_budget: int
+    ) -> List[Dict[str, Any]]:
+        """類似度と新しさのスコア順に、トークン予算内で記憶を選ぶ（時系列順）"""
+        now = datetime.now()
+        half_life = settings.memory_recency_half_life_days * 86400
+        scored = []
+        for candidate in candidates:
+            created_at = candidate.get("created_at")
+            age = (now - created_at).total_seconds() if isinstance(created_at, datetime) else half_life * 4
+            recency = math.pow(0.5, max(age, 0) / half_life)
+            similarity = similarities[f"{candidate['type']}:{candidate['id']}"]
+            scored.append((SIMILARITY_WEIGHT * similarity + RECENCY_WEIGHT * recency, candidate))
+        scored.sort(key=lambda item: item[0], reverse=True)
+
+        # スコア順に、トークン予算を超えない範囲で選ぶ
+        selected: List[Dict[str, Any]] = []
+        used_tokens = 0
+        for score, candidate in scored:
+            if len(selected) >= top_k:
+                break
+            excerpt = _excerpt(candidate["content"])
+            tokens = estimate_token_count(excerpt)
+            if used_tokens + tokens > token_budget:
+                continue
+            used_tokens += tokens
+            selected.append({
+                "type": candidate["type"],
+                "id": candidate["id"],
+                "theme": candidate.get("theme"),
+                "journal_id": candidate.get("journal_id"),
+                "own": candidate.get("own", True),
+                "author_name": candidate.get("author_name"),
+                "excerpt": excerpt,
+                "created_at": candidate.get("created_at"),
+                "score": round(score, 4),
+                "tokens": tokens,
+            })
+
+        # プロンプトでは時系列に並べる
+        selected.sort(key=lambda memory: memory["created_at"] or datetime.min)
+        return selected
+
+    async def retrieve(
+        self,
+        character: Dict[str, Any],
+        theme: str,
+        db,
+        top_k: Optional[int] = None,
+        token_budget: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """テーマに関連する記憶を時系列順で返す"""
+        return (await self.retrieve_many(character, [theme], db, top_k, token_budget))[theme]
+
+    async def retrieve_many(
+        self,
+        character: Dict[str, Any],
+        themes: List[str],
+        db,
+        top_k: Optional[int] = None,
+        token_budget: Optional[int] = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """複数のテーマの記憶をテーマごとに返す（候補の読み込みは1回だけ行う）"""
+        character_id = str(character["_id"])
+        top_k = settings.memory_top_k if top_k is None else top_k
+        token_budget = settings.memory_token_budget if token_budget is None else token_budget
+        themes = list(dict.fromkeys(themes))
+        if top_k <= 0 or token_budget <= 0:
+            return {theme: [] for theme in themes}
+
+        results: Dict[str, List[Dict[str, Any]]] = {}
+        for theme in themes:
+            cached = self._cached(character_id, (theme, top_k, token_budget))
+            if cached is not None:
+                results[theme] = cached
+        missing = [theme for theme in themes if theme not in results]
+        if not missing:
+            return results
+
+        loading = self._loading.setdefault(character_id, [0, 0])
+        loading[0] += 1
+        invalidations = loading[1]
+        try:
+            candidates = await self._candidates(character_id, db)
+            similarities = await self._similarities(missing, candidates)
+            for theme in missing:
+                selected = self._select(candidates, similarities[theme], top_k, token_budget)
+                if loading[1] == invalidations:
+                    self._store(character_id, (theme, top_k, token_budget), selected)
+                results[theme] = selected
+        finally:
+            loading[0] -= 1
+            if loading[0] == 0:
+                del self._loading[character_id]
+        return results
+
+
+# シングルトンインスタンス
+character_memory = CharacterMemory()
@@ -0,0 +1,64 @@
+"""生成されたキャラクター候補の重複判定
+
+名前は正規化して完全一致で比較し、背景はn-gramのシングル集合の
+Jaccard係数で比較する。候補数は多くても数十件なので総当たりで判定する。
+"""
+import unicodedata
+from typing import Any, Dict, Iterable, List, Set
+
+# 背景のシングル長（文字数）
+SHINGLE_SIZE = 3
+
+# この値以上のJaccard係数なら同じ背景とみなす
+BACKSTORY_SIMILARITY_THRESHOLD = 0.5
+
+# 名前の比較で無視する文字（空白・中黒・記号）
+_NAME_SEPARATORS = set(" 　・･.-_=＝")
+
+
+def normalize_name(name: str) -> str:
+    """名前を比較用に正規化（全角半角・大文字小文字・区切り文字の違いを無視）"""
+    normalized = unicodedata.normalize("NFKC", name or "").lower()
+    return "".join(char for char in normalized if char not in _NAME_SEPARATORS and not char.isspace())
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> Set[str]:
+    """テキストの文字n-gram集合"""
+    normalized = "".join(unicodedata.normalize("NFKC", text or "").lower().split())
+    if len(normalized) <= size:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def select_distinct(
+    candidates: Iterable[Dict[str, Any]],
+    existing_names: Iterable[str],
+    limit: int,
+    threshold: float = BACKSTORY_SIMILARITY_THRESHOLD
+) -> List[Dict[str, Any]]:
+    """既存キャラクターや互いに重複しない候補を、先頭から最大limit件選ぶ"""
+    taken_names = {normalize_name(name) for name in existing_names}
+    taken_names.discard("")
+    selected: List[Dict[str, Any]] = []
+    selected_shingles: List[Set[str]] = []
+
+    for candidate in candidates:
+        if len(selected) >= limit:
+            break
+        name = normalize_name(candidate.get("name", ""))
+        if not name or name in taken_names:
+            continue
+        backstory = shingles(candidate.get("backstory", ""))
+        if any(jaccard(backstory, other) >= threshold for other in selected_shingles):
+            continue
+        taken_names.add(name)
+        selected.append(candidate)
+        selected_shingles.append(backstory)
+
+    return selected
@@ -0,0 +1,204 @@
+"""テキスト埋め込み（Embedding）プロバイダー"""
+import asyncio
+import hashlib
+import math
+from abc import ABC, abstractmethod
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+import numpy as np
+
+from app.core.config import settings
+from app.core.settings_store import provider_settings
+from app.services.ai_provider import resolve_timeouts
+from app.services.search_index import normalize_text, tokenize
+
+
+class BaseEmbedder(ABC):
+    """埋め込みプロバイダーの基底クラス
+
+    embed() は L2正規化済みの float32 行列（テキスト数 × 次元数）を返す
+    """
+
+    name: str
+
+    @abstractmethod
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        """テキストのリストを埋め込みベクトルに変換"""
+        pass
+
+    async def aclose(self) -> None:
+        """保持している接続を閉じる"""
+        pass
+
+    async def retire(self) -> None:
+        """設定が変わって使わなくなった。処理中の呼び出しが終わってから接続を閉じる"""
+        await self.aclose()
+
+
+class _HTTPEmbedder(BaseEmbedder):
+    """HTTP APIの埋め込みプロバイダー（接続を使い回す）"""
+
+    provider: str
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        # 処理中のリクエスト数と、使わなくなった（retire）か
+        self._active = 0
+        self._retired = False
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient()
+        return self._client
+
+    async def _post(self, url: str, **kwargs) -> httpx.Response:
+        """LLM呼び出しと同じタイムアウト（LLM_TIMEOUTS のプロバイダーごとの上書きを含む）でPOST"""
+        timeouts = resolve_timeouts(self.provider)
+        self._active += 1
+        try:
+            async with asyncio.timeout(timeouts.total):
+                response = await self._http().post(url, timeout=timeouts.httpx_timeout(), **kwargs)
+        finally:
+            self._active -= 1
+            if self._retired and self._active == 0:
+                await self.aclose()
+        response.raise_for_status()
+        return response
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+    async def retire(self) -> None:
+        self._retired = True
+        if self._active == 0:
+            await self.aclose()
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+
+class HashingEmbedder(BaseEmbedder):
+    """ローカルのハッシュ埋め込み（オフライン・テスト用）
+
+    文字bi-gramを feature hashing で固定次元に射影する。意味的な近さは
+    表層的な語の重なりに限られるが、外部サービスなしで決定的に動作する。
+    """
+
+    def __init__(self, dimension: int):
+        self.dimension = dimension
+        self.name = f"hashing-{dimension}"
+
+    def _vector(self, text: str) -> np.ndarray:
+        counts: Dict[Tuple[int, float], int] = {}
+        for gram in tokenize(normalize_text(text)):
+            digest = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "little")
+            key = (digest % self.dimension, 1.0 if (digest >> 32) & 1 else -1.0)
+            counts[key] = counts.get(key, 0) + 1
+
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for (index, sign), count in counts.items():
+            vector[index] += sign * (1.0 + math.log(count))
+        return vector
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        return _normalize_rows(np.stack([self._vector(text) for text in texts]))
+
+
+class OllamaEmbedder(_HTTPEmbedder):
+    """Ollama /api/embeddings による埋め込み"""
+
+    provider = "ollama"
+
+    def __init__(self, api_url: str, model: str, concurrency: int = 4):
+        super().__init__()
+        self.api_url = api_url
+        self.model = model
+        self.name = f"ollama-{model}"
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        async def embed_one(text: str) -> List[float]:
+            async with self._semaphore:
+                response = await self._post(
+                    f"{self.api_url}/api/embeddings",
+                    json={"model": self.model, "prompt": text}
+                )
+                return response.json()["embedding"]
+
+        vectors = await asyncio.gather(*(embed_one(text) for text in texts))
+        return _normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+
+class OpenAIEmbedder(_HTTPEmbedder):
+    """OpenAI /embeddings による埋め込み（1リクエストでバッチ処理）"""
+
+    provider = "openai"
+
+    def __init__(self, api_key: str, model: str, base_url: str):
+        super().__init__()
+        self.api_key = api_key
+        self.model = model
+        self.base_url = base_url
+        self.name = f"openai-{model}"
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        response = await self._post(
+            f"{self.base_url}/embeddings",
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            json={"model": self.model, "input": texts}
+        )
+        data = sorted(response.json()["data"], key=lambda item: item["index"])
+        return _normalize_rows(np.asarray([item["embedding"] for item in data], dtype=np.float32))
+
+
+# プロバイダーの種類 -> (作成時の設定, 埋め込みプロバイダー)
+_embedders: Dict[str, Tuple[Tuple[Any, ...], BaseEmbedder]] = {}
+
+
+def get_embedder() -> BaseEmbedder:
+    """現在の設定に基づいて埋め込みプロバイダーを取得
+
+    接続先・モデル・APIキーが変わった場合は作り直し、前のものは処理中の呼び出しが
+    終わってから接続を閉じる。
+    """
+    current = provider_settings()
+    create: Callable[[], BaseEmbedder]
+    if settings.embedding_provider == "hashing":
+        key: Tuple[Any, ...] = (settings.embedding_dimension,)
+        create = partial(HashingEmbedder, settings.embedding_dimension)
+    elif settings.embedding_provider == "ollama":
+        key = (current.ollama_api_url, settings.ollama_embedding_model)
+        create = partial(OllamaEmbedder, current.ollama_api_url, settings.ollama_embedding_model)
+    elif settings.embedding_provider == "openai":
+        if not current.openai_api_key:
+            raise ValueError("OpenAI API key is not set")
+        base_url = current.openai_base_url or "https://api.openai.com/v1"
+        key = (base_url, settings.openai_embedding_model, current.openai_api_key)
+        create = partial(OpenAIEmbedder, current.openai_api_key, settings.openai_embedding_model, base_url)
+    else:
+        raise ValueError(f"Unsupported embedding provider: {settings.embedding_provider}")
+
+    cached = _embedders.get(settings.embedding_provider)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    embedder = create()
+    _embedders[settings.embedding_provider] = (key, embedder)
+    if cached is not None:
+        asyncio.ensure_future(cached[1].retire())
+    return embedder
+
+
+async def close_embedders() -> None:
+    """作成した埋め込みプロバイダーの接続を閉じる"""
+    embedders = [embedder for _, embedder in _embedders.values()]
+    _embedders.clear()
+    await asyncio.gather(*(embedder.aclose() for embedder in embedders), return_exceptions=True)
@@ -0,0 +1,229 @@
+"""ジャーナル・コメントの生成と保存
+
+API（generation_mode=local）と生成ワーカー（queue）の両方から、タスクキューの
+ハンドラーとして呼ばれる。MongoDB への保存までを行い、保存したドキュメントを返す。
+保存したドキュメントは index_sync でこのプロセスの派生インデックスに反映し、
+変更イベントとして記録する（他のプロセスは index_events 経由で反映する）。
+そのため待っていたクライアントが切断した後に完了したタスクも、全ての
+API プロセスの検索・記憶に反映される。
+
+ワーカーでは保存の後・タスクの完了前に落ちると同じタスクが再実行されるため、
+保存するドキュメントにタスクの ID（task_id、一意インデックス付き）を記録し、
+保存済みのタスクは生成し直さずに保存済みのドキュメントを返す。
+"""
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from app.core.database import COLLECTIONS, get_database
+from app.core.task_queue import current_task_id, task_queue
+from app.services import index_sync
+from app.services.character_memory import character_memory
+from app.services.model_router import record_routes
+from app.services.relationship_graph import relationship_graph
+from app.services.ollama import generate_comment, generate_journal
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_TASK = "journal.generate"
+COMMENT_TASK = "comment.generate"
+
+
+async def create_indexes(db) -> None:
+    """タスクの再実行で二重に保存しないための一意インデックスを作成"""
+    for name in ("journals", "comments"):
+        try:
+            await db[COLLECTIONS[name]].create_index(
+                [("task_id", ASCENDING)], unique=True,
+                partialFilterExpression={"task_id": {"$type": "string"}}
+            )
+        except Exception as e:
+            logger.warning(f"{name} の task_id インデックスを作成できませんでした: {e}")
+
+
+async def _saved_by_task(collection) -> Optional[Dict[str, Any]]:
+    """実行中のタスクがすでに保存したドキュメント"""
+    task_id = current_task_id()
+    if task_id is None:
+        return None
+    document = await collection.find_one({"task_id": task_id})
+    if document is not None:
+        document["_id"] = str(document["_id"])
+    return document
+
+
+async def _insert_once(collection, document: Dict[str, Any]) -> Dict[str, Any]:
+    """ドキュメントを保存（同じタスクがすでに保存していれば、保存済みのものを返す）"""
+    task_id = current_task_id()
+    if task_id is not None:
+        document["task_id"] = task_id
+    try:
+        result = await collection.insert_one(document)
+    except DuplicateKeyError:
+        # リースを失った後も動いていた前の試行と競合した
+        saved = await _saved_by_task(collection)
+        if saved is None:
+            raise
+        return saved
+    document["_id"] = str(result.inserted_id)
+    return document
+
+
+async def enrich_characters_relationships(characters: List[dict], db) -> List[dict]:
+    """複数キャラクターの関係性にターゲットキャラクター名をまとめて追加
+
+    関係性グラフから名前を解決し、未構築の場合は1回のクエリで取得する
+    """
+    target_ids = {
+        rel.get("target_character_id")
+        for character in characters
+        for rel in character.get("relationships", [])
+        if rel.get("target_character_id")
+    }
+
+    names: Dict[str, str] = {}
+    if relationship_graph.loaded:
+        for target_id in target_ids:
+            name = relationship_graph.name_of(target_id)
+            if name is not None:
+                names[target_id] = name
+    else:
+        object_ids = [ObjectId(target_id) for target_id in target_ids if ObjectId.is_valid(target_id)]
+        async for target in db[COLLECTIONS["characters"]].find({"_id": {"$in": object_ids}}, {"name": 1}):
+            names[str(target["_id"])] = target["name"]
+
+    enriched_characters = []
+    for character in characters:
+        enriched_character = character.copy()
+        enriched_character["relationships"] = [
+            {
+                "target_character_id": rel.get("target_character_id"),
+                "target_character_name": names.get(rel.get("target_character_id"), "不明なキャラクター"),
+                "description": rel.get("description", "")
+            }
+            for rel in character.get("relationships", [])
+        ]
+        enriched_characters.append(enriched_character)
+    return enriched_characters
+
+
+async def enrich_character_relationships(character: dict, db) -> dict:
+    """キャラクターの関係性にターゲットキャラクター名を追加
+
+    target_character_idからキャラクター名を解決して、
+    target_character_nameフィールドを追加する
+    """
+    return (await enrich_characters_relationships([character], db))[0]
+
+
+async def generate_and_save_journal(db, character_id: str, theme: str) -> Optional[Dict[str, Any]]:
+    """1キャラクターのジャーナルを生成して保存（キャラクターが無ければ None）"""
+    saved = await _saved_by_task(db[COLLECTIONS["journals"]])
+    if saved is not None:
+        # 反映の前に中断した場合に備えて、反映からやり直す
+        index_sync.journal_saved(saved, created=True)
+        return saved
+
+    character = await db[COLLECTIONS["characters"]].find_one({"_id": ObjectId(character_id)})
+    if not character:
+        return None
+
+    # 関係性にキャラクター名を追加
+    enriched_character = await enrich_character_relationships(character, db)
+
+    # 過去の日記・コメントから関連する記憶を取得
+    memories = await character_memory.retrieve(character, theme, db)
+
+    # ジャーナルを生成（使ったモデルのルートも記録する）
+    with record_routes() as routes:
+        content = await generate_journal(enriched_character, theme, memories)
+
+    # ジャーナルを保存
+    journal_data = {
+        "character_id": character_id,
+        "theme": theme,
+        "content": content,
+        "created_at": datetime.now(),
+        "updated_at": datetime.now(),
+        "comment_ids": [],
+        "generation_route": routes[-1] if routes else None
+    }
+    journal_data = await _insert_once(db[COLLECTIONS["journals"]], journal_data)
+    index_sync.journal_saved(journal_data, created=True)
+    return journal_data
+
+
+async def generate_and_save_comment(
+    db,
+    journal_id: str,
+    character_id: str,
+    parent_comment_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """コメントを生成して保存（ジャーナル・キャラクターが無ければ LookupError）"""
+    saved = await _saved_by_task(db[COLLECTIONS["comments"]])
+    if saved is not None:
+        # コメントIDリストの更新・反映の前に中断した場合に備えて、更新からやり直す
+        await _add_comment_id(db, saved)
+        index_sync.comment_saved(saved, created=True)
+        return saved
+
+    journal = await db[COLLECTIONS["journals"]].find_one({"_id": ObjectId(journal_id)})
+    if not journal:
+        raise LookupError("ジャーナルが見つかりません")
+
+    character = await db[COLLECTIONS["characters"]].find_one({"_id": ObjectId(character_id)})
+    if not character:
+        raise LookupError("キャラクターが見つかりません")
+
+    # 関係性にキャラクター名を追加
+    enriched_character = await enrich_character_relationships(character, db)
+
+    # 既存のコメントを取得
+    existing_comments = []
+    async for comment in db[COLLECTIONS["comments"]].find({"journal_id": journal_id}).sort("created_at", 1):
+        existing_comments.append(comment)
+
+    # コメントを生成（使ったモデルのルートも記録する）
+    with record_routes() as routes:
+        content = await generate_comment(enriched_character, journal, existing_comments, parent_comment_id)
+
+    # コメントを保存
+    comment_data = {
+        "journal_id": journal_id,
+        "character_id": character_id,
+        "content": content,
+        "parent_comment_id": parent_comment_id,
+        "created_at": datetime.now(),
+        "updated_at": datetime.now(),
+        "generation_route": routes[-1] if routes else None
+    }
+    comment_data = await _insert_once(db[COLLECTIONS["comments"]], comment_data)
+    await _add_comment_id(db, comment_data)
+    index_sync.comment_saved(comment_data, created=True)
+    return comment_data
+
+
+async def _add_comment_id(db, comment: Dict[str, Any]) -> None:
+    """ジャーナルのコメントIDリストを更新（再実行しても重複しない）"""
+    await db[COLLECTIONS["journals"]].update_one(
+        {"_id": ObjectId(comment["journal_id"])},
+        {"$addToSet": {"comment_ids": comment["_id"]}}
+    )
+
+
+async def _journal_task(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    return await generate_and_save_journal(get_database(), payload["character_id"], payload["theme"])
+
+
+async def _comment_task(payload: Dict[str, Any]) -> Dict[str, Any]:
+    return await generate_and_save_comment(
+        get_database(), payload["journal_id"], payload["character_id"], payload.get("parent_comment_id")
+    )
+
+
+task_queue.register(JOURNAL_TASK, _journal_task)
+task_queue.register(COMMENT_TASK, _comment_task)
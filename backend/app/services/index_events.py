@@ -0,0 +1,161 @@
+"""派生インデックスの変更のプロセス間伝搬
+
+関係性グラフ・全文検索・セマンティック検索・記憶のキャッシュはプロセスごとに
+メモリ上に持つため、あるプロセス（APIワーカーや生成ワーカー）での書き込みを
+MongoDB の index_events コレクションに記録し、全てのプロセスがポーリングして
+自分のインデックスに反映する（index_sync.apply_event）。
+
+- イベントには変更の対象（種類・ID）だけを記録する。保存のイベントを受け取った側は
+  ドキュメントを MongoDB から読み直すため、イベントの順序が前後しても最新の状態になる
+- 自分が記録したイベントは反映済みのため無視する
+- created_at が index_event_lookback 秒前以降のイベントを毎回読み、読んだイベントの ID を
+  覚えておく。書き込みの遅れやプロセス間の時計のずれがこの範囲なら取りこぼさない
+- イベントは TTL インデックスで index_event_ttl_seconds 後に自動で削除される
+
+記録は書き込み経路を待たせないように、バックグラウンドでまとめて insert_many する。
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo import ASCENDING
+
+from app.core import metrics
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+INDEX_EVENTS_COLLECTION = "index_events"
+
+SAVED = "saved"
+DELETED = "deleted"
+REBUILD = "rebuild"
+
+EventHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class IndexEvents:
+    """変更イベントの記録と、他のプロセスのイベントの購読"""
+
+    def __init__(self):
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._collection = None
+        self._handler: Optional[EventHandler] = None
+        self._buffer: List[Dict[str, Any]] = []
+        self._buffered = asyncio.Event()
+        self._publisher: Optional[asyncio.Task] = None
+        self._consumer: Optional[asyncio.Task] = None
+        # 反映済みのイベント（ID -> created_at）
+        self._seen: Dict[Any, datetime] = {}
+
+    async def start(self, db, handler: EventHandler) -> None:
+        """記録を開始し、他のプロセスのイベントを handler で反映する"""
+        self._collection = db[INDEX_EVENTS_COLLECTION]
+        self._handler = handler
+        self._buffered = asyncio.Event()
+        try:
+            await self._collection.create_index([("created_at", ASCENDING)])
+            await self._collection.create_index("expires_at", expireAfterSeconds=0)
+        except Exception as e:
+            logger.warning(f"インデックスの変更イベントのインデックスを作成できませんでした: {e}")
+        self._publisher = asyncio.create_task(self._publish())
+        self._consumer = asyncio.create_task(self._consume())
+
+    async def stop(self) -> None:
+        tasks = [task for task in (self._consumer, self._publisher) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._consumer = self._publisher = None
+        # 終了前に記録できなかったイベントを書き出す
+        await self._flush()
+        self._collection = None
+
+    # ---- 記録 ----
+
+    def record(
+        self,
+        kind: str,
+        operation: str,
+        document_id: str,
+        journal_id: Optional[str] = None,
+        character_id: Optional[str] = None,
+        created: bool = False
+    ) -> None:
+        """変更を記録する（開始していないプロセスでは何もしない）"""
+        if self._collection is None:
+            return
+        now = datetime.now()
+        self._buffer.append({
+            "origin": self.origin,
+            "kind": kind,
+            "operation": operation,
+            "document_id": document_id,
+            "journal_id": journal_id,
+            "character_id": character_id,
+            "created": created,
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=settings.index_event_ttl_seconds),
+        })
+        self._buffered.set()
+
+    async def _publish(self) -> None:
+        while True:
+            await self._buffered.wait()
+            self._buffered.clear()
+            await self._flush()
+
+    async def _flush(self) -> None:
+        if not self._buffer or self._collection is None:
+            return
+        events, self._buffer = self._buffer, []
+        try:
+            await self._collection.insert_many(events)
+        except Exception as e:
+            logger.warning(f"インデックスの変更イベントを記録できませんでした（{len(events)}件）: {e}")
+            return
+        metrics.index_events_total.inc(len(events), direction="published")
+
+    # ---- 購読 ----
+
+    async def _consume(self) -> None:
+        while True:
+            await asyncio.sleep(settings.index_event_poll_interval)
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"インデックスの変更イベントを取得できませんでした: {e}")
+
+    async def poll(self) -> int:
+        """他のプロセスの新しいイベントを反映し、反映した件数を返す"""
+        if self._collection is None or self._handler is None:
+            return 0
+        since = datetime.now() - timedelta(seconds=settings.index_event_lookback)
+        self._seen = {event_id: created_at for event_id, created_at in self._seen.items() if created_at >= since}
+        applied = 0
+        cursor = self._collection.find(
+            {"created_at": {"$gte": since}, "origin": {"$ne": self.origin}}
+        ).sort("created_at", ASCENDING)
+        async for event in cursor:
+            if event["_id"] in self._seen:
+                continue
+            self._seen[event["_id"]] = event["created_at"]
+            try:
+                await self._handler(event)
+            except Exception as e:
+                logger.warning(f"インデックスの変更イベントを反映できませんでした（{event['kind']}:{event['document_id']}）: {e}")
+                continue
+            applied += 1
+        if applied:
+            metrics.index_events_total.inc(applied, direction="applied")
+        return applied
+
+
+# シングルトンインスタンス
+index_events = IndexEvents()
@@ -0,0 +1,187 @@
+"""派生インデックスの同期
+
+書き込み経路（API・生成ワーカー）から呼び出し、データベースの変更をインメモリの
+関係性グラフ・全文検索インデックス・セマンティック検索インデックス、
+キャラクターの記憶キャッシュへまとめて反映し、リアルタイム配信に発行する。
+
+同じ変更を index_events に記録し、他のプロセスは apply_event で自分の
+インデックスに反映する。
+"""
+from typing import Any, Dict, Iterable, Optional
+
+from bson import ObjectId
+
+from app.core.database import COLLECTIONS, get_database
+from app.services.character_memory import character_memory
+from app.services.index_events import DELETED, REBUILD, SAVED, index_events
+from app.services.live_updates import live_updates
+from app.services.relationship_graph import relationship_graph
+from app.services.search_index import search_index
+from app.services.semantic_index import SEMANTIC_KINDS, semantic_index
+
+
+def _remove_vectors(keys: Iterable[str]) -> None:
+    """全文検索のカスケード削除で消えたジャーナル・コメントのベクトルも削除"""
+    for key in keys:
+        kind, document_id = key.split(":", 1)
+        if kind in SEMANTIC_KINDS:
+            semantic_index.remove(kind, document_id)
+
+
+# ---- このプロセスのインデックスへの反映 ----
+
+def _apply_character_saved(character: Dict[str, Any]) -> None:
+    relationship_graph.upsert_character(character)
+    search_index.index_character(character)
+
+
+def _apply_character_deleted(character_id: str) -> None:
+    relationship_graph.remove_character(character_id)
+    _remove_vectors(search_index.remove_character(character_id))
+    character_memory.invalidate(character_id)
+    live_updates.publish("character", "deleted", character_id, character_id=character_id)
+
+
+def _apply_journal_saved(journal: Dict[str, Any], created: bool) -> None:
+    journal_id = str(journal["_id"])
+    search_index.index_journal(journal)
+    semantic_index.enqueue("journal", journal)
+    character_memory.journal_changed(journal_id, journal.get("character_id"))
+    live_updates.publish(
+        "journal", "created" if created else "updated", journal_id,
+        journal_id=journal_id, character_id=journal.get("character_id"), data=journal
+    )
+
+
+def _apply_journal_deleted(journal_id: str, character_id: Optional[str]) -> None:
+    # 全文検索のインデックスの構築前でも、ジャーナル自体のベクトルは削除する
+    _remove_vectors({*search_index.remove_journal(journal_id), f"journal:{journal_id}"})
+    character_memory.journal_changed(journal_id, character_id)
+    live_updates.publish("journal", "deleted", journal_id, journal_id=journal_id, character_id=character_id)
+
+
+def _apply_comment_saved(comment: Dict[str, Any], created: bool) -> None:
+    search_index.index_comment(comment)
+    semantic_index.enqueue("comment", comment)
+    character_memory.comment_changed(comment)
+    live_updates.publish(
+        "comment", "created" if created else "updated", str(comment["_id"]),
+        journal_id=comment.get("journal_id"), character_id=comment.get("character_id"), data=comment
+    )
+
+
+def _apply_comment_deleted(comment: Dict[str, Any]) -> None:
+    comment_id = str(comment["_id"])
+    search_index.remove_comment(comment_id)
+    semantic_index.remove("comment", comment_id)
+    character_memory.comment_changed(comment)
+    live_updates.publish(
+        "comment", "deleted", comment_id,
+        journal_id=comment.get("journal_id"), character_id=comment.get("character_id")
+    )
+
+
+# ---- 書き込み経路 ----
+
+def character_saved(character: Dict[str, Any]) -> None:
+    """キャラクターの作成・更新を反映"""
+    _apply_character_saved(character)
+    index_events.record("character", SAVED, str(character["_id"]))
+
+
+def characters_saved(characters: Iterable[Dict[str, Any]]) -> None:
+    """複数キャラクターの作成・更新をまとめて反映"""
+    characters = list(characters)
+    relationship_graph.upsert_characters(characters)
+    for character in characters:
+        search_index.index_character(character)
+        index_events.record("character", SAVED, str(character["_id"]))
+
+
+def character_deleted(character_id: str) -> None:
+    """キャラクターの削除（ジャーナル・コメントのカスケード削除を含む）を反映"""
+    _apply_character_deleted(character_id)
+    index_events.record("character", DELETED, character_id, character_id=character_id)
+
+
+def journal_saved(journal: Dict[str, Any], created: bool = False) -> None:
+    """ジャーナルの作成・更新を反映"""
+    _apply_journal_saved(journal, created)
+    index_events.record(
+        "journal", SAVED, str(journal["_id"]), character_id=journal.get("character_id"), created=created
+    )
+
+
+def journal_deleted(journal_id: str, character_id: Optional[str] = None) -> None:
+    """ジャーナルの削除（コメントのカスケード削除を含む）を反映"""
+    _apply_journal_deleted(journal_id, character_id)
+    index_events.record("journal", DELETED, journal_id, character_id=character_id)
+
+
+def comment_saved(comment: Dict[str, Any], created: bool = False) -> None:
+    """コメントの作成・更新を反映"""
+    _apply_comment_saved(comment, created)
+    index_events.record(
+        "comment", SAVED, str(comment["_id"]),
+        journal_id=comment.get("journal_id"), character_id=comment.get("character_id"), created=created
+    )
+
+
+def comment_deleted(comment: Dict[str, Any]) -> None:
+    """コメントの削除を反映"""
+    _apply_comment_deleted(comment)
+    index_events.record(
+        "comment", DELETED, str(comment["_id"]),
+        journal_id=comment.get("journal_id"), character_id=comment.get("character_id")
+    )
+
+
+def search_index_rebuilt() -> None:
+    """全文検索インデックスを再構築したことを他のプロセスに伝える（各プロセスでも再構築する）"""
+    index_events.record("search_index", REBUILD, "all")
+
+
+# ---- 他のプロセスの変更 ----
+
+async def _load(collection: str, document_id: str) -> Optional[Dict[str, Any]]:
+    document = await get_database()[COLLECTIONS[collection]].find_one({"_id": ObjectId(document_id)})
+    if document is not None:
+        document["_id"] = str(document["_id"])
+    return document
+
+
+async def apply_event(event: Dict[str, Any]) -> None:
+    """他のプロセスが記録した変更（index_events）をこのプロセスのインデックスに反映
+
+    保存のイベントではドキュメントを読み直し、すでに削除されていれば何もしない
+    （削除のイベントが別に届く）。
+    """
+    kind, document_id = event["kind"], event["document_id"]
+    if event["operation"] == REBUILD:
+        # 検索インデックスを持つプロセスだけ、バックグラウンドで再構築する
+        if kind == "search_index" and search_index.loaded:
+            search_index.start_background_build(get_database())
+        return
+    if event["operation"] == DELETED:
+        if kind == "character":
+            _apply_character_deleted(document_id)
+        elif kind == "journal":
+            _apply_journal_deleted(document_id, event.get("character_id"))
+        elif kind == "comment":
+            _apply_comment_deleted({
+                "_id": document_id, "journal_id": event.get("journal_id"), "character_id": event.get("character_id")
+            })
+        return
+
+    if kind == "character":
+        character = await _load("characters", document_id)
+        if character is not None:
+            _apply_character_saved(character)
+    elif kind == "journal":
+        journal = await _load("journals", document_id)
+        if journal is not None:
+            _apply_journal_saved(journal, event.get("created", False))
+    elif kind == "comment":
+        comment = await _load("comments", document_id)
+        if comment is not None:
+            _apply_comment_saved(comment, event.get("created", False))
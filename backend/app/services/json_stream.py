@@ -0,0 +1,108 @@
+"""ストリーミングJSONのインクリメンタルパーサー"""
+import json
+from typing import Any, Dict, List, Optional
+
+
+class JsonObjectStream:
+    """ストリーミングされるJSONテキストから、配列要素のオブジェクトを取り出す
+
+    {"characters": [{...}, {...}]} や [{...}, {...}] のような出力に対して、
+    配列直下のオブジェクトが閉じた時点でその部分文字列を返す。
+    JSONの前後にある説明文やコードフェンスは無視する。
+    """
+
+    def __init__(self):
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._capture: Optional[List[str]] = None
+        self._capture_depth = 0
+
+    def feed(self, chunk: str) -> List[str]:
+        """チャンクを読み込み、新たに閉じたオブジェクトの文字列を返す"""
+        completed = []
+        for char in chunk:
+            if self._capture is not None:
+                self._capture.append(char)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                # JSONの外側（説明文）の引用符は無視する
+                if self._stack:
+                    self._in_string = True
+            elif char in "{[":
+                if char == "{" and self._capture is None and self._stack and self._stack[-1] == "[":
+                    self._capture = ["{"]
+                    self._capture_depth = len(self._stack)
+                self._stack.append(char)
+            elif char in "}]" and self._stack:
+                self._stack.pop()
+                if char == "}" and self._capture is not None and len(self._stack) == self._capture_depth:
+                    completed.append("".join(self._capture))
+                    self._capture = None
+        return completed
+
+
+def _strip_comments_and_trailing_commas(text: str) -> str:
+    """文字列の外側にある // コメントと末尾カンマを取り除く"""
+    result = []
+    in_string = False
+    escape = False
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if in_string:
+            result.append(char)
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+            result.append(char)
+        elif text.startswith("//", i):
+            newline = text.find("\n", i)
+            i = len(text) if newline < 0 else newline
+            continue
+        elif char in "}]":
+            # 直前の空白を飛ばしてカンマがあれば削除
+            j = len(result) - 1
+            while j >= 0 and result[j].isspace():
+                j -= 1
+            if j >= 0 and result[j] == ",":
+                del result[j]
+            result.append(char)
+        else:
+            result.append(char)
+        i += 1
+    return "".join(result)
+
+
+def parse_json_object(raw: str) -> Optional[Dict[str, Any]]:
+    """JSONオブジェクトをパースし、失敗した場合は軽微な崩れを修復して再試行"""
+    for candidate in (raw, _strip_comments_and_trailing_commas(raw)):
+        try:
+            value = json.loads(candidate, strict=False)
+        except json.JSONDecodeError:
+            continue
+        return value if isinstance(value, dict) else None
+    return None
+
+
+def extract_json_object(text: str) -> Optional[Dict[str, Any]]:
+    """テキスト中の最初のJSONオブジェクトを取り出してパース"""
+    start = text.find("{")
+    end = text.rfind("}")
+    if start < 0 or end <= start:
+        return None
+    return parse_json_object(text[start:end + 1])
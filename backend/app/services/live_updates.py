@@ -0,0 +1,307 @@
+"""ジャーナル・コメントのリアルタイム配信
+
+ジャーナル・コメントの作成・更新・削除を差分イベントとして購読者に配信する。
+
+- レプリカセットでは MongoDB の change stream を購読する。どのプロセス（他の
+  APIワーカーや生成ワーカー）からの書き込みも届き、イベントIDには change stream の
+  再開トークンを使う。
+- change stream が使えない単体の MongoDB では、index_sync から呼ばれる
+  プロセス内のパブリッシャーで配信する（このプロセスでの書き込みのみ）。
+
+購読者ごとにキューの上限があり、溢れた購読者にはイベントを捨てて reset イベントを
+送る（クライアントは取り直す）。最近のイベントはリングバッファに残し、再接続時に
+Last-Event-ID 以降を再送する。バッファに無い場合は change stream を再開トークンから
+開き直して追いつく。
+"""
+import asyncio
+import itertools
+import logging
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Any, AsyncIterator, Deque, Dict, Iterable, List, Optional, Set
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.database import COLLECTIONS
+
+logger = logging.getLogger(__name__)
+
+# change stream の操作 -> イベントの操作
+_OPERATIONS = {"insert": "created", "update": "updated", "replace": "updated", "delete": "deleted"}
+
+# change stream が一時的に切れたときに開き直すまでの秒数
+RECONNECT_DELAY = 1.0
+
+
+def _plain(value: Any) -> Any:
+    """ObjectId・datetime を JSON にできる値に変換"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    return value
+
+
+def _event(
+    kind: str,
+    operation: str,
+    document_id: str,
+    journal_id: Optional[str],
+    character_id: Optional[str],
+    data: Optional[Dict[str, Any]]
+) -> Dict[str, Any]:
+    return {
+        "type": f"{kind}.{operation}",
+        "kind": kind,
+        "operation": operation,
+        "document_id": document_id,
+        "journal_id": journal_id,
+        "character_id": character_id,
+        "data": _plain(data) if data is not None else None,
+        "timestamp": datetime.now().isoformat(),
+    }
+
+
+class Subscription:
+    """1クライアントの購読条件と送信待ちのキュー"""
+
+    def __init__(self, journal_ids: Iterable[str] = (), character_ids: Iterable[str] = ()):
+        self.journal_ids: Set[str] = set(journal_ids)
+        self.character_ids: Set[str] = set(character_ids)
+        self.queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=settings.live_queue_size)
+        self.overflowed = False
+
+    def matches(self, event: Dict[str, Any]) -> bool:
+        if not self.journal_ids and not self.character_ids:
+            return True
+        if event["journal_id"] in self.journal_ids or event["character_id"] in self.character_ids:
+            return True
+        # change stream の削除イベントには本文が無く、どのジャーナルのものか分からないため全員に送る
+        return event["operation"] == "deleted" and event["journal_id"] is None and event["character_id"] is None
+
+    def offer(self, event: Dict[str, Any]) -> None:
+        if self.overflowed or not self.matches(event):
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # 読み出しが追いつかないクライアント。以降は reset を送るまで捨てる
+            self.overflowed = True
+            metrics.live_events_dropped_total.inc()
+
+
+class LiveUpdates:
+    """イベントの発行（change stream またはプロセス内）と購読者への配信"""
+
+    def __init__(self):
+        self._db = None
+        self._watcher: Optional[asyncio.Task] = None
+        self._subscribers: Set[Subscription] = set()
+        self._buffer: Deque[Dict[str, Any]] = deque(maxlen=settings.live_buffer_size)
+        self._resume_token: Optional[Dict[str, Any]] = None
+        # プロセス内で発行したイベントのIDは、プロセスごとの接頭辞と連番
+        self._local_prefix = f"local-{uuid.uuid4().hex[:8]}-"
+        self._sequence = itertools.count(1)
+        self.change_stream_active = False
+
+    @property
+    def mode(self) -> str:
+        return "change_stream" if self.change_stream_active else "in_process"
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    async def start(self, db) -> None:
+        self._db = db
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+        self.change_stream_active = False
+
+    # ---- 発行 ----
+
+    def _dispatch(self, event_id: str, event: Dict[str, Any]) -> None:
+        event["id"] = event_id
+        self._buffer.append(event)
+        metrics.live_events_total.inc(type=event["type"])
+        for subscription in list(self._subscribers):
+            subscription.offer(event)
+
+    def publish(
+        self,
+        kind: str,
+        operation: str,
+        document_id: str,
+        journal_id: Optional[str] = None,
+        character_id: Optional[str] = None,
+        data: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """書き込み経路（index_sync）から呼ばれるプロセス内のパブリッシャー
+
+        change stream が動いている間は、同じ変更がそちらから届くため何もしない。
+        """
+        if self.change_stream_active:
+            return
+        event = _event(kind, operation, document_id, journal_id, character_id, data)
+        self._dispatch(f"{self._local_prefix}{next(self._sequence)}", event)
+
+    def _pipeline(self) -> List[Dict[str, Any]]:
+        return [{"$match": {
+            "ns.coll": {"$in": [COLLECTIONS["journals"], COLLECTIONS["comments"]]},
+            "operationType": {"$in": list(_OPERATIONS)},
+        }}]
+
+    def _from_change(self, change: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """change stream のイベントを差分イベントに変換"""
+        operation = _OPERATIONS.get(change.get("operationType", ""))
+        if operation is None:
+            return None
+        kind = "journal" if change["ns"]["coll"] == COLLECTIONS["journals"] else "comment"
+        document_id = str(change["documentKey"]["_id"])
+        document = change.get("fullDocument") or {}
+
+        data: Optional[Dict[str, Any]]
+        if operation == "created":
+            data = {**document, "_id": document_id}
+        elif operation == "updated" and "updateDescription" in change:
+            description = change["updateDescription"]
+            data = {"updated_fields": description.get("updatedFields", {}),
+                    "removed_fields": description.get("removedFields", [])}
+        elif operation == "updated":
+            data = {**document, "_id": document_id}
+        else:
+            data = None
+
+        journal_id: Optional[str]
+        if kind == "journal":
+            journal_id = document_id
+        else:
+            journal_id = document.get("journal_id")
+        # 削除では本文が無いため、ジャーナルIDも分からない（全購読者に送る）
+        if operation == "deleted":
+            journal_id = document_id if kind == "journal" else None
+        return _event(kind, operation, document_id, journal_id, document.get("character_id"), data)
+
+    async def _watch(self) -> None:
+        """change stream を購読する（使えない場合はプロセス内の発行に任せる）"""
+        while True:
+            try:
+                async with self._db.watch(
+                    self._pipeline(), full_document="updateLookup", resume_after=self._resume_token
+                ) as stream:
+                    if not self.change_stream_active:
+                        logger.info("ジャーナル・コメントの変更を change stream で配信します")
+                    self.change_stream_active = True
+                    async for change in stream:
+                        self._resume_token = change["_id"]
+                        event = self._from_change(change)
+                        if event is not None:
+                            self._dispatch(change["_id"]["_data"], event)
+            except asyncio.CancelledError:
+                raise
+            except (OperationFailure, NotImplementedError, AttributeError) as e:
+                if not self.change_stream_active:
+                    logger.info(f"change stream を使えないため、このプロセスでの変更のみ配信します: {e}")
+                    return
+                # 再開トークンが古すぎる場合などは現在位置から開き直す
+                logger.warning(f"change stream を開き直します: {e}")
+                self._resume_token = None
+            except Exception as e:
+                logger.warning(f"change stream が切断されました: {e}")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    # ---- 購読 ----
+
+    async def _replay(self, last_event_id: str, subscription: Subscription) -> Optional[List[Dict[str, Any]]]:
+        """last_event_id より後のイベント（追いつけない場合は None）"""
+        ids = [event["id"] for event in self._buffer]
+        if last_event_id in ids:
+            position = ids.index(last_event_id)
+            return [event for event in list(self._buffer)[position + 1:] if subscription.matches(event)]
+        if not self.change_stream_active or last_event_id.startswith("local-"):
+            return None
+
+        events: List[Dict[str, Any]] = []
+        try:
+            async with self._db.watch(
+                self._pipeline(), full_document="updateLookup", resume_after={"_data": last_event_id}
+            ) as stream:
+                while True:
+                    change = await stream.try_next()
+                    if change is None:
+                        return events
+                    event = self._from_change(change)
+                    if event is None:
+                        continue
+                    event["id"] = change["_id"]["_data"]
+                    if subscription.matches(event):
+                        events.append(event)
+                    if len(events) > settings.live_replay_limit:
+                        return None
+        except PyMongoError as e:
+            logger.info(f"再開トークンから再開できませんでした: {e}")
+            return None
+
+    def _reset(self, reason: str) -> Dict[str, Any]:
+        """取り直しを求めるイベント（ID は最新のイベント）"""
+        return {
+            "id": self._buffer[-1]["id"] if self._buffer else None,
+            "type": "reset",
+            "reason": reason,
+            "timestamp": datetime.now().isoformat(),
+        }
+
+    async def events(
+        self,
+        subscription: Subscription,
+        last_event_id: Optional[str] = None
+    ) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """購読者へ送るイベント（None はハートビート）"""
+        # 再送の間に届いたイベントを取りこぼさないよう、先に登録する
+        self._subscribers.add(subscription)
+        metrics.live_subscribers.inc()
+        try:
+            replayed: Set[str] = set()
+            if last_event_id:
+                events = await self._replay(last_event_id, subscription)
+                if events is None:
+                    yield self._reset("resume_unavailable")
+                else:
+                    for event in events:
+                        replayed.add(event["id"])
+                        yield event
+
+            while True:
+                if subscription.overflowed:
+                    while not subscription.queue.empty():
+                        subscription.queue.get_nowait()
+                    subscription.overflowed = False
+                    yield self._reset("overflow")
+                    continue
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), settings.live_heartbeat_interval)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event["id"] in replayed:
+                    continue
+                yield event
+        finally:
+            self._subscribers.discard(subscription)
+            metrics.live_subscribers.dec()
+
+
+live_updates = LiveUpdates()
@@ -0,0 +1,83 @@
+"""Ollama のモデルの事前読み込み
+
+Ollama はしばらく呼び出されないモデルをメモリから降ろすため、起動直後や
+モデルを切り替えた直後の最初の呼び出しはモデルの読み込み（数秒〜数十秒）を待つ。
+起動時と設定の変更時に、使う予定のOllamaのモデル（ai_provider が ollama の
+場合のモデルと、llm_routing のルートに含まれるOllamaのモデル）を読み込んでおく。
+読み込んだモデルは ollama_keep_alive の間メモリに残る。
+
+読み込みに失敗しても起動・設定の変更は止めない（最初の呼び出しで読み込まれる）。
+"""
+import asyncio
+import contextvars
+import logging
+from typing import List, Set
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.settings_store import ProviderSettings, settings_store
+from app.services.ai_provider import OllamaProvider, ProviderConfig
+
+logger = logging.getLogger(__name__)
+
+
+def ollama_targets(current: ProviderSettings) -> List[ProviderConfig]:
+    """設定で使うOllamaのモデル"""
+    models = []
+    if current.ai_provider == "ollama":
+        models.append(current.ollama_model)
+    for route in current.llm_routing.values():
+        for target in route.targets:
+            if target.provider == "ollama":
+                models.append(target.model or current.ollama_model)
+    base_url = current.ollama_api_url.rstrip("/")
+    return [ProviderConfig(provider="ollama", model=model, base_url=base_url, api_key=None) for model in dict.fromkeys(models)]
+
+
+class ModelPreloader:
+    """起動時・設定の変更時にOllamaのモデルを読み込む"""
+
+    def __init__(self):
+        self._tasks: Set["asyncio.Task[None]"] = set()
+        self._listening = False
+
+    def start(self) -> None:
+        if not settings.ollama_preload:
+            return
+        if not self._listening:
+            settings_store.add_listener(self._settings_changed)
+            self._listening = True
+        self._preload(ollama_targets(settings_store.current))
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _settings_changed(self, previous: ProviderSettings, current: ProviderSettings) -> None:
+        # 接続先・モデルが変わったものだけ読み込む
+        loaded = set(ollama_targets(previous))
+        self._preload([config for config in ollama_targets(current) if config not in loaded])
+
+    def _preload(self, configs: List[ProviderConfig]) -> None:
+        for config in configs:
+            # リクエストの処理中に設定が変わった場合も、そのリクエストの期限などは引き継がない
+            task = asyncio.create_task(self._load(config), context=contextvars.Context())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _load(self, config: ProviderConfig) -> None:
+        try:
+            await OllamaProvider(config).preload()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.ollama_warmups_total.inc(model=config.model, status="error")
+            logger.warning(f"Ollamaのモデル {config.model} を読み込めませんでした: {e}")
+            return
+        metrics.ollama_warmups_total.inc(model=config.model, status="ok")
+        logger.info(f"Ollamaのモデル {config.model} を読み込みました")
+
+
+model_preloader = ModelPreloader()
@@ -0,0 +1,368 @@
+"""タスク種別ごとのモデルのルーティング
+
+ジャーナル・コメント・Friends Discovery・要約・接続テストの LLM 呼び出しを、
+プロバイダー設定の llm_routing に従ってタスク種別ごとのプロバイダー・モデルに
+振り分ける。ルートは設定ストアに保存されるため、実行中に変更でき、全ての
+ワーカーに反映される。ルートの無いタスク種別は従来どおり ai_provider の設定で呼び出す。
+
+- ルートの候補（targets）を先頭から順に試し、失敗したら次の候補にフォールバックする
+  （ストリーミングでは最初のチャンクを返す前の失敗のみ）
+- 候補ごと・タスク種別ごとに直近の応答時間を記録し、p95 が latency_budget_ms を
+  超える候補は飛ばす。記録は LATENCY_WINDOW_SECONDS で古くなるため、飛ばした候補も
+  いずれ試し直す
+- 入力トークン数と想定出力トークン数から料金を見積もり、cost_budget_usd を超える
+  候補は飛ばす（料金の分からないモデルは飛ばさない）
+
+ルートの hedge を有効にすると、候補が最初のトークン（一括生成では応答）を
+直近の p95（llm_hedge_percentile）の時間内に返さない場合に、次の候補にも同じ
+リクエストを送る（ヘッジ）。先に成功した方を使い、もう一方は取り消す。
+候補が失敗した場合は待たずにすぐ次の候補に切り替える。
+
+使ったルートは record_routes() の範囲で集められ、生成したドキュメントに
+generation_route として保存する。
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import aclosing, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+from app.core import metrics
+from app.core.config import GenerationTask, settings
+from app.core.deadline import DeadlineExceeded
+from app.core.settings_store import TaskRoute, provider_settings
+from app.services import ai_provider
+from app.services.ai_provider import GenerationOptions, ProviderConfig
+from app.services.tokenizer import estimate_cost, estimate_token_count
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 料金の見積もりに使う、タスク種別ごとの想定出力トークン数
+EXPECTED_OUTPUT_TOKENS: Dict[str, int] = {
+    "journal": 2000,
+    "comment": 400,
+    "discovery": 1500,
+    "summary": 500,
+    "connection_test": 20,
+}
+
+# 応答時間の記録を残す秒数・件数と、パーセンタイルを使い始める件数
+LATENCY_WINDOW_SECONDS = 600.0
+LATENCY_WINDOW_SIZE = 100
+MIN_LATENCY_SAMPLES = 5
+
+_routes: ContextVar[Optional[List[Dict[str, Any]]]] = ContextVar("llm_routes", default=None)
+
+
+@contextmanager
+def record_routes() -> Iterator[List[Dict[str, Any]]]:
+    """この範囲（とここから作ったタスク）の呼び出しで使ったルートを集める"""
+    routes: List[Dict[str, Any]] = []
+    token = _routes.set(routes)
+    try:
+        yield routes
+    finally:
+        _routes.reset(token)
+
+
+def _target_key(task: str, config: ProviderConfig) -> Tuple[str, str, str]:
+    return (task, config.provider, config.model)
+
+
+class ModelRouter:
+    """ルートの候補の選択と、候補ごとの応答時間の記録"""
+
+    def __init__(self):
+        # 種別（latency: 応答全体 / ttft: 最初のトークン） -> (タスク種別, プロバイダー, モデル) -> (記録した時刻, 秒数)
+        self._samples: Dict[str, Dict[Tuple[str, str, str], Deque[Tuple[float, float]]]] = {
+            "latency": {},
+            "ttft": {},
+        }
+        # タスク種別 -> [ルーティングした呼び出し数, ヘッジした呼び出し数]
+        self._hedge_counts: Dict[str, List[int]] = {}
+
+    def observe(self, task: str, config: ProviderConfig, seconds: float, kind: str = "latency") -> None:
+        samples = self._samples[kind].setdefault(_target_key(task, config), deque(maxlen=LATENCY_WINDOW_SIZE))
+        samples.append((time.monotonic(), seconds))
+
+    def percentile(self, task: str, config: ProviderConfig, q: float, kind: str = "latency") -> Optional[float]:
+        """直近の応答時間のパーセンタイル（秒。記録が少なければ None）"""
+        return self._percentile(self._samples[kind].get(_target_key(task, config)), q)
+
+    def latency_p95(self, task: str, config: ProviderConfig) -> Optional[float]:
+        return self.percentile(task, config, 0.95)
+
+    def _percentile(self, samples: Optional[Deque[Tuple[float, float]]], q: float) -> Optional[float]:
+        if not samples:
+            return None
+        since = time.monotonic() - LATENCY_WINDOW_SECONDS
+        values = sorted(seconds for recorded_at, seconds in samples if recorded_at >= since)
+        if len(values) < MIN_LATENCY_SAMPLES:
+            return None
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+    def hedge_delay(self, task: str, config: ProviderConfig, kind: str) -> float:
+        """この候補の応答を待ってからヘッジするまでの秒数"""
+        delay = self.percentile(task, config, settings.llm_hedge_percentile, kind)
+        if delay is None:
+            return settings.llm_hedge_initial_delay
+        return max(delay, settings.llm_hedge_min_delay)
+
+    def count_request(self, task: str, hedged: bool) -> None:
+        counts = self._hedge_counts.setdefault(task, [0, 0])
+        counts[0] += 1
+        counts[1] += int(hedged)
+
+    def route(self, task: GenerationTask) -> Optional[TaskRoute]:
+        return provider_settings().llm_routing.get(task)
+
+    def hedging(self, task: GenerationTask) -> bool:
+        route = self.route(task)
+        return route is not None and route.hedge
+
+    def _skip_reason(self, task: str, route: TaskRoute, config: ProviderConfig, prompt: str) -> Optional[str]:
+        if route.latency_budget_ms is not None:
+            p95 = self.latency_p95(task, config)
+            if p95 is not None and p95 * 1000 > route.latency_budget_ms:
+                return "skipped_latency"
+        if route.cost_budget_usd is not None:
+            cost = estimate_cost(
+                config.model, estimate_token_count(prompt), EXPECTED_OUTPUT_TOKENS[task], config.provider
+            )
+            if cost is not None and cost > route.cost_budget_usd:
+                return "skipped_cost"
+        return None
+
+    def candidates(self, task: GenerationTask, prompt: str) -> List[ProviderConfig]:
+        """試す順の接続設定"""
+        route = self.route(task)
+        if route is None:
+            return [ProviderConfig.from_settings()]
+        configs = [ProviderConfig.from_settings(target.provider, model=target.model) for target in route.targets]
+        within_budget = []
+        for config in configs:
+            reason = self._skip_reason(task, route, config, prompt)
+            if reason is None:
+                within_budget.append(config)
+            else:
+                metrics.llm_route_attempts_total.inc(
+                    task=task, provider=config.provider, model=config.model, status=reason
+                )
+        if not within_budget:
+            logger.info(f"{task} のルートに予算内の候補が無いため、予算を無視して順に試します")
+        return within_budget or configs
+
+    def stats(self) -> Dict[str, Any]:
+        """候補ごとの直近の応答時間と、タスク種別ごとのヘッジ率"""
+        targets = []
+        for (task, provider, model), samples in self._samples["latency"].items():
+            p95 = self._percentile(samples, 0.95)
+            ttft_p95 = self._percentile(self._samples["ttft"].get((task, provider, model)), 0.95)
+            targets.append({
+                "task": task,
+                "provider": provider,
+                "model": model,
+                "samples": len(samples),
+                "latency_p95_ms": None if p95 is None else round(p95 * 1000, 1),
+                "ttft_p95_ms": None if ttft_p95 is None else round(ttft_p95 * 1000, 1),
+            })
+        hedging = {
+            task: {"requests": requests, "hedged": hedged, "hedge_rate": round(hedged / requests, 4) if requests else 0.0}
+            for task, (requests, hedged) in self._hedge_counts.items()
+        }
+        return {"targets": targets, "hedging": hedging}
+
+
+model_router = ModelRouter()
+
+
+def _succeeded(task: str, config: ProviderConfig, attempt: int, seconds: float, hedged: bool) -> None:
+    model_router.observe(task, config, seconds)
+    metrics.llm_route_attempts_total.inc(task=task, provider=config.provider, model=config.model, status="ok")
+    routes = _routes.get()
+    if routes is not None:
+        routes.append({
+            "task": task,
+            "provider": config.provider,
+            "model": config.model,
+            "attempt": attempt,
+            "fallback": attempt > 0,
+            "hedged": hedged,
+            "latency_ms": round(seconds * 1000, 1),
+            "settings_version": provider_settings().version,
+        })
+
+
+def _failed(task: str, config: ProviderConfig, error: BaseException, last: bool) -> None:
+    metrics.llm_route_attempts_total.inc(task=task, provider=config.provider, model=config.model, status="failed")
+    if not last:
+        logger.warning(f"{task} の {config.provider}/{config.model} が失敗したため次の候補を試します: {error}")
+
+
+async def _race(
+    task: GenerationTask,
+    candidates: List[ProviderConfig],
+    attempt: Callable[[ProviderConfig], Awaitable[T]],
+    delay_kind: str,
+    discard: Optional[Callable[[T], Awaitable[None]]] = None
+) -> Tuple[T, int, bool]:
+    """候補を順に試し、(結果, 成功した候補の位置, ヘッジしたか) を返す
+
+    失敗したらすぐ次の候補を試す。ヘッジが有効なら、最後に送った候補が
+    hedge_delay の間に応答しない場合にも次の候補を送り、先に成功した方を使う。
+    """
+    hedge = model_router.hedging(task) and len(candidates) > 1
+    pending: Dict["asyncio.Future[T]", int] = {}
+    launched_at: Dict[int, float] = {}
+    hedged = False
+    last_error: Optional[BaseException] = None
+    winner: Optional[Tuple[T, int]] = None
+    returned = False
+    # 使わなかった成功結果（どの経路で抜けても discard で閉じる）
+    unused: List[T] = []
+
+    def launch() -> None:
+        index = len(launched_at)
+        launched_at[index] = time.perf_counter()
+        pending[asyncio.ensure_future(attempt(candidates[index]))] = index
+
+    launch()
+    try:
+        while pending:
+            timeout = None
+            if hedge and len(launched_at) < len(candidates):
+                latest = len(launched_at) - 1
+                hedge_at = launched_at[latest] + model_router.hedge_delay(task, candidates[latest], delay_kind)
+                timeout = max(hedge_at - time.perf_counter(), 0.0)
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # 応答が遅い。次の候補にも送る
+                backup = candidates[len(launched_at)]
+                metrics.llm_hedges_total.inc(task=task, provider=backup.provider, model=backup.model)
+                hedged = True
+                launch()
+                continue
+
+            expired: Optional[DeadlineExceeded] = None
+            for finished in done:
+                index = pending.pop(finished)
+                if finished.cancelled():
+                    continue
+                error = finished.exception()
+                if error is None:
+                    if winner is None:
+                        winner = (finished.result(), index)
+                    else:
+                        # 同時に成功した候補の結果は捨てる
+                        unused.append(finished.result())
+                elif isinstance(error, DeadlineExceeded):
+                    expired = error
+                else:
+                    last_error = error
+                    _failed(task, candidates[index], error, last=not pending and len(launched_at) == len(candidates))
+            if winner is not None:
+                result, index = winner
+                model_router.count_request(task, hedged)
+                if hedged:
+                    metrics.llm_hedged_requests_total.inc(task=task, winner="primary" if index == 0 else "backup")
+                returned = True
+                return result, index, hedged
+            if expired is not None:
+                # 期限切れは他の候補でも間に合わない
+                model_router.count_request(task, hedged)
+                raise expired
+            if not pending and len(launched_at) < len(candidates):
+                launch()
+        model_router.count_request(task, hedged)
+        raise last_error or asyncio.CancelledError()
+    finally:
+        # 負けた候補は取り消す（HTTPリクエストも中断される）
+        for loser in pending:
+            loser.cancel()
+        if pending:
+            results = await asyncio.gather(*pending, return_exceptions=True)
+            # 取り消す前に成功していた候補の結果も捨てる
+            unused.extend(result for result in results if not isinstance(result, BaseException))
+        if winner is not None and not returned:
+            unused.append(winner[0])
+        if discard is not None:
+            for result in unused:
+                try:
+                    await discard(result)
+                except Exception as e:
+                    logger.warning(f"使わなかった候補の結果を閉じられませんでした: {e}")
+
+
+async def generate_text(task: GenerationTask, prompt: str) -> str:
+    """タスク種別のルートでテキストを生成（一括生成のため応答全体の時間でヘッジする）"""
+    candidates = model_router.candidates(task, prompt)
+
+    async def attempt(config: ProviderConfig) -> Tuple[str, float]:
+        started = time.perf_counter()
+        text = await ai_provider.generate_text(prompt, config, task=task)
+        return text, time.perf_counter() - started
+
+    (result, elapsed), index, hedged = await _race(task, candidates, attempt, "latency")
+    _succeeded(task, candidates[index], index, elapsed, hedged)
+    return result
+
+
+async def _open_stream(
+    task: GenerationTask,
+    prompt: str,
+    json_schema: Optional[Dict[str, Any]],
+    options: Optional[GenerationOptions],
+    config: ProviderConfig
+) -> Tuple[AsyncGenerator[str, None], Optional[str], float]:
+    """ストリームを開いて最初のチャンクまで読む（(ストリーム, 最初のチャンク, 秒数)）"""
+    started = time.perf_counter()
+    chunks = ai_provider.stream_text(prompt, json_schema, options, config, task=task)
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except BaseException:
+        await chunks.aclose()
+        raise
+    return chunks, first, time.perf_counter() - started
+
+
+async def _close_stream(opened: Tuple[AsyncGenerator[str, None], Optional[str], float]) -> None:
+    await opened[0].aclose()
+
+
+async def stream_text(
+    task: GenerationTask,
+    prompt: str,
+    json_schema: Optional[Dict[str, Any]] = None,
+    options: Optional[GenerationOptions] = None
+) -> AsyncGenerator[str, None]:
+    """タスク種別のルートでストリーミング生成
+
+    フォールバック・ヘッジは最初のチャンクまで。以降の失敗はそのまま呼び出し元に返す。
+    """
+    candidates = model_router.candidates(task, prompt)
+    start = time.perf_counter()
+
+    async def attempt(config: ProviderConfig) -> Tuple[AsyncGenerator[str, None], Optional[str], float]:
+        return await _open_stream(task, prompt, json_schema, options, config)
+
+    (chunks, first, ttft), index, hedged = await _race(task, candidates, attempt, "ttft", _close_stream)
+    config = candidates[index]
+    model_router.observe(task, config, ttft, kind="ttft")
+    async with aclosing(chunks):
+        try:
+            if first is not None:
+                yield first
+            async for chunk in chunks:
+                yield chunk
+        except (asyncio.CancelledError, GeneratorExit):
+            raise
+        except Exception as e:
+            _failed(task, config, e, last=True)
+            raise
+    _succeeded(task, config, index, time.perf_counter() - start, hedged)
@@ -1,20 +1,39 @@
 """AI API連携サービス (旧Ollama専用 -> 汎用AI対応)"""
-import json
-from typing import Dict, List, Any, Optional
-from app.services.ai_provider import generate_text
+import asyncio
+import itertools
+import math
+import random
+from contextlib import aclosing
+from typing import Dict, List, Any, Optional, AsyncGenerator, Iterable
+from app.core.config import GenerationTask
+from app.services.ai_provider import generate_text, GenerationOptions
+from app.services import model_router
+from app.services.dedup import select_distinct
+from app.services.json_stream import JsonObjectStream, parse_json_object, extract_json_object
+from app.core import tracing
 from app.prompts import journal_prompt, comment_prompt, friends_discovery_prompt
 
-async def call_ollama(prompt: str) -> str:
-    """AI APIを呼び出し (後方互換性のため関数名維持)"""
-    return await generate_text(prompt)
+async def call_ollama(prompt: str, task: Optional[GenerationTask] = None) -> str:
+    """AI APIを呼び出し (後方互換性のため関数名維持)
 
-async def generate_journal(character: Dict[str, Any], theme: str) -> str:
+    task を指定すると、そのタスク種別のルート（llm_routing）で呼び出す。
+    """
+    if task is None:
+        return await generate_text(prompt)
+    return await model_router.generate_text(task, prompt)
+
+async def generate_journal(
+    character: Dict[str, Any],
+    theme: str,
+    memories: Optional[List[Dict[str, Any]]] = None
+) -> str:
     """ジャーナルエントリーを生成"""
     # プロンプトを構築
-    prompt = journal_prompt.create_journal_prompt(character, theme)
+    with tracing.span("prompt.render", template="journal"):
+        prompt = journal_prompt.create_journal_prompt(character, theme, memories)
     
     # Ollamaを呼び出し
-    response = await call_ollama(prompt)
+    response = await call_ollama(prompt, "journal")
     
     # "Dear Diary"で始まることを確認
     if not response.strip().startswith("Dear Diary"):
@@ -30,45 +49,152 @@ async def generate_comment(
 ) -> str:
     """コメントを生成"""
     # プロンプトを構築
-    prompt = comment_prompt.create_comment_prompt(
-        character, journal, existing_comments, parent_comment_id
-    )
+    with tracing.span("prompt.render", template="comment"):
+        prompt = comment_prompt.create_comment_prompt(
+            character, journal, existing_comments, parent_comment_id
+        )
     
     # Ollamaを呼び出し
-    response = await call_ollama(prompt)
+    response = await call_ollama(prompt, "comment")
     
     return response.strip()
 
+# Friends Discoveryで1回に生成するキャラクター数
+DISCOVERY_COUNT = 3
+
+# 崩れたキャラクターを作り直す最大回数
+MAX_REGENERATE_ATTEMPTS = 2
+
+# 候補を複数生成する場合の並列呼び出し数の上限と、重複除去を見込んだ多めの生成倍率
+MAX_DISCOVERY_CALLS = 8
+DISCOVERY_OVERSAMPLE = 1.5
+
+# 並列呼び出しごとに変える温度
+DISCOVERY_TEMPERATURES = (0.7, 0.9, 1.0, 0.8, 1.1, 0.75, 0.95, 1.05)
+
+DISCOVERY_FIELDS = ("name", "introduction", "backstory", "my_relationship", "your_relationship")
+
+def validate_discovered_character(value: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """生成されたキャラクターに必須項目が揃っているか確認"""
+    if not value:
+        return None
+    if not all(isinstance(value.get(field), str) and value[field].strip() for field in DISCOVERY_FIELDS):
+        return None
+    return {field: value[field].strip() for field in DISCOVERY_FIELDS}
+
+async def regenerate_discovered_character(
+    character: Dict[str, Any],
+    relationship_phrase: str,
+    exclude_names: List[str],
+    options: Optional[GenerationOptions] = None
+) -> Optional[Dict[str, Any]]:
+    """崩れたキャラクター1人分だけを作り直す"""
+    with tracing.span("prompt.render", template="friends_discovery_single"):
+        prompt = friends_discovery_prompt.create_single_character_prompt(
+            character, relationship_phrase, exclude_names
+        )
+    for _ in range(MAX_REGENERATE_ATTEMPTS):
+        chunks = model_router.stream_text("discovery", prompt, friends_discovery_prompt.CHARACTER_SCHEMA, options)
+        response = "".join([chunk async for chunk in chunks])
+        candidate = validate_discovered_character(extract_json_object(response))
+        if candidate:
+            return candidate
+    return None
+
+async def stream_friends_discovery(
+    character: Dict[str, Any],
+    relationship_phrase: str,
+    options: Optional[GenerationOptions] = None
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """Friends Discoveryで新しいキャラクターを生成し、1人分が完成するたびに返す
+
+    JSONモード・構造化出力でストリーミングし、配列内のオブジェクトが閉じた時点で
+    パースする。崩れたキャラクターは、ストリームの残りと並行してその1人分だけ作り直す。
+    """
+    with tracing.span("prompt.render", template="friends_discovery"):
+        prompt = friends_discovery_prompt.create_discovery_prompt(character, relationship_phrase)
+    parser = JsonObjectStream()
+    emitted: List[Dict[str, Any]] = []
+    repairs: List[asyncio.Task] = []
+
+    def names() -> List[str]:
+        return [candidate["name"] for candidate in emitted]
+
+    try:
+        chunks = model_router.stream_text("discovery", prompt, friends_discovery_prompt.FRIENDS_DISCOVERY_SCHEMA, options)
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                for raw in parser.feed(chunk):
+                    if len(emitted) + len(repairs) >= DISCOVERY_COUNT:
+                        break
+                    candidate = validate_discovered_character(parse_json_object(raw))
+                    if candidate:
+                        emitted.append(candidate)
+                        yield candidate
+                    else:
+                        repairs.append(asyncio.create_task(
+                            regenerate_discovered_character(character, relationship_phrase, names(), options)
+                        ))
+                if len(emitted) + len(repairs) >= DISCOVERY_COUNT:
+                    # 人数がそろったら残りの生成を待たずにストリームを閉じる（LLMへのリクエストも中断される）
+                    break
+
+        # 途中で切れた・足りない分も1人ずつ作り直す
+        missing = DISCOVERY_COUNT - len(emitted) - len(repairs)
+        for _ in range(max(missing, 0)):
+            repairs.append(asyncio.create_task(
+                regenerate_discovered_character(character, relationship_phrase, names(), options)
+            ))
+
+        for repair in asyncio.as_completed(repairs):
+            candidate = await repair
+            if candidate:
+                emitted.append(candidate)
+                yield candidate
+    finally:
+        for repair in repairs:
+            repair.cancel()
+
 async def generate_friends_discovery(
     character: Dict[str, Any],
-    relationship_phrase: str
+    relationship_phrase: str,
+    options: Optional[GenerationOptions] = None
 ) -> List[Dict[str, Any]]:
     """Friends Discoveryで新しいキャラクターを生成"""
-    # プロンプトを構築
-    prompt = friends_discovery_prompt.create_discovery_prompt(character, relationship_phrase)
-    
-    # Ollamaを呼び出し
-    response = await call_ollama(prompt)
-    
-    # JSON形式でパース
-    try:
-        # レスポンスからJSON部分を抽出
-        import re
-        json_match = re.search(r'\{.*\}', response, re.DOTALL)
-        if json_match:
-            result = json.loads(json_match.group())
-            return result.get("characters", [])
-    except json.JSONDecodeError:
-        # JSONパースに失敗した場合はデフォルトの構造を返す
-        pass
-    
-    # フォールバック: 基本的な構造を返す
-    return [
-        {
-            "name": "新キャラクター1",
-            "introduction": "キャラクターの紹介",
-            "backstory": "キャラクターの背景",
-            "my_relationship": f"{character['name']}との関係",
-            "your_relationship": f"{character['name']}から見た関係"
-        }
-    ]
\ No newline at end of file
+    return [candidate async for candidate in stream_friends_discovery(character, relationship_phrase, options)]
+
+async def generate_friends_candidates(
+    character: Dict[str, Any],
+    relationship_phrase: str,
+    count: Optional[int] = None,
+    existing_names: Iterable[str] = ()
+) -> List[Dict[str, Any]]:
+    """温度・シードを変えた並列呼び出しで候補を集め、重複を除いた最大count人を返す
+
+    count を省略した場合は従来どおり1回の呼び出し（DISCOVERY_COUNT人）で済ませる。
+    """
+    if count is None:
+        count, calls = DISCOVERY_COUNT, 1
+    else:
+        calls = max(1, min(MAX_DISCOVERY_CALLS, math.ceil(count * DISCOVERY_OVERSAMPLE / DISCOVERY_COUNT)))
+    option_sets: List[Optional[GenerationOptions]] = [
+        GenerationOptions(temperature=DISCOVERY_TEMPERATURES[i], seed=random.randrange(2 ** 31))
+        for i in range(calls)
+    ] if calls > 1 else [None]
+    results = await asyncio.gather(
+        *(generate_friends_discovery(character, relationship_phrase, options) for options in option_sets),
+        return_exceptions=True
+    )
+
+    batches = [result for result in results if not isinstance(result, BaseException)]
+    if not batches:
+        raise next(result for result in results if isinstance(result, BaseException))
+
+    # 各呼び出しの先頭から順に交互に並べ、特定の温度の結果に偏らないようにする
+    interleaved = [
+        candidate
+        for group in itertools.zip_longest(*batches)
+        for candidate in group
+        if candidate is not None
+    ]
+    return select_distinct(interleaved, [character.get("name", ""), *existing_names], count)
@@ -0,0 +1,144 @@
+"""AIプロバイダーのヘルスチェック
+
+プロバイダー・モデルの組み合わせごとに変更不可の ProviderConfig を作り、
+短いテキスト生成（レイテンシ・可用性）とモデル一覧の取得を並行して行う。
+グローバルな設定は書き換えないため、複数の組み合わせを同時に検査できる。
+
+結果は設定ごとに provider_health_ttl 秒キャッシュし、同じ設定への同時の
+問い合わせは実行中のプローブを共有する。プロバイダー設定が変わると（他のプロセスでの
+変更も settings_store から届く）キャッシュを破棄する。
+"""
+import asyncio
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.llm_scheduler import BACKGROUND, llm_lane
+from app.core.settings_store import ProviderSettings, settings_store
+from app.services.ai_provider import ProviderConfig, generate_text, get_ai_provider
+
+PROVIDERS = ["ollama", "openai", "anthropic", "google"]
+
+HEALTH_PROMPT = "Hi"
+
+
+def _error_message(error: BaseException) -> str:
+    if isinstance(error, asyncio.TimeoutError):
+        return f"{settings.provider_health_timeout}秒以内に応答がありませんでした"
+    return str(error) or type(error).__name__
+
+
+def configured_targets(extra_models: Iterable[Tuple[str, str]] = ()) -> List[ProviderConfig]:
+    """設定済みのプロバイダー（APIキーが必要なものはキーがあるもの）と追加のモデル"""
+    targets = []
+    for provider in PROVIDERS:
+        config = ProviderConfig.from_settings(provider)
+        if provider == "ollama" or config.api_key:
+            targets.append(config)
+    for provider, model in extra_models:
+        config = ProviderConfig.from_settings(provider, model=model)
+        if config not in targets:
+            targets.append(config)
+    return targets
+
+
+class ProviderHealthChecker:
+    """プローブ結果のキャッシュと同時実行の集約"""
+
+    def __init__(self):
+        self._cache: Dict[ProviderConfig, Tuple[float, Dict[str, Any]]] = {}
+        self._pending: Dict[ProviderConfig, "asyncio.Future[Dict[str, Any]]"] = {}
+        self._listening = False
+
+    def start(self) -> None:
+        """設定の変更時にキャッシュを破棄する"""
+        if not self._listening:
+            settings_store.add_listener(self._settings_changed)
+            self._listening = True
+
+    def _settings_changed(self, previous: ProviderSettings, current: ProviderSettings) -> None:
+        self.clear()
+
+    async def probe(self, config: ProviderConfig) -> Dict[str, Any]:
+        """1つの設定を検査（例外は結果に含めて返す）"""
+        provider = get_ai_provider(config)
+        timeout = settings.provider_health_timeout
+
+        async def timed_generate() -> float:
+            start = time.perf_counter()
+            # 生成の実行枠は background レーンで待つ（待ち時間も応答時間に含まれる）
+            with llm_lane(BACKGROUND):
+                await generate_text(HEALTH_PROMPT, config)
+            return (time.perf_counter() - start) * 1000
+
+        generation, listing = await asyncio.gather(
+            asyncio.wait_for(timed_generate(), timeout),
+            asyncio.wait_for(provider.list_models(), timeout),
+            return_exceptions=True
+        )
+
+        result: Dict[str, Any] = {
+            **config.summary(),
+            "available": not isinstance(generation, BaseException),
+            "latency_ms": None if isinstance(generation, BaseException) else round(generation, 1),
+            "error": _error_message(generation) if isinstance(generation, BaseException) else None,
+            "models": None,
+            "model_listed": None,
+            "models_error": None,
+            "checked_at": datetime.now(),
+        }
+        if isinstance(listing, BaseException):
+            result["models_error"] = _error_message(listing)
+        else:
+            result["models"] = listing
+            # Ollama は "llama3" を "llama3:latest" として返す
+            result["model_listed"] = any(
+                name == config.model or name == f"{config.model}:latest" for name in listing
+            )
+        return result
+
+    async def _probe_and_cache(self, config: ProviderConfig) -> Dict[str, Any]:
+        result = await self.probe(config)
+        now = time.monotonic()
+        self._cache = {key: value for key, value in self._cache.items() if value[0] > now}
+        self._cache[config] = (now + settings.provider_health_ttl, result)
+        return result
+
+    async def check(self, config: ProviderConfig, refresh: bool = False) -> Dict[str, Any]:
+        """キャッシュが有効ならそれを、なければプローブした結果を返す"""
+        cached = self._cache.get(config)
+        if cached and not refresh and cached[0] > time.monotonic():
+            return {**cached[1], "cached": True}
+
+        future = self._pending.get(config)
+        if future is None:
+            future = asyncio.ensure_future(self._probe_and_cache(config))
+            self._pending[config] = future
+            future.add_done_callback(lambda _: self._pending.pop(config, None))
+        # 呼び出し元が切断しても、他の待機者のためにプローブは続ける
+        result = await asyncio.shield(future)
+        return {**result, "cached": False}
+
+    async def matrix(self, targets: List[ProviderConfig], refresh: bool = False) -> List[Dict[str, Any]]:
+        """全ての設定を並行して検査"""
+        return list(await asyncio.gather(*(self.check(config, refresh) for config in targets)))
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+provider_health = ProviderHealthChecker()
+
+
+def parse_models(value: Optional[str]) -> List[Tuple[str, str]]:
+    """"provider:model" のカンマ区切り（モデル名に ":" を含んでもよい）"""
+    models = []
+    for item in (value or "").split(","):
+        provider, _, model = item.strip().partition(":")
+        if not provider:
+            continue
+        if provider not in PROVIDERS or not model:
+            raise ValueError(f"不正なモデル指定です: {item.strip()}（provider:model の形式で指定してください）")
+        models.append((provider, model))
+    return models
@@ -0,0 +1,241 @@
+"""キャラクター関係性グラフのインメモリインデックス
+
+キャラクターに埋め込まれた relationships（target_character_id のリスト）から
+隣接リストを一度だけ構築し、以降は作成・更新・インポート・削除のたびに
+差分更新する。近傍探索や経路探索は辿った辺の数に比例するコストで応答する。
+"""
+import asyncio
+import uuid
+from collections import deque
+from typing import Any, Dict, Iterable, List, Literal, Optional, Set
+
+from app.core.database import COLLECTIONS
+
+Direction = Literal["out", "in", "both"]
+
+
+class RelationshipGraph:
+    """キャラクター関係性の隣接リスト"""
+
+    def __init__(self):
+        # source_id -> {target_id: description}
+        self._out: Dict[str, Dict[str, str]] = {}
+        # target_id -> {source_id}
+        self._in: Dict[str, Set[str]] = {}
+        # character_id -> ノード情報（name, image_path）
+        self._nodes: Dict[str, Dict[str, Any]] = {}
+        self._loaded = False
+        self._lock = asyncio.Lock()
+        # プロセスごとに異なる値にして、再起動後に古いETagが一致しないようにする
+        self._epoch = uuid.uuid4().hex[:8]
+        self._version = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    @property
+    def etag(self) -> str:
+        """グラフ全体のETag（変更のたびに変わる）"""
+        return f'"{self._epoch}-{self._version}"'
+
+    async def load(self, db) -> None:
+        """データベースから隣接リストを構築"""
+        async with self._lock:
+            self._out.clear()
+            self._in.clear()
+            self._nodes.clear()
+            projection = {"name": 1, "image_path": 1, "relationships": 1}
+            async for char in db[COLLECTIONS["characters"]].find({}, projection):
+                self._set_character(char)
+            self._loaded = True
+            self._version += 1
+
+    async def ensure_loaded(self, db) -> None:
+        """未構築の場合のみデータベースから構築"""
+        if not self._loaded:
+            await self.load(db)
+
+    def upsert_character(self, character: Dict[str, Any]) -> None:
+        """キャラクターの追加・更新をグラフに反映"""
+        if not self._loaded:
+            return
+        self._set_character(character)
+        self._version += 1
+
+    def upsert_characters(self, characters: Iterable[Dict[str, Any]]) -> None:
+        """複数キャラクターの追加・更新をまとめて反映"""
+        if not self._loaded:
+            return
+        for character in characters:
+            self._set_character(character)
+        self._version += 1
+
+    def remove_character(self, character_id: str) -> None:
+        """キャラクターの削除をグラフに反映（双方向の辺も削除）"""
+        if not self._loaded:
+            return
+        for target_id in self._out.pop(character_id, {}):
+            self._in.get(target_id, set()).discard(character_id)
+        for source_id in self._in.pop(character_id, set()):
+            self._out.get(source_id, {}).pop(character_id, None)
+        self._nodes.pop(character_id, None)
+        self._version += 1
+
+    def _set_character(self, character: Dict[str, Any]) -> None:
+        character_id = str(character["_id"])
+        self._nodes[character_id] = {
+            "name": character.get("name", ""),
+            "image_path": character.get("image_path"),
+        }
+
+        # 既存の出辺を外してから張り直す
+        for target_id in self._out.get(character_id, {}):
+            self._in.get(target_id, set()).discard(character_id)
+
+        edges: Dict[str, str] = {}
+        for rel in character.get("relationships", []) or []:
+            target_id = rel.get("target_character_id")
+            if not target_id:
+                continue
+            edges[target_id] = rel.get("description", "")
+            self._in.setdefault(target_id, set()).add(character_id)
+        self._out[character_id] = edges
+
+    def has_character(self, character_id: str) -> bool:
+        return character_id in self._nodes
+
+    def name_of(self, character_id: str) -> Optional[str]:
+        """キャラクター名を取得（存在しない場合はNone）"""
+        node = self._nodes.get(character_id)
+        return node["name"] if node else None
+
+    def names(self) -> List[str]:
+        """全キャラクター名の一覧"""
+        return [node["name"] for node in self._nodes.values()]
+
+    def _node(self, character_id: str) -> Dict[str, Any]:
+        node = self._nodes.get(character_id, {})
+        return {
+            "id": character_id,
+            "name": node.get("name", "不明なキャラクター"),
+            "image_path": node.get("image_path"),
+        }
+
+    def _edge(self, source_id: str, target_id: str) -> Dict[str, Any]:
+        return {
+            "source": source_id,
+            "target": target_id,
+            "description": self._out.get(source_id, {}).get(target_id, ""),
+            "mutual": source_id in self._out.get(target_id, {}),
+        }
+
+    def _neighbors(self, character_id: str, direction: Direction) -> Iterable[str]:
+        if direction in ("out", "both"):
+            yield from self._out.get(character_id, {})
+        if direction in ("in", "both"):
+            yield from self._in.get(character_id, ())
+
+    def snapshot(self) -> Dict[str, Any]:
+        """可視化用にグラフ全体を返す
+
+        削除済みキャラクターへの辺（ダングリング）は含めない
+        """
+        nodes = [self._node(character_id) for character_id in self._nodes]
+        edges = [
+            self._edge(source_id, target_id)
+            for source_id, targets in self._out.items()
+            for target_id in targets
+            if target_id in self._nodes
+        ]
+        return {"nodes": nodes, "edges": edges}
+
+    def neighborhood(
+        self,
+        character_id: str,
+        depth: int = 1,
+        direction: Direction = "both"
+    ) -> Dict[str, Any]:
+        """指定キャラクターから depth ホップ以内の部分グラフを返す（BFS）"""
+        distances = {character_id: 0}
+        queue = deque([character_id])
+        while queue:
+            current = queue.popleft()
+            if distances[current] >= depth:
+                continue
+            for neighbor in self._neighbors(current, direction):
+                if neighbor not in distances and neighbor in self._nodes:
+                    distances[neighbor] = distances[current] + 1
+                    queue.append(neighbor)
+
+        nodes = [
+            {**self._node(node_id), "distance": distance}
+            for node_id, distance in distances.items()
+        ]
+        edges = [
+            self._edge(source_id, target_id)
+            for source_id in distances
+            for target_id in self._out.get(source_id, {})
+            if target_id in distances
+        ]
+        return {"center": character_id, "depth": depth, "nodes": nodes, "edges": edges}
+
+    def mutual(self, character_id: str) -> List[Dict[str, Any]]:
+        """相互に関係性を持つキャラクターを返す"""
+        outgoing = self._out.get(character_id, {})
+        result = []
+        for target_id, description in outgoing.items():
+            if character_id in self._out.get(target_id, {}) and target_id in self._nodes:
+                result.append({
+                    **self._node(target_id),
+                    "description": description,
+                    "reverse_description": self._out[target_id][character_id],
+                })
+        return result
+
+    def shortest_path(
+        self,
+        source_id: str,
+        target_id: str,
+        direction: Direction = "both",
+        max_depth: int = 6
+    ) -> Optional[List[str]]:
+        """2キャラクター間の最短経路（キャラクターIDのリスト）を返す"""
+        if source_id == target_id:
+            return [source_id]
+
+        parents: Dict[str, Optional[str]] = {source_id: None}
+        frontier = [source_id]
+        for _ in range(max_depth):
+            next_frontier = []
+            for current in frontier:
+                for neighbor in self._neighbors(current, direction):
+                    if neighbor in parents or neighbor not in self._nodes:
+                        continue
+                    parents[neighbor] = current
+                    if neighbor == target_id:
+                        path = [neighbor]
+                        parent = parents[neighbor]
+                        while parent is not None:
+                            path.append(parent)
+                            parent = parents[parent]
+                        return list(reversed(path))
+                    next_frontier.append(neighbor)
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        return None
+
+    def path_details(self, path: List[str]) -> Dict[str, Any]:
+        """経路をノード・辺の情報に展開"""
+        edges = []
+        for source_id, target_id in zip(path, path[1:]):
+            if target_id in self._out.get(source_id, {}):
+                edges.append(self._edge(source_id, target_id))
+            else:
+                edges.append(self._edge(target_id, source_id))
+        return {"nodes": [self._node(node_id) for node_id in path], "edges": edges}
+
+
+# シングルトンインスタンス
+relationship_graph = RelationshipGraph()
@@ -0,0 +1,425 @@
+"""全文検索用のインメモリ転置インデックス
+
+日本語は空白で単語が区切られないため、正規化したテキストを文字bi-gramに
+分割して転置インデックスを作る。キャラクター属性・ジャーナル・コメントの
+各書き込み経路から差分更新され、検索時は bi-gram の積集合で候補を絞り込んだ後
+部分文字列で照合し、BM25風のスコアで順位付けする。1文字の語は文字ごとの
+転置リスト（unigrams）で絞り込む。正規化したテキストは登録時に保持し、検索の
+たびに正規化し直さない。
+
+インデックスはプロセスごとのメモリ上にある。再構築（POST /api/search/rebuild）は
+受け付けたプロセスで行い、index_events で他のプロセスにも再構築を依頼する。
+"""
+import asyncio
+import math
+import re
+import unicodedata
+from typing import Any, Collection, Dict, Iterable, List, Literal, Optional, Set, Tuple
+
+from app.core.database import COLLECTIONS
+
+DocumentKind = Literal["character", "journal", "comment"]
+DOCUMENT_KINDS: Tuple[str, ...] = ("character", "journal", "comment")
+
+# フィールドごとの重み（名前・テーマへの一致を優先）
+FIELD_WEIGHTS = {
+    "name": 3.0,
+    "theme": 2.0,
+}
+
+# 単語として扱う文字の並び（英数字・かな・漢字など）
+_SEGMENT_RE = re.compile(r"\w+")
+
+# スニペットとして一致箇所の前後に含める文字数
+SNIPPET_BEFORE = 30
+SNIPPET_AFTER = 60
+
+
+def normalize_text(text: str) -> str:
+    """検索用にテキストを正規化
+
+    全角英数字→半角、半角カナ→全角などのNFKC正規化と小文字化を1文字単位で行う。
+    文字数が変わる変換は行わないため、正規化後のオフセットが元のテキストと一致する。
+    """
+    chars = []
+    for char in text:
+        normalized = unicodedata.normalize("NFKC", char).lower()
+        if len(normalized) != 1:
+            normalized = char.lower() if len(char.lower()) == 1 else char
+        chars.append(normalized)
+    return "".join(chars)
+
+
+def tokenize(normalized: str) -> List[str]:
+    """正規化済みテキストを bi-gram に分割（1文字だけの語はそのまま）"""
+    grams = []
+    for segment in _SEGMENT_RE.findall(normalized):
+        if len(segment) == 1:
+            grams.append(segment)
+        else:
+            grams.extend(segment[i:i + 2] for i in range(len(segment) - 1))
+    return grams
+
+
+def _characters(normalized_texts: Iterable[str]) -> Set[str]:
+    """単語を構成する文字の集合"""
+    return {char for text in normalized_texts for segment in _SEGMENT_RE.findall(text) for char in segment}
+
+
+def document_key(kind: str, document_id: str) -> str:
+    return f"{kind}:{document_id}"
+
+
+class _IndexState:
+    """インデックス本体（再構築時は丸ごと差し替える）"""
+
+    def __init__(self):
+        # gram -> {doc_key: 出現回数}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        # 文字 -> その文字を含む doc_key（1文字の語の絞り込み用）
+        self.unigrams: Dict[str, Set[str]] = {}
+        # doc_key -> ドキュメント情報（fields, メタデータ, gram数）
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        # カスケード削除用の逆引き
+        self.by_character: Dict[str, Set[str]] = {}
+        self.by_journal: Dict[str, Set[str]] = {}
+        self.total_length = 0
+
+    def add(self, key: str, document: Dict[str, Any]) -> None:
+        self.remove(key)
+
+        document["normalized"] = {field: normalize_text(text) for field, text in document["fields"].items()}
+        counts: Dict[str, int] = {}
+        for normalized in document["normalized"].values():
+            for gram in tokenize(normalized):
+                counts[gram] = counts.get(gram, 0) + 1
+        for gram, count in counts.items():
+            self.postings.setdefault(gram, {})[key] = count
+        for char in _characters(document["normalized"].values()):
+            self.unigrams.setdefault(char, set()).add(key)
+
+        document["length"] = sum(counts.values())
+        self.total_length += document["length"]
+        self.documents[key] = document
+        if document.get("character_id"):
+            self.by_character.setdefault(document["character_id"], set()).add(key)
+        if document.get("journal_id"):
+            self.by_journal.setdefault(document["journal_id"], set()).add(key)
+
+    def remove(self, key: str) -> None:
+        document = self.documents.pop(key, None)
+        if not document:
+            return
+
+        for normalized in document["normalized"].values():
+            for gram in set(tokenize(normalized)):
+                postings = self.postings.get(gram)
+                if postings is None:
+                    continue
+                postings.pop(key, None)
+                if not postings:
+                    del self.postings[gram]
+        for char in _characters(document["normalized"].values()):
+            keys = self.unigrams.get(char)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self.unigrams[char]
+
+        self.total_length -= document["length"]
+        if document.get("character_id"):
+            self.by_character.get(document["character_id"], set()).discard(key)
+        if document.get("journal_id"):
+            self.by_journal.get(document["journal_id"], set()).discard(key)
+
+
+class SearchIndex:
+    """bi-gram 転置インデックスによる全文検索"""
+
+    def __init__(self):
+        self._state = _IndexState()
+        self._loaded = False
+        self._build_task: Optional[asyncio.Task] = None
+        # 再構築は1つずつ行う（再構築中の書き込みの記録 _pending を共有するため）
+        self._rebuild_lock = asyncio.Lock()
+        # 再構築中に発生した書き込み（再構築後に新しいインデックスへ再適用する）
+        self._pending: Optional[List[Tuple[str, Any]]] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    # ---- ドキュメント変換 ----
+
+    @staticmethod
+    def _character_document(character: Dict[str, Any]) -> Dict[str, Any]:
+        fields = {"name": character.get("name", "")}
+        for attr in character.get("attributes", []) or []:
+            attr_type = attr.get("type", "attribute")
+            if attr_type in fields:
+                fields[attr_type] += "\n" + attr.get("content", "")
+            else:
+                fields[attr_type] = attr.get("content", "")
+        return {
+            "kind": "character",
+            "id": str(character["_id"]),
+            "fields": fields,
+            "created_at": character.get("created_at"),
+        }
+
+    @staticmethod
+    def _journal_document(journal: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "kind": "journal",
+            "id": str(journal["_id"]),
+            "character_id": journal.get("character_id"),
+            "fields": {
+                "theme": journal.get("theme", ""),
+                "content": journal.get("content", ""),
+            },
+            "created_at": journal.get("created_at"),
+        }
+
+    @staticmethod
+    def _comment_document(comment: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "kind": "comment",
+            "id": str(comment["_id"]),
+            "character_id": comment.get("character_id"),
+            "journal_id": comment.get("journal_id"),
+            "fields": {"content": comment.get("content", "")},
+            "created_at": comment.get("created_at"),
+        }
+
+    # ---- 差分更新 ----
+
+    def _apply(self, op: str, arg: Any) -> List[str]:
+        """操作を適用し、削除したドキュメントのキーを返す"""
+        state = self._state
+        if op == "add":
+            state.add(document_key(arg["kind"], arg["id"]), arg)
+            return []
+        if op == "remove":
+            keys = [arg]
+        elif op == "remove_character":
+            keys = [*state.by_character.pop(arg, set()), document_key("character", arg)]
+        elif op == "remove_journal":
+            keys = [*state.by_journal.pop(arg, set()), document_key("journal", arg)]
+        else:
+            return []
+        removed = [key for key in keys if key in state.documents]
+        for key in removed:
+            state.remove(key)
+        return removed
+
+    def _write(self, op: str, arg: Any) -> List[str]:
+        if not self._loaded and self._pending is None:
+            # 構築していない（検索しないプロセス）。使うときに ensure_loaded で構築する
+            return []
+        if self._pending is not None:
+            self._pending.append((op, arg))
+        return self._apply(op, arg)
+
+    def index_character(self, character: Dict[str, Any]) -> None:
+        self._write("add", self._character_document(character))
+
+    def index_journal(self, journal: Dict[str, Any]) -> None:
+        self._write("add", self._journal_document(journal))
+
+    def index_comment(self, comment: Dict[str, Any]) -> None:
+        self._write("add", self._comment_document(comment))
+
+    def remove_character(self, character_id: str) -> List[str]:
+        """キャラクターと、そのキャラクターのジャーナル・コメントを削除し、削除したキーを返す"""
+        return self._write("remove_character", character_id)
+
+    def remove_journal(self, journal_id: str) -> List[str]:
+        """ジャーナルと、そのジャーナルへのコメントを削除し、削除したキーを返す"""
+        return self._write("remove_journal", journal_id)
+
+    def remove_comment(self, comment_id: str) -> None:
+        self._write("remove", document_key("comment", comment_id))
+
+    # ---- 構築 ----
+
+    async def rebuild(self, db) -> Dict[str, int]:
+        """データベースからインデックスを再構築（実行中の再構築があれば、その完了後に行う）"""
+        async with self._rebuild_lock:
+            return await self._rebuild(db)
+
+    async def _rebuild(self, db) -> Dict[str, int]:
+        self._pending = []
+        new_state = _IndexState()
+        counts = {kind: 0 for kind in DOCUMENT_KINDS}
+        try:
+            sources = [
+                ("character", COLLECTIONS["characters"], self._character_document,
+                 {"name": 1, "attributes": 1, "created_at": 1}),
+                ("journal", COLLECTIONS["journals"], self._journal_document,
+                 {"character_id": 1, "theme": 1, "content": 1, "created_at": 1}),
+                ("comment", COLLECTIONS["comments"], self._comment_document,
+                 {"character_id": 1, "journal_id": 1, "content": 1, "created_at": 1}),
+            ]
+            for kind, collection, to_document, projection in sources:
+                async for doc in db[collection].find({}, projection):
+                    document = to_document(doc)
+                    new_state.add(document_key(kind, document["id"]), document)
+                    counts[kind] += 1
+
+            # 差し替え後、再構築中の書き込みを再適用
+            pending, self._pending = self._pending, None
+            self._state = new_state
+            for op, arg in pending:
+                self._apply(op, arg)
+            self._loaded = True
+        finally:
+            self._pending = None
+        return counts
+
+    def start_background_build(self, db) -> None:
+        """起動時にバックグラウンドでインデックスを構築"""
+        if self._build_task is None or self._build_task.done():
+            self._build_task = asyncio.create_task(self.rebuild(db))
+
+    async def ensure_loaded(self, db) -> None:
+        if self._loaded:
+            return
+        # 実行中の構築があれば、その完了を待ってから確認する
+        async with self._rebuild_lock:
+            if not self._loaded:
+                await self._rebuild(db)
+
+    # ---- 検索 ----
+
+    def _idf(self, gram: str) -> float:
+        document_count = len(self._state.documents)
+        frequency = len(self._state.postings.get(gram, {}))
+        return math.log(1 + (document_count - frequency + 0.5) / (frequency + 0.5))
+
+    def _candidates(self, segments: List[str], kinds: Set[str]) -> Iterable[str]:
+        state = self._state
+        # 絞り込みに使う転置リスト（2文字以上の語は bi-gram、1文字の語は文字）
+        lists: List[Collection[str]] = []
+        for segment in segments:
+            if len(segment) < 2:
+                lists.append(state.unigrams.get(segment, ()))
+            else:
+                lists.extend(state.postings.get(gram, {}) for gram in set(tokenize(segment)))
+        if not lists:
+            return []
+
+        # 短い転置リストから積集合を取る
+        lists.sort(key=len)
+        candidate_keys = set(lists[0])
+        for keys in lists[1:]:
+            if not candidate_keys:
+                return []
+            candidate_keys.intersection_update(keys)
+        return [key for key in candidate_keys if state.documents[key]["kind"] in kinds]
+
+    @staticmethod
+    def _highlight(text: str, normalized: str, segments: List[str]) -> Dict[str, Any]:
+        first = min(
+            (pos for pos in (normalized.find(segment) for segment in segments) if pos >= 0),
+            default=0
+        )
+        start = max(0, first - SNIPPET_BEFORE)
+        end = min(len(text), first + SNIPPET_AFTER)
+        window = normalized[start:end]
+
+        # ranges はスニペット先頭の省略記号を含めたオフセット
+        prefix = "…" if start > 0 else ""
+        ranges = []
+        for segment in segments:
+            pos = window.find(segment)
+            while pos >= 0:
+                ranges.append([len(prefix) + pos, len(prefix) + pos + len(segment)])
+                pos = window.find(segment, pos + len(segment))
+        ranges.sort()
+
+        return {
+            "snippet": prefix + text[start:end] + ("…" if end < len(text) else ""),
+            "highlights": ranges,
+        }
+
+    def search(
+        self,
+        query: str,
+        kinds: Optional[Iterable[str]] = None,
+        limit: int = 20,
+        offset: int = 0
+    ) -> Dict[str, Any]:
+        """クエリに一致するドキュメントをスコア順に返す
+
+        空白区切りの各語をすべて含むドキュメントが対象（AND検索）
+        """
+        state = self._state
+        segments = _SEGMENT_RE.findall(normalize_text(query))
+        if not segments:
+            return {"query": query, "total": 0, "results": []}
+        kind_set = set(kinds or DOCUMENT_KINDS)
+
+        query_grams = [gram for segment in segments if len(segment) >= 2 for gram in set(tokenize(segment))]
+        idf = {gram: self._idf(gram) for gram in query_grams}
+        average_length = state.total_length / len(state.documents) if state.documents else 1.0
+
+        scored = []
+        for key in self._candidates(segments, kind_set):
+            document = state.documents[key]
+
+            # bi-gram の偽陽性を除くため、各語が実際に含まれているか確認
+            best_field, best_score, phrase_score = None, 0.0, 0.0
+            matched = {segment: False for segment in segments}
+            for field, normalized in document["normalized"].items():
+                field_score = 0.0
+                for segment in segments:
+                    occurrences = normalized.count(segment)
+                    if occurrences:
+                        matched[segment] = True
+                        field_score += FIELD_WEIGHTS.get(field, 1.0) * (1 + math.log(occurrences))
+                if field_score > best_score:
+                    best_field, best_score = field, field_score
+                phrase_score += field_score
+            if not all(matched.values()):
+                continue
+
+            # BM25（k1=1.2, b=0.75）
+            bm25 = 0.0
+            length_norm = 1.2 * (0.25 + 0.75 * document["length"] / average_length)
+            for gram in query_grams:
+                tf = state.postings.get(gram, {}).get(key, 0)
+                bm25 += idf[gram] * tf * 2.2 / (tf + length_norm)
+
+            scored.append((bm25 + phrase_score, key, best_field))
+
+        scored.sort(key=lambda item: item[0], reverse=True)
+        results = []
+        for score, key, field in scored[offset:offset + limit]:
+            document = state.documents[key]
+            result = {
+                "type": document["kind"],
+                "id": document["id"],
+                "score": round(score, 4),
+                "field": field,
+                **self._highlight(document["fields"][field], document["normalized"][field], segments),
+            }
+            if document.get("character_id"):
+                result["character_id"] = document["character_id"]
+            if document.get("journal_id"):
+                result["journal_id"] = document["journal_id"]
+            if document.get("created_at"):
+                result["created_at"] = document["created_at"]
+            results.append(result)
+
+        return {"query": query, "total": len(scored), "results": results}
+
+    def stats(self) -> Dict[str, int]:
+        counts = {kind: 0 for kind in DOCUMENT_KINDS}
+        for document in self._state.documents.values():
+            counts[document["kind"]] += 1
+        return {**counts, "grams": len(self._state.postings)}
+
+
+# シングルトンインスタンス
+search_index = SearchIndex()
@@ -0,0 +1,240 @@
+"""セマンティック検索パイプライン
+
+ジャーナル・コメントの書き込みをキューで受け取り、バッチ単位で埋め込みを
+計算してベクトルインデックスに反映する。埋め込みの再計算はドキュメントの
+updated_at が変わった場合のみ行う。
+
+インデックスのディレクトリ（embedding_index_dir）を共有するプロセスのうち、書き込みロックを
+取った1プロセスだけが埋め込みの計算・バックフィル・書き出しを行う。他のプロセスは
+読み取り専用でインデックスを開いて検索し、書き込み側が終了するとロックを取って引き継ぐ。
+ロックはファイルロックのため、同じホスト（または同じボリューム）のプロセス間でのみ有効。
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.database import COLLECTIONS
+from app.services.embeddings import close_embedders, get_embedder
+from app.services.vector_index import VectorIndex
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_KINDS = ("journal", "comment")
+
+# 埋め込み対象テキストの最大文字数
+MAX_TEXT_LENGTH = 2000
+
+# バックフィル時にキューへ溜める件数の上限（書き込み経路の遅延を防ぐ）
+BACKFILL_QUEUE_LIMIT = 1000
+
+# 読み取り専用のプロセスが書き込みロックの取得を試みる間隔（秒）
+WRITER_RETRY_INTERVAL = 5.0
+
+
+def _timestamp(value: Any) -> str:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value) if value is not None else ""
+
+
+def journal_text(journal: Dict[str, Any]) -> str:
+    return f"{journal.get('theme', '')}\n{journal.get('content', '')}"[:MAX_TEXT_LENGTH]
+
+
+def comment_text(comment: Dict[str, Any]) -> str:
+    return comment.get("content", "")[:MAX_TEXT_LENGTH]
+
+
+class SemanticIndex:
+    """埋め込みのバッチ計算とベクトルインデックスの管理"""
+
+    def __init__(self):
+        self.index = VectorIndex(os.path.join(settings.embedding_index_dir, settings.embedding_provider))
+        # (キー, テキスト, updated_at)。テキストが None の場合は削除
+        self._queue: "asyncio.Queue[Tuple[str, Optional[str], str]]" = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._backfill: Optional[asyncio.Task] = None
+        self._follower: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    @property
+    def is_writer(self) -> bool:
+        return self._worker is not None
+
+    async def start(self, db) -> None:
+        """書き込みロックを取れればワーカーとバックフィルを開始し、取れなければ読み取り専用で開く"""
+        if self.index.acquire_writer():
+            self._start_writer(db)
+        else:
+            logger.info("埋め込みインデックスは他のプロセスが書き込み中のため、読み取り専用で開きます")
+            self._follower = asyncio.create_task(self._follow(db))
+
+    def _start_writer(self, db) -> None:
+        self._worker = asyncio.create_task(self._run())
+        self._backfill = asyncio.create_task(self._backfill_from(db))
+
+    async def stop(self) -> None:
+        tasks = [task for task in (self._follower, self._backfill, self._worker) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.index.writable and self.index.is_open:
+            await self._flush()
+        self.index.release_writer()
+        self._worker = self._backfill = self._follower = None
+        await close_embedders()
+
+    async def _follow(self, db) -> None:
+        """読み取り専用: インデックスを開き、書き込み側が終了したら引き継ぐ"""
+        while True:
+            try:
+                if not self.index.is_open:
+                    embedder = get_embedder()
+                    probe = await embedder.embed(["probe"])
+                    self._open_for(embedder.name, probe.shape[1])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"埋め込みインデックスを開けませんでした: {e}")
+            await asyncio.sleep(WRITER_RETRY_INTERVAL)
+            if self.index.acquire_writer():
+                logger.info("埋め込みインデックスの書き込みを引き継ぎました")
+                if self.index.embedder_name is not None:
+                    # 書き込み用に開き直す（読み取り中に止まったログの末尾もここで取り込む）
+                    self.index.open(self.index.embedder_name, self.index.dimension)
+                self._follower = None
+                self._start_writer(db)
+                return
+
+    def _open_for(self, name: str, dimension: int) -> None:
+        if not self.index.is_open or self.index.embedder_name != name or self.index.dimension != dimension:
+            self.index.open(name, dimension)
+
+    def refresh(self) -> None:
+        """読み取り専用のプロセスで、書き込み側の変更を取り込む"""
+        self.index.refresh()
+
+    async def _flush(self) -> None:
+        # 取り出した順にログへ追記するため、書き出しは1つずつ行う
+        async with self._flush_lock:
+            changes = self.index.pending_changes()
+            if changes is not None:
+                await asyncio.to_thread(self.index.flush, changes)
+
+    # ---- 書き込み経路 ----
+
+    def enqueue(self, kind: str, document: Dict[str, Any]) -> None:
+        """ドキュメントを埋め込み計算キューに追加（読み取り専用のプロセスでは何もしない）"""
+        if not self.is_writer:
+            return
+        text = journal_text(document) if kind == "journal" else comment_text(document)
+        key = f"{kind}:{document['_id']}"
+        updated_at = _timestamp(document.get("updated_at"))
+        if self.index.is_open and not self.index.needs_update(key, updated_at):
+            return
+        self._queue.put_nowait((key, text, updated_at))
+
+    def remove(self, kind: str, document_id: str) -> None:
+        """ベクトルの削除をキューに追加（計算中の埋め込みより後に反映する）"""
+        if not self.is_writer:
+            return
+        self._queue.put_nowait((f"{kind}:{document_id}", None, ""))
+
+    async def _backfill_from(self, db) -> None:
+        """未計算・更新済みのドキュメントをキューに追加し、MongoDBに無いドキュメントのベクトルを削除"""
+        try:
+            # 既存インデックスを開いて updated_at を比較できるようにする
+            embedder = get_embedder()
+            probe = await embedder.embed(["probe"])
+            self._open_for(embedder.name, probe.shape[1])
+            indexed = set(self.index.keys())
+            seen = set()
+
+            sources = [
+                ("journal", COLLECTIONS["journals"], journal_text, {"theme": 1, "content": 1, "updated_at": 1}),
+                ("comment", COLLECTIONS["comments"], comment_text, {"content": 1, "updated_at": 1}),
+            ]
+            for kind, collection, to_text, projection in sources:
+                async for doc in db[collection].find({}, projection):
+                    key = f"{kind}:{doc['_id']}"
+                    seen.add(key)
+                    updated_at = _timestamp(doc.get("updated_at"))
+                    if not self.index.needs_update(key, updated_at):
+                        continue
+                    await self._backfill_put((key, to_text(doc), updated_at))
+
+            # 停止中に削除されたドキュメント（削除は埋め込み計算キュー経由でログに書き出される）
+            stale = indexed - seen
+            for key in stale:
+                await self._backfill_put((key, None, ""))
+            if stale:
+                logger.info(f"削除済みドキュメントのベクトルを{len(stale)}件削除します")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"埋め込みのバックフィルに失敗しました: {e}")
+
+    async def _backfill_put(self, item: Tuple[str, Optional[str], str]) -> None:
+        while self._queue.qsize() >= BACKFILL_QUEUE_LIMIT:
+            await asyncio.sleep(0.1)
+        self._queue.put_nowait(item)
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < settings.embedding_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            # 同じキーは最新のものだけ反映する
+            latest: Dict[str, Tuple[Optional[str], str]] = {}
+            for key, text, updated_at in batch:
+                latest[key] = (text, updated_at)
+            removed = [key for key, (text, _) in latest.items() if text is None]
+            items = {key: (text, updated_at) for key, (text, updated_at) in latest.items() if text is not None}
+
+            try:
+                if removed and self.index.is_open:
+                    for key in removed:
+                        self.index.remove(key)
+                await self._embed_batch(items)
+                if self.index.is_open:
+                    await self._flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"埋め込みの計算に失敗しました（{len(latest)}件）: {e}")
+
+    async def _embed_batch(self, items: Dict[str, Tuple[str, str]]) -> None:
+        embedder = get_embedder()
+        if self.index.is_open:
+            items = {key: value for key, value in items.items() if self.index.needs_update(key, value[1])}
+        if not items:
+            return
+
+        keys = list(items)
+        vectors = await embedder.embed([items[key][0] for key in keys])
+        self._open_for(embedder.name, vectors.shape[1])
+        for key, vector in zip(keys, vectors):
+            self.index.upsert(key, vector, items[key][1])
+
+    # ---- 検索 ----
+
+    async def search(self, query: str, k: int = 10, kinds: Optional[List[str]] = None) -> List[Tuple[str, str, float]]:
+        """クエリに意味的に近いドキュメントを (kind, id, score) のリストで返す"""
+        embedder = get_embedder()
+        query_vector = (await embedder.embed([query]))[0]
+        self._open_for(embedder.name, query_vector.shape[0])
+        self.index.refresh()
+        prefixes = [f"{kind}:" for kind in (kinds or SEMANTIC_KINDS)]
+        results = []
+        for key, score in self.index.search(query_vector, k, prefixes):
+            kind, document_id = key.split(":", 1)
+            results.append((kind, document_id, score))
+        return results
+
+
+# シングルトンインスタンス
+semantic_index = SemanticIndex()
@@ -0,0 +1,171 @@
+"""トークン数の計算
+
+プロバイダーごとにオフラインで使えるトークナイザーがあればそれを使い
+（OpenAI系モデルは tiktoken がインストールされている場合）、なければ
+文字種ベースの概算にフォールバックする。結果はテキストのハッシュで
+メモ化し、複数テキストはまとめて計算する。
+"""
+import hashlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.core.settings_store import provider_settings
+
+# メモ化するテキスト数の上限
+CACHE_SIZE = 10000
+
+# モデルごとの料金（USD / 100万トークン、入力・出力）
+MODEL_PRICING: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4": (30.00, 60.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "claude-sonnet-4-5-20250929": (3.00, 15.00),
+    "claude-3-5-sonnet-20241022": (3.00, 15.00),
+    "claude-3-sonnet-20240229": (3.00, 15.00),
+    "gemini-2.5-pro": (1.25, 10.00),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-pro": (0.50, 1.50),
+}
+
+
+class BaseTokenizer(ABC):
+    """トークナイザーの基底クラス"""
+
+    name: str
+
+    @abstractmethod
+    def count_batch(self, texts: List[str]) -> List[int]:
+        """複数テキストのトークン数を計算"""
+        pass
+
+
+class HeuristicTokenizer(BaseTokenizer):
+    """文字種ベースの概算トークナイザー
+
+    簡易的な推定方法:
+    - 日本語文字（U+3000以上）: 1文字 ≈ 2.5トークン
+    - 英数字・記号: 1文字 ≈ 0.25トークン
+
+    注: これは概算値であり、実際のトークン数とは±20%程度の誤差があります
+    """
+
+    name = "heuristic"
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        if not texts:
+            return []
+
+        # 全テキストを連結してUTF-32のコードポイント配列にし、まとめて判定する
+        lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+        codepoints = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32)
+        zero = np.zeros(1, dtype=np.int64)
+        japanese_cumsum = np.concatenate((zero, np.cumsum(codepoints >= 0x3000, dtype=np.int64)))
+        boundaries = np.concatenate((zero, np.cumsum(lengths)))
+        japanese_chars = japanese_cumsum[boundaries[1:]] - japanese_cumsum[boundaries[:-1]]
+        other_chars = lengths - japanese_chars
+
+        estimated = (japanese_chars * 2.5 + other_chars * 0.25).astype(np.int64)
+        return estimated.tolist()
+
+
+class TiktokenTokenizer(BaseTokenizer):
+    """tiktoken によるOpenAIモデルのトークナイザー"""
+
+    def __init__(self, model: str):
+        import tiktoken
+
+        try:
+            self._encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+        self.name = f"tiktoken-{self._encoding.name}"
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [len(tokens) for tokens in self._encoding.encode_ordinary_batch(texts)]
+
+
+_heuristic = HeuristicTokenizer()
+_tokenizers: Dict[Tuple[str, str], BaseTokenizer] = {}
+_cache: "OrderedDict[Tuple[str, bytes], int]" = OrderedDict()
+
+
+def _current_model(provider: str) -> str:
+    return getattr(provider_settings(), f"{provider}_model", "")
+
+
+def get_tokenizer(provider: Optional[str] = None, model: Optional[str] = None) -> BaseTokenizer:
+    """プロバイダー・モデルに対応するトークナイザーを取得"""
+    provider = provider or provider_settings().ai_provider
+    model = model or _current_model(provider)
+    key = (provider, model)
+    if key not in _tokenizers:
+        tokenizer: BaseTokenizer = _heuristic
+        if provider == "openai":
+            try:
+                tokenizer = TiktokenTokenizer(model)
+            except Exception:
+                # tiktoken未インストール、またはエンコーディングを取得できない（オフライン）
+                tokenizer = _heuristic
+        _tokenizers[key] = tokenizer
+    return _tokenizers[key]
+
+
+def count_tokens_batch(
+    texts: List[str],
+    provider: Optional[str] = None,
+    model: Optional[str] = None
+) -> List[int]:
+    """複数テキストのトークン数を計算（メモ化あり）"""
+    tokenizer = get_tokenizer(provider, model)
+    keys = [
+        (tokenizer.name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+        for text in texts
+    ]
+
+    counts: List[Optional[int]] = []
+    missing: Dict[Tuple[str, bytes], str] = {}
+    for key, text in zip(keys, texts):
+        count = _cache.get(key)
+        if count is None:
+            missing[key] = text
+        else:
+            _cache.move_to_end(key)
+        counts.append(count)
+
+    computed: Dict[Tuple[str, bytes], int] = {}
+    if missing:
+        computed = dict(zip(missing, tokenizer.count_batch(list(missing.values()))))
+        for key, count in computed.items():
+            _cache[key] = count
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return [computed[key] if count is None else count for key, count in zip(keys, counts)]
+
+
+def count_tokens(text: str, provider: Optional[str] = None, model: Optional[str] = None) -> int:
+    """テキストのトークン数を計算"""
+    if not text:
+        return 0
+    return count_tokens_batch([text], provider, model)[0]
+
+
+def estimate_token_count(text: str) -> int:
+    """現在のプロバイダーでのプロンプトのトークン数を計算"""
+    return count_tokens(text)
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int = 0, provider: Optional[str] = None) -> Optional[float]:
+    """料金の概算（USD）。ローカル実行のOllamaは0、料金不明のモデルはNone"""
+    if provider == "ollama":
+        return 0.0
+    pricing = MODEL_PRICING.get(model)
+    if pricing is None:
+        return None
+    input_price, output_price = pricing
+    return round((input_tokens * input_price + output_tokens * output_price) / 1_000_000, 6)
@@ -0,0 +1,396 @@
+"""ベクトルインデックス（NumPy + メモリマップファイル）
+
+埋め込みベクトルを (容量 × 次元) の float32 行列としてディスク上の
+メモリマップファイルに保持し、コサイン類似度の総当たりで上位k件を求める。
+ベクトルはL2正規化済みのため、類似度は行列とクエリベクトルの内積1回で計算できる。
+
+ディスク上のファイル（directory 以下）:
+
+- vectors.f32: ベクトル行列。容量を増やすときはファイルをその場で伸ばす
+- meta.json: キーと updated_at のスナップショット（generation 付き）
+- meta-<generation>.log: スナップショット以降の追加・削除を1行1件で追記するログ
+
+書き込みはログへの追記だけで済み、ログがキーの数より長くなったらスナップショットに
+畳み込んで次の generation のログに切り替える（1件あたりの書き込みは償却 O(1)）。
+
+同じディレクトリを複数のプロセス（APIワーカー・生成ワーカー）が開くため、書き込めるのは
+書き込みロック（writer.lock）を取った1プロセスだけにする。他のプロセスは読み取り専用で
+開き、refresh() でログの増えた分を取り込む。
+"""
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional, TextIO, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows では書き込みロックを使わない（1プロセスで動かす）
+    fcntl = None  # type: ignore[assignment]
+
+INITIAL_CAPACITY = 1024
+
+# これより短いログはスナップショットに畳み込まない
+COMPACT_MIN_ENTRIES = 10000
+
+_FLOAT32_SIZE = np.dtype(np.float32).itemsize
+
+
+class VectorIndex:
+    """キー付きベクトルの総当たり検索インデックス"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.embedder_name: Optional[str] = None
+        self.dimension = 0
+        self.generation = 0
+        self.writable = False
+        self._matrix: Optional[np.memmap] = None
+        self._keys: List[str] = []
+        self._updated_at: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._lock_file: Optional[TextIO] = None
+        # 書き込み側: ディスクに書き出していない操作と、現在のログの行数
+        self._pending_log: List[List[str]] = []
+        self._log_entries = 0
+        # 読み取り側: 取り込んだスナップショットとログの位置
+        self._meta_stamp: Optional[Tuple[int, int]] = None
+        self._log_offset = 0
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.directory, "vectors.f32")
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.directory, "meta.json")
+
+    @property
+    def _lock_path(self) -> str:
+        return os.path.join(self.directory, "writer.lock")
+
+    def _log_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"meta-{generation}.log")
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    # ---- 書き込みロック ----
+
+    def acquire_writer(self) -> bool:
+        """書き込みロックを取る（他のプロセスが持っていれば False。ロックはプロセスの終了で外れる）"""
+        if self._lock_file is not None:
+            return True
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(self._lock_path, "a+")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+        self._lock_file = lock_file
+        self.writable = True
+        return True
+
+    def release_writer(self) -> None:
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self.writable = False
+
+    # ---- 読み込み ----
+
+    def _read_meta(self) -> Optional[Dict[str, Any]]:
+        if not (os.path.exists(self._meta_path) and os.path.exists(self._vectors_path)):
+            return None
+        with open(self._meta_path, "r", encoding="utf-8") as f:
+            stat = os.fstat(f.fileno())
+            meta = json.load(f)
+        self._meta_stamp = (stat.st_ino, stat.st_mtime_ns)
+        return meta
+
+    def _map(self) -> None:
+        """ファイルの大きさに合わせてベクトル行列を開き直す"""
+        capacity = os.path.getsize(self._vectors_path) // (self.dimension * _FLOAT32_SIZE)
+        self._matrix = np.memmap(
+            self._vectors_path, dtype=np.float32, mode="r+" if self.writable else "r",
+            shape=(capacity, self.dimension)
+        )
+
+    def open(self, embedder_name: str, dimension: int) -> None:
+        """ディスクからインデックスを読み込み
+
+        埋め込みモデルや次元数が保存時と異なる場合、書き込み側は空のインデックスから
+        始め、読み取り側は書き込み側が作り直すまで閉じたままにする。
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.embedder_name = embedder_name
+        self.dimension = dimension
+        self._keys, self._updated_at, self._positions = [], [], {}
+        self._pending_log = []
+        self._matrix = None
+
+        meta = self._read_meta()
+        if meta is not None and (meta.get("embedder") != embedder_name or meta.get("dimension") != dimension):
+            if not self.writable:
+                return
+            meta = None
+
+        if meta is None:
+            if self.writable:
+                self._create(self._meta_generation() + 1)
+            return
+
+        self.generation = meta.get("generation", 0)
+        self._keys = list(meta["keys"])
+        self._updated_at = list(meta["updated_at"])
+        self._positions = {key: i for i, key in enumerate(self._keys)}
+        self._map()
+        self._log_offset = 0
+        self._log_entries = self._replay_log()
+        if self.writable:
+            self._remove_stale_logs()
+
+    def _meta_generation(self) -> int:
+        try:
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                return json.load(f).get("generation", 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _create(self, generation: int) -> None:
+        """空のインデックスを作る（読み取り側が開いているファイルは置き換えるだけで書き換えない）"""
+        tmp_path = self._vectors_path + ".tmp"
+        matrix = np.memmap(tmp_path, dtype=np.float32, mode="w+", shape=(INITIAL_CAPACITY, self.dimension))
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, self._vectors_path)
+        self.generation = generation
+        self._log_entries = 0
+        self._map()
+        self._write_snapshot(self._snapshot())
+
+    def _replay_log(self) -> int:
+        """ログの未取り込みの行を適用し、適用した行数を返す"""
+        path = self._log_path(self.generation)
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            f.seek(self._log_offset)
+            data = f.read()
+        # 書き込み途中の最後の行は次回に回す
+        complete = data[:data.rfind(b"\n") + 1]
+        if self.writable and len(complete) < len(data):
+            with open(path, "r+b") as f:
+                f.truncate(self._log_offset + len(complete))
+        count = 0
+        for line in complete.splitlines():
+            if not line:
+                continue
+            entry = json.loads(line)
+            if entry[0] == "u":
+                self._set_meta(entry[1], entry[2])
+            elif entry[0] == "r":
+                self._remove_meta(entry[1])
+            count += 1
+        self._log_offset += len(complete)
+        return count
+
+    def _remove_stale_logs(self) -> None:
+        current = os.path.basename(self._log_path(self.generation))
+        for name in os.listdir(self.directory):
+            if name.startswith("meta-") and name.endswith(".log") and name != current:
+                os.remove(os.path.join(self.directory, name))
+
+    def refresh(self) -> None:
+        """読み取り側: 書き込み側のスナップショット・ログの変更を取り込む"""
+        if self.writable or self.embedder_name is None:
+            return
+        try:
+            stat = os.stat(self._meta_path)
+        except FileNotFoundError:
+            return
+        if self._matrix is None or (stat.st_ino, stat.st_mtime_ns) != self._meta_stamp:
+            # スナップショットが置き換わった（畳み込み・作り直し）
+            self.open(self.embedder_name, self.dimension)
+            return
+        # ログに現れる行のベクトルは書き出し済みのため、先に行を読んでから開き直す
+        position = self._log_offset
+        keys, updated_at, positions = list(self._keys), list(self._updated_at), dict(self._positions)
+        try:
+            self._replay_log()
+        except ValueError:
+            self._keys, self._updated_at, self._positions = keys, updated_at, positions
+            self._log_offset = position
+            return
+        if len(self._keys) > self._matrix.shape[0]:
+            self._map()
+
+    @property
+    def is_open(self) -> bool:
+        return self._matrix is not None
+
+    def _require_open(self) -> np.memmap:
+        if self._matrix is None:
+            raise RuntimeError("ベクトルインデックスが開かれていません")
+        return self._matrix
+
+    # ---- 更新 ----
+
+    def _require_writable(self) -> None:
+        if not self.writable:
+            raise RuntimeError("ベクトルインデックスは読み取り専用で開かれています")
+
+    def _ensure_capacity(self, size: int) -> None:
+        matrix = self._require_open()
+        capacity = matrix.shape[0]
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+
+        # 読み取り側の割り当てが無効にならないよう、ファイルはその場で伸ばす
+        matrix.flush()
+        with open(self._vectors_path, "r+b") as f:
+            f.truncate(capacity * self.dimension * _FLOAT32_SIZE)
+        self._map()
+
+    def _set_meta(self, key: str, updated_at: str) -> int:
+        position = self._positions.get(key)
+        if position is None:
+            position = len(self._keys)
+            self._keys.append(key)
+            self._updated_at.append(updated_at)
+            self._positions[key] = position
+        else:
+            self._updated_at[position] = updated_at
+        return position
+
+    def _remove_meta(self, key: str) -> Optional[Tuple[int, int]]:
+        """キーを削除し、(空いた位置, そこへ移した末尾の位置) を返す"""
+        position = self._positions.pop(key, None)
+        if position is None:
+            return None
+        last = len(self._keys) - 1
+        if position != last:
+            last_key = self._keys[last]
+            self._keys[position] = last_key
+            self._updated_at[position] = self._updated_at[last]
+            self._positions[last_key] = position
+        self._keys.pop()
+        self._updated_at.pop()
+        return position, last
+
+    def needs_update(self, key: str, updated_at: str) -> bool:
+        """ベクトルが未登録か、ドキュメントの updated_at が変わっている場合True"""
+        position = self._positions.get(key)
+        return position is None or self._updated_at[position] != updated_at
+
+    def keys(self) -> List[str]:
+        return list(self._keys)
+
+    def upsert(self, key: str, vector: np.ndarray, updated_at: str) -> None:
+        self._require_writable()
+        if key not in self._positions:
+            self._ensure_capacity(len(self._keys) + 1)
+        position = self._set_meta(key, updated_at)
+        self._require_open()[position] = vector
+        self._pending_log.append(["u", key, updated_at])
+
+    def remove(self, key: str) -> None:
+        """ベクトルを削除（末尾の行を空いた位置に移動して詰める）"""
+        self._require_writable()
+        moved = self._remove_meta(key)
+        if moved is None:
+            return
+        position, last = moved
+        if position != last:
+            matrix = self._require_open()
+            matrix[position] = matrix[last]
+        self._pending_log.append(["r", key])
+
+    # ---- 検索 ----
+
+    def vector(self, key: str) -> Optional[np.ndarray]:
+        position = self._positions.get(key)
+        if position is None:
+            return None
+        return np.array(self._require_open()[position])
+
+    def vectors(self, keys: Iterable[str]) -> Tuple[List[str], np.ndarray]:
+        """登録済みのキーとそのベクトル行列を返す"""
+        found = [key for key in keys if key in self._positions]
+        if not found:
+            return [], np.zeros((0, self.dimension), dtype=np.float32)
+        return found, np.asarray(self._require_open()[[self._positions[key] for key in found]])
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int = 10,
+        prefixes: Optional[Iterable[str]] = None
+    ) -> List[Tuple[str, float]]:
+        """コサイン類似度の上位k件を返す"""
+        size = len(self._keys)
+        if size == 0 or k <= 0:
+            return []
+
+        scores = np.asarray(self._require_open()[:size] @ query.astype(np.float32))
+        if prefixes:
+            prefixes = tuple(prefixes)
+            mask = np.fromiter((key.startswith(prefixes) for key in self._keys), dtype=bool, count=size)
+            scores = np.where(mask, scores, -np.inf)
+
+        k = min(k, size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self._keys[i], float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    # ---- 書き出し ----
+
+    def _snapshot(self) -> Dict[str, Any]:
+        return {
+            "embedder": self.embedder_name,
+            "dimension": self.dimension,
+            "generation": self.generation,
+            "keys": list(self._keys),
+            "updated_at": list(self._updated_at),
+        }
+
+    def _write_snapshot(self, snapshot: Dict[str, Any]) -> None:
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self._meta_path)
+        self._remove_stale_logs()
+
+    def pending_changes(self) -> Optional[Dict[str, Any]]:
+        """書き出していない変更を取り出す（イベントループ側で呼び、flush() に渡す）
+
+        ログがキーの数より長くなったら、この時点のスナップショットも含める。
+        """
+        if not self.writable or self._matrix is None:
+            return None
+        operations, self._pending_log = self._pending_log, []
+        self._log_entries += len(operations)
+        changes: Dict[str, Any] = {"generation": self.generation, "operations": operations, "snapshot": None}
+        if self._log_entries > max(COMPACT_MIN_ENTRIES, len(self._keys)):
+            self.generation += 1
+            self._log_entries = 0
+            changes["snapshot"] = self._snapshot()
+        return changes
+
+    def flush(self, changes: Optional[Dict[str, Any]] = None) -> None:
+        """ベクトルを書き出してから、変更をログに追記する（スナップショットがあれば置き換える）"""
+        changes = changes if changes is not None else self.pending_changes()
+        if changes is None or self._matrix is None:
+            return
+        self._matrix.flush()
+        if changes["snapshot"] is not None:
+            # スナップショットには取り出した変更も含まれている
+            self._write_snapshot(changes["snapshot"])
+        elif changes["operations"]:
+            lines = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in changes["operations"])
+            with open(self._log_path(changes["generation"]), "a", encoding="utf-8") as f:
+                f.write(lines)
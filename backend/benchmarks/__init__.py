@@ -0,0 +1 @@
+"""APIベンチマーク（run.py）と比較ツール（compare.py）、スタブLLMサーバー"""
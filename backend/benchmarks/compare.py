@@ -0,0 +1,85 @@
+"""ベンチマーク結果の比較
+
+    python -m benchmarks.compare base.json head.json --threshold 0.10
+
+シナリオごとにスループットと p50/p95/p99 の変化率を表示し、しきい値を
+超えて悪化したものがあれば終了コード1を返す（CIでの回帰検出用）。
+"""
+import argparse
+import json
+import sys
+from typing import Any, Dict, List, Tuple
+
+# (キー, 大きいほど良いか)
+METRICS: List[Tuple[str, bool]] = [
+    ("throughput_rps", True),
+    ("p50", False),
+    ("p95", False),
+    ("p99", False),
+]
+
+
+def _value(scenario: Dict[str, Any], key: str) -> float:
+    if key in scenario:
+        return float(scenario[key])
+    return float(scenario.get("latency_ms", {}).get(key, 0.0))
+
+
+def compare(base: Dict[str, Any], head: Dict[str, Any], threshold: float) -> Tuple[List[Dict[str, Any]], bool]:
+    """シナリオ・指標ごとの変化率と、回帰があったかを返す"""
+    rows = []
+    regressed = False
+    for name in sorted(set(base["scenarios"]) & set(head["scenarios"])):
+        for key, higher_is_better in METRICS:
+            before = _value(base["scenarios"][name], key)
+            after = _value(head["scenarios"][name], key)
+            change = (after - before) / before if before else 0.0
+            worse = -change if higher_is_better else change
+            is_regression = worse > threshold
+            regressed = regressed or is_regression
+            rows.append({
+                "scenario": name,
+                "metric": key,
+                "base": before,
+                "head": after,
+                "change": round(change, 4),
+                "regression": is_regression,
+            })
+    return rows, regressed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ベンチマーク結果の比較")
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument("--threshold", type=float, default=0.10, help="回帰とみなす悪化率（既定: 10%%）")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力")
+    args = parser.parse_args()
+
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.head, encoding="utf-8") as f:
+        head = json.load(f)
+
+    rows, regressed = compare(base, head, args.threshold)
+    if args.json:
+        print(json.dumps({
+            "base": base["meta"].get("git_commit"),
+            "head": head["meta"].get("git_commit"),
+            "rows": rows,
+            "regressed": regressed,
+        }, ensure_ascii=False, indent=2))
+    else:
+        print(f"base: {base['meta'].get('git_commit')}  head: {head['meta'].get('git_commit')}")
+        print(f"{'scenario':<20} {'metric':<16} {'base':>12} {'head':>12} {'change':>9}")
+        for row in rows:
+            mark = "  !" if row["regression"] else ""
+            print(
+                f"{row['scenario']:<20} {row['metric']:<16} {row['base']:>12.3f} {row['head']:>12.3f} "
+                f"{row['change'] * 100:>8.1f}%{mark}"
+            )
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""LLMプロバイダーのレイテンシ・スループット計測
+
+実際の BaseAIProvider 実装（Ollama / OpenAI / Anthropic / Google）に、
+app/prompts で組み立てたジャーナル・コメントのプロンプトを並列度を変えながら
+送り、プロバイダー・モデルごとに TTFT、トークン/秒、p50/p95 レイテンシ、
+エラー率と飽和点（並列度を上げてもスループットが伸びなくなる点）を報告する。
+
+既定ではスタブLLMサーバーに対して全プロバイダーを計測するため、ネットワークや
+APIキーは不要。--live を付けると .env / 環境変数の接続先とAPIキーを使う。
+
+    cd backend
+    python -m benchmarks.providers --concurrency 1,2,4,8,16 --requests 40 --max-concurrency 4
+    python -m benchmarks.providers --live --targets ollama:gpt-oss:20B,ollama:llama3.1:8b
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from benchmarks.run import git_commit, percentile, summarize
+from benchmarks.seed import _SENTENCES, _THEMES, _paragraphs, generate_world
+from benchmarks.stub_llm import StubServer, add_stub_arguments, stub_config_from_args
+
+PROVIDERS = ["ollama", "openai", "anthropic", "google"]
+PROMPT_KINDS = ["journal", "comment"]
+
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "samples_chara")
+
+# 並列度を上げたときのスループットの伸びがこれ未満なら飽和とみなす
+SATURATION_GAIN = 0.10
+
+
+def load_characters(samples_dir: str) -> List[Dict[str, Any]]:
+    """サンプルキャラクター（無ければ合成したキャラクター）を読み込む"""
+    characters = []
+    for path in sorted(glob.glob(os.path.join(samples_dir, "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            characters.append(json.load(f))
+    if characters:
+        return characters
+
+    world = generate_world(characters=8, journals_per_character=0, comments_per_journal=0)
+    names = {str(character["_id"]): character["name"] for character in world.characters}
+    for character in world.characters:
+        for relationship in character["relationships"]:
+            relationship["target_character_name"] = names[relationship["target_character_id"]]
+    return world.characters
+
+
+def build_prompts(kind: str, characters: List[Dict[str, Any]], count: int, seed: int) -> List[str]:
+    """app/prompts のテンプレートで代表的なプロンプトを組み立てる"""
+    from app.prompts import comment_prompt, journal_prompt
+
+    rng = random.Random(seed)
+    prompts = []
+    for _ in range(count):
+        character = rng.choice(characters)
+        if kind == "journal":
+            prompts.append(journal_prompt.create_journal_prompt(character, rng.choice(_THEMES)))
+        else:
+            journal = {"content": "Dear Diary,\n\n" + _paragraphs(rng, 8)}
+            existing = [{"_id": str(i), "content": rng.choice(_SENTENCES)} for i in range(rng.randrange(4))]
+            prompts.append(comment_prompt.create_comment_prompt(character, journal, existing))
+    return prompts
+
+
+def target_config(provider: str, model: str, stub_url: Optional[str]):
+    """計測対象の接続設定（スタブの場合は接続先とダミーのAPIキーを差し替える）"""
+    from app.services.ai_provider import ProviderConfig
+
+    if not stub_url:
+        return ProviderConfig.from_settings(provider, model=model)
+    base_url = {
+        "ollama": stub_url,
+        "openai": f"{stub_url}/v1",
+        "anthropic": f"{stub_url}/v1",
+        "google": f"{stub_url}/v1beta",
+    }[provider]
+    return ProviderConfig.from_settings(provider, model=model, base_url=base_url, api_key="stub")
+
+
+def parse_targets(value: str, live: bool) -> List[Tuple[str, str]]:
+    """"provider:model" のカンマ区切り（モデル名に ":" を含んでもよい）"""
+    from app.core.settings_store import provider_settings
+
+    current = provider_settings()
+    if not value:
+        if live:
+            return [(current.ai_provider, getattr(current, f"{current.ai_provider}_model"))]
+        return [(provider, "stub-model") for provider in PROVIDERS]
+
+    targets = []
+    for item in value.split(","):
+        provider, _, model = item.strip().partition(":")
+        if provider not in PROVIDERS:
+            raise SystemExit(f"不明なプロバイダーです: {provider}")
+        targets.append((provider, model or getattr(current, f"{provider}_model")))
+    return targets
+
+
+async def run_level(provider, prompts: List[str], requests: int, concurrency: int, operation: str) -> Dict[str, Any]:
+    """1つの並列度で requests 回呼び出して計測"""
+    from app.core import metrics
+
+    latencies: List[float] = []
+    ttfts: List[float] = []
+    decode_times: List[float] = []
+    errors = 0
+    error_samples: List[str] = []
+    counter = iter(range(requests))
+    tokens_before = metrics.llm_tokens_total.value(provider=provider.name, model=provider.model, type="output")
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            prompt = prompts[i % len(prompts)]
+            start = time.perf_counter()
+            try:
+                if operation == "stream":
+                    first: Optional[float] = None
+                    async for _ in provider.stream_text(prompt):
+                        if first is None:
+                            first = time.perf_counter() - start
+                    if first is None:
+                        raise RuntimeError("空の応答")
+                    ttfts.append(first)
+                else:
+                    await provider.generate_text(prompt)
+                    first = 0.0
+                latency = time.perf_counter() - start
+                latencies.append(latency)
+                decode_times.append(latency - first)
+            except Exception as e:
+                errors += 1
+                if len(error_samples) < 5:
+                    error_samples.append(f"{type(e).__name__}: {e}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, requests)))))
+    wall_time = time.perf_counter() - start
+
+    output_tokens = metrics.llm_tokens_total.value(provider=provider.name, model=provider.model, type="output") - tokens_before
+    result = {"concurrency": concurrency, **summarize(latencies, errors, wall_time)}
+    values = sorted(ttfts)
+    result["ttft_ms"] = {
+        "p50": round(percentile(values, 0.50) * 1000, 3),
+        "p95": round(percentile(values, 0.95) * 1000, 3),
+    } if values else None
+    result["output_tokens"] = int(output_tokens)
+    # 全リクエスト合計の生成速度と、1ストリームあたりの生成速度（最初のトークン以降）
+    result["output_tokens_per_s"] = round(output_tokens / wall_time, 1) if wall_time > 0 else 0.0
+    decode_time = sum(decode_times)
+    result["stream_tokens_per_s"] = round(output_tokens / decode_time, 1) if decode_time > 0 else 0.0
+    if error_samples:
+        result["error_samples"] = error_samples
+    return result
+
+
+def saturation_point(levels: List[Dict[str, Any]], max_error_rate: float) -> Optional[int]:
+    """スループットの伸びが止まる（またはエラー率が上限を超える）直前の並列度"""
+    for previous, current in zip(levels, levels[1:]):
+        if current["error_rate"] > max_error_rate:
+            return previous["concurrency"]
+        if current["throughput_rps"] < previous["throughput_rps"] * (1 + SATURATION_GAIN):
+            return previous["concurrency"]
+    return None
+
+
+async def run_benchmark(args: argparse.Namespace, stub_url: Optional[str]) -> Dict[str, Any]:
+    from app.services.ai_provider import get_ai_provider
+
+    characters = load_characters(args.samples_dir)
+    kinds = [kind.strip() for kind in args.prompts.split(",") if kind.strip()]
+    levels = [int(level) for level in args.concurrency.split(",")]
+    results = []
+
+    for provider_name, model in parse_targets(args.targets, args.live):
+        provider = get_ai_provider(target_config(provider_name, model, stub_url))
+        for kind in kinds:
+            if kind not in PROMPT_KINDS:
+                raise SystemExit(f"不明なプロンプトです: {kind}")
+            prompts = build_prompts(kind, characters, args.prompt_variants, args.seed)
+            entry: Dict[str, Any] = {"provider": provider_name, "model": model, "prompt": kind, "levels": []}
+            for concurrency in levels:
+                print(f"[providers] {provider_name}:{model} {kind} concurrency={concurrency}", file=sys.stderr)
+                level = await run_level(provider, prompts, args.requests, concurrency, args.operation)
+                entry["levels"].append(level)
+                # 全滅した並列度より上は計測しない
+                if level["error_rate"] >= 1.0:
+                    break
+            entry["saturation_concurrency"] = saturation_point(entry["levels"], args.max_error_rate)
+            results.append(entry)
+
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "git_commit": git_commit(),
+            "backend": "live" if args.live else "stub",
+            "operation": args.operation,
+            "config": {key: value for key, value in vars(args).items() if key != "output"},
+        },
+        "results": results,
+    }
+
+
+def print_table(result: Dict[str, Any]) -> None:
+    print(
+        f"{'target':<32} {'prompt':<8} {'conc':>4} {'rps':>8} {'tok/s':>9} {'ttft p50':>9} "
+        f"{'p50 ms':>9} {'p95 ms':>9} {'err':>6}",
+        file=sys.stderr
+    )
+    for entry in result["results"]:
+        target = f"{entry['provider']}:{entry['model']}"
+        for level in entry["levels"]:
+            ttft = level["ttft_ms"]["p50"] if level["ttft_ms"] else float("nan")
+            print(
+                f"{target:<32} {entry['prompt']:<8} {level['concurrency']:>4} {level['throughput_rps']:>8.2f} "
+                f"{level['output_tokens_per_s']:>9.1f} {ttft:>9.1f} {level['latency_ms']['p50']:>9.1f} "
+                f"{level['latency_ms']['p95']:>9.1f} {level['error_rate'] * 100:>5.1f}%",
+                file=sys.stderr
+            )
+        saturation = entry["saturation_concurrency"]
+        print(f"{'':<32} 飽和点: {saturation if saturation is not None else '未到達'}", file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="LLMプロバイダーのレイテンシ・スループット計測")
+    parser.add_argument("--targets", default="", help="provider:model のカンマ区切り（既定: スタブでは全プロバイダー）")
+    parser.add_argument("--prompts", default=",".join(PROMPT_KINDS), help="journal,comment")
+    parser.add_argument("--operation", choices=["stream", "generate"], default="stream",
+                        help="stream はTTFTも計測する。generate は非ストリーミングAPI")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="計測する並列度のカンマ区切り")
+    parser.add_argument("--requests", type=int, default=20, help="並列度ごとのリクエスト数")
+    parser.add_argument("--prompt-variants", type=int, default=8, help="使い回すプロンプトの種類数")
+    parser.add_argument("--max-error-rate", type=float, default=0.05, help="飽和とみなすエラー率")
+    parser.add_argument("--samples-dir", default=SAMPLES_DIR)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--live", action="store_true", help="スタブではなく設定済みの接続先を使う")
+    parser.add_argument("--output", default="-", help="結果JSONの出力先（- は標準出力）")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    if args.live:
+        result = asyncio.run(run_benchmark(args, None))
+    else:
+        with StubServer(stub_config_from_args(args)) as stub:
+            result = asyncio.run(run_benchmark(args, stub.url))
+
+    print_table(result)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"[providers] 結果を {args.output} に保存しました", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""APIベンチマーク
+
+FastAPIアプリをプロセス内で起動し（ASGIで直接呼び出す）、スタブLLMと
+ローカルのMongoDB（--in-memory の場合は mongomock_motor）に対して
+主要な経路のスループットと p50/p95/p99 レイテンシを計測する。
+結果はJSONで出力し、compare.py でコミット間の差分を確認できる。
+
+    cd backend
+    python -m benchmarks.run --characters 200 --journals-per-character 5 \\
+        --comments-per-journal 4 --requests 100 --concurrency 8 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from benchmarks.seed import export_document, generate_world, insert_world
+from benchmarks.stub_llm import StubServer, add_stub_arguments, stub_config_from_args
+
+SCENARIOS = [
+    "list_characters",
+    "list_journals",
+    "journal_comments",
+    "generate_journal",
+    "generate_comment",
+    "import",
+    "export_character",
+    "export_all",
+    "delete_cascade",
+]
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """線形補間によるパーセンタイル"""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize(latencies: List[float], errors: int, wall_time: float) -> Dict[str, Any]:
+    values = sorted(latencies)
+    count = len(values) + errors
+    return {
+        "requests": count,
+        "errors": errors,
+        "error_rate": round(errors / count, 4) if count else 0.0,
+        "throughput_rps": round(count / wall_time, 3) if wall_time > 0 else 0.0,
+        "wall_time_s": round(wall_time, 3),
+        "latency_ms": {
+            "min": round(values[0] * 1000, 3) if values else 0.0,
+            "mean": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+            "p50": round(percentile(values, 0.50) * 1000, 3),
+            "p95": round(percentile(values, 0.95) * 1000, 3),
+            "p99": round(percentile(values, 0.99) * 1000, 3),
+            "max": round(values[-1] * 1000, 3) if values else 0.0,
+        },
+    }
+
+
+async def measure(
+    requests: int,
+    concurrency: int,
+    call: Callable[[int], Awaitable[Any]]
+) -> Dict[str, Any]:
+    """call(i) を requests 回、concurrency 並列で実行して計測"""
+    latencies: List[float] = []
+    errors = 0
+    error_samples: List[str] = []
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                response = await call(i)
+                if getattr(response, "status_code", 200) >= 400:
+                    raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors += 1
+                if len(error_samples) < 5:
+                    error_samples.append(str(e))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, requests)))))
+    result = summarize(latencies, errors, time.perf_counter() - start)
+    if error_samples:
+        result["error_samples"] = error_samples
+    return result
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def configure_environment(args: argparse.Namespace, stub_url: str, data_dir: str) -> None:
+    """アプリのモジュールを読み込む前に、ベンチマーク用の設定を環境変数で渡す"""
+    os.environ.update({
+        "MONGODB_URL": args.mongodb_url,
+        "DATABASE_NAME": args.database,
+        "AI_PROVIDER": "ollama",
+        "OLLAMA_API_URL": stub_url,
+        "OLLAMA_MODEL": "stub-model",
+        "EMBEDDING_PROVIDER": "hashing",
+        "EMBEDDING_INDEX_DIR": os.path.join(data_dir, "embeddings"),
+        "UPLOAD_DIR": os.path.join(data_dir, "uploads"),
+        "TRACING_EXPORTER": "none",
+    })
+
+
+def use_in_memory_database(main_module) -> None:
+    """MongoDBの代わりに mongomock_motor を使う（未インストールの場合はエラー）"""
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        sys.exit("--in-memory には mongomock-motor が必要です: pip install mongomock-motor")
+
+    from app.core import database
+    from app.core.config import settings
+
+    async def connect_in_memory():
+        # 投入済みのデータを保つため、2回目以降は同じクライアントを使う
+        if database.db.client is None:
+            database.db.client = AsyncMongoMockClient()
+            database.db.db = database.db.client[settings.database_name]
+
+    database.connect_to_mongo = connect_in_memory
+    main_module.connect_to_mongo = connect_in_memory
+
+
+async def run_benchmark(args: argparse.Namespace, stub_url: str) -> Dict[str, Any]:
+    import httpx
+    import main as app_main
+    from app.core import database
+
+    if args.in_memory:
+        use_in_memory_database(app_main)
+
+    world = generate_world(
+        args.characters,
+        args.journals_per_character,
+        args.comments_per_journal,
+        args.relationships_per_character,
+        args.seed
+    )
+    rng = random.Random(args.seed)
+    scenarios = [name.strip() for name in args.scenarios.split(",")] if args.scenarios else SCENARIOS
+
+    # delete_cascade で削除するキャラクターは他のシナリオでは使わない
+    delete_count = min(args.requests, len(world.characters) // 2) if "delete_cascade" in scenarios else 0
+    victims = [str(character["_id"]) for character in world.characters[:delete_count]]
+    character_ids = [str(character["_id"]) for character in world.characters[delete_count:]]
+    journal_ids = [str(journal["_id"]) for journal in world.journals if journal["character_id"] in set(character_ids)]
+    names = {str(character["_id"]): character["name"] for character in world.characters}
+
+    results: Dict[str, Any] = {}
+    await database.connect_to_mongo()
+    if not args.in_memory:
+        await database.get_database().client.drop_database(args.database)
+    seed_start = time.perf_counter()
+    await insert_world(database.get_database(), world)
+    seed_time = time.perf_counter() - seed_start
+    if not args.in_memory:
+        # アプリのライフサイクルで接続し直す
+        await database.close_mongo_connection()
+
+    try:
+        async with app_main.app.router.lifespan_context(app_main.app):
+            # httpx の ASGI アプリの型は Starlette のシグネチャと一致しない
+            transport = httpx.ASGITransport(app=app_main.app)  # type: ignore[arg-type]
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+                import_payload = [
+                    export_document({**character, "name": f"{character['name']} (import)"}, names)
+                    for character in world.characters[:args.import_batch]
+                ]
+                calls: Dict[str, Callable[[int], Awaitable[Any]]] = {
+                    "list_characters": lambda i: client.get("/api/characters"),
+                    "list_journals": lambda i: client.get("/api/journals"),
+                    "journal_comments": lambda i: client.get(f"/api/comments/journal/{rng.choice(journal_ids)}"),
+                    "generate_journal": lambda i: client.post(
+                        "/api/journals/generate",
+                        json={"character_ids": [rng.choice(character_ids)], "theme": "ベンチマーク"}
+                    ),
+                    "generate_comment": lambda i: client.post(
+                        "/api/comments/generate",
+                        json={"journal_id": rng.choice(journal_ids), "character_id": rng.choice(character_ids)}
+                    ),
+                    "import": lambda i: client.post("/api/characters/import", files=[
+                        (
+                            "files",
+                            (f"{i}-{n}.json", json.dumps({**doc, "name": f"{doc['name']} {i}"}, ensure_ascii=False), "application/json")
+                        )
+                        for n, doc in enumerate(import_payload)
+                    ]),
+                    "export_character": lambda i: client.get(f"/api/characters/{rng.choice(character_ids)}/export"),
+                    "export_all": lambda i: client.get("/api/characters/export/all"),
+                    "delete_cascade": lambda i: client.delete(f"/api/characters/{victims[i]}"),
+                }
+
+                for name in scenarios:
+                    if name not in calls:
+                        raise SystemExit(f"不明なシナリオです: {name}")
+                    requests = delete_count if name == "delete_cascade" else args.requests
+                    if name in ("export_all", "list_journals"):
+                        requests = min(requests, args.heavy_requests)
+                    print(f"[bench] {name}: {requests} requests, concurrency {args.concurrency}", file=sys.stderr)
+                    results[name] = await measure(requests, args.concurrency, calls[name])
+    finally:
+        if not args.in_memory and not args.keep_database:
+            await database.connect_to_mongo()
+            await database.get_database().client.drop_database(args.database)
+            await database.close_mongo_connection()
+
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": "in-memory" if args.in_memory else "mongodb",
+            "world": world.counts(),
+            "seed_time_s": round(seed_time, 3),
+            "config": {
+                key: value for key, value in vars(args).items()
+                if key not in ("output", "mongodb_url")
+            },
+        },
+        "scenarios": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Constella APIのベンチマーク")
+    parser.add_argument("--characters", type=int, default=100)
+    parser.add_argument("--journals-per-character", type=int, default=5)
+    parser.add_argument("--comments-per-journal", type=int, default=4)
+    parser.add_argument("--relationships-per-character", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--requests", type=int, default=50, help="シナリオごとのリクエスト数")
+    parser.add_argument("--heavy-requests", type=int, default=10, help="全件取得系シナリオのリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--import-batch", type=int, default=5, help="import 1回あたりのファイル数")
+    parser.add_argument("--scenarios", default="", help=f"カンマ区切り（既定: すべて）: {','.join(SCENARIOS)}")
+    parser.add_argument("--mongodb-url", default=os.environ.get("BENCH_MONGODB_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--database", default=f"constella_bench_{uuid.uuid4().hex[:8]}")
+    parser.add_argument("--keep-database", action="store_true")
+    parser.add_argument("--in-memory", action="store_true", help="MongoDBの代わりに mongomock_motor を使う")
+    parser.add_argument("--output", default="-", help="結果JSONの出力先（- は標準出力）")
+    add_stub_arguments(parser)
+    parser.set_defaults(ttft_ms=20.0, tokens_per_second=5000.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="constella-bench-") as data_dir:
+        with StubServer(stub_config_from_args(args)) as stub:
+            configure_environment(args, stub.url, data_dir)
+            result = asyncio.run(run_benchmark(args, stub.url))
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"[bench] 結果を {args.output} に保存しました", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""ベンチマーク用のワールド（キャラクター・ジャーナル・コメント）の生成と投入"""
+import random
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from bson import ObjectId
+
+# insert_many 1回あたりの件数
+INSERT_BATCH_SIZE = 5000
+
+_FAMILY_NAMES = ["佐藤", "鈴木", "高橋", "田中", "伊藤", "渡辺", "山本", "中村", "小林", "加藤", "吉田", "山田"]
+_GIVEN_NAMES = ["美咲", "蓮", "陽菜", "湊", "結衣", "大和", "葵", "悠真", "凛", "樹", "紬", "陽翔"]
+_THEMES = ["雨の日の出来事", "久しぶりの再会", "小さな失敗", "休日の過ごし方", "忘れられない言葉", "新しい挑戦"]
+_SENTENCES = [
+    "今日は朝から落ち着かない一日だった。",
+    "帰り道、ふと昔のことを思い出した。",
+    "あの人の言葉が、まだ胸の奥に残っている。",
+    "小さなことでも、誰かと分かち合えると嬉しい。",
+    "明日はもう少しだけ素直になりたい。",
+    "窓の外では、季節が静かに移り変わっていた。",
+]
+
+
+@dataclass
+class World:
+    """生成されたドキュメント一式"""
+    characters: List[Dict[str, Any]] = field(default_factory=list)
+    journals: List[Dict[str, Any]] = field(default_factory=list)
+    comments: List[Dict[str, Any]] = field(default_factory=list)
+
+    def counts(self) -> Dict[str, int]:
+        return {
+            "characters": len(self.characters),
+            "journals": len(self.journals),
+            "comments": len(self.comments),
+        }
+
+
+def _paragraphs(rng: random.Random, sentences: int) -> str:
+    return "".join(rng.choice(_SENTENCES) for _ in range(sentences))
+
+
+def generate_world(
+    characters: int,
+    journals_per_character: int,
+    comments_per_journal: int,
+    relationships_per_character: int = 3,
+    seed: int = 0
+) -> World:
+    """指定サイズのワールドを生成（同じシードなら同じ内容）"""
+    rng = random.Random(seed)
+    world = World()
+    now = datetime.now()
+
+    ids = [ObjectId() for _ in range(characters)]
+    for index, character_id in enumerate(ids):
+        targets = rng.sample(ids, min(relationships_per_character + 1, characters))
+        world.characters.append({
+            "_id": character_id,
+            "name": f"{rng.choice(_FAMILY_NAMES)} {rng.choice(_GIVEN_NAMES)} {index:05d}",
+            "image_path": None,
+            "attributes": [
+                {"type": "description", "content": _paragraphs(rng, 2)},
+                {"type": "personality", "content": _paragraphs(rng, 2)},
+                {"type": "backstory", "content": _paragraphs(rng, 4)},
+            ],
+            "relationships": [
+                {"target_character_id": str(target), "description": "知り合い"}
+                for target in targets if target != character_id
+            ][:relationships_per_character],
+            "created_at": now - timedelta(days=365),
+            "updated_at": now - timedelta(days=365),
+        })
+
+    for character_id in ids:
+        for _ in range(journals_per_character):
+            created_at = now - timedelta(minutes=rng.randrange(60 * 24 * 365))
+            journal_id = ObjectId()
+            comment_ids = []
+            parent_ids: List[str] = []
+            for _ in range(comments_per_journal):
+                comment_id = ObjectId()
+                comment_ids.append(str(comment_id))
+                # 半分は既存コメントへの返信にしてスレッドを作る
+                parent = rng.choice(parent_ids) if parent_ids and rng.random() < 0.5 else None
+                world.comments.append({
+                    "_id": comment_id,
+                    "journal_id": str(journal_id),
+                    "character_id": str(rng.choice(ids)),
+                    "content": _paragraphs(rng, 1),
+                    "parent_comment_id": parent,
+                    "created_at": created_at + timedelta(minutes=len(comment_ids)),
+                    "updated_at": created_at + timedelta(minutes=len(comment_ids)),
+                })
+                parent_ids.append(str(comment_id))
+            world.journals.append({
+                "_id": journal_id,
+                "character_id": str(character_id),
+                "theme": rng.choice(_THEMES),
+                "content": "Dear Diary,\n\n" + _paragraphs(rng, 6),
+                "comment_ids": comment_ids,
+                "created_at": created_at,
+                "updated_at": created_at,
+            })
+
+    return world
+
+
+async def insert_world(db, world: World) -> None:
+    """ワールドをデータベースに一括投入"""
+    # 設定を環境変数で上書きしてから読み込めるよう、アプリのモジュールは遅延インポートする
+    from app.core.database import COLLECTIONS
+
+    for name, documents in (
+        ("characters", world.characters),
+        ("journals", world.journals),
+        ("comments", world.comments),
+    ):
+        for start in range(0, len(documents), INSERT_BATCH_SIZE):
+            await db[COLLECTIONS[name]].insert_many(documents[start:start + INSERT_BATCH_SIZE], ordered=False)
+
+
+def export_document(character: Dict[str, Any], names: Dict[str, str]) -> Dict[str, Any]:
+    """キャラクターを export_character と同じ形式（関係性は名前参照）に変換"""
+    return {
+        "name": character["name"],
+        "attributes": character.get("attributes", []),
+        "relationships": [
+            {"target_character_name": names.get(rel["target_character_id"], ""), "description": rel["description"]}
+            for rel in character.get("relationships", [])
+        ],
+        "image_path": character.get("image_path"),
+        "created_at": character["created_at"].isoformat() if character.get("created_at") else None,
+        "updated_at": character["updated_at"].isoformat() if character.get("updated_at") else None,
+        "export_version": "1.0",
+    }
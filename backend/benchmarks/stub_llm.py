@@ -0,0 +1,371 @@
+"""ベンチマーク用のスタブLLMサーバー
+
+Ollama / OpenAI / Anthropic / Google のAPIを模倣し、設定した遅延
+（最初のトークンまでの時間・トークン生成速度）とエラー率で応答する。
+ストリーミング・非ストリーミングの両方に対応し、JSONスキーマが指定された
+場合（Friends Discovery）は有効なJSONを返す。ネットワークに出ずに
+アプリ全体やプロバイダー実装をベンチマークできる。
+
+単体で起動する場合:
+    python -m benchmarks.stub_llm --port 11434 --ttft-ms 200 --tokens-per-second 50
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 生成テキストの素材（1要素 ≈ 1トークンとして扱う）
+_WORDS = [
+    "今日", "は", "朝", "から", "雨", "が", "降って", "いた", "。", "窓", "の", "外", "を",
+    "眺め", "ながら", "、", "昨日", "の", "こと", "を", "思い出した", "。", "あの", "人",
+    "の", "言葉", "が", "まだ", "胸", "に", "残って", "いる", "。", "明日", "は", "もう",
+    "少し", "素直", "に", "なれる", "だろう", "か", "。",
+]
+
+_NAMES = ["春野", "秋月", "冬木", "夏川", "朝倉", "夕凪", "星野", "月岡", "風間", "雪村", "花房", "水瀬"]
+_GIVEN_NAMES = ["葵", "蓮", "凛", "湊", "結衣", "陽向", "紬", "律", "楓", "朔", "澪", "悠"]
+
+
+@dataclass
+class StubConfig:
+    """スタブの応答特性"""
+    ttft_ms: float = 50.0
+    tokens_per_second: float = 2000.0
+    output_tokens: int = 200
+    error_rate: float = 0.0
+    max_concurrency: int = 0  # 0 = 無制限。超えた分は待たされる（サーバーの飽和を模倣）
+    chunk_tokens: int = 4
+    embedding_dimension: int = 256
+
+
+def _text(output_tokens: int, seed: int, prefix: str = "") -> List[str]:
+    rng = random.Random(seed)
+    tokens = [_WORDS[rng.randrange(len(_WORDS))] for _ in range(max(output_tokens, 1))]
+    if prefix:
+        tokens.insert(0, prefix)
+    return tokens
+
+
+def _character(rng: random.Random) -> Dict[str, str]:
+    name = f"{rng.choice(_NAMES)} {rng.choice(_GIVEN_NAMES)}"
+    return {
+        "name": name,
+        "introduction": f"{name}は物静かだが芯の強い人物。{rng.randrange(1000)}番目の物語に登場する。",
+        "backstory": f"{name}は{rng.randrange(10, 60)}歳。地方の町で育ち、{rng.randrange(1000)}年前の出来事をきっかけに上京した。",
+        "my_relationship": "昔から頼りにしている相手",
+        "your_relationship": "気にかけている相手",
+    }
+
+
+def _json_output(schema: Dict[str, Any], seed: int) -> List[str]:
+    """JSONスキーマに合う出力（配列を含む場合は3人分）"""
+    rng = random.Random(seed)
+    if "characters" in (schema.get("properties") or {}):
+        value: Any = {"characters": [_character(rng) for _ in range(3)]}
+    else:
+        value = _character(rng)
+    text = json.dumps(value, ensure_ascii=False)
+    # JSONを数文字ずつのチャンクに分ける（インクリメンタルパーサーの動作確認用）
+    return [text[i:i + 8] for i in range(0, len(text), 8)]
+
+
+def _count_prompt_tokens(prompt: str) -> int:
+    return max(1, len(prompt) // 2)
+
+
+def _embedding(text: str, dimension: int) -> List[float]:
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=32).digest()
+    rng = random.Random(digest)
+    vector = [rng.uniform(-1.0, 1.0) for _ in range(dimension)]
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+def create_stub_app(config: Optional[StubConfig] = None) -> FastAPI:
+    """スタブLLMのFastAPIアプリを作成"""
+    config = config or StubConfig()
+    app = FastAPI(title="Stub LLM")
+    app.state.config = config
+    app.state.semaphore = asyncio.Semaphore(config.max_concurrency) if config.max_concurrency > 0 else None
+    app.state.requests = 0
+
+    async def acquire() -> None:
+        app.state.requests += 1
+        if random.random() < config.error_rate:
+            raise HTTPException(status_code=500, detail="stub error")
+
+    async def tokens_stream(tokens: List[str]) -> AsyncIterator[str]:
+        """設定した速度でトークンをチャンク単位に返す"""
+        semaphore = app.state.semaphore
+        if semaphore:
+            await semaphore.acquire()
+        try:
+            await asyncio.sleep(config.ttft_ms / 1000)
+            step = max(config.chunk_tokens, 1)
+            for i in range(0, len(tokens), step):
+                if i:
+                    await asyncio.sleep(step / config.tokens_per_second)
+                yield "".join(tokens[i:i + step])
+        finally:
+            if semaphore:
+                semaphore.release()
+
+    async def collect(tokens: List[str]) -> str:
+        return "".join([chunk async for chunk in tokens_stream(tokens)])
+
+    def output_for(prompt: str, schema: Optional[Dict[str, Any]], max_tokens: Optional[int]) -> List[str]:
+        seed = random.randrange(2 ** 31)
+        if schema:
+            return _json_output(schema, seed)
+        prefix = "Dear Diary,\n\n" if "Dear Diary" in prompt else ""
+        return _text(min(config.output_tokens, max_tokens or config.output_tokens), seed, prefix)
+
+    def sse(data: Dict[str, Any], event: Optional[str] = None) -> str:
+        head = f"event: {event}\n" if event else ""
+        return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    # ---- Ollama ----
+
+    async def ollama_response(body: Dict[str, Any], chat: bool):
+        await acquire()
+        if chat:
+            prompt = "\n".join(message.get("content", "") for message in body.get("messages", []))
+        else:
+            prompt = body.get("prompt", "")
+        schema = body.get("format") if isinstance(body.get("format"), dict) else None
+        options = body.get("options") or {}
+        tokens = output_for(prompt, schema, options.get("num_predict"))
+        prompt_tokens = _count_prompt_tokens(prompt)
+        start = time.perf_counter_ns()
+
+        def final(text: str = "") -> Dict[str, Any]:
+            elapsed = time.perf_counter_ns() - start
+            result = {
+                "model": body.get("model"),
+                "done": True,
+                "done_reason": "stop",
+                "total_duration": elapsed,
+                "load_duration": 0,
+                "prompt_eval_count": prompt_tokens,
+                "prompt_eval_duration": int(config.ttft_ms * 1_000_000),
+                "eval_count": len(tokens),
+                "eval_duration": max(elapsed - int(config.ttft_ms * 1_000_000), 0),
+            }
+            if chat:
+                result["message"] = {"role": "assistant", "content": text}
+            else:
+                result["response"] = text
+            return result
+
+        if body.get("stream", True):
+            async def events():
+                async for chunk in tokens_stream(tokens):
+                    part = {"model": body.get("model"), "done": False}
+                    if chat:
+                        part["message"] = {"role": "assistant", "content": chunk}
+                    else:
+                        part["response"] = chunk
+                    yield json.dumps(part, ensure_ascii=False) + "\n"
+                yield json.dumps(final(), ensure_ascii=False) + "\n"
+            return StreamingResponse(events(), media_type="application/x-ndjson")
+        return JSONResponse(final(await collect(tokens)))
+
+    @app.post("/api/generate")
+    async def ollama_generate(request: Request):
+        return await ollama_response(await request.json(), chat=False)
+
+    @app.post("/api/chat")
+    async def ollama_chat(request: Request):
+        return await ollama_response(await request.json(), chat=True)
+
+    @app.get("/api/tags")
+    async def ollama_tags():
+        return {"models": [{"name": "stub-model", "model": "stub-model", "size": 0}]}
+
+    @app.post("/api/embeddings")
+    async def ollama_embeddings(request: Request):
+        body = await request.json()
+        return {"embedding": _embedding(body.get("prompt", ""), config.embedding_dimension)}
+
+    # ---- OpenAI ----
+
+    @app.post("/v1/chat/completions")
+    async def openai_chat(request: Request):
+        await acquire()
+        body = await request.json()
+        prompt = "\n".join(message.get("content", "") for message in body.get("messages", []))
+        response_format = body.get("response_format") or {}
+        schema = (response_format.get("json_schema") or {}).get("schema")
+        tokens = output_for(prompt, schema, body.get("max_tokens"))
+        usage = {
+            "prompt_tokens": _count_prompt_tokens(prompt),
+            "completion_tokens": len(tokens),
+            "total_tokens": _count_prompt_tokens(prompt) + len(tokens),
+        }
+
+        if body.get("stream"):
+            async def events():
+                async for chunk in tokens_stream(tokens):
+                    yield sse({"choices": [{"index": 0, "delta": {"content": chunk}}]})
+                yield sse({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    yield sse({"choices": [], "usage": usage})
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream")
+        text = await collect(tokens)
+        return {
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    @app.get("/v1/models")
+    async def openai_models():
+        return {"data": [{"id": "stub-model", "object": "model"}]}
+
+    @app.post("/v1/embeddings")
+    async def openai_embeddings(request: Request):
+        body = await request.json()
+        inputs = body.get("input") or []
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        return {"data": [
+            {"index": i, "embedding": _embedding(text, config.embedding_dimension)} for i, text in enumerate(inputs)
+        ]}
+
+    # ---- Anthropic ----
+
+    @app.post("/v1/messages")
+    async def anthropic_messages(request: Request):
+        await acquire()
+        body = await request.json()
+        prompt = "\n".join(
+            message["content"] if isinstance(message.get("content"), str) else ""
+            for message in body.get("messages", [])
+        )
+        tokens = output_for(prompt, None, body.get("max_tokens"))
+        input_tokens = _count_prompt_tokens(prompt)
+
+        if body.get("stream"):
+            async def events():
+                yield sse({"type": "message_start", "message": {"usage": {"input_tokens": input_tokens, "output_tokens": 0}}}, "message_start")
+                yield sse({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, "content_block_start")
+                async for chunk in tokens_stream(tokens):
+                    yield sse({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}}, "content_block_delta")
+                yield sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+                yield sse({"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": len(tokens)}}, "message_delta")
+                yield sse({"type": "message_stop"}, "message_stop")
+            return StreamingResponse(events(), media_type="text/event-stream")
+        text = await collect(tokens)
+        return {
+            "content": [{"type": "text", "text": text}],
+            "usage": {"input_tokens": input_tokens, "output_tokens": len(tokens)},
+        }
+
+    # ---- Google ----
+
+    @app.post("/v1beta/models/{model_action}")
+    async def google_generate(model_action: str, request: Request):
+        await acquire()
+        _, _, action = model_action.partition(":")
+        body = await request.json()
+        prompt = "\n".join(
+            part.get("text", "")
+            for content in body.get("contents", [])
+            for part in content.get("parts", [])
+        )
+        generation_config = body.get("generationConfig") or {}
+        tokens = output_for(prompt, generation_config.get("responseSchema"), generation_config.get("maxOutputTokens"))
+        usage = {"promptTokenCount": _count_prompt_tokens(prompt), "candidatesTokenCount": len(tokens)}
+
+        if action == "streamGenerateContent":
+            async def events():
+                async for chunk in tokens_stream(tokens):
+                    yield sse({"candidates": [{"content": {"parts": [{"text": chunk}]}}], "usageMetadata": usage})
+            return StreamingResponse(events(), media_type="text/event-stream")
+        if action != "generateContent":
+            raise HTTPException(status_code=404, detail="unknown action")
+        text = await collect(tokens)
+        return {"candidates": [{"content": {"parts": [{"text": text}]}}], "usageMetadata": usage}
+
+    @app.get("/v1beta/models")
+    async def google_models():
+        return {"models": [{"name": "models/stub-model"}]}
+
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StubServer:
+    """スタブLLMを別スレッドのuvicornで起動する"""
+
+    def __init__(self, config: Optional[StubConfig] = None, port: Optional[int] = None):
+        self.config = config or StubConfig()
+        self.port = port or free_port()
+        self.app = create_stub_app(self.config)
+        self._server = uvicorn.Server(uvicorn.Config(self.app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self) -> "StubServer":
+        self._thread = threading.Thread(target=self._server.run, name="stub-llm", daemon=True)
+        self._thread.start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("スタブLLMサーバーの起動に失敗しました")
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.should_exit = True
+        if self._thread:
+            self._thread.join(timeout=5)
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--ttft-ms", type=float, default=StubConfig.ttft_ms, help="最初のトークンまでの遅延（ミリ秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=StubConfig.tokens_per_second)
+    parser.add_argument("--output-tokens", type=int, default=StubConfig.output_tokens)
+    parser.add_argument("--error-rate", type=float, default=StubConfig.error_rate)
+    parser.add_argument("--max-concurrency", type=int, default=StubConfig.max_concurrency,
+                        help="同時に処理するリクエスト数の上限（0 = 無制限）")
+
+
+def stub_config_from_args(args: argparse.Namespace) -> StubConfig:
+    return StubConfig(
+        ttft_ms=args.ttft_ms,
+        tokens_per_second=args.tokens_per_second,
+        output_tokens=args.output_tokens,
+        error_rate=args.error_rate,
+        max_concurrency=args.max_concurrency,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ベンチマーク用のスタブLLMサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_stub_app(stub_config_from_args(args)), host=args.host, port=args.port, log_level="info")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""スケール検証用の合成ワールド生成
+
+数千人のキャラクター（優先的選択による裾の重い関係性の次数分布）、数十万件の
+ジャーナル、深い返信チェーンを含む数百万件のコメントを生成する。
+ドキュメントはバッチ単位で逐次生成するため、件数が増えてもメモリ使用量は一定。
+
+出力先は2通り:
+
+- MongoDBへ直接投入（insert_many を並列に発行し、スループットを表示）
+- JSONファイル: characters/ に export_character 形式（関係性は名前参照で
+  /api/characters/import にそのまま渡せる）、加えて mongoimport 用の
+  characters.jsonl / journals.jsonl / comments.jsonl（Extended JSON）
+
+    cd backend
+    python -m benchmarks.world --characters 5000 --journals 200000 \\
+        --comments-per-journal 10 --mongodb-url mongodb://localhost:27017 --database constella_scale --drop
+    python -m benchmarks.world --characters 500 --journals 5000 --format json --output-dir world
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from bson import ObjectId
+
+from benchmarks.seed import _FAMILY_NAMES, _GIVEN_NAMES, _THEMES, _paragraphs, export_document
+
+# (A から見た B, B から見た A)
+_RELATIONSHIP_PAIRS = [
+    ("幼なじみ。昔からの付き合いで、何でも話せる。", "幼なじみ。気づけばいつも隣にいる。"),
+    ("頼りになる先輩。仕事の相談によく乗ってもらう。", "面倒を見ている後輩。危なっかしいが伸びしろがある。"),
+    ("同じ趣味の仲間。週末に一緒に出かけることが多い。", "趣味仲間。話し始めると止まらない。"),
+    ("ライバル。負けたくないが、実力は認めている。", "ライバル。口には出さないが刺激を受けている。"),
+    ("近所に住む知り合い。顔を合わせれば立ち話をする。", "ご近所さん。いつも気さくに声をかけてくれる。"),
+    ("親戚。年に数回、家族の集まりで会う。", "親戚。会うたびに近況を聞いてくる。"),
+]
+
+# 返信の書き出し（スレッドらしさを出すため）
+_REPLY_OPENINGS = ["それ、わかる。", "そうだったんだね。", "本当に？", "ありがとう。", "今度詳しく聞かせて。"]
+
+
+@dataclass
+class WorldSpec:
+    """生成するワールドの規模と形"""
+    characters: int = 2000
+    journals: int = 100_000
+    comments_per_journal: float = 10.0
+    # 優先的選択で新しいキャラクターが張る関係の数（平均次数はおよそ2倍）
+    attachment: int = 3
+    # 2件目以降のコメントが返信になる確率
+    reply_probability: float = 0.7
+    # 返信のうち、直前のコメントに返信して会話を続ける（チェーンを深くする）確率
+    chain_probability: float = 0.6
+    # 関係のあるキャラクターがコメントする確率（残りは活動量に応じて全体から選ぶ）
+    neighbor_comment_probability: float = 0.7
+    batch_size: int = 5000
+    seed: int = 0
+
+
+@dataclass
+class WorldStats:
+    """生成結果の統計"""
+    characters: int = 0
+    journals: int = 0
+    comments: int = 0
+    relationships: int = 0
+    max_degree: int = 0
+    max_reply_depth: int = 0
+    max_comments_per_journal: int = 0
+
+    def to_dict(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+
+def relationship_edges(characters: int, attachment: int, rng: random.Random) -> List[Tuple[int, int]]:
+    """優先的選択（Barabási–Albert）による無向辺の一覧
+
+    次数の大きいキャラクターほど新しい関係を得やすく、少数の「顔の広い」
+    キャラクターと多数の関係の少ないキャラクターからなるべき分布になる。
+    """
+    edges: List[Tuple[int, int]] = []
+    # 次数の分だけノードを並べたリスト（ここから一様に選ぶと次数に比例した選択になる）
+    endpoints: List[int] = []
+    initial = min(attachment + 1, characters)
+    for a in range(initial):
+        for b in range(a + 1, initial):
+            edges.append((a, b))
+            endpoints.extend((a, b))
+    for node in range(initial, characters):
+        targets: Set[int] = set()
+        while len(targets) < min(attachment, node):
+            targets.add(rng.choice(endpoints) if endpoints else rng.randrange(node))
+        for target in targets:
+            edges.append((node, target))
+            endpoints.extend((node, target))
+    return edges
+
+
+class WorldGenerator:
+    """ワールドのドキュメントをコレクションごとのバッチとして逐次生成"""
+
+    def __init__(self, spec: WorldSpec):
+        self.spec = spec
+        self.rng = random.Random(spec.seed)
+        self.now = datetime.now()
+        self.stats = WorldStats()
+        self.ids: List[ObjectId] = []
+        self.names: Dict[str, str] = {}
+        self.neighbors: List[List[int]] = []
+        # キャラクターごとの活動量（ジャーナル執筆・コメントの頻度、パレート分布）
+        self.activity: List[float] = []
+        self._cumulative_activity: List[float] = []
+
+    def characters(self) -> List[Dict[str, Any]]:
+        """全キャラクター（関係性は双方向に設定）"""
+        spec, rng = self.spec, self.rng
+        self.ids = [ObjectId() for _ in range(spec.characters)]
+        self.neighbors = [[] for _ in range(spec.characters)]
+        relationships: List[List[Dict[str, str]]] = [[] for _ in range(spec.characters)]
+        for a, b in relationship_edges(spec.characters, spec.attachment, rng):
+            forward, backward = rng.choice(_RELATIONSHIP_PAIRS)
+            relationships[a].append({"target_character_id": str(self.ids[b]), "description": forward})
+            relationships[b].append({"target_character_id": str(self.ids[a]), "description": backward})
+            self.neighbors[a].append(b)
+            self.neighbors[b].append(a)
+        self.activity = [rng.paretovariate(1.5) for _ in range(spec.characters)]
+
+        documents = []
+        created_at = self.now - timedelta(days=2 * 365)
+        for index, character_id in enumerate(self.ids):
+            name = f"{rng.choice(_FAMILY_NAMES)} {rng.choice(_GIVEN_NAMES)} {index:06d}"
+            self.names[str(character_id)] = name
+            documents.append({
+                "_id": character_id,
+                "name": name,
+                "image_path": None,
+                "attributes": [
+                    {"type": "description", "content": _paragraphs(rng, 2)},
+                    {"type": "personality", "content": _paragraphs(rng, 2)},
+                    {"type": "currentStatus", "content": _paragraphs(rng, 2)},
+                    {"type": "backstory", "content": _paragraphs(rng, 4)},
+                ],
+                "relationships": relationships[index],
+                "created_at": created_at,
+                "updated_at": created_at,
+            })
+
+        self.stats.characters = len(documents)
+        self.stats.relationships = sum(len(rels) for rels in relationships)
+        self.stats.max_degree = max((len(rels) for rels in relationships), default=0)
+        return documents
+
+    def _commenter(self, author: int) -> int:
+        rng = self.rng
+        if self.neighbors[author] and rng.random() < self.spec.neighbor_comment_probability:
+            return rng.choice(self.neighbors[author])
+        return rng.choices(range(len(self.ids)), cum_weights=self._cumulative_activity)[0]
+
+    def _thread(self, journal_id: ObjectId, author: int, created_at: datetime) -> List[Dict[str, Any]]:
+        """1ジャーナル分のコメント（返信チェーンを含む）"""
+        spec, rng = self.spec, self.rng
+        count = int(rng.expovariate(1 / spec.comments_per_journal)) if spec.comments_per_journal > 0 else 0
+        comments: List[Dict[str, Any]] = []
+        depths: List[int] = []
+        timestamp = created_at
+        for position in range(count):
+            parent: Optional[int] = None
+            if comments and rng.random() < spec.reply_probability:
+                parent = len(comments) - 1 if rng.random() < spec.chain_probability else rng.randrange(len(comments))
+            if parent is None:
+                character = self._commenter(author)
+                content = _paragraphs(rng, 1)
+                depth = 0
+            else:
+                # 返信は親コメントの1つ上の発言者（会話の相手）か、ジャーナルの作者が返すことが多い
+                grandparent = comments[parent]["_parent_index"]
+                if grandparent is not None and rng.random() < 0.5:
+                    character = comments[grandparent]["_character_index"]
+                elif rng.random() < 0.3:
+                    character = author
+                else:
+                    character = self._commenter(author)
+                content = rng.choice(_REPLY_OPENINGS) + _paragraphs(rng, 1)
+                depth = depths[parent] + 1
+            timestamp += timedelta(minutes=rng.randrange(1, 180))
+            comments.append({
+                "_id": ObjectId(),
+                "journal_id": str(journal_id),
+                "character_id": str(self.ids[character]),
+                "content": content,
+                "parent_comment_id": str(comments[parent]["_id"]) if parent is not None else None,
+                "created_at": timestamp,
+                "updated_at": timestamp,
+                "_parent_index": parent,
+                "_character_index": character,
+            })
+            depths.append(depth)
+
+        for comment in comments:
+            del comment["_parent_index"], comment["_character_index"]
+        if depths:
+            self.stats.max_reply_depth = max(self.stats.max_reply_depth, max(depths))
+        self.stats.max_comments_per_journal = max(self.stats.max_comments_per_journal, count)
+        return comments
+
+    def batches(self) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+        """(コレクション名, ドキュメントのバッチ) を順に返す"""
+        spec, rng = self.spec, self.rng
+        characters = self.characters()
+        for start in range(0, len(characters), spec.batch_size):
+            yield "characters", characters[start:start + spec.batch_size]
+
+        self._cumulative_activity = []
+        total = 0.0
+        for weight in self.activity:
+            total += weight
+            self._cumulative_activity.append(total)
+
+        journals: List[Dict[str, Any]] = []
+        comments: List[Dict[str, Any]] = []
+        span_minutes = 60 * 24 * 2 * 365
+        for _ in range(spec.journals):
+            author = rng.choices(range(len(self.ids)), cum_weights=self._cumulative_activity)[0]
+            journal_id = ObjectId()
+            created_at = self.now - timedelta(minutes=rng.randrange(span_minutes))
+            thread = self._thread(journal_id, author, created_at)
+            journals.append({
+                "_id": journal_id,
+                "character_id": str(self.ids[author]),
+                "theme": rng.choice(_THEMES),
+                "content": "Dear Diary,\n\n" + _paragraphs(rng, 6),
+                "comment_ids": [str(comment["_id"]) for comment in thread],
+                "created_at": created_at,
+                "updated_at": created_at,
+            })
+            comments.extend(thread)
+            self.stats.journals += 1
+            self.stats.comments += len(thread)
+            if len(journals) >= spec.batch_size:
+                yield "journals", journals
+                journals = []
+            while len(comments) >= spec.batch_size:
+                yield "comments", comments[:spec.batch_size]
+                comments = comments[spec.batch_size:]
+        if journals:
+            yield "journals", journals
+        if comments:
+            yield "comments", comments
+
+
+def _extended_json(value: Any) -> Dict[str, str]:
+    """mongoimport が解釈できる Extended JSON（json_util より大幅に速い）"""
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat(timespec="milliseconds") + "Z"}
+    raise TypeError(f"JSONに変換できない型です: {type(value).__name__}")
+
+
+class Progress:
+    """コレクションごとの件数とスループットを標準エラーに表示"""
+
+    def __init__(self, interval: float = 2.0):
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.counts: Dict[str, int] = {}
+
+    def add(self, collection: str, count: int) -> None:
+        self.counts[collection] = self.counts.get(collection, 0) + count
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def report(self) -> None:
+        counts = " ".join(f"{name}={count}" for name, count in self.counts.items())
+        rate = self.total / self.elapsed if self.elapsed > 0 else 0.0
+        print(f"[world] {counts} ({rate:,.0f} docs/s)", file=sys.stderr)
+
+
+async def write_to_mongo(generator: WorldGenerator, args: argparse.Namespace, progress: Progress) -> None:
+    """insert_many（順序なし）を最大 --parallel 個同時に発行して投入"""
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    # 投入先のコレクション名はアプリと揃える
+    os.environ.setdefault("DATABASE_NAME", args.database)
+    from app.core.database import COLLECTIONS
+
+    client: Any = AsyncIOMotorClient(args.mongodb_url)
+    db = client[args.database]
+    if args.drop:
+        await client.drop_database(args.database)
+
+    slots = asyncio.Semaphore(args.parallel)
+    pending = set()
+    errors: List[BaseException] = []
+
+    async def insert(collection: str, documents: List[Dict[str, Any]]) -> None:
+        try:
+            await db[COLLECTIONS[collection]].insert_many(documents, ordered=False, bypass_document_validation=True)
+            progress.add(collection, len(documents))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
+
+    try:
+        for collection, documents in generator.batches():
+            if errors:
+                raise errors[0]
+            await slots.acquire()
+            task = asyncio.create_task(insert(collection, documents))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        await asyncio.gather(*pending)
+        if errors:
+            raise errors[0]
+    finally:
+        client.close()
+
+
+def write_to_files(generator: WorldGenerator, output_dir: str, progress: Progress) -> None:
+    """export_character 形式のキャラクターファイルと mongoimport 用のJSONLを書き出す"""
+    character_dir = os.path.join(output_dir, "characters")
+    os.makedirs(character_dir, exist_ok=True)
+    handles = {
+        name: open(os.path.join(output_dir, f"{name}.jsonl"), "w", encoding="utf-8")
+        for name in ("characters", "journals", "comments")
+    }
+    try:
+        for collection, documents in generator.batches():
+            if collection == "characters":
+                for character in documents:
+                    path = os.path.join(character_dir, f"{character['name'].replace(' ', '_')}.json")
+                    with open(path, "w", encoding="utf-8") as f:
+                        json.dump(export_document(character, generator.names), f, ensure_ascii=False, indent=2)
+            handles[collection].writelines(
+                json.dumps(document, default=_extended_json, ensure_ascii=False) + "\n"
+                for document in documents
+            )
+            progress.add(collection, len(documents))
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="スケール検証用の合成ワールド生成")
+    parser.add_argument("--characters", type=int, default=WorldSpec.characters)
+    parser.add_argument("--journals", type=int, default=WorldSpec.journals, help="ジャーナルの総数")
+    parser.add_argument("--comments-per-journal", type=float, default=WorldSpec.comments_per_journal, help="平均（指数分布）")
+    parser.add_argument("--attachment", type=int, default=WorldSpec.attachment, help="優先的選択で張る関係の数")
+    parser.add_argument("--reply-probability", type=float, default=WorldSpec.reply_probability)
+    parser.add_argument("--chain-probability", type=float, default=WorldSpec.chain_probability)
+    parser.add_argument("--batch-size", type=int, default=WorldSpec.batch_size)
+    parser.add_argument("--seed", type=int, default=WorldSpec.seed)
+    parser.add_argument("--format", choices=["mongo", "json"], default="mongo")
+    parser.add_argument("--mongodb-url", default=os.environ.get("MONGODB_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--database", default="constella_synthetic")
+    parser.add_argument("--drop", action="store_true", help="投入前にデータベースを削除")
+    parser.add_argument("--parallel", type=int, default=4, help="同時に発行する insert_many の数")
+    parser.add_argument("--output-dir", default="world", help="--format json の出力先")
+    args = parser.parse_args()
+
+    generator = WorldGenerator(WorldSpec(
+        characters=args.characters,
+        journals=args.journals,
+        comments_per_journal=args.comments_per_journal,
+        attachment=args.attachment,
+        reply_probability=args.reply_probability,
+        chain_probability=args.chain_probability,
+        batch_size=args.batch_size,
+        seed=args.seed,
+    ))
+    progress = Progress()
+    if args.format == "mongo":
+        asyncio.run(write_to_mongo(generator, args, progress))
+    else:
+        write_to_files(generator, args.output_dir, progress)
+
+    progress.report()
+    summary = {
+        **generator.stats.to_dict(),
+        "elapsed_s": round(progress.elapsed, 3),
+        "docs_per_second": round(progress.total / progress.elapsed, 1) if progress.elapsed > 0 else 0.0,
+    }
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,29 @@ Constella バックエンドアプリケーション
 """
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from contextlib import asynccontextmanager
 import os
 from dotenv import load_dotenv
+from pymongo.errors import PyMongoError
 
-from app.api import characters, journals, comments, discovery, uploads, settings
-from app.core.database import connect_to_mongo, close_mongo_connection
+from app.api import characters, journals, comments, discovery, uploads, settings, search, traces, profiles, tasks, live
+from app.core.database import connect_to_mongo, close_mongo_connection, get_database
+from app.core import deadline, metrics
+from app.core.tracing import TracingMiddleware, trace_exporter
+from app.core.profiling import ProfilingMiddleware
+from app.core.settings_store import SettingsSnapshotMiddleware, settings_store
+from app.core.task_queue import task_queue
+from app.core.idempotency import REPLAYED_HEADER, idempotency_store
+from app.core.llm_scheduler import SchedulerOverloadedError
+from app.services import generation, index_sync
+from app.services.index_events import index_events
+from app.services.live_updates import live_updates
+from app.services.model_preload import model_preloader
+from app.services.provider_health import provider_health
+from app.services.relationship_graph import relationship_graph
+from app.services.search_index import search_index
+from app.services.semantic_index import semantic_index
 
 # 環境変数を読み込み
 load_dotenv()
@@ -18,8 +35,29 @@ async def lifespan(app: FastAPI):
     """アプリケーションのライフサイクル管理"""
     # 起動時
     await connect_to_mongo()
+    await trace_exporter.start(get_database())
+    await settings_store.start(get_database())
+    # 最初の生成がモデルの読み込みを待たないように、Ollamaのモデルを読み込んでおく
+    model_preloader.start()
+    provider_health.start()
+    await relationship_graph.load(get_database())
+    await task_queue.start(get_database())
+    await generation.create_indexes(get_database())
+    await idempotency_store.start(get_database())
+    # 検索インデックスはデータ量が多いためバックグラウンドで構築
+    search_index.start_background_build(get_database())
+    await semantic_index.start(get_database())
+    # 他のプロセス（生成ワーカー・他のAPIワーカー）の書き込みを派生インデックスに反映
+    await index_events.start(get_database(), index_sync.apply_event)
+    await live_updates.start(get_database())
     yield
     # 終了時
+    await live_updates.stop()
+    await index_events.stop()
+    await semantic_index.stop()
+    await model_preloader.stop()
+    await settings_store.stop()
+    await trace_exporter.stop()
     await close_mongo_connection()
 
 # FastAPIアプリケーションのインスタンス作成
@@ -37,8 +75,24 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id", "X-Profile-Id", "Retry-After", REPLAYED_HEADER],
 )
 
+# リクエストごとにAIプロバイダー設定のスナップショットを固定
+app.add_middleware(SettingsSnapshotMiddleware)
+
+# X-Request-Deadline の期限を DB・LLM 呼び出しに伝える
+app.add_middleware(deadline.DeadlineMiddleware)
+
+# オンデマンドのプロファイリング（管理者トークン付きの X-Profile ヘッダー、または設定したルート）
+app.add_middleware(ProfilingMiddleware)
+
+# メトリクス（ルートごとのレイテンシ・処理中リクエスト数）
+app.add_middleware(metrics.MetricsMiddleware)
+
+# トレーシング（リクエストごとのトレースID・スパン）
+app.add_middleware(TracingMiddleware)
+
 # ルートエンドポイント
 @app.get("/")
 async def root():
@@ -55,10 +109,43 @@ async def health_check():
     """ヘルスチェック"""
     return {"status": "healthy"}
 
+# メトリクスエンドポイント（Prometheus形式）
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus形式のメトリクス"""
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+# LLM呼び出しのレーンが混雑している場合は 503 で断る
+@app.exception_handler(SchedulerOverloadedError)
+async def scheduler_overloaded(request, exc: SchedulerOverloadedError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc), "lane": exc.lane},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+# リクエストの期限までに終わらない処理は 504 で打ち切る
+@app.exception_handler(deadline.DeadlineExceeded)
+async def deadline_exceeded(request, exc: deadline.DeadlineExceeded):
+    return JSONResponse(status_code=504, content={"detail": str(exc), "operation": exc.operation})
+
+# 期限（pymongo.timeout）による MongoDB のタイムアウトも 504 にする
+@app.exception_handler(PyMongoError)
+async def database_error(request, exc: PyMongoError):
+    if not (exc.timeout and deadline.remaining() == 0.0):
+        raise exc
+    metrics.deadline_exceeded_total.inc(operation="database")
+    return JSONResponse(status_code=504, content={"detail": str(deadline.DeadlineExceeded("database")), "operation": "database"})
+
 # APIルーターを登録
 app.include_router(characters.router, prefix="/api/characters", tags=["characters"])
 app.include_router(journals.router, prefix="/api/journals", tags=["journals"])
 app.include_router(comments.router, prefix="/api/comments", tags=["comments"])
 app.include_router(discovery.router, prefix="/api/discovery", tags=["discovery"])
 app.include_router(uploads.router, prefix="/uploads", tags=["uploads"])
-app.include_router(settings.router, prefix="/api/settings", tags=["settings"])
\ No newline at end of file
+app.include_router(settings.router, prefix="/api/settings", tags=["settings"])
+app.include_router(search.router, prefix="/api/search", tags=["search"])
+app.include_router(traces.router, prefix="/api/traces", tags=["traces"])
+app.include_router(profiles.router, prefix="/api/profiles", tags=["profiles"])
+app.include_router(tasks.router, prefix="/api/tasks", tags=["tasks"])
+app.include_router(live.router, prefix="/api/live", tags=["live"])
\ No newline at end of file
@@ -0,0 +1,37 @@
+"""検索インデックス再構築コマンド
+
+検索インデックスはAPIプロセスのメモリ上にあるため、起動中のAPIに
+再構築を依頼する。依頼を受けたプロセスが再構築を終えると、他のAPIプロセスにも
+index_events で再構築が伝わる（数秒後にバックグラウンドで再構築される）。
+
+使い方:
+    python scripts/rebuild_search_index.py --api-url http://localhost:8000
+"""
+import argparse
+import sys
+
+import httpx
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="検索インデックスを再構築します")
+    parser.add_argument("--api-url", default="http://localhost:8000", help="Constella APIのURL")
+    parser.add_argument("--timeout", type=float, default=600.0, help="タイムアウト（秒）")
+    args = parser.parse_args()
+
+    try:
+        response = httpx.post(f"{args.api_url}/api/search/rebuild", timeout=args.timeout)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        print(f"再構築に失敗しました: {e}", file=sys.stderr)
+        return 1
+
+    result = response.json()
+    print(result["message"])
+    for kind, count in result["indexed"].items():
+        print(f"  {kind}: {count}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
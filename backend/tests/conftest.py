@@ -0,0 +1,20 @@
+"""テスト共通のフィクスチャ"""
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from app.core.config import settings
+
+
+@pytest.fixture
+def db():
+    """テストごとに空のインメモリ MongoDB（Motor 互換）"""
+    return AsyncMongoMockClient()["constella_test"]
+
+
+@pytest.fixture
+def override_settings(monkeypatch):
+    """settings の値をテストの間だけ差し替える"""
+    def override(**values):
+        for name, value in values.items():
+            monkeypatch.setattr(settings, name, value)
+    return override
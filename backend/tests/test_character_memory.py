@@ -0,0 +1,86 @@
+"""キャラクターの記憶の検索とキャッシュ"""
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from app.core.database import COLLECTIONS
+from app.services import character_memory as character_memory_module
+from app.services.character_memory import CharacterMemory
+
+
+@pytest.fixture
+def memory(override_settings):
+    override_settings(embedding_provider="hashing", memory_cache_ttl=300, memory_top_k=5, memory_token_budget=1500)
+    return CharacterMemory()
+
+
+async def add_journal(db, journal_id: str, character_id: str, content: str):
+    await db[COLLECTIONS["journals"]].insert_one({
+        "_id": journal_id, "character_id": character_id, "theme": "海", "content": content, "created_at": datetime.now(),
+    })
+
+
+def ids(memories):
+    return sorted(memory["id"] for memory in memories)
+
+
+async def test_result_is_cached_until_the_character_is_invalidated(memory, db):
+    await add_journal(db, "j1", "c1", "海辺を歩いた")
+    assert ids(await memory.retrieve({"_id": "c1"}, "海", db)) == ["j1"]
+
+    await add_journal(db, "j2", "c1", "海で泳いだ")
+    assert ids(await memory.retrieve({"_id": "c1"}, "海", db)) == ["j1"]
+
+    memory.journal_changed("j2", "c1")
+    assert ids(await memory.retrieve({"_id": "c1"}, "海", db)) == ["j1", "j2"]
+
+
+async def test_result_invalidated_during_retrieval_is_not_cached(memory, db, monkeypatch):
+    await add_journal(db, "j1", "c1", "海辺を歩いた")
+    loading = asyncio.Event()
+    release = asyncio.Event()
+    load_candidates = memory._candidates
+
+    async def slow_candidates(character_id, db):
+        candidates = await load_candidates(character_id, db)
+        loading.set()
+        await release.wait()
+        return candidates
+
+    monkeypatch.setattr(memory, "_candidates", slow_candidates)
+    retrieval = asyncio.create_task(memory.retrieve({"_id": "c1"}, "海", db))
+    await loading.wait()
+    # 読み込んだ後にジャーナルが書かれた
+    await add_journal(db, "j2", "c1", "海で泳いだ")
+    memory.journal_changed("j2", "c1")
+    release.set()
+
+    assert ids(await retrieval) == ["j1"]
+    assert "c1" not in memory._cache
+    assert memory._loading == {}
+    monkeypatch.setattr(memory, "_candidates", load_candidates)
+    assert ids(await memory.retrieve({"_id": "c1"}, "海", db)) == ["j1", "j2"]
+
+
+async def test_cache_keeps_only_recently_used_characters(memory, db, monkeypatch):
+    monkeypatch.setattr(character_memory_module, "MEMORY_CACHE_LIMIT", 2)
+    for character_id in ("c1", "c2", "c3"):
+        await add_journal(db, f"j-{character_id}", character_id, "海辺を歩いた")
+    await memory.retrieve({"_id": "c1"}, "海", db)
+    await memory.retrieve({"_id": "c2"}, "海", db)
+    await memory.retrieve({"_id": "c1"}, "海", db)
+    await memory.retrieve({"_id": "c3"}, "海", db)
+
+    assert list(memory._cache) == ["c1", "c3"]
+
+
+async def test_expired_results_are_dropped(memory, db, override_settings):
+    await add_journal(db, "j1", "c1", "海辺を歩いた")
+    await memory.retrieve({"_id": "c1"}, "海", db)
+    override_settings(memory_cache_ttl=0)
+
+    await memory.retrieve({"_id": "c1"}, "山", db)
+    assert list(memory._cache["c1"]) == [("山", 5, 1500)]
+    await add_journal(db, "j2", "c1", "海で泳いだ")
+    assert ids(await memory.retrieve({"_id": "c1"}, "海", db)) == ["j1", "j2"]
@@ -0,0 +1,71 @@
+"""リクエストの期限（X-Request-Deadline）"""
+import time
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from app.core import deadline
+from app.core.deadline import DEADLINE_HEADER, DeadlineMiddleware, parse_deadline
+
+
+def test_parse_unix_seconds():
+    assert parse_deadline("1700000000") == 1700000000.0
+    assert parse_deadline(" 1700000000.25 ") == 1700000000.25
+
+
+def test_parse_iso_8601_with_utc_designator_and_offset():
+    expected = datetime(2030, 1, 2, 3, 4, 5, tzinfo=timezone.utc).timestamp()
+    assert parse_deadline("2030-01-02T03:04:05Z") == expected
+    assert parse_deadline("2030-01-02T12:04:05+09:00") == expected
+
+
+@pytest.mark.parametrize("value", ["", "tomorrow", "2030-13-01T00:00:00Z"])
+def test_parse_rejects_other_formats(value):
+    with pytest.raises(ValueError):
+        parse_deadline(value)
+
+
+def test_deadline_scope_never_extends_the_current_deadline():
+    now = time.time()
+    with deadline.deadline_scope(now + 10):
+        with deadline.deadline_scope(now + 100):
+            assert deadline.current_deadline() == now + 10
+        with deadline.deadline_scope(None):
+            assert deadline.current_deadline() == now + 10
+    assert deadline.current_deadline() is None
+
+
+@pytest.fixture
+async def client():
+    app = FastAPI()
+    app.add_middleware(DeadlineMiddleware)
+
+    @app.get("/deadline")
+    async def current():
+        return {"deadline": deadline.current_deadline(), "remaining": deadline.remaining()}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+
+
+async def test_request_without_header_has_no_deadline(client):
+    assert (await client.get("/deadline")).json() == {"deadline": None, "remaining": None}
+
+
+async def test_header_deadline_is_visible_to_the_handler(client):
+    value = time.time() + 30
+    body = (await client.get("/deadline", headers={DEADLINE_HEADER: str(value)})).json()
+    assert body["deadline"] == pytest.approx(value)
+    assert 0 < body["remaining"] <= 30
+
+
+async def test_invalid_header_is_400(client):
+    response = await client.get("/deadline", headers={DEADLINE_HEADER: "soon"})
+    assert response.status_code == 400
+
+
+async def test_past_deadline_is_504_without_running_the_handler(client):
+    response = await client.get("/deadline", headers={DEADLINE_HEADER: str(time.time() - 1)})
+    assert response.status_code == 504
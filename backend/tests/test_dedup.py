@@ -0,0 +1,55 @@
+"""キャラクター候補の重複判定"""
+from app.services.dedup import jaccard, normalize_name, select_distinct, shingles
+
+
+def test_shingles_are_character_trigrams_of_normalized_text():
+    assert shingles("AbCd") == {"abc", "bcd"}
+    # 全角・空白の違いは無視する
+    assert shingles("ＡＢ Ｃ　Ｄ") == shingles("abcd")
+
+
+def test_shingles_of_short_and_empty_text():
+    assert shingles("ab") == {"ab"}
+    assert shingles("abc") == {"abc"}
+    assert shingles("") == set()
+    assert shingles(None) == set()
+
+
+def test_shingles_size():
+    assert shingles("abcd", size=2) == {"ab", "bc", "cd"}
+
+
+def test_jaccard():
+    assert jaccard({"a", "b"}, {"b", "c"}) == 1 / 3
+    assert jaccard(set(), {"a"}) == 0.0
+
+
+def test_normalize_name_ignores_width_case_and_separators():
+    assert normalize_name("ＪＯＨＮ・Ｓｍｉｔｈ") == normalize_name("john smith") == "johnsmith"
+
+
+def test_select_distinct_skips_existing_and_duplicate_names():
+    candidates = [
+        {"name": "Alice", "backstory": "a painter from the north"},
+        {"name": "ＡＬＩＣＥ", "backstory": "a sailor"},
+        {"name": "Bob", "backstory": "a chef who loves spicy food"},
+        {"name": "Carol", "backstory": "an astronomer"},
+    ]
+    selected = select_distinct(candidates, existing_names=["Bob"], limit=5)
+    assert [candidate["name"] for candidate in selected] == ["Alice", "Carol"]
+
+
+def test_select_distinct_skips_similar_backstories_and_respects_limit():
+    candidates = [
+        {"name": "A", "backstory": "幼い頃から海辺の町で灯台守をしている"},
+        {"name": "B", "backstory": "幼い頃から海辺の町で灯台守をしていた"},
+        {"name": "C", "backstory": "山奥の工房で時計を修理している"},
+        {"name": "D", "backstory": "都会の図書館で司書として働く"},
+    ]
+    selected = select_distinct(candidates, existing_names=[], limit=2)
+    assert [candidate["name"] for candidate in selected] == ["A", "C"]
+
+
+def test_select_distinct_skips_candidates_without_name():
+    selected = select_distinct([{"name": " ・ ", "backstory": "x"}], existing_names=[""], limit=3)
+    assert selected == []
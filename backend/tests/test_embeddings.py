@@ -0,0 +1,63 @@
+"""埋め込みプロバイダーの取得と、設定変更時の作り直し"""
+import asyncio
+
+import httpx
+import pytest
+
+from app.core.settings_store import ProviderSettings, settings_store
+from app.services import embeddings
+from app.services.embeddings import OllamaEmbedder, get_embedder
+
+
+@pytest.fixture
+def set_ollama_url(monkeypatch, override_settings):
+    monkeypatch.setattr(embeddings, "_embedders", {})
+    override_settings(embedding_provider="ollama", ollama_embedding_model="embed-model")
+
+    def set_ollama_url(url: str):
+        current = settings_store.current
+        monkeypatch.setattr(settings_store, "_current", ProviderSettings(**{**current.dict(), "ollama_api_url": url}))
+    return set_ollama_url
+
+
+async def test_same_settings_reuse_the_embedder(set_ollama_url):
+    set_ollama_url("http://ollama-a:11434")
+    assert get_embedder() is get_embedder()
+
+
+async def test_changed_url_replaces_and_closes_the_previous_embedder(set_ollama_url):
+    set_ollama_url("http://ollama-a:11434")
+    previous = get_embedder()
+    client = previous._http()
+
+    set_ollama_url("http://ollama-b:11434")
+    embedder = get_embedder()
+    await asyncio.sleep(0)
+
+    assert embedder is not previous
+    assert isinstance(embedder, OllamaEmbedder) and embedder.api_url == "http://ollama-b:11434"
+    assert client.is_closed
+    assert len(embeddings._embedders) == 1
+
+
+async def test_previous_embedder_is_closed_after_in_flight_requests(set_ollama_url):
+    set_ollama_url("http://ollama-a:11434")
+    previous = get_embedder()
+    release = asyncio.Event()
+
+    async def handler(request):
+        await release.wait()
+        return httpx.Response(200, json={"embedding": [1.0, 0.0]})
+
+    client = previous._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    embedding = asyncio.create_task(previous.embed(["text"]))
+    await asyncio.sleep(0.01)
+
+    set_ollama_url("http://ollama-b:11434")
+    get_embedder()
+    await asyncio.sleep(0.01)
+    assert not client.is_closed
+
+    release.set()
+    assert (await embedding).shape == (1, 2)
+    assert client.is_closed
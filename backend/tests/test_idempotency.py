@@ -0,0 +1,161 @@
+"""生成エンドポイントの冪等性キー"""
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from fastapi import FastAPI, Request, Response
+
+from app.core import idempotency
+from app.core.idempotency import (
+    COMPLETED, IDEMPOTENCY_COLLECTION, IN_PROGRESS, REPLAYED_HEADER,
+    IdempotencyConflictError, IdempotencyStore, idempotent
+)
+
+
+@pytest.fixture
+async def store(db, override_settings):
+    override_settings(idempotency_lock_timeout=60.0, idempotency_poll_interval=0.01, idempotency_wait_timeout=1.0)
+    store = IdempotencyStore()
+    await store.start(db)
+    return store
+
+
+def counting(result):
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return result
+    return compute, calls
+
+
+async def test_completed_key_is_replayed_without_recomputing(store, db):
+    compute, calls = counting({"text": "generated"})
+    assert await store.run("k1", "scope", {"a": 1}, compute) == ({"text": "generated"}, "new")
+    assert await store.run("k1", "scope", {"a": 1}, compute) == ({"text": "generated"}, "replayed")
+    assert len(calls) == 1
+    record = await db[IDEMPOTENCY_COLLECTION].find_one({"_id": "scope:k1"})
+    assert record["status"] == COMPLETED
+
+
+async def test_same_key_with_different_payload_is_a_conflict(store):
+    compute, _ = counting("ok")
+    await store.run("k1", "scope", {"a": 1}, compute)
+    with pytest.raises(IdempotencyConflictError):
+        await store.run("k1", "scope", {"a": 2}, compute)
+
+
+async def test_same_key_in_another_scope_is_independent(store):
+    compute, calls = counting("ok")
+    await store.run("k1", "journals", {"a": 1}, compute)
+    assert (await store.run("k1", "comments", {"a": 2}, compute))[1] == "new"
+    assert len(calls) == 2
+
+
+async def test_concurrent_retry_attaches_to_running_computation(store):
+    started = asyncio.Event()
+    release = asyncio.Event()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        started.set()
+        await release.wait()
+        return "done"
+
+    first = asyncio.create_task(store.run("k1", "scope", {}, compute))
+    await started.wait()
+    second = asyncio.create_task(store.run("k1", "scope", {}, compute))
+    await asyncio.sleep(0.02)
+    release.set()
+    assert await first == ("done", "new")
+    assert await second == ("done", "attached")
+    assert len(calls) == 1
+
+
+async def test_failed_computation_releases_the_key(store, db):
+    async def fail():
+        raise RuntimeError("LLM error")
+
+    with pytest.raises(RuntimeError):
+        await store.run("k1", "scope", {}, fail)
+    assert await db[IDEMPOTENCY_COLLECTION].find_one({"_id": "scope:k1"}) is None
+
+    compute, calls = counting("retried")
+    assert await store.run("k1", "scope", {}, compute) == ("retried", "new")
+
+
+async def test_expired_lease_is_taken_over(store, db):
+    """処理していたプロセスが落ちたキーは、リースの期限後に別のリクエストが引き継ぐ"""
+    now = datetime.now()
+    await db[IDEMPOTENCY_COLLECTION].insert_one({
+        "_id": "scope:k1",
+        "request_hash": idempotency._fingerprint({"a": 1}),
+        "status": IN_PROGRESS,
+        "owner": "crashed",
+        "lease_expires_at": now - timedelta(seconds=1),
+        "response": None,
+        "expires_at": now + timedelta(hours=1),
+    })
+    compute, calls = counting("recovered")
+    assert await store.run("k1", "scope", {"a": 1}, compute) == ("recovered", "attached")
+    assert len(calls) == 1
+    record = await db[IDEMPOTENCY_COLLECTION].find_one({"_id": "scope:k1"})
+    assert record["status"] == COMPLETED
+    assert record["owner"] != "crashed"
+    assert record["response"] == "recovered"
+
+
+async def test_live_lease_is_waited_for_until_completed(store, db):
+    """他のプロセスで処理中（リースが有効）のキーは、完了を待って結果を返す"""
+    now = datetime.now()
+    await db[IDEMPOTENCY_COLLECTION].insert_one({
+        "_id": "scope:k1",
+        "request_hash": idempotency._fingerprint({}),
+        "status": IN_PROGRESS,
+        "owner": "other-process",
+        "lease_expires_at": now + timedelta(seconds=60),
+        "response": None,
+        "expires_at": now + timedelta(hours=1),
+    })
+    compute, calls = counting("never")
+    waiting = asyncio.create_task(store.run("k1", "scope", {}, compute))
+    await asyncio.sleep(0.03)
+    await db[IDEMPOTENCY_COLLECTION].update_one(
+        {"_id": "scope:k1"}, {"$set": {"status": COMPLETED, "response": "from other"}}
+    )
+    assert await waiting == ("from other", "attached")
+    assert calls == []
+
+
+@pytest.fixture
+async def client(store, monkeypatch):
+    monkeypatch.setattr(idempotency, "idempotency_store", store)
+    app = FastAPI()
+
+    @app.post("/generate")
+    async def generate(payload: dict, request: Request, response: Response):
+        async def compute():
+            return {"echo": payload}
+        return await idempotent(request, response, "test.generate", payload, compute)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+
+
+async def test_endpoint_marks_replayed_responses(client):
+    headers = {"Idempotency-Key": "abc"}
+    first = await client.post("/generate", json={"a": 1}, headers=headers)
+    second = await client.post("/generate", json={"a": 1}, headers=headers)
+    assert first.json() == second.json() == {"echo": {"a": 1}}
+    assert REPLAYED_HEADER not in first.headers
+    assert second.headers[REPLAYED_HEADER] == "true"
+
+
+async def test_endpoint_rejects_conflicting_and_oversized_keys(client):
+    await client.post("/generate", json={"a": 1}, headers={"Idempotency-Key": "abc"})
+    conflict = await client.post("/generate", json={"a": 2}, headers={"Idempotency-Key": "abc"})
+    assert conflict.status_code == 422
+    too_long = await client.post("/generate", json={}, headers={"Idempotency-Key": "x" * 256})
+    assert too_long.status_code == 400
@@ -0,0 +1,117 @@
+"""ストリーミングJSONパーサーと、崩れた出力の修復"""
+import pytest
+
+from app.services import ollama
+from app.services.json_stream import JsonObjectStream, extract_json_object, parse_json_object
+
+
+def feed_all(parser: JsonObjectStream, chunks):
+    completed = []
+    for chunk in chunks:
+        completed.extend(parser.feed(chunk))
+    return completed
+
+
+def test_objects_in_wrapped_array_are_returned_when_closed():
+    parser = JsonObjectStream()
+    assert parser.feed('{"characters": [{"name": "A"}, {"na') == ['{"name": "A"}']
+    assert parser.feed('me": "B"}]}') == ['{"name": "B"}']
+
+
+def test_top_level_array_split_at_every_character():
+    text = '[{"name": "A", "tags": ["x", "y"]}, {"name": "B", "nested": {"k": 1}}]'
+    assert feed_all(JsonObjectStream(), text) == [
+        '{"name": "A", "tags": ["x", "y"]}',
+        '{"name": "B", "nested": {"k": 1}}',
+    ]
+
+
+def test_brackets_and_escaped_quotes_inside_strings_are_ignored():
+    text = '[{"name": "A}]", "quote": "say \\"{hi}\\""}]'
+    assert feed_all(JsonObjectStream(), [text[:12], text[12:]]) == [text[1:-1]]
+
+
+def test_prose_and_code_fences_around_json_are_ignored():
+    text = 'Here is the "result":\n```json\n{"characters": [{"name": "A"}]}\n```\nDone "ok".'
+    assert feed_all(JsonObjectStream(), text) == ['{"name": "A"}']
+
+
+def test_objects_outside_an_array_are_not_returned():
+    assert feed_all(JsonObjectStream(), '{"name": "A", "profile": {"age": 3}}') == []
+
+
+def test_parse_json_object_accepts_valid_json_and_control_characters():
+    assert parse_json_object('{"text": "line1\nline2"}') == {"text": "line1\nline2"}
+
+
+def test_parse_json_object_repairs_trailing_commas_and_comments():
+    raw = '{\n  "name": "A", // 名前\n  "tags": ["x", "y",],\n}'
+    assert parse_json_object(raw) == {"name": "A", "tags": ["x", "y"]}
+
+
+def test_repair_keeps_comment_like_text_inside_strings():
+    raw = '{"url": "https://example.com/a,]", "note": "x",}'
+    assert parse_json_object(raw) == {"url": "https://example.com/a,]", "note": "x"}
+
+
+@pytest.mark.parametrize("raw", ['{"name": "A"', '["A"]', "not json"])
+def test_parse_json_object_returns_none_when_unrecoverable(raw):
+    assert parse_json_object(raw) is None
+
+
+def test_extract_json_object_from_surrounding_text():
+    assert extract_json_object('```json\n{"name": "A",}\n```') == {"name": "A"}
+    assert extract_json_object("no object") is None
+
+
+def character_json(name: str) -> str:
+    return (
+        f'{{"name": "{name}", "introduction": "intro", "backstory": "story of {name}", '
+        f'"my_relationship": "friend", "your_relationship": "friend"}}'
+    )
+
+
+async def test_stream_friends_discovery_regenerates_only_broken_character(monkeypatch):
+    """崩れた1人分だけを作り直し、正しいキャラクターはそのまま返す"""
+    calls = []
+
+    async def fake_stream_text(task, prompt, json_schema=None, options=None):
+        calls.append(json_schema)
+        if len(calls) == 1:
+            # 2人目は必須項目が欠けている
+            text = f'{{"characters": [{character_json("A")}, {{"name": "B"}}, {character_json("C")}]}}'
+        else:
+            text = character_json("D")
+        for i in range(0, len(text), 7):
+            yield text[i:i + 7]
+
+    monkeypatch.setattr(ollama.model_router, "stream_text", fake_stream_text)
+    character = {"_id": "c1", "name": "Base", "introduction": "", "backstory": ""}
+    names = [candidate["name"] async for candidate in ollama.stream_friends_discovery(character, "friend")]
+
+    assert names == ["A", "C", "D"]
+    assert len(calls) == 2
+
+
+async def test_stream_friends_discovery_closes_stream_once_enough_characters(monkeypatch):
+    """必要な人数がそろったら、残りを読まずにストリームを閉じる"""
+    pulled = []
+    closed = []
+
+    async def fake_stream_text(task, prompt, json_schema=None, options=None):
+        try:
+            yield '{"characters": ['
+            for i in range(ollama.DISCOVERY_COUNT + 5):
+                pulled.append(i)
+                yield character_json(f"N{i}") + ","
+            yield "]}"
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(ollama.model_router, "stream_text", fake_stream_text)
+    character = {"_id": "c1", "name": "Base", "introduction": "", "backstory": ""}
+    names = [candidate["name"] async for candidate in ollama.stream_friends_discovery(character, "friend")]
+
+    assert names == [f"N{i}" for i in range(ollama.DISCOVERY_COUNT)]
+    assert closed == [True]
+    assert len(pulled) == ollama.DISCOVERY_COUNT
@@ -0,0 +1,129 @@
+"""LLM呼び出しのスケジューラー（重み付き公平キューイングと待ち件数の上限）"""
+import asyncio
+import time
+
+import pytest
+
+from app.core import deadline
+from app.core.deadline import DeadlineExceeded
+from app.core.llm_scheduler import BACKGROUND, BATCH, INTERACTIVE, LLMScheduler, SchedulerOverloadedError
+
+
+@pytest.fixture
+def scheduler(override_settings):
+    override_settings(
+        llm_max_concurrency=1,
+        llm_lane_weights="interactive:8,batch:2,background:1",
+        llm_lane_max_depth="interactive:32,batch:32,background:32",
+    )
+    return LLMScheduler()
+
+
+async def hold(scheduler: LLMScheduler, lane: str, release: asyncio.Event, order: list, name: str):
+    async with scheduler.slot("ollama", lane):
+        order.append(name)
+        await release.wait()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def run_queued(scheduler: LLMScheduler, queued):
+    """枠を1つ埋めた状態で queued を順に並べ、枠が割り当てられた順を返す"""
+    order: list = []
+    release = asyncio.Event()
+    holder = asyncio.create_task(hold(scheduler, INTERACTIVE, release, order, "holder"))
+    await settle()
+    waiters = []
+    for name, lane in queued:
+        waiters.append(asyncio.create_task(hold(scheduler, lane, release, order, name)))
+        await settle()
+    release.set()
+    await asyncio.gather(holder, *waiters)
+    return order[1:]
+
+
+async def test_interactive_calls_overtake_queued_batch(scheduler):
+    order = await run_queued(scheduler, [
+        ("b1", BATCH), ("b2", BATCH), ("b3", BATCH), ("i1", INTERACTIVE), ("i2", INTERACTIVE),
+    ])
+    assert order == ["i1", "i2", "b1", "b2", "b3"]
+
+
+async def test_lanes_share_slots_by_weight(scheduler):
+    """対話的な呼び出しが続いても、一括生成は重みの比率で枠を得る"""
+    queued = [(f"b{i}", BATCH) for i in range(2)] + [(f"i{i}", INTERACTIVE) for i in range(8)]
+    order = await run_queued(scheduler, queued)
+    assert order.index("b0") == 3
+    assert order.index("b1") < order.index("i7")
+
+
+async def test_same_lane_is_first_in_first_out(scheduler):
+    order = await run_queued(scheduler, [("g1", BACKGROUND), ("g2", BACKGROUND), ("g3", BACKGROUND)])
+    assert order == ["g1", "g2", "g3"]
+
+
+async def test_full_lane_is_shed_with_retry_after(scheduler, override_settings):
+    override_settings(llm_lane_max_depth="interactive:1,batch:1,background:1")
+    release = asyncio.Event()
+    order: list = []
+    holder = asyncio.create_task(hold(scheduler, BATCH, release, order, "holder"))
+    waiter = asyncio.create_task(hold(scheduler, BATCH, release, order, "waiter"))
+    await settle()
+
+    with pytest.raises(SchedulerOverloadedError) as raised:
+        async with scheduler.slot("ollama", BATCH):
+            pass
+    assert raised.value.lane == BATCH
+    assert raised.value.retry_after >= 1
+
+    # 他のレーンは断らない
+    other = asyncio.create_task(hold(scheduler, INTERACTIVE, release, order, "other"))
+    await settle()
+    release.set()
+    await asyncio.gather(holder, waiter, other)
+    assert sorted(order) == ["holder", "other", "waiter"]
+
+
+async def test_cancelled_waiter_leaves_the_queue(scheduler):
+    release = asyncio.Event()
+    order: list = []
+    holder = asyncio.create_task(hold(scheduler, INTERACTIVE, release, order, "holder"))
+    waiter = asyncio.create_task(hold(scheduler, BATCH, release, order, "waiter"))
+    await settle()
+    assert scheduler.snapshot()["ollama"]["waiting"][BATCH] == 1
+
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    assert scheduler.snapshot()["ollama"]["waiting"][BATCH] == 0
+
+    release.set()
+    await holder
+    assert order == ["holder"]
+    assert scheduler.snapshot()["ollama"]["active"] == 0
+
+
+async def test_waiting_stops_at_request_deadline(scheduler):
+    release = asyncio.Event()
+    holder = asyncio.create_task(hold(scheduler, INTERACTIVE, release, [], "holder"))
+    await settle()
+
+    with deadline.deadline_scope(time.time() + 0.05):
+        with pytest.raises(DeadlineExceeded):
+            async with scheduler.slot("ollama", INTERACTIVE):
+                pass
+    assert scheduler.snapshot()["ollama"]["waiting"][INTERACTIVE] == 0
+
+    release.set()
+    await holder
+
+
+async def test_idle_time_is_excluded_from_service_time(scheduler):
+    async with scheduler.slot("ollama", INTERACTIVE) as usage:
+        with usage.idle():
+            await asyncio.sleep(0.05)
+    assert usage.busy_seconds < 0.04
+    # 初期値（10秒）に、ほぼ0秒の実績を重み0.2で反映した値
+    assert scheduler.snapshot()["ollama"]["service_time_seconds"] == pytest.approx(8.0, abs=0.01)
@@ -0,0 +1,22 @@
+"""Prometheus形式のメトリクス"""
+import httpx
+
+from app.core import metrics
+
+
+async def test_worker_metrics_server_serves_registry():
+    server = await metrics.serve("127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    metrics.tasks_total.inc(type="test_metrics", status="succeeded")
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            response = await client.get("/metrics")
+            missing = await client.get("/")
+    finally:
+        server.close()
+        await server.wait_closed()
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith(metrics.CONTENT_TYPE)
+    assert 'tasks_total{type="test_metrics",status="succeeded"} 1' in response.text
+    assert missing.status_code == 404
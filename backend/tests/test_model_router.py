@@ -0,0 +1,189 @@
+"""タスク種別ごとのモデルのルーティング（フォールバックと予算）"""
+import asyncio
+
+import pytest
+
+from app.core.settings_store import ProviderSettings, RouteTarget, TaskRoute, settings_store
+from app.services import model_router
+from app.services.model_router import MIN_LATENCY_SAMPLES, ModelRouter, record_routes
+
+
+@pytest.fixture
+def router(monkeypatch):
+    router = ModelRouter()
+    monkeypatch.setattr(model_router, "model_router", router)
+    return router
+
+
+@pytest.fixture
+def set_route(monkeypatch):
+    def set_route(task: str, *targets, **options):
+        route = TaskRoute(
+            targets=tuple(RouteTarget(provider=provider, model=model) for provider, model in targets), **options
+        )
+        current = settings_store.current
+        monkeypatch.setattr(settings_store, "_current", ProviderSettings(**{**current.dict(), "llm_routing": {task: route}}))
+    return set_route
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    """モデル名ごとに (秒数, 結果または例外) を返す偽のプロバイダー"""
+    behaviors = {}
+    calls = []
+
+    async def generate_text(prompt, config=None, task=None):
+        calls.append(config.model)
+        delay, result = behaviors[config.model]
+        await asyncio.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(model_router.ai_provider, "generate_text", generate_text)
+    return behaviors, calls
+
+
+async def test_task_without_route_uses_the_default_provider(router, provider):
+    behaviors, calls = provider
+    default_model = settings_store.current.dict()[f"{settings_store.current.ai_provider}_model"]
+    behaviors[default_model] = (0, "default")
+    assert await model_router.generate_text("comment", "prompt") == "default"
+    assert calls == [default_model]
+
+
+async def test_failed_target_falls_back_to_the_next(router, provider, set_route):
+    behaviors, calls = provider
+    set_route("comment", ("ollama", "a"), ("ollama", "b"))
+    behaviors["a"] = (0, RuntimeError("down"))
+    behaviors["b"] = (0, "from b")
+
+    with record_routes() as routes:
+        assert await model_router.generate_text("comment", "prompt") == "from b"
+    assert calls == ["a", "b"]
+    assert [(route["model"], route["attempt"], route["fallback"]) for route in routes] == [("b", 1, True)]
+
+
+async def test_last_error_is_raised_when_every_target_fails(router, provider, set_route):
+    behaviors, _ = provider
+    set_route("comment", ("ollama", "a"), ("ollama", "b"))
+    behaviors["a"] = (0, RuntimeError("a down"))
+    behaviors["b"] = (0, RuntimeError("b down"))
+
+    with pytest.raises(RuntimeError, match="b down"):
+        await model_router.generate_text("comment", "prompt")
+
+
+async def test_target_over_latency_budget_is_skipped(router, provider, set_route):
+    behaviors, calls = provider
+    set_route("comment", ("ollama", "slow"), ("ollama", "fast"), latency_budget_ms=1000)
+    behaviors["slow"] = (0, "from slow")
+    behaviors["fast"] = (0, "from fast")
+    slow, fast = router.candidates("comment", "prompt")
+    for _ in range(MIN_LATENCY_SAMPLES):
+        router.observe("comment", slow, 2.0)
+
+    assert [config.model for config in router.candidates("comment", "prompt")] == ["fast"]
+    assert await model_router.generate_text("comment", "prompt") == "from fast"
+    assert calls == ["fast"]
+
+
+async def test_few_latency_samples_do_not_skip(router, set_route):
+    set_route("comment", ("ollama", "slow"), ("ollama", "fast"), latency_budget_ms=1000)
+    slow, _ = router.candidates("comment", "prompt")
+    for _ in range(MIN_LATENCY_SAMPLES - 1):
+        router.observe("comment", slow, 2.0)
+    assert [config.model for config in router.candidates("comment", "prompt")] == ["slow", "fast"]
+
+
+async def test_target_over_cost_budget_is_skipped(router, set_route):
+    set_route(
+        "journal", ("openai", "gpt-4"), ("openai", "unpriced-model"), ("ollama", "local"),
+        cost_budget_usd=0.01
+    )
+    # 料金の分からないモデルと ollama（無料）は飛ばさない
+    assert [config.model for config in router.candidates("journal", "prompt")] == ["unpriced-model", "local"]
+
+
+async def test_every_target_over_budget_tries_all_in_order(router, set_route):
+    set_route("journal", ("openai", "gpt-4"), ("openai", "gpt-4-turbo"), cost_budget_usd=0.0001)
+    assert [config.model for config in router.candidates("journal", "prompt")] == ["gpt-4", "gpt-4-turbo"]
+
+
+async def test_slow_target_is_hedged_and_the_loser_cancelled(router, provider, set_route, override_settings):
+    behaviors, calls = provider
+    override_settings(llm_hedge_initial_delay=0.05)
+    set_route("comment", ("ollama", "a"), ("ollama", "b"), hedge=True)
+    behaviors["a"] = (5.0, "from a")
+    behaviors["b"] = (0, "from b")
+
+    with record_routes() as routes:
+        assert await asyncio.wait_for(model_router.generate_text("comment", "prompt"), 1.0) == "from b"
+    assert calls == ["a", "b"]
+    assert routes[0]["hedged"] and routes[0]["model"] == "b"
+    assert router.stats()["hedging"]["comment"] == {"requests": 1, "hedged": 1, "hedge_rate": 1.0}
+
+
+async def test_race_discards_result_of_loser_that_finished_while_cancelled(router, set_route, override_settings):
+    override_settings(llm_hedge_initial_delay=0.01)
+    set_route("comment", ("ollama", "a"), ("ollama", "b"), hedge=True)
+    candidates = router.candidates("comment", "prompt")
+    discarded = []
+
+    async def attempt(config):
+        if config.model == "a":
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                # 取り消しが届く前に応答が返ってきた
+                return "a"
+        return config.model
+
+    async def discard(result):
+        discarded.append(result)
+
+    assert await model_router._race("comment", candidates, attempt, "latency", discard) == ("b", 1, True)
+    assert discarded == ["a"]
+
+
+async def test_cancelled_race_cancels_every_pending_target(router, set_route, override_settings):
+    override_settings(llm_hedge_initial_delay=0.0)
+    set_route("comment", ("ollama", "a"), ("ollama", "b"), hedge=True)
+    candidates = router.candidates("comment", "prompt")
+    started = []
+    cancelled = []
+
+    async def attempt(config):
+        started.append(config.model)
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(config.model)
+            raise
+
+    race = asyncio.create_task(model_router._race("comment", candidates, attempt, "latency"))
+    while len(started) < 2:
+        await asyncio.sleep(0.01)
+    race.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await race
+    assert sorted(cancelled) == ["a", "b"]
+
+
+async def test_losing_stream_is_closed(router, set_route, override_settings, monkeypatch):
+    override_settings(llm_hedge_initial_delay=0.05)
+    set_route("comment", ("ollama", "a"), ("ollama", "b"), hedge=True)
+    closed = []
+
+    async def stream_text(prompt, json_schema=None, options=None, config=None, task=None):
+        try:
+            await asyncio.sleep(5.0 if config.model == "a" else 0)
+            yield f"{config.model}1"
+            yield f"{config.model}2"
+        finally:
+            closed.append(config.model)
+
+    monkeypatch.setattr(model_router.ai_provider, "stream_text", stream_text)
+    chunks = [chunk async for chunk in model_router.stream_text("comment", "prompt")]
+    assert chunks == ["b1", "b2"]
+    assert sorted(closed) == ["a", "b"]
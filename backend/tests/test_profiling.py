@@ -0,0 +1,50 @@
+"""プロファイルの保存"""
+import threading
+
+from app.core.profiling import ProfileSession, ProfileStore
+
+
+def finished_session() -> ProfileSession:
+    session = ProfileSession(threading.get_ident(), "GET", "/api/characters", "header")
+    session.samples.update({"main;handler": 3, "main;handler;db": 1})
+    return session
+
+
+async def test_profiles_are_kept_newest_first_up_to_the_limit(override_settings):
+    override_settings(profiling_max_stored=2, profiling_dir=None)
+    store = ProfileStore()
+    sessions = [finished_session() for _ in range(3)]
+    for session in sessions:
+        await store.add(session)
+    assert store.list() == [sessions[2], sessions[1]]
+    assert store.get(sessions[0].id) is None
+
+
+async def test_folded_file_is_written_off_the_event_loop(override_settings, tmp_path, monkeypatch):
+    override_settings(profiling_max_stored=10, profiling_dir=str(tmp_path / "profiles"))
+    threads = []
+    write = ProfileStore._write
+
+    def recording_write(directory, session):
+        threads.append(threading.get_ident())
+        write(directory, session)
+
+    monkeypatch.setattr(ProfileStore, "_write", staticmethod(recording_write))
+    session = finished_session()
+    await ProfileStore().add(session)
+
+    assert threads and threads[0] != threading.get_ident()
+    (path,) = (tmp_path / "profiles").iterdir()
+    assert path.name.endswith(f"-{session.id}.folded")
+    assert path.read_text(encoding="utf-8") == "main;handler 3\nmain;handler;db 1\n"
+
+
+async def test_write_failure_keeps_the_profile_in_memory(override_settings, tmp_path, caplog):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    override_settings(profiling_max_stored=10, profiling_dir=str(blocker / "profiles"))
+    store = ProfileStore()
+    session = finished_session()
+    await store.add(session)
+    assert store.get(session.id) is session
+    assert "保存できませんでした" in caplog.text
@@ -0,0 +1,105 @@
+"""全文検索のインデックス（再構築と差分更新）"""
+import asyncio
+
+import pytest
+
+from app.core.database import COLLECTIONS
+from app.services.search_index import SearchIndex
+
+
+class SlowDatabase:
+    """1件読むごとにイベントループに制御を返すデータベース（再構築を他の処理と交互に進める）"""
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getitem__(self, name):
+        return SlowCollection(self._db[name])
+
+
+class SlowCollection:
+    def __init__(self, collection):
+        self._collection = collection
+
+    async def find(self, *args, **kwargs):
+        async for document in self._collection.find(*args, **kwargs):
+            await asyncio.sleep(0)
+            yield document
+
+
+@pytest.fixture
+async def db(db):
+    await db[COLLECTIONS["characters"]].insert_many([
+        {"_id": f"c{i}", "name": f"キャラクター{i}", "attributes": []} for i in range(5)
+    ])
+    await db[COLLECTIONS["journals"]].insert_many([
+        {"_id": f"j{i}", "character_id": "c0", "theme": "旅の記録", "content": f"灯台を訪ねた{i}"} for i in range(5)
+    ])
+    return db
+
+
+def found_ids(index: SearchIndex, query: str):
+    return sorted(result["id"] for result in index.search(query)["results"])
+
+
+async def test_rebuild_indexes_every_collection(db):
+    index = SearchIndex()
+    assert await index.rebuild(db) == {"character": 5, "journal": 5, "comment": 0}
+    assert found_ids(index, "灯台") == [f"j{i}" for i in range(5)]
+
+
+async def test_unloaded_index_ignores_writes_until_ensure_loaded(db):
+    index = SearchIndex()
+    index.index_journal({"_id": "extra", "theme": "山", "content": "時計塔"})
+    assert not index.loaded
+    await index.ensure_loaded(db)
+    assert found_ids(index, "時計塔") == []
+    assert found_ids(index, "灯台") == [f"j{i}" for i in range(5)]
+
+
+async def test_write_during_rebuild_is_kept(db):
+    index = SearchIndex()
+    await index.rebuild(db)
+    rebuild = asyncio.create_task(index.rebuild(SlowDatabase(db)))
+    await asyncio.sleep(0)
+    index.index_journal({"_id": "extra", "character_id": "c1", "theme": "山", "content": "時計塔を修理した"})
+    index.remove_journal("j0")
+    await rebuild
+    assert found_ids(index, "時計塔") == ["extra"]
+    assert "j0" not in found_ids(index, "灯台")
+
+
+async def save_journal(db, index: SearchIndex, journal):
+    """書き込み経路と同じく、保存してからインデックスに反映する"""
+    await db[COLLECTIONS["journals"]].insert_one(journal)
+    index.index_journal(journal)
+
+
+async def test_concurrent_rebuilds_keep_writes_made_during_either(db):
+    index = SearchIndex()
+    await index.rebuild(db)
+    slow = SlowDatabase(db)
+
+    first = asyncio.create_task(index.rebuild(slow))
+    for _ in range(8):
+        await asyncio.sleep(0)
+    await save_journal(db, index, {"_id": "during-first", "theme": "山", "content": "時計塔を修理した"})
+    second = asyncio.create_task(index.rebuild(slow))
+    await first
+    for _ in range(8):
+        await asyncio.sleep(0)
+    assert not second.done()
+    await save_journal(db, index, {"_id": "during-second", "theme": "海", "content": "時計塔から海を見た"})
+    await second
+
+    assert found_ids(index, "時計塔") == ["during-first", "during-second"]
+
+
+async def test_ensure_loaded_waits_for_background_build(db):
+    index = SearchIndex()
+    index.start_background_build(SlowDatabase(db))
+    await asyncio.sleep(0)
+    index.index_journal({"_id": "extra", "theme": "山", "content": "時計塔を修理した"})
+    await index.ensure_loaded(db)
+    assert index.loaded
+    assert found_ids(index, "時計塔") == ["extra"]
@@ -0,0 +1,81 @@
+"""AIプロバイダー設定のストア（バージョン付きの原子的な更新）"""
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from app.api import settings as settings_api
+from app.core.settings_store import ProviderSettings, SettingsConflictError, SettingsStore
+
+
+@pytest.fixture
+async def store(db):
+    store = SettingsStore()
+    await store.start(db)
+    yield store
+    await store.stop()
+
+
+async def test_update_bumps_version_and_applies_snapshot(store):
+    changed = []
+    store.add_listener(lambda previous, current: changed.append((previous.version, current.version)))
+
+    updated = await store.update({"ollama_model": "llama3"})
+    assert updated.version == 1
+    assert store.current.ollama_model == "llama3"
+    assert (await store.update({"ollama_model": "qwen"}, expected_version=1)).version == 2
+    assert changed == [(0, 1), (1, 2)]
+
+
+async def test_stale_expected_version_is_a_conflict(store):
+    await store.update({"ollama_model": "llama3"})
+    await store.update({"ollama_model": "qwen"}, expected_version=1)
+
+    with pytest.raises(SettingsConflictError):
+        await store.update({"ollama_model": "mistral"}, expected_version=1)
+    assert store.current.version == 2
+    assert store.current.ollama_model == "qwen"
+
+
+async def test_unknown_and_invalid_fields_are_rejected(store):
+    with pytest.raises(ValueError):
+        await store.update({"version": 5})
+    with pytest.raises(ValueError):
+        await store.update({"ai_provider": "unknown"})
+    assert store.current.version == 0
+
+
+async def test_saved_settings_are_loaded_on_start(store, db):
+    await store.update({"ollama_model": "llama3"})
+    other = SettingsStore()
+    await other.start(db)
+    try:
+        assert other.current.version == 1
+        assert other.current.ollama_model == "llama3"
+    finally:
+        await other.stop()
+
+
+def test_fields_exclude_version():
+    assert "version" not in ProviderSettings.fields()
+    assert "llm_routing" in ProviderSettings.fields()
+
+
+@pytest.fixture
+async def client(store, monkeypatch):
+    monkeypatch.setattr(settings_api, "settings_store", store)
+    app = FastAPI()
+    app.include_router(settings_api.router, prefix="/api/settings")
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+
+
+async def test_endpoint_returns_409_for_stale_version(client):
+    first = await client.post("/api/settings/ai-provider", json={"provider": "ollama", "ollama_model": "llama3", "version": 0})
+    assert first.status_code == 200
+    assert first.json()["version"] == 1
+
+    stale = await client.post("/api/settings/ai-provider", json={"provider": "ollama", "ollama_model": "qwen", "version": 0})
+    assert stale.status_code == 409
+
+    routing = await client.put("/api/settings/routing", json={"routes": {}, "version": 0})
+    assert routing.status_code == 409
@@ -0,0 +1,235 @@
+"""MongoDB のタスクキュー"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+from app.core import database
+from app.core.database import COLLECTIONS
+from app.core.llm_scheduler import BACKGROUND, BATCH, INTERACTIVE, SchedulerOverloadedError, llm_lane
+from app.core.task_queue import (
+    CANCELLED, FAILED, QUEUED, SUCCEEDED, TASKS_COLLECTION, TaskFailedError, TaskQueue, TaskWorker
+)
+from app.services import generation
+
+
+@pytest.fixture
+async def queue(db, override_settings):
+    override_settings(
+        task_max_attempts=3,
+        task_retry_delay=0.0,
+        task_visibility_timeout=60.0,
+        task_heartbeat_interval=60.0,
+        llm_lane_max_depth="interactive:32,batch:3,background:16",
+    )
+    queue = TaskQueue()
+    await queue.start(db)
+    return queue
+
+
+async def test_enqueue_sheds_when_lane_is_full(queue):
+    with llm_lane(BATCH):
+        await queue.enqueue_many("journal", [{"n": i} for i in range(2)])
+        with pytest.raises(SchedulerOverloadedError) as raised:
+            await queue.enqueue_many("journal", [{"n": 2}, {"n": 3}])
+    assert raised.value.lane == BATCH
+    assert raised.value.retry_after >= 1
+    assert (await queue.counts())[QUEUED] == 2
+
+    # 他のレーンは断らない
+    with llm_lane(INTERACTIVE):
+        await queue.enqueue("journal", {"n": 4})
+
+
+async def test_empty_lane_accepts_batch_larger_than_limit(queue):
+    with llm_lane(BATCH):
+        assert len(await queue.enqueue_many("journal", [{"n": i} for i in range(5)])) == 5
+
+
+async def test_overloaded_task_is_requeued_without_using_an_attempt(queue):
+    async def overloaded(payload):
+        raise SchedulerOverloadedError("ollama", INTERACTIVE, 30)
+
+    queue.register("journal", overloaded)
+    task_id = await queue.enqueue("journal", {})
+    worker = TaskWorker(queue, 1, worker_id="w1")
+    await worker._execute(await queue.claim("w1", ["journal"]))
+
+    task = await queue.get(task_id)
+    assert task["status"] == QUEUED
+    assert task["attempts"] == 0
+    assert task["error"] is None
+    assert (task["available_at"] - task["updated_at"]).total_seconds() == pytest.approx(30, abs=1)
+    # Retry-After が過ぎるまでは取得されない
+    assert await queue.claim("w1", ["journal"]) is None
+
+
+async def set_lease_expired(db, task_id):
+    await db[TASKS_COLLECTION].update_one(
+        {"_id": ObjectId(task_id)}, {"$set": {"lease_expires_at": datetime.now() - timedelta(seconds=1)}}
+    )
+
+
+async def test_claim_prefers_higher_priority_lanes_then_oldest(queue):
+    with llm_lane(BACKGROUND):
+        background = await queue.enqueue("journal", {"n": "background"})
+    with llm_lane(BATCH):
+        batch = await queue.enqueue_many("journal", [{"n": "batch1"}, {"n": "batch2"}])
+    interactive = await queue.enqueue("journal", {"n": "interactive"})
+
+    claimed = []
+    while (task := await queue.claim("w1", ["journal"])) is not None:
+        claimed.append(str(task["_id"]))
+    assert claimed == [interactive, *batch, background]
+
+
+async def test_claim_skips_other_types_and_delayed_tasks(queue, db):
+    task_id = await queue.enqueue("journal", {})
+    assert await queue.claim("w1", ["comment"]) is None
+    await db[TASKS_COLLECTION].update_one(
+        {"_id": ObjectId(task_id)}, {"$set": {"available_at": datetime.now() + timedelta(seconds=60)}}
+    )
+    assert await queue.claim("w1", ["journal"]) is None
+
+
+async def test_expired_lease_is_taken_over_by_another_worker(queue, db):
+    task_id = await queue.enqueue("journal", {})
+    first = await queue.claim("w1", ["journal"])
+    # リースが有効な間は他のワーカーは取得できない
+    assert await queue.claim("w2", ["journal"]) is None
+
+    await set_lease_expired(db, task_id)
+    second = await queue.claim("w2", ["journal"])
+    assert str(second["_id"]) == task_id
+    assert second["lease_owner"] == "w2"
+    assert second["attempts"] == 2
+
+    # リースを失ったワーカーの結果は記録されない
+    assert not await queue.complete(first, "w1", "stale")
+    assert await queue.heartbeat(first, "w1") is None
+    assert await queue.complete(second, "w2", "fresh")
+    assert (await queue.get(task_id))["result"] == "fresh"
+
+
+async def test_task_that_keeps_losing_its_lease_is_failed(queue, db):
+    """ワーカーが落ち続けるタスクは max_attempts を超えたら実行せずに失敗にする"""
+    calls = []
+
+    async def handler(payload):
+        calls.append(payload)
+
+    queue.register("journal", handler)
+    task_id = await queue.enqueue("journal", {})
+    for _ in range(3):
+        await queue.claim("w1", ["journal"])
+        await set_lease_expired(db, task_id)
+    task = await queue.claim("w2", ["journal"])
+    assert task["attempts"] == 4
+
+    await TaskWorker(queue, 1, worker_id="w2")._execute(task)
+    task = await queue.get(task_id)
+    assert task["status"] == FAILED
+    assert task["error"]["exception"] == "TimeoutError"
+    assert calls == []
+    with pytest.raises(TaskFailedError):
+        await queue.wait(task_id, timeout=1.0)
+
+
+async def test_release_does_not_count_as_an_attempt(queue):
+    task_id = await queue.enqueue("journal", {})
+    task = await queue.claim("w1", ["journal"])
+    await queue.release(task, "w1")
+    task = await queue.get(task_id)
+    assert task["status"] == QUEUED
+    assert task["attempts"] == 0
+    assert task["lease_owner"] is None
+    assert (await queue.claim("w2", ["journal"]))["attempts"] == 1
+
+
+async def test_failed_task_is_retried_until_max_attempts(queue):
+    async def handler(payload):
+        raise RuntimeError("LLM error")
+
+    queue.register("journal", handler)
+    task_id = await queue.enqueue("journal", {})
+    worker = TaskWorker(queue, 1, worker_id="w1")
+    for attempt in range(1, 4):
+        task = await queue.claim("w1", ["journal"])
+        assert task["attempts"] == attempt
+        await worker._execute(task)
+
+    task = await queue.get(task_id)
+    assert task["status"] == FAILED
+    assert task["error"]["message"] == "LLM error"
+    assert task["error"]["attempt"] == 3
+
+
+async def test_lookup_error_is_not_retried(queue):
+    async def handler(payload):
+        raise LookupError("ジャーナルが見つかりません")
+
+    queue.register("comment", handler)
+    task_id = await queue.enqueue("comment", {})
+    await TaskWorker(queue, 1, worker_id="w1")._execute(await queue.claim("w1", ["comment"]))
+    with pytest.raises(LookupError):
+        await queue.wait(task_id, timeout=1.0)
+
+
+async def test_cancel_request_stops_running_task_at_next_heartbeat(queue, override_settings):
+    override_settings(task_heartbeat_interval=0.01)
+    started = asyncio.Event()
+
+    async def handler(payload):
+        started.set()
+        await asyncio.sleep(60)
+
+    queue.register("journal", handler)
+    task_id = await queue.enqueue("journal", {})
+    worker = TaskWorker(queue, 1, worker_id="w1")
+    execution = asyncio.create_task(worker._execute(await queue.claim("w1", ["journal"])))
+    await started.wait()
+
+    assert await queue.cancel([task_id]) == 1
+    await asyncio.wait_for(execution, timeout=1.0)
+    assert (await queue.get(task_id))["status"] == CANCELLED
+
+
+async def test_queued_task_is_cancelled_before_it_runs(queue):
+    task_id = await queue.enqueue("journal", {})
+    assert await queue.cancel([task_id]) == 1
+    assert await queue.claim("w1", ["journal"]) is None
+    with pytest.raises(TaskFailedError):
+        await queue.wait(task_id, timeout=1.0)
+
+
+async def test_retried_generation_task_does_not_save_twice(queue, db, monkeypatch):
+    """保存の後・完了の前に落ちたタスクを再実行しても、生成し直さずに保存済みのジャーナルを返す"""
+    calls = []
+
+    async def fake_generate_journal(character, theme, memories=None):
+        calls.append(theme)
+        return "Dear Diary,\n\ntoday"
+
+    monkeypatch.setattr(generation, "generate_journal", fake_generate_journal)
+    monkeypatch.setattr(database.db, "db", db)
+    await generation.create_indexes(db)
+    character = await db[COLLECTIONS["characters"]].insert_one({"name": "A", "relationships": []})
+    queue.register(generation.JOURNAL_TASK, generation._journal_task)
+    task_id = await queue.enqueue(generation.JOURNAL_TASK, {"character_id": str(character.inserted_id), "theme": "海"})
+    worker = TaskWorker(queue, 1, worker_id="w1")
+
+    first = await queue.claim("w1", [generation.JOURNAL_TASK])
+    # 1回目の実行は保存したがリースを失った（完了を記録できなかった）
+    await set_lease_expired(db, task_id)
+    second = await queue.claim("w2", [generation.JOURNAL_TASK])
+    await worker._execute(first)
+    await TaskWorker(queue, 1, worker_id="w2")._execute(second)
+
+    journals = await db[COLLECTIONS["journals"]].find({}).to_list(None)
+    assert len(journals) == 1
+    assert journals[0]["task_id"] == task_id
+    assert calls == ["海"]
+    task = await queue.get(task_id)
+    assert task["status"] == SUCCEEDED
+    assert task["result"]["_id"] == str(journals[0]["_id"])
@@ -0,0 +1,167 @@
+"""ベクトルインデックス（スナップショット・ログ・畳み込みと読み取り側の refresh）"""
+import json
+import os
+
+import numpy as np
+import pytest
+
+from app.services import vector_index
+from app.services.vector_index import VectorIndex
+
+DIMENSION = 4
+
+
+def unit(*values: float) -> np.ndarray:
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def open_writer(directory) -> VectorIndex:
+    index = VectorIndex(str(directory))
+    assert index.acquire_writer()
+    index.open("test-embedder", DIMENSION)
+    return index
+
+
+def open_reader(directory) -> VectorIndex:
+    index = VectorIndex(str(directory))
+    index.open("test-embedder", DIMENSION)
+    return index
+
+
+@pytest.fixture
+def writer(tmp_path):
+    index = open_writer(tmp_path)
+    yield index
+    index.release_writer()
+
+
+def test_search_returns_nearest_keys_with_prefix_filter(writer):
+    writer.upsert("journal:1", unit(1, 0, 0, 0), "t1")
+    writer.upsert("journal:2", unit(1, 1, 0, 0), "t1")
+    writer.upsert("comment:1", unit(1, 0.1, 0, 0), "t1")
+
+    assert [key for key, _ in writer.search(unit(1, 0, 0, 0), k=2)] == ["journal:1", "comment:1"]
+    assert [key for key, _ in writer.search(unit(1, 0, 0, 0), k=5, prefixes=["journal:"])] == ["journal:1", "journal:2"]
+
+
+def test_remove_moves_last_row_into_the_gap(writer):
+    for i, vector in enumerate([unit(1, 0, 0, 0), unit(0, 1, 0, 0), unit(0, 0, 1, 0)]):
+        writer.upsert(f"journal:{i}", vector, "t1")
+    writer.remove("journal:0")
+
+    assert sorted(writer.keys()) == ["journal:1", "journal:2"]
+    np.testing.assert_allclose(writer.vector("journal:2"), unit(0, 0, 1, 0))
+    assert writer.search(unit(1, 0, 0, 0), k=1)[0][0] != "journal:0"
+
+
+def test_needs_update_compares_updated_at(writer):
+    writer.upsert("journal:1", unit(1, 0, 0, 0), "t1")
+    assert not writer.needs_update("journal:1", "t1")
+    assert writer.needs_update("journal:1", "t2")
+    assert writer.needs_update("journal:2", "t1")
+
+
+def test_flushed_changes_are_appended_to_the_log_and_replayed(tmp_path, writer):
+    writer.upsert("journal:1", unit(1, 0, 0, 0), "t1")
+    writer.upsert("journal:2", unit(0, 1, 0, 0), "t1")
+    writer.flush()
+    writer.remove("journal:1")
+    writer.flush()
+
+    # スナップショットは作成時のまま、変更はログにだけ書かれる
+    with open(tmp_path / "meta.json", encoding="utf-8") as f:
+        assert json.load(f)["keys"] == []
+    with open(tmp_path / f"meta-{writer.generation}.log", encoding="utf-8") as f:
+        assert [json.loads(line)[0] for line in f] == ["u", "u", "r"]
+
+    writer.release_writer()
+    reopened = open_writer(tmp_path)
+    assert reopened.keys() == ["journal:2"]
+    np.testing.assert_allclose(reopened.vector("journal:2"), unit(0, 1, 0, 0))
+    reopened.release_writer()
+
+
+def test_long_log_is_compacted_into_a_new_snapshot(tmp_path, writer, monkeypatch):
+    monkeypatch.setattr(vector_index, "COMPACT_MIN_ENTRIES", 2)
+    first_generation = writer.generation
+    # 同じキーの更新が続いてログがキーの数より長くなる
+    for updated_at in ("t1", "t2", "t3"):
+        writer.upsert("journal:0", unit(1, 0, 0, 0), updated_at)
+        writer.upsert("journal:1", unit(0, 1, 0, 0), updated_at)
+    writer.flush()
+
+    assert writer.generation == first_generation + 1
+    with open(tmp_path / "meta.json", encoding="utf-8") as f:
+        meta = json.load(f)
+    assert meta["generation"] == writer.generation
+    assert sorted(meta["keys"]) == ["journal:0", "journal:1"]
+    assert meta["updated_at"] == ["t3", "t3"]
+    assert not any(name.endswith(".log") for name in os.listdir(tmp_path))
+
+
+def test_only_one_process_holds_the_writer_lock(tmp_path, writer):
+    other = VectorIndex(str(tmp_path))
+    assert not other.acquire_writer()
+    other.open("test-embedder", DIMENSION)
+    with pytest.raises(RuntimeError):
+        other.upsert("journal:1", unit(1, 0, 0, 0), "t1")
+
+    writer.release_writer()
+    assert other.acquire_writer()
+    other.release_writer()
+
+
+def test_reader_refresh_picks_up_log_and_grown_file(tmp_path, writer):
+    reader = open_reader(tmp_path)
+    assert reader.is_open and len(reader) == 0
+
+    capacity = vector_index.INITIAL_CAPACITY
+    for i in range(capacity + 1):
+        writer.upsert(f"journal:{i}", unit(1, i, 0, 0), "t1")
+    writer.flush()
+
+    reader.refresh()
+    assert len(reader) == capacity + 1
+    np.testing.assert_allclose(reader.vector(f"journal:{capacity}"), unit(1, capacity, 0, 0), rtol=1e-6)
+
+
+def test_reader_refresh_reopens_after_compaction(tmp_path, writer, monkeypatch):
+    reader = open_reader(tmp_path)
+    monkeypatch.setattr(vector_index, "COMPACT_MIN_ENTRIES", 1)
+    for updated_at in ("t1", "t2"):
+        writer.upsert("journal:1", unit(1, 0, 0, 0), updated_at)
+        writer.upsert("journal:2", unit(0, 1, 0, 0), updated_at)
+    writer.flush()
+    assert writer.generation == reader.generation + 1
+
+    reader.refresh()
+    assert reader.generation == writer.generation
+    assert sorted(reader.keys()) == ["journal:1", "journal:2"]
+
+
+def test_reader_skips_partially_written_log_line(tmp_path, writer):
+    reader = open_reader(tmp_path)
+    writer.upsert("journal:1", unit(1, 0, 0, 0), "t1")
+    writer.flush()
+    with open(tmp_path / f"meta-{writer.generation}.log", "a", encoding="utf-8") as f:
+        f.write('["u", "journal:2", ')
+
+    reader.refresh()
+    assert reader.keys() == ["journal:1"]
+    with open(tmp_path / f"meta-{writer.generation}.log", "a", encoding="utf-8") as f:
+        f.write('"t1"]\n')
+    reader.refresh()
+    assert reader.keys() == ["journal:1", "journal:2"]
+
+
+def test_reader_stays_closed_for_another_embedder(tmp_path, writer):
+    writer.upsert("journal:1", unit(1, 0, 0, 0), "t1")
+    writer.flush()
+    reader = VectorIndex(str(tmp_path))
+    reader.open("other-embedder", DIMENSION)
+    assert not reader.is_open
+
+    # 書き込み側は空のインデックスで作り直す
+    writer.open("other-embedder", DIMENSION)
+    assert writer.is_open and len(writer) == 0
@@ -0,0 +1,85 @@
+"""
+Constella 生成ワーカー
+
+GENERATION_MODE=queue のとき、APIが登録したジャーナル・コメントの生成タスクを
+MongoDB のタスクキューから取り出して実行する。生成の処理能力を増やすには
+このプロセスを増やす。
+
+    cd backend
+    python worker.py --concurrency 4 --metrics-port 9100
+
+LLM呼び出し・タスクなどのメトリクスはワーカーのメモリ上にあるため、
+--metrics-port の /metrics で公開する（Prometheus はワーカーごとに収集する）。
+"""
+import argparse
+import asyncio
+import logging
+import signal
+
+from dotenv import load_dotenv
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.database import close_mongo_connection, connect_to_mongo, get_database
+from app.core.settings_store import settings_store
+from app.core.task_queue import TaskWorker, task_queue
+from app.core.tracing import trace_exporter
+from app.services import generation, index_sync  # generation はタスクのハンドラーも登録する
+from app.services.index_events import index_events
+from app.services.model_preload import model_preloader
+from app.services.relationship_graph import relationship_graph
+
+# 環境変数を読み込み
+load_dotenv()
+
+logger = logging.getLogger("constella.worker")
+
+
+async def run(concurrency: int, metrics_port: int) -> None:
+    metrics_server = None
+    if metrics_port:
+        metrics_server = await metrics.serve(settings.worker_metrics_host, metrics_port)
+        logger.info(f"メトリクスを http://{settings.worker_metrics_host}:{metrics_port}/metrics で公開しています")
+    await connect_to_mongo()
+    await trace_exporter.start(get_database())
+    await settings_store.start(get_database())
+    model_preloader.start()
+    # 記憶の検索で書き手の名前を引くために使う
+    await relationship_graph.load(get_database())
+    await task_queue.start(get_database())
+    await generation.create_indexes(get_database())
+    # 保存したジャーナル・コメントをAPIプロセスに伝え、他のプロセスの変更（キャラクターの
+    # 名前・関係性、記憶のキャッシュ）をこのプロセスに反映する
+    await index_events.start(get_database(), index_sync.apply_event)
+
+    worker = TaskWorker(task_queue, concurrency)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, worker.stop)
+    try:
+        await worker.run()
+    finally:
+        await index_events.stop()
+        await model_preloader.stop()
+        await settings_store.stop()
+        await trace_exporter.stop()
+        await close_mongo_connection()
+        if metrics_server is not None:
+            metrics_server.close()
+            await metrics_server.wait_closed()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Constella 生成ワーカー")
+    parser.add_argument("--concurrency", type=int, default=settings.worker_concurrency,
+                        help="並行して処理するタスク数")
+    parser.add_argument("--metrics-port", type=int, default=settings.worker_metrics_port,
+                        help="/metrics を公開するポート（0で無効）")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(run(args.concurrency, args.metrics_port))
+
+
+if __name__ == "__main__":
+    main()
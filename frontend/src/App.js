@@ -6,7 +6,7 @@ import RightSidebar from './components/RightSidebar';
 import CharacterPanel from './components/CharacterPanel';
 import JournalsPanel from './components/JournalsPanel';
 import SettingsPanel from './components/SettingsPanel';
-import api from './services/api';
+import api, { applyLiveDelta } from './services/api';
 
 function App() {
   const [characters, setCharacters] = useState([]);
@@ -20,6 +20,27 @@ function App() {
     loadJournals();
   }, []);
 
+  // ジャーナルの追加・更新・削除をリアルタイムに反映（再取得しない）
+  useEffect(() => {
+    return api.subscribeLiveUpdates({}, (event) => {
+      if (event.type === 'reset' || event.type === 'character.deleted') {
+        loadJournals();
+        return;
+      }
+      if (event.kind !== 'journal') return;
+      setJournals(prev => {
+        const rest = prev.filter(journal => (journal.id || journal._id) !== event.document_id);
+        if (event.operation === 'deleted') return rest;
+        if (event.operation === 'created') {
+          return rest.length === prev.length ? [event.data, ...prev] : prev;
+        }
+        return prev.map(journal => (
+          (journal.id || journal._id) === event.document_id ? applyLiveDelta(journal, event) : journal
+        ));
+      });
+    });
+  }, []);
+
   const loadCharacters = async () => {
     try {
       const data = await api.getCharacters();
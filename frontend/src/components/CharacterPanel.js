@@ -177,20 +177,11 @@ const CharacterPanel = ({ character, onClose, onSave, allCharacters = [] }) => {
 
   const handleSaveGeneratedCharacter = async (generatedChar) => {
     try {
-      const formDataObj = new FormData();
-      formDataObj.append('name', generatedChar.name);
+      // キャラクター作成・属性・双方向の関係性を1回のリクエストで保存
+      const result = await api.acceptFriends(character.id || character._id, [generatedChar]);
+      const newCharacter = result.created[0];
       
-      const newCharacter = await api.createCharacter(formDataObj);
-      
-      // 属性を追加
-      const attributes = [
-        { type: 'description', content: generatedChar.introduction },
-        { type: 'backstory', content: generatedChar.backstory }
-      ];
-      
-      await api.updateCharacter(newCharacter.id, { attributes });
-      
-      // 現在のキャラクターとの関係性を追加
+      // 現在のキャラクターとの関係性をフォームにも反映
       const currentRelationships = [...formData.relationships];
       currentRelationships.push({
         target_character_id: newCharacter.id,
@@ -202,14 +193,6 @@ const CharacterPanel = ({ character, onClose, onSave, allCharacters = [] }) => {
         relationships: currentRelationships
       });
       
-      // 新キャラクターにも逆の関係性を追加
-      await api.updateCharacter(newCharacter.id, {
-        relationships: [{
-          target_character_id: character.id || character._id,
-          description: generatedChar.my_relationship
-        }]
-      });
-      
       onSave(); // リストを更新
       alert(`${generatedChar.name}をキャラクターとして保存しました！`);
     } catch (error) {
@@ -1,5 +1,5 @@
 import React, { useState, useEffect } from 'react';
-import api from '../services/api';
+import api, { applyLiveDelta } from '../services/api';
 import CharacterSelector from './CharacterSelector';
 
 const JournalsPanel = ({ journals, characters, onClose, onUpdate }) => {
@@ -21,12 +21,43 @@ const JournalsPanel = ({ journals, characters, onClose, onUpdate }) => {
   const [generatingComments, setGeneratingComments] = useState(new Set()); // 生成中のコメントID
 
   useEffect(() => {
-    // 各ジャーナルのコメントを読み込み
+    // まだ読み込んでいないジャーナルのコメントを読み込み（以降の変更はリアルタイム配信で反映）
     journals.forEach(journal => {
-      loadComments(journal.id || journal._id);
+      const journalId = journal.id || journal._id;
+      if (!(journalId in journalComments)) loadComments(journalId);
     });
   }, [journals]);
 
+  // 表示中のジャーナルへのコメントをリアルタイムに反映
+  const journalIdsKey = journals.map(journal => journal.id || journal._id).join(',');
+  useEffect(() => {
+    if (!journalIdsKey) return undefined;
+    return api.subscribeLiveUpdates({ journalIds: journalIdsKey.split(',') }, (event) => {
+      if (event.type === 'reset') {
+        journalIdsKey.split(',').forEach(loadComments);
+        return;
+      }
+      if (event.kind !== 'comment') return;
+      setJournalComments(prev => {
+        // 削除イベントはジャーナルIDを含まないことがあるため全ジャーナルから探す
+        const next = {};
+        Object.entries(prev).forEach(([journalId, comments]) => {
+          next[journalId] = event.operation === 'deleted'
+            ? comments.filter(comment => (comment.id || comment._id) !== event.document_id)
+            : comments.map(comment => (
+              (comment.id || comment._id) === event.document_id ? applyLiveDelta(comment, event) : comment
+            ));
+        });
+        const comments = next[event.journal_id];
+        if (event.operation === 'created' && comments
+            && !comments.some(comment => (comment.id || comment._id) === event.document_id)) {
+          next[event.journal_id] = [...comments, event.data];
+        }
+        return next;
+      });
+    });
+  }, [journalIdsKey]);
+
   const loadComments = async (journalId) => {
     try {
       const comments = await api.getJournalComments(journalId);
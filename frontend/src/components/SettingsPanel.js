@@ -10,10 +10,13 @@ const SettingsPanel = ({ onClose }) => {
   const [testing, setTesting] = useState(false);
   const [alert, setAlert] = useState(null);
   const [showApiKeyModal, setShowApiKeyModal] = useState(false);
+  const [health, setHealth] = useState({});
+  const [checkingHealth, setCheckingHealth] = useState(false);
 
   useEffect(() => {
     loadProviders();
     loadCurrentSettings();
+    loadHealth();
   }, []);
 
   const loadProviders = async () => {
@@ -37,6 +40,33 @@ const SettingsPanel = ({ onClose }) => {
     }
   };
 
+  // 設定済みプロバイダーの接続状態（サーバー側で短時間キャッシュされる）
+  const loadHealth = async (refresh = false) => {
+    try {
+      setCheckingHealth(true);
+      const response = await axios.get('/api/settings/ai-providers/health', { params: { refresh } });
+      const byProvider = {};
+      response.data.results.forEach(result => {
+        byProvider[result.provider] = result;
+      });
+      setHealth(byProvider);
+    } catch (error) {
+      setHealth({});
+    } finally {
+      setCheckingHealth(false);
+    }
+  };
+
+  const renderHealthBadge = (providerName) => {
+    const result = health[providerName];
+    if (!result) return null;
+    return result.available ? (
+      <Badge bg="success" title={result.model}>接続OK {Math.round(result.latency_ms)}ms</Badge>
+    ) : (
+      <Badge bg="danger" title={result.error}>接続不可</Badge>
+    );
+  };
+
   const handleProviderChange = (provider) => {
     setFormData(prev => ({
       ...prev,
@@ -56,9 +86,12 @@ const SettingsPanel = ({ onClose }) => {
       setSaving(true);
       await axios.post('/api/settings/ai-provider', formData);
       await loadCurrentSettings();
+      loadHealth();
       setAlert({ type: 'success', message: '設定を保存しました' });
     } catch (error) {
-      setAlert({ type: 'danger', message: '設定の保存に失敗しました' });
+      // 409: 読み込んだ後に他の画面から設定が更新された
+      const detail = error.response?.status === 409 ? `: ${error.response.data.detail}` : '';
+      setAlert({ type: 'danger', message: `設定の保存に失敗しました${detail}` });
     } finally {
       setSaving(false);
     }
@@ -320,6 +353,7 @@ const SettingsPanel = ({ onClose }) => {
                                 <Badge bg="warning">API キー必要</Badge>
                               </div>
                             )}
+                            <div className="mt-2">{renderHealthBadge(provider.name)}</div>
                           </Card.Body>
                         </Card>
                       </div>
@@ -359,6 +393,21 @@ const SettingsPanel = ({ onClose }) => {
                       '接続テスト'
                     )}
                   </Button>
+
+                  <Button
+                    variant="outline-secondary"
+                    onClick={() => loadHealth(true)}
+                    disabled={checkingHealth}
+                  >
+                    {checkingHealth ? (
+                      <>
+                        <Spinner as="span" animation="border" size="sm" className="me-2" />
+                        確認中...
+                      </>
+                    ) : (
+                      '接続状態を更新'
+                    )}
+                  </Button>
                 </div>
               </Form>
             </Card.Body>
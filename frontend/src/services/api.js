@@ -2,6 +2,32 @@ import axios from 'axios';
 
 const API_BASE_URL = '';
 
+// リアルタイム配信のイベント種別
+const LIVE_EVENT_TYPES = [
+  'journal.created', 'journal.updated', 'journal.deleted',
+  'comment.created', 'comment.updated', 'comment.deleted',
+  'character.deleted', 'reset'
+];
+
+// 生成リクエストの冪等性キー（プロキシなどが再送しても二重に生成されない）
+const newIdempotencyKey = () => (
+  window.crypto && window.crypto.randomUUID
+    ? window.crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(36).slice(2)}`
+);
+
+// 差分イベントをドキュメントに適用（change stream の更新は変更されたフィールドのみ）
+export const applyLiveDelta = (doc, event) => {
+  if (!event.data) return doc;
+  if (!event.data.updated_fields) return { ...doc, ...event.data };
+  const updated = { ...doc };
+  Object.entries(event.data.updated_fields).forEach(([key, value]) => {
+    // "comment_ids.3" のような配列要素の更新は一覧表示に使わないため無視
+    if (!key.includes('.')) updated[key] = value;
+  });
+  return updated;
+};
+
 const api = {
   // キャラクター関連
   getCharacters: async () => {
@@ -58,10 +84,12 @@ const api = {
     return response.data;
   },
 
-  generateJournals: async (characterIds, theme) => {
+  generateJournals: async (characterIds, theme, idempotencyKey = newIdempotencyKey()) => {
     const response = await axios.post(`${API_BASE_URL}/api/journals/generate`, {
       character_ids: characterIds,
       theme: theme
+    }, {
+      headers: { 'Idempotency-Key': idempotencyKey }
     });
     return response.data;
   },
@@ -105,11 +133,13 @@ const api = {
     return response.data;
   },
 
-  generateComment: async (journalId, characterId, parentCommentId = null) => {
+  generateComment: async (journalId, characterId, parentCommentId = null, idempotencyKey = newIdempotencyKey()) => {
     const response = await axios.post(`${API_BASE_URL}/api/comments/generate`, {
       journal_id: journalId,
       character_id: characterId,
       parent_comment_id: parentCommentId
+    }, {
+      headers: { 'Idempotency-Key': idempotencyKey }
     });
     return response.data;
   },
@@ -125,10 +155,20 @@ const api = {
   },
 
   // Friends Discovery
-  generateFriends: async (characterId, relationshipPhrase) => {
+  generateFriends: async (characterId, relationshipPhrase, idempotencyKey = newIdempotencyKey()) => {
     const response = await axios.post(`${API_BASE_URL}/api/discovery/friends`, {
       character_id: characterId,
       relationship_phrase: relationshipPhrase
+    }, {
+      headers: { 'Idempotency-Key': idempotencyKey }
+    });
+    return response.data;
+  },
+
+  acceptFriends: async (characterId, characters) => {
+    const response = await axios.post(`${API_BASE_URL}/api/discovery/friends/accept`, {
+      character_id: characterId,
+      characters
     });
     return response.data;
   },
@@ -170,6 +210,18 @@ const api = {
       }
     });
     return response.data;
+  },
+
+  // ジャーナル・コメントの差分イベントを購読（解除する関数を返す）
+  // 再接続時はブラウザが Last-Event-ID を送り、続きから受け取る
+  subscribeLiveUpdates: ({ journalIds = [], characterIds = [] } = {}, onEvent) => {
+    const params = new URLSearchParams();
+    if (journalIds.length > 0) params.set('journal_ids', journalIds.join(','));
+    if (characterIds.length > 0) params.set('character_ids', characterIds.join(','));
+    const source = new EventSource(`${API_BASE_URL}/api/live/events?${params.toString()}`);
+    const handleEvent = (message) => onEvent(JSON.parse(message.data));
+    LIVE_EVENT_TYPES.forEach(type => source.addEventListener(type, handleEvent));
+    return () => source.close();
   }
 };
 